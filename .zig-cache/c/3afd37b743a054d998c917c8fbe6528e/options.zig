@@ -0,0 +1,2 @@
+pub const acl_list: []const u8 = "admin:minioadmin:minioadmin";
+pub const data_dir: []const u8 = "data";
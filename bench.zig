@@ -0,0 +1,119 @@
+//! Micro-benchmarks for hot paths that don't need a running server.
+//! Run with `zig build bench` (ReleaseFast).
+
+const std = @import("std");
+const zs3 = @import("main.zig");
+const acl = @import("acl.zig");
+
+const ITERATIONS = 500_000;
+
+// A bucket-shaped tree of empty files for the tree walk: WALK_DIRS
+// directories of WALK_FILES_PER_DIR files each. Built on the first run and
+// reused after that.
+const WALK_TREE = "/tmp/zs3-bench-tree";
+const WALK_DIRS = 1000;
+const WALK_FILES_PER_DIR = 1000;
+const WALK_THREADS = [_]usize{ 1, 2, 4, 8, 16 };
+
+// A signed ListObjectsV2 GET, as boto3 would send it. The query is out of
+// order on purpose so canonicalization has to sort it.
+const AMZ_DATE = "20130524T000000Z";
+const EMPTY_SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855";
+const AUTHORIZATION = "AWS4-HMAC-SHA256 Credential=minioadmin/20130524/us-east-1/s3/aws4_request, " ++
+    "SignedHeaders=host;x-amz-content-sha256;x-amz-date, " ++
+    "Signature=186e3773b1a8f266e981e191c217c76369b7b650d34f59ff09ea00e2e2202d31";
+
+pub fn main(init: std.process.Init) !void {
+    const allocator = init.gpa;
+    zs3.app_io = init.io;
+
+    var access_control_map = std.StringHashMap(acl.Credential).init(allocator);
+    defer access_control_map.deinit();
+    try access_control_map.put("minioadmin", .{ .access_key = "minioadmin", .secret_key = "minioadmin", .role = .Admin });
+    const ctx = zs3.S3Context{
+        .allocator = allocator,
+        .data_dir = "",
+        .access_control_map = access_control_map,
+        .committer = undefined,
+        .key_index = undefined,
+    };
+
+    var headers = std.StringHashMap([]const u8).init(allocator);
+    defer headers.deinit();
+    try headers.put("host", "127.0.0.1:9000");
+    try headers.put("x-amz-content-sha256", EMPTY_SHA256);
+    try headers.put("x-amz-date", AMZ_DATE);
+    try headers.put("authorization", AUTHORIZATION);
+    try headers.put("user-agent", "Boto3/1.35.0 md/Botocore#1.35.0 ua/2.0 os/linux#6.8.0 lang/python#3.11.7");
+    try headers.put("accept-encoding", "identity");
+    const req = zs3.Request{
+        .method = "GET",
+        .path = "/bench/object.txt",
+        .query = "prefix=a&list-type=2",
+        .headers = headers,
+        .body = "",
+        .remote_address = std.Io.net.IpAddress.parseIp4("127.0.0.1", 0) catch unreachable,
+    };
+
+    if (!zs3.SigV4.verify(&ctx, &req, allocator).authenticated) return error.BenchRequestRejected;
+
+    // Same allocator the server hands handlers: a per-connection arena
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+
+    const start = std.Io.Clock.awake.now(init.io);
+    for (0..ITERATIONS) |_| {
+        const result = zs3.SigV4.verify(&ctx, &req, arena.allocator());
+        std.mem.doNotOptimizeAway(result);
+        _ = arena.reset(.retain_capacity);
+    }
+    const elapsed_ns: u64 = @intCast(start.durationTo(std.Io.Clock.awake.now(init.io)).nanoseconds);
+
+    const per_sec = @as(f64, ITERATIONS) * std.time.ns_per_s / @as(f64, @floatFromInt(elapsed_ns));
+    std.debug.print("SigV4.verify: {d} iterations, {d:.0} verifies/s, {d:.2}us each\n", .{
+        ITERATIONS,
+        per_sec,
+        @as(f64, @floatFromInt(elapsed_ns)) / ITERATIONS / std.time.ns_per_us,
+    });
+
+    try benchTreeWalk(init.io, allocator);
+}
+
+fn benchTreeWalk(io: std.Io, allocator: std.mem.Allocator) !void {
+    try buildTree(io);
+    for (WALK_THREADS) |threads| {
+        var arena = std.heap.ArenaAllocator.init(allocator);
+        defer arena.deinit();
+        const start = std.Io.Clock.awake.now(io);
+        const keys = try zs3.collectKeys(arena.allocator(), WALK_TREE, threads);
+        const elapsed_ns: u64 = @intCast(start.durationTo(std.Io.Clock.awake.now(io)).nanoseconds);
+        if (keys.len != WALK_DIRS * WALK_FILES_PER_DIR) return error.BenchTreeIncomplete;
+        std.debug.print("collectKeys: {d} files, {d} threads, {d:.0}ms\n", .{
+            keys.len,
+            threads,
+            @as(f64, @floatFromInt(elapsed_ns)) / std.time.ns_per_ms,
+        });
+    }
+}
+
+fn buildTree(io: std.Io) !void {
+    const cwd = std.Io.Dir.cwd();
+    const done = WALK_TREE ++ ".complete";
+    if (cwd.access(io, done, .{})) |_| return else |_| {}
+
+    std.debug.print("building {s} ({d} files), once\n", .{ WALK_TREE, WALK_DIRS * WALK_FILES_PER_DIR });
+    var name: [64]u8 = undefined;
+    for (0..WALK_DIRS) |d| {
+        const dir_path = try std.fmt.bufPrint(&name, "{s}/d{d:0>4}", .{ WALK_TREE, d });
+        try cwd.createDirPath(io, dir_path);
+        var dir = try cwd.openDir(io, dir_path, .{});
+        defer dir.close(io);
+        var file_name: [16]u8 = undefined;
+        for (0..WALK_FILES_PER_DIR) |f| {
+            const file = try dir.createFile(io, try std.fmt.bufPrint(&file_name, "f{d:0>4}", .{f}), .{});
+            file.close(io);
+        }
+    }
+    const file = try cwd.createFile(io, done, .{});
+    file.close(io);
+}
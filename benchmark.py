@@ -9,6 +9,10 @@ import urllib.request
 import urllib.error
 import argparse
 import json
+import os
+import socket
+import subprocess
+import tempfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
 
@@ -265,6 +269,63 @@ def print_concurrent_results(results, name):
     print(f"  Latency min:    {results['min_latency']:.2f}ms")
     print(f"  Latency max:    {results['max_latency']:.2f}ms")
 
+def server_cpu_seconds(pid):
+    """User + system CPU time a local process has used so far (Linux only)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def io_backend_benchmark(binary, port, workers, access_key, secret_key, concurrency, requests_per_worker):
+    """Run the concurrent small-object GET benchmark against one zs3 binary
+    started with --io=epoll and then --io=uring, on the same host"""
+    endpoint = f"http://localhost:{port}"
+    results = {}
+    for backend in ("epoll", "uring"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            proc = subprocess.Popen(
+                [binary, f"--port={port}", f"--data-dir={data_dir}", f"--io={backend}", f"--workers={workers}"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            try:
+                if not wait_for_port(port):
+                    print(f"zs3 --io={backend} did not start")
+                    continue
+                cpu_before = server_cpu_seconds(proc.pid)
+                r = concurrent_benchmark(f"zs3 --io={backend}", endpoint, access_key, secret_key, concurrency, requests_per_worker)
+                cpu = server_cpu_seconds(proc.pid) - cpu_before
+            finally:
+                proc.terminate()
+                _, err = proc.communicate(timeout=10)
+            if "falling back to epoll" in err:
+                print("io_uring is not available on this host; both runs used epoll")
+            if r:
+                # Setup and cleanup requests are included in the CPU time
+                r["cpu_us_per_request"] = cpu * 1e6 / r["successful"]
+                results[backend] = r
+                print_concurrent_results(r, f"zs3 --io={backend}")
+                print(f"  Server CPU:     {r['cpu_us_per_request']:.0f}us/request")
+
+    if len(results) == 2:
+        e, u = results["epoll"], results["uring"]
+        print(f"\n{'='*60}")
+        print("I/O backend comparison (epoll vs io_uring)")
+        print(f"{'='*60}")
+        print(f"{'Metric':<20} {'epoll':>12} {'io_uring':>12} {'Ratio':>10}")
+        print("-" * 60)
+        print(f"{'Throughput (req/s)':<20} {e['throughput']:>12.1f} {u['throughput']:>12.1f} {u['throughput'] / e['throughput']:>9.2f}x")
+        print(f"{'Latency mean (ms)':<20} {e['mean_latency']:>12.2f} {u['mean_latency']:>12.2f} {e['mean_latency'] / u['mean_latency']:>9.2f}x")
+        print(f"{'Latency p99 (ms)':<20} {e['p99_latency']:>12.2f} {u['p99_latency']:>12.2f} {e['p99_latency'] / u['p99_latency']:>9.2f}x")
+        print(f"{'CPU (us/request)':<20} {e['cpu_us_per_request']:>12.0f} {u['cpu_us_per_request']:>12.0f} {e['cpu_us_per_request'] / u['cpu_us_per_request']:>9.2f}x")
+
 def main():
     parser = argparse.ArgumentParser(description="Benchmark S3-compatible servers")
     parser.add_argument("--zs3", default="http://localhost:9000", help="zs3 endpoint")
@@ -279,9 +340,18 @@ def main():
     parser.add_argument("--requests-per-worker", type=int, default=20, help="Requests per worker")
     parser.add_argument("--only", default="zs3,rustfs",
                         help="Comma-separated servers to benchmark from {zs3,rustfs,garage} (e.g. 'zs3,garage')")
-    parser.add_argument("--mode", choices=["sequential", "concurrent", "all"], default="all", help="Benchmark mode")
+    parser.add_argument("--mode", choices=["sequential", "concurrent", "all", "io"], default="all",
+                        help="Benchmark mode ('io' compares zs3's epoll and io_uring backends)")
+    parser.add_argument("--zs3-binary", default="./zig-out/bin/zs3", help="zs3 binary started by --mode io")
+    parser.add_argument("--port", type=int, default=9100, help="Port for the zs3 instances started by --mode io")
+    parser.add_argument("--workers", type=int, default=1, help="--workers for the zs3 instances started by --mode io")
     args = parser.parse_args()
 
+    if args.mode == "io":
+        io_backend_benchmark(args.zs3_binary, args.port, args.workers, args.access_key, args.secret_key,
+                             args.concurrency, args.requests_per_worker)
+        return
+
     available = {
         "zs3":    ("zs3",    args.zs3,    args.access_key, args.secret_key),
         "rustfs": ("RustFS", args.rustfs, args.access_key, args.secret_key),
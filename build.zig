@@ -50,4 +50,15 @@ pub fn build(b: *std.Build) !void {
     });
     const run_unit_tests = b.addRunArtifact(unit_tests);
     test_step.dependOn(&run_unit_tests.step);
+
+    const bench_step = b.step("bench", "Run micro-benchmarks");
+    const bench_exe = b.addExecutable(.{
+        .name = "zs3-bench",
+        .root_module = b.createModule(.{
+            .root_source_file = b.path("bench.zig"),
+            .target = target,
+            .optimize = .ReleaseFast,
+        }),
+    });
+    bench_step.dependOn(&b.addRunArtifact(bench_exe).step);
 }
@@ -5,31 +5,80 @@ const Allocator = std.mem.Allocator;
 const builtin = @import("builtin");
 const build_options = @import("build_options");
 const acl = @import("acl.zig");
-var app_io: std.Io = undefined;
+pub var app_io: std.Io = undefined;
 
 const MAX_HEADER_SIZE = 8 * 1024;
 const MAX_BODY_SIZE = 5 * 1024 * 1024 * 1024;
 const MAX_KEY_LENGTH = 1024;
 const MAX_BUCKET_LENGTH = 63;
 const MAX_CONNECTIONS = 1024;
+const URING_ENTRIES = 1024; // Submission queue size for --io=uring (one op in flight per connection)
+const HEADER_TIMEOUT_MS = 10_000; // Default time allowed to receive a full request head
+const BODY_TIMEOUT_MS = 30_000; // Default time a body read or response write may go without progress
+const IDLE_TIMEOUT_MS = 5_000; // Default time a keep-alive connection may sit between requests
+const LINGER_TIMEOUT_MS = 2_000; // Drain period after an error response before closing
+const MAX_REQUESTS_PER_CONNECTION = 1000; // Recycle a persistent connection after this many requests
+const STREAM_BODY_THRESHOLD = 256 * 1024; // PUT bodies larger than this are spooled to disk, not buffered
+const SPOOL_CHUNK_SIZE = 64 * 1024; // Read/write unit when streaming bodies and files
+const MAX_CHUNK_HEADER = 256; // aws-chunked header line: hex size, chunk-signature and CRLF
+const MAX_STACK_QUERY_PARAMS = 32; // Query parameters SigV4 sorts without allocating
+const SIGNING_KEY_CACHE_SIZE = 16; // Derived SigV4 signing keys kept per worker
+const KEY_INDEX_BLOCK = 128; // Keys between sparse-index entries of a bucket's key index
+pub const KEY_INDEX_FLUSH = 16 * 1024; // Logged key changes merged into a bucket's base index at once
+const LIST_BATCH_KEYS = 250; // Keys per piece of a streamed LIST response
 
 // Distributed mode constants
-const CHUNK_SIZE = 4 * 1024 * 1024; // 4MB chunks for large files
+const CHUNK_SIZE = 4 * 1024 * 1024; // Average content-defined chunk; larger objects are stored in chunks
+const CHUNK_MIN_SIZE = CHUNK_SIZE / 4; // No chunk but an object's last is shorter than this
+const CHUNK_MAX_SIZE = CHUNK_SIZE * 4; // A chunk is cut here whatever its content
+const CHUNK_FETCH_THREADS = 4; // Threads a GET uses to fetch missing chunks from peers
 const MAX_PEERS = 100;
 const GOSSIP_INTERVAL_MS = 30_000;
 const REPLICATION_TARGET = 3;
 const TOMBSTONE_TTL_SECS = 24 * 60 * 60; // 24 hours before tombstone cleanup
+const TOMBSTONE_SWEEP_INTERVAL_MS = 60_000; // How often expired tombstones are removed
+const TOMBSTONE_EXPIRE_BATCH = 1024; // Tombstones removed per hold of the metadata lock
 const INLINE_THRESHOLD = 4 * 1024; // Objects <= 4KB stored inline in metadata
 const GC_GRACE_PERIOD_SECS = 10 * 60; // 10 min delay before deleting unreferenced blocks
+const GC_BLOBS_PER_SEC = 256; // Cap on unreferenced blobs deleted per second
 const QUORUM_SIZE = 2; // Need 2 matching responses for quorum reads
 const MAX_BROADCAST_PEERS = 64; // Max peers a metadata/announce broadcast reaches
-const MAX_META_RESPONSE = 16 * 1024; // Meta entries are small: header + inline data
-const MAX_INDEX_SYNC_SIZE = 256 * 1024 * 1024; // Cap on a full index dump during join sync
+const MAX_META_RESPONSE = 256 * 1024; // Meta entry: header + inline data or a chunk manifest
+const MAX_INDEX_SYNC_SIZE = 256 * 1024 * 1024; // Cap on one metadata sync response (a full dump or a set of tree leaves)
+const TREE_SYNC_BATCH = 256; // Tree nodes, or leaves, asked of a peer in one request
 const PEER_IO_TIMEOUT_SECS = 5; // Socket timeout for peer-to-peer requests
+const PEER_POOL_IDLE = 4; // Idle keep-alive connections kept per peer
+const PEER_IDLE_MS = 4_000; // Idle peer connections are closed after this, before the peer's idle timeout
+const PEER_DEADLINE_MS = 1_000; // Default time a fan-out to peers waits for its acks
+const WRITE_ACKS = QUORUM_SIZE - 1; // Default peer acks a metadata write waits for (plus this node)
+const FANOUT_STACK_SIZE = 256 * 1024; // Stack of each thread sending one fan-out request
+const MAX_FANOUT_THREADS = 512; // Fan-out requests in flight at once; past this they fail at once
+const GROUP_COMMIT_MS = 5; // Default flush interval for --durability=group
+const GROUP_COMMIT_THREADS = 32; // Threads running write requests under --durability=group, whose commits share flushes
+const META_SEGMENT_SIZE = 64 * 1024 * 1024; // Metadata log segment size before starting a new one
+const META_CHECKPOINT_BYTES = 16 * 1024 * 1024; // Metadata log growth between checkpoints
+const META_COMPACT_MIN = 64 * 1024 * 1024; // Metadata log size below which it is never compacted
+const META_MAINTENANCE_INTERVAL_MS = 10_000; // How often the metadata log checks for checkpoint/compaction
+const META_CACHE_ENTRIES = 4096; // Inline objects kept in memory by the metadata log
+const META_CACHE_BYTES = 16 * 1024 * 1024; // Bytes of inline objects kept in memory by the metadata log
+const SCAN_THREADS = 8; // Default threads reading directories in parallel when walking a tree
 
 const ERROR_403 = "HTTP/1.1 403 Forbidden\r\nContent-Length: 6\r\nConnection: keep-alive\r\n\r\nDenied";
+const ERROR_403_CLOSE = "HTTP/1.1 403 Forbidden\r\nContent-Length: 6\r\nConnection: close\r\n\r\nDenied";
 const ERROR_431 = "HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n";
 const ERROR_400_ENTITY_TOO_LARGE = "HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n";
+const ERROR_400_BAD_FRAMING = staticXmlError("400 Bad Request", "InvalidRequest", "Invalid, repeated or conflicting Content-Length");
+// Rejections of an aws-chunked upload before or while its body is read
+const ERROR_403_STREAM_DENIED = staticXmlError("403 Forbidden", "AccessDenied", "Invalid credentials");
+const ERROR_403_CHUNK_SIGNATURE = staticXmlError("403 Forbidden", "SignatureDoesNotMatch", "Chunk signature does not match");
+const ERROR_400_MALFORMED_CHUNK = staticXmlError("400 Bad Request", "IncompleteBody", "Malformed aws-chunked body");
+const ERROR_411_DECODED_LENGTH = staticXmlError("411 Length Required", "MissingContentLength", "x-amz-decoded-content-length is required");
+
+/// Canned S3 error response that closes the connection
+fn staticXmlError(comptime status: []const u8, comptime code: []const u8, comptime message: []const u8) []const u8 {
+    const body = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>" ++ code ++ "</Code><Message>" ++ message ++ "</Message></Error>";
+    return std.fmt.comptimePrint("HTTP/1.1 {s}\r\nContent-Type: application/xml\r\nContent-Length: {d}\r\nConnection: close\r\n\r\n{s}", .{ status, body.len, body });
+}
 
 /// Format a Unix timestamp (seconds) as an HTTP date (RFC 7231).
 /// Returns a 29-byte string like "Mon, 02 Jan 2006 15:04:05 GMT".
@@ -79,37 +128,113 @@ pub fn formatIso8601(buf: *[20]u8, timestamp: i64) void {
     }) catch unreachable;
 }
 
-/// Decode AWS chunked transfer encoding.
+/// Decode a whole AWS chunked body without checking chunk signatures.
 /// Format: <hex-size>;chunk-signature=...\r\n<data>\r\n repeated, terminated by 0-size chunk.
 pub fn decodeAwsChunked(allocator: Allocator, body: []const u8) ![]const u8 {
     var result: std.ArrayListUnmanaged(u8) = .empty;
     errdefer result.deinit(allocator);
 
-    var pos: usize = 0;
-    while (pos < body.len) {
-        // Find the end of the chunk header line (terminated by \r\n)
-        const line_end = std.mem.indexOfPos(u8, body, pos, "\r\n") orelse break;
-        const chunk_header = body[pos..line_end];
-
-        // Parse hex chunk size (before the first ';')
-        const size_end = std.mem.indexOf(u8, chunk_header, ";") orelse chunk_header.len;
-        const hex_str = chunk_header[0..size_end];
-        const chunk_size = std.fmt.parseInt(usize, hex_str, 16) catch break;
+    var decoder: AwsChunkedDecoder = .{};
+    var rest = body;
+    while (rest.len > 0) {
+        const step = try decoder.decode(rest);
+        try result.appendSlice(allocator, step.data);
+        rest = rest[step.consumed..];
+    }
+    if (!decoder.finished()) return error.MalformedChunk;
 
-        if (chunk_size == 0) break;
+    return result.toOwnedSlice(allocator);
+}
 
-        // Data starts after \r\n
-        const data_start = line_end + 2;
-        if (data_start + chunk_size > body.len) break;
+/// Incremental AWS chunked decoder. Input may be split at any byte, and
+/// payload comes back as slices of the input, so a body can be decoded
+/// straight off the socket into its destination. With a signer, each chunk's
+/// signature is checked as soon as its data is complete, so a bad upload
+/// fails at the first bad chunk rather than after the whole body.
+pub const AwsChunkedDecoder = struct {
+    signer: ?SigV4.ChunkSigner = null,
+    state: State = .header,
+    line: [MAX_CHUNK_HEADER]u8 = undefined, // partial chunk header
+    line_len: usize = 0, // bytes in `line`, or of the CRLF seen in .crlf
+    left: u64 = 0, // data bytes of the current chunk still to come
+    last: bool = false, // the current chunk is the 0-size terminator
+    signature: [64]u8 = undefined, // claimed signature of the current chunk
+    hasher: SigV4.Sha256 = .init(.{}),
+
+    const State = enum { header, data, crlf, done };
+
+    pub const Step = struct {
+        consumed: usize, // input bytes used
+        data: []const u8, // payload among them
+    };
 
-        try result.appendSlice(allocator, body[data_start .. data_start + chunk_size]);
+    /// Decode from the front of `input` (non-empty). Call again with the
+    /// unconsumed rest.
+    pub fn decode(self: *AwsChunkedDecoder, input: []const u8) !Step {
+        switch (self.state) {
+            .header => {
+                const newline = std.mem.indexOfScalar(u8, input, '\n');
+                const n = if (newline) |i| i + 1 else input.len;
+                if (self.line_len + n > self.line.len) return error.MalformedChunk;
+                @memcpy(self.line[self.line_len..][0..n], input[0..n]);
+                self.line_len += n;
+                if (newline != null) try self.beginChunk();
+                return .{ .consumed = n, .data = "" };
+            },
+            .data => {
+                const n: usize = @intCast(@min(self.left, input.len));
+                if (self.signer != null) self.hasher.update(input[0..n]);
+                self.left -= n;
+                if (self.left == 0) try self.endChunk();
+                return .{ .consumed = n, .data = input[0..n] };
+            },
+            .crlf => {
+                const n = @min(2 - self.line_len, input.len);
+                if (!std.mem.eql(u8, input[0..n], "\r\n"[self.line_len..][0..n])) return error.MalformedChunk;
+                self.line_len += n;
+                if (self.line_len == 2) {
+                    self.line_len = 0;
+                    self.state = if (self.last) .done else .header;
+                }
+                return .{ .consumed = n, .data = "" };
+            },
+            // Nothing may follow the terminating chunk
+            .done => return error.MalformedChunk,
+        }
+    }
 
-        // Skip past data + \r\n
-        pos = data_start + chunk_size + 2;
+    /// Whether the terminating chunk has been decoded
+    pub fn finished(self: *const AwsChunkedDecoder) bool {
+        return self.state == .done;
+    }
+
+    /// Parse the complete header line in `line`
+    fn beginChunk(self: *AwsChunkedDecoder) !void {
+        const line = std.mem.trimEnd(u8, self.line[0..self.line_len], "\r\n");
+        self.line_len = 0;
+        const size_end = std.mem.indexOfScalar(u8, line, ';') orelse line.len;
+        self.left = std.fmt.parseInt(u64, line[0..size_end], 16) catch return error.MalformedChunk;
+        self.last = self.left == 0;
+        if (self.signer != null) {
+            const marker = ";chunk-signature=";
+            const at = std.mem.indexOf(u8, line, marker) orelse return error.MalformedChunk;
+            const sig = line[at + marker.len ..];
+            if (sig.len != self.signature.len) return error.MalformedChunk;
+            @memcpy(&self.signature, sig);
+        }
+        if (self.left == 0) try self.endChunk() else self.state = .data;
     }
 
-    return result.toOwnedSlice(allocator);
-}
+    /// All of the current chunk's data is in
+    fn endChunk(self: *AwsChunkedDecoder) !void {
+        if (self.signer) |*signer| {
+            const digest = self.hasher.finalResult();
+            self.hasher = .init(.{});
+            if (!signer.check(digest, &self.signature)) return error.SignatureDoesNotMatch;
+        }
+        self.state = .crlf;
+    }
+};
 
 /// Heap-allocate an RFC 7231 date string suitable for Response.setHeader.
 fn allocHttpDate(allocator: Allocator, timestamp: i64) ![]const u8 {
@@ -137,6 +262,9 @@ fn bytesToHex(bytes: []const u8, out: []u8) void {
 /// Content-Addressed Store - stores objects by their hash
 const CAS = struct {
     data_dir: []const u8,
+    committer: *Committer,
+    refs: *BlobRefs,
+    present: *BlobSet,
 
     const Blake3 = std.crypto.hash.Blake3;
 
@@ -151,44 +279,72 @@ const CAS = struct {
         const path = try self.hashToPath(allocator, hash);
         defer allocator.free(path);
 
+        // Before the existence check, so the collector can't remove the
+        // blob between it and the metadata write that references it
+        self.refs.touch(hash);
+
         // Check if already exists (deduplication)
-        if (std.Io.Dir.cwd().access(app_io, path, .{})) |_| {
-            return hash;
-        } else |_| {}
+        if (self.isStored(path, hash)) return hash;
 
         // Create parent directory (.cas/xx/)
         if (std.fs.path.dirname(path)) |dir| {
             std.Io.Dir.cwd().createDirPath(app_io, dir) catch {};
         }
 
-        var file = try std.Io.Dir.cwd().createFile(app_io, path, .{});
-        defer file.close(app_io);
-        try file.writeStreamingAll(app_io, data);
-
+        try self.committer.writeFile(allocator, path, &.{data});
+        self.present.add(hash);
         return hash;
     }
 
-    /// Retrieve data by content hash
-    pub fn retrieve(self: *const CAS, allocator: Allocator, hash: ContentHash) ![]const u8 {
+    /// Add a finished file under its precomputed content hash, by moving it
+    /// (a temp file) or copying it (a file that must stay where it is). When
+    /// the content is already stored the source is left untouched.
+    pub fn storeFile(self: *const CAS, allocator: Allocator, src_path: []const u8, hash: ContentHash, how: enum { move, copy }) !void {
         const path = try self.hashToPath(allocator, hash);
         defer allocator.free(path);
 
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return error.NotFound;
-        defer file.close(app_io);
+        self.refs.touch(hash);
+        if (self.isStored(path, hash)) return;
+
+        if (std.fs.path.dirname(path)) |dir| {
+            std.Io.Dir.cwd().createDirPath(app_io, dir) catch {};
+        }
+        switch (how) {
+            .move => try self.committer.commit(src_path, path),
+            .copy => {
+                const tmp_path = try tempFilePath(allocator, self.data_dir);
+                defer allocator.free(tmp_path);
+                errdefer std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
+                try std.Io.Dir.copyFile(std.Io.Dir.cwd(), src_path, std.Io.Dir.cwd(), tmp_path, app_io, .{});
+                try self.committer.commit(tmp_path, path);
+            },
+        }
+        self.present.add(hash);
+    }
 
-        const stat = try file.stat(app_io);
-        const data = try allocator.alloc(u8, stat.size);
-        const bytes_read = try file.readPositionalAll(app_io, data, 0);
-        return data[0..bytes_read];
+    /// Open the blob with this content hash for reading. Blobs are sent
+    /// with sendfile rather than read into memory.
+    pub fn open(self: *const CAS, allocator: Allocator, hash: ContentHash) !std.Io.File {
+        if (!self.present.mayContain(hash)) return error.NotFound;
+        const path = try self.hashToPath(allocator, hash);
+        defer allocator.free(path);
+        return std.Io.Dir.cwd().openFile(app_io, path, .{}) catch error.NotFound;
     }
 
     /// Check if content exists locally
     pub fn exists(self: *const CAS, allocator: Allocator, hash: ContentHash) bool {
+        if (!self.present.mayContain(hash)) return false;
         const path = self.hashToPath(allocator, hash) catch return false;
         defer allocator.free(path);
         return if (std.Io.Dir.cwd().access(app_io, path, .{})) |_| true else |_| false;
     }
 
+    /// Whether the blob at `path` is stored; only a possible hit touches the disk
+    fn isStored(self: *const CAS, path: []const u8, hash: ContentHash) bool {
+        if (!self.present.mayContain(hash)) return false;
+        return if (std.Io.Dir.cwd().access(app_io, path, .{})) |_| true else |_| false;
+    }
+
     /// Convert hash to filesystem path: .cas/xx/xxxx....blob
     fn hashToPath(self: *const CAS, allocator: Allocator, hash: ContentHash) ![]const u8 {
         var hex: [40]u8 = undefined;
@@ -196,6 +352,18 @@ const CAS = struct {
         return std.fs.path.join(allocator, &.{ self.data_dir, ".cas", hex[0..2], hex[2..] ++ ".blob" });
     }
 
+    /// The hash of the blob `entry` in `.cas/<prefix>/`, or null if it isn't one
+    fn blobHash(prefix: []const u8, entry: std.Io.Dir.Entry) ?ContentHash {
+        if (entry.kind != .file or prefix.len != 2) return null;
+        if (entry.name.len != 38 + ".blob".len or !std.mem.endsWith(u8, entry.name, ".blob")) return null;
+        var hex: [40]u8 = undefined;
+        @memcpy(hex[0..2], prefix);
+        @memcpy(hex[2..], entry.name[0..38]);
+        var hash: ContentHash = undefined;
+        _ = std.fmt.hexToBytes(&hash, &hex) catch return null;
+        return hash;
+    }
+
     /// Compute hash without storing
     pub fn computeHash(data: []const u8) ContentHash {
         var hasher = Blake3.init(.{});
@@ -205,441 +373,1950 @@ const CAS = struct {
         return full_hash[0..20].*;
     }
 
-    /// Garbage collect unreferenced blocks
-    /// Scans metadata index to build reference set, then removes orphaned CAS blobs
-    pub fn garbageCollect(self: *const CAS, allocator: Allocator, meta_index: *const MetaIndex) !struct { scanned: usize, deleted: usize } {
+    /// Delete up to `limit` blobs that have been unreferenced for
+    /// GC_GRACE_PERIOD_SECS. Costs what it deletes, not the size of the store.
+    pub fn collectGarbage(self: *const CAS, allocator: Allocator, limit: usize) usize {
+        const refs = self.refs;
+        refs.mutex.lockUncancelable(app_io);
+        defer refs.mutex.unlock(app_io);
+        const now = std.Io.Clock.real.now(app_io).toSeconds();
+
+        var deleted: usize = 0;
+        while (deleted < limit) {
+            const hash = refs.nextDue(now - GC_GRACE_PERIOD_SECS) orelse break;
+            // Deleted under the lock, so a concurrent store sees it gone
+            const path = self.hashToPath(allocator, hash) catch break;
+            defer allocator.free(path);
+            std.Io.Dir.cwd().deleteFile(app_io, path) catch |err| switch (err) {
+                error.FileNotFound => continue,
+                else => {
+                    std.log.warn("removing unreferenced blob {x}: {}", .{ hash, err });
+                    continue;
+                },
+            };
+            self.present.remove(hash);
+            deleted += 1;
+        }
+        return deleted;
+    }
+
+    /// Garbage collect unreferenced blocks with a full sweep
+    /// Scans metadata index to build reference set, then removes orphaned CAS blobs.
+    /// Routine garbage is handled incrementally by collectGarbage; this also
+    /// catches blobs orphaned by a crash before any entry referenced them.
+    /// The `.cas/xx/` directories are read with `threads` threads.
+    pub fn garbageCollect(self: *const CAS, allocator: Allocator, meta_index: *const MetaIndex, threads: usize) !struct { scanned: usize, deleted: usize } {
         var referenced = std.AutoHashMap(ContentHash, void).init(allocator);
         defer referenced.deinit();
 
         // Phase 1: Collect all referenced hashes from metadata index
-        const index_path = try std.fs.path.join(allocator, &.{ meta_index.data_dir, ".index" });
-        defer allocator.free(index_path);
-
-        var index_dir = std.Io.Dir.cwd().openDir(app_io, index_path, .{ .iterate = true }) catch {
-            return .{ .scanned = 0, .deleted = 0 };
-        };
-        defer index_dir.close(app_io);
+        // (tombstones included - they still reference content)
+        try meta_index.log.collectHashes(&referenced);
 
-        var bucket_iter = index_dir.iterate();
-        while (try bucket_iter.next(app_io)) |bucket_entry| {
-            if (bucket_entry.kind == .directory) {
-                try self.collectReferencedHashes(allocator, meta_index, bucket_entry.name, &referenced);
+        // Phase 2: Scan CAS directory and delete unreferenced blocks
+        const Sweeper = struct {
+            cas: *const CAS,
+            referenced: *const std.AutoHashMap(ContentHash, void),
+            now: i64,
+            scanned: usize = 0,
+            deleted: usize = 0,
+
+            pub fn visit(sweeper: *@This(), dir: std.Io.Dir, path: []const u8, entry: std.Io.Dir.Entry) !bool {
+                if (path.len == 0) return entry.kind == .directory and entry.name.len == 2;
+                const hash = blobHash(path, entry) orelse return false;
+                sweeper.scanned += 1;
+                if (sweeper.referenced.contains(hash)) return false;
+
+                // Check grace period using mtime
+                const stat = dir.statFile(app_io, entry.name, .{}) catch return false;
+                if (sweeper.now - stat.mtime.toSeconds() > GC_GRACE_PERIOD_SECS) {
+                    dir.deleteFile(app_io, entry.name) catch return false;
+                    sweeper.cas.present.remove(hash);
+                    sweeper.deleted += 1;
+                }
+                return false;
             }
-        }
+        };
 
-        // Phase 2: Scan CAS directory and delete unreferenced blocks
         const cas_path = try std.fs.path.join(allocator, &.{ self.data_dir, ".cas" });
         defer allocator.free(cas_path);
-
-        var cas_dir = std.Io.Dir.cwd().openDir(app_io, cas_path, .{ .iterate = true }) catch {
-            return .{ .scanned = 0, .deleted = 0 };
-        };
-        defer cas_dir.close(app_io);
+        const sweepers = try allocator.alloc(Sweeper, @max(threads, 1));
+        defer allocator.free(sweepers);
+        @memset(sweepers, .{ .cas = self, .referenced = &referenced, .now = std.Io.Clock.real.now(app_io).toSeconds() });
+        try walkTree(Sweeper, allocator, cas_path, sweepers);
 
         var scanned: usize = 0;
         var deleted: usize = 0;
-        const now = std.Io.Clock.real.now(app_io).toSeconds();
+        for (sweepers) |sweeper| {
+            scanned += sweeper.scanned;
+            deleted += sweeper.deleted;
+        }
+        return .{ .scanned = scanned, .deleted = deleted };
+    }
+};
 
-        var prefix_iter = cas_dir.iterate();
-        while (try prefix_iter.next(app_io)) |prefix_entry| {
-            if (prefix_entry.kind == .directory and prefix_entry.name.len == 2) {
-                const prefix_path = try std.fs.path.join(allocator, &.{ cas_path, prefix_entry.name });
-                defer allocator.free(prefix_path);
+/// Content-defined chunk boundaries (FastCDC). A gear hash rolls over the
+/// stream, and a chunk ends where the hash's top bits are all zero. That
+/// depends only on the 64 bytes before the cut, so an edit moves the
+/// boundaries near it and leaves the rest where they were: versions of a
+/// file that differ slightly share most chunks. The test is stricter
+/// before CHUNK_SIZE and looser after it (normalized chunking), which keeps
+/// sizes close to the average, between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE.
+pub const ChunkCutter = struct {
+    fp: u64 = 0,
+    len: u64 = 0, // bytes in the current chunk
+
+    const BITS: comptime_int = std.math.log2_int(u64, CHUNK_SIZE);
+    const MASK_STRICT: u64 = ~@as(u64, 0) << (64 - (BITS + 2));
+    const MASK_LOOSE: u64 = ~@as(u64, 0) << (64 - (BITS - 2));
+
+    /// Fixed forever: chunk boundaries, and so the hashes every node
+    /// stores, follow from it
+    const GEAR: [256]u64 = blk: {
+        var table: [256]u64 = undefined;
+        var state: u64 = 0x7a73_3363_6463_0001;
+        for (&table) |*g| {
+            // SplitMix64
+            state +%= 0x9e37_79b9_7f4a_7c15;
+            var z = state;
+            z = (z ^ (z >> 30)) *% 0xbf58_476d_1ce4_e5b9;
+            z = (z ^ (z >> 27)) *% 0x94d0_49bb_1331_11eb;
+            g.* = z ^ (z >> 31);
+        }
+        break :blk table;
+    };
 
-                var blob_dir = std.Io.Dir.cwd().openDir(app_io, prefix_path, .{ .iterate = true }) catch continue;
-                defer blob_dir.close(app_io);
+    /// Where the current chunk ends in `bytes` (one past its last byte),
+    /// or null if it goes on past them
+    pub fn cut(self: *ChunkCutter, bytes: []const u8) ?usize {
+        var i: usize = 0;
+        // Nothing can end before CHUNK_MIN_SIZE, and by then only the last
+        // 64 bytes are in the hash
+        const skip_to = CHUNK_MIN_SIZE - 64;
+        if (self.len < skip_to) {
+            const n: usize = @intCast(@min(bytes.len, skip_to - self.len));
+            i += n;
+            self.len += n;
+        }
+        while (i < bytes.len) : (i += 1) {
+            self.fp = (self.fp << 1) +% GEAR[bytes[i]];
+            self.len += 1;
+            if (self.len < CHUNK_MIN_SIZE) continue;
+            const mask = if (self.len < CHUNK_SIZE) MASK_STRICT else MASK_LOOSE;
+            if (self.fp & mask == 0 or self.len == CHUNK_MAX_SIZE) {
+                self.* = .{};
+                return i + 1;
+            }
+        }
+        return null;
+    }
+};
 
-                var blob_iter = blob_dir.iterate();
-                while (try blob_iter.next(app_io)) |blob_entry| {
-                    if (blob_entry.kind == .file and std.mem.endsWith(u8, blob_entry.name, ".blob")) {
-                        scanned += 1;
+/// The chunks of an object stored in chunks, in order: each one's content
+/// hash and size, 28 bytes apiece. It lives in the object's metadata
+/// entry, where a small object keeps its data, and the object's hash is
+/// the manifest's.
+const Manifest = struct {
+    bytes: []const u8,
 
-                        // Reconstruct hash from path: prefix + name (without .blob)
-                        const name_without_ext = blob_entry.name[0 .. blob_entry.name.len - 5];
-                        if (name_without_ext.len != 38) continue; // 40 - 2 prefix = 38
+    const ENTRY_SIZE = 20 + 8;
+    const Chunk = struct { hash: ContentHash, size: u64 };
 
-                        var hex: [40]u8 = undefined;
-                        @memcpy(hex[0..2], prefix_entry.name);
-                        @memcpy(hex[2..], name_without_ext);
+    fn count(self: Manifest) usize {
+        return self.bytes.len / ENTRY_SIZE;
+    }
 
-                        var hash: ContentHash = undefined;
-                        _ = std.fmt.hexToBytes(&hash, &hex) catch continue;
+    fn chunk(self: Manifest, i: usize) Chunk {
+        const e = self.bytes[i * ENTRY_SIZE ..][0..ENTRY_SIZE];
+        return .{ .hash = e[0..20].*, .size = std.mem.readInt(u64, e[20..28], .little) };
+    }
 
-                        // Check if referenced
-                        if (!referenced.contains(hash)) {
-                            // Check grace period using mtime
-                            const blob_path = try std.fs.path.join(allocator, &.{ prefix_path, blob_entry.name });
-                            defer allocator.free(blob_path);
+    /// Whether `bytes` lists chunks that add up to `size`
+    fn isValid(bytes: []const u8, size: u64) bool {
+        if (bytes.len == 0 or bytes.len % ENTRY_SIZE != 0) return false;
+        const m = Manifest{ .bytes = bytes };
+        var total: u64 = 0;
+        for (0..m.count()) |i| total +|= m.chunk(i).size;
+        return total == size;
+    }
+};
 
-                            const file = std.Io.Dir.cwd().openFile(app_io, blob_path, .{}) catch continue;
-                            const stat = file.stat(app_io) catch {
-                                file.close(app_io);
-                                continue;
-                            };
-                            file.close(app_io);
+/// Cuts a stream into content-defined chunks and stores each in the CAS as
+/// soon as it is complete. Only the chunk being written sits outside the
+/// CAS, and memory holds just the manifest.
+const ChunkWriter = struct {
+    cas: *const CAS,
+    allocator: Allocator,
+    cutter: ChunkCutter = .{},
+    file: ?std.Io.File = null, // the chunk being written
+    path: []const u8 = "",
+    hasher: CAS.Blake3 = .init(.{}),
+    chunk_size: u64 = 0,
+    size: u64 = 0, // everything written
+    manifest: std.ArrayListUnmanaged(u8) = .empty,
+
+    fn init(allocator: Allocator, cas: *const CAS) ChunkWriter {
+        return .{ .cas = cas, .allocator = allocator };
+    }
+
+    fn write(self: *ChunkWriter, bytes: []const u8) !void {
+        var rest = bytes;
+        while (rest.len > 0) {
+            const end = self.cutter.cut(rest);
+            const piece = rest[0 .. end orelse rest.len];
+            if (self.file == null) {
+                const path = try tempFilePath(self.allocator, self.cas.data_dir);
+                errdefer self.allocator.free(path);
+                self.file = try std.Io.Dir.cwd().createFile(app_io, path, .{ .exclusive = true });
+                self.path = path;
+            }
+            self.hasher.update(piece);
+            try self.file.?.writeStreamingAll(app_io, piece);
+            self.chunk_size += piece.len;
+            self.size += piece.len;
+            if (end != null) try self.store();
+            rest = rest[piece.len..];
+        }
+    }
 
-                            const mtime_secs = stat.mtime.toSeconds();
-                            const age = now - mtime_secs;
+    /// The chunk being written is complete: move it into the CAS
+    fn store(self: *ChunkWriter) !void {
+        self.file.?.close(app_io);
+        self.file = null;
+        // Still there if the CAS already had the chunk
+        defer {
+            std.Io.Dir.cwd().deleteFile(app_io, self.path) catch {};
+            self.allocator.free(self.path);
+            self.path = "";
+        }
 
-                            if (age > GC_GRACE_PERIOD_SECS) {
-                                std.Io.Dir.cwd().deleteFile(app_io, blob_path) catch continue;
-                                deleted += 1;
-                            }
-                        }
-                    }
-                }
+        var full: [32]u8 = undefined;
+        self.hasher.final(&full);
+        self.hasher = .init(.{});
+        const hash: ContentHash = full[0..20].*;
+        try self.manifest.ensureUnusedCapacity(self.allocator, Manifest.ENTRY_SIZE);
+        try self.cas.storeFile(self.allocator, self.path, hash, .move);
+        self.manifest.appendSliceAssumeCapacity(&hash);
+        std.mem.writeInt(u64, self.manifest.addManyAsArrayAssumeCapacity(8), self.chunk_size, .little);
+        self.chunk_size = 0;
+    }
+
+    /// Store the last chunk and return the manifest
+    fn finish(self: *ChunkWriter) ![]const u8 {
+        if (self.file != null) try self.store();
+        return self.manifest.items;
+    }
+
+    /// Drop the chunk being written. Those already stored are unreferenced
+    /// and will be collected.
+    fn abort(self: *ChunkWriter) void {
+        const file = self.file orelse return;
+        file.close(app_io);
+        std.Io.Dir.cwd().deleteFile(app_io, self.path) catch {};
+        self.allocator.free(self.path);
+        self.file = null;
+    }
+
+    fn deinit(self: *ChunkWriter) void {
+        self.abort();
+        self.manifest.deinit(self.allocator);
+    }
+};
+
+/// Which blobs the CAS holds, as 8-byte fingerprints of their hashes, so
+/// dedup checks and lookups of missing blobs cost no syscall. A fingerprint
+/// can be shared, so a hit is confirmed on disk; a miss is exact. Each
+/// fingerprint counts its blobs, so deleting one doesn't hide another that
+/// shares it. About 12 bytes per blob.
+pub const BlobSet = struct {
+    allocator: Allocator,
+    mutex: std.Io.Mutex = .init,
+    counts: std.AutoHashMapUnmanaged(u64, u8) = .empty, // sticks at its max rather than wrap
+    complete: bool = true, // cleared when a blob couldn't be added; every lookup then hits the disk
+
+    pub fn init(allocator: Allocator) BlobSet {
+        return .{ .allocator = allocator };
+    }
+
+    pub fn deinit(self: *BlobSet) void {
+        self.counts.deinit(self.allocator);
+    }
+
+    fn fingerprint(hash: ContentHash) u64 {
+        return std.mem.readInt(u64, hash[0..8], .little);
+    }
+
+    /// Add every blob under `cas_path` (.cas/xx/*.blob), read with
+    /// `threads` threads
+    pub fn load(self: *BlobSet, cas_path: []const u8, threads: usize) !void {
+        const Lister = struct {
+            allocator: Allocator,
+            hashes: std.ArrayListUnmanaged(ContentHash) = .empty,
+
+            pub fn visit(lister: *@This(), _: std.Io.Dir, path: []const u8, entry: std.Io.Dir.Entry) !bool {
+                if (path.len == 0) return entry.kind == .directory and entry.name.len == 2;
+                const hash = CAS.blobHash(path, entry) orelse return false;
+                try lister.hashes.append(lister.allocator, hash);
+                return false;
             }
+        };
+
+        const listers = try self.allocator.alloc(Lister, @max(threads, 1));
+        defer self.allocator.free(listers);
+        @memset(listers, .{ .allocator = self.allocator });
+        defer for (listers) |*l| l.hashes.deinit(self.allocator);
+        try walkTree(Lister, self.allocator, cas_path, listers);
+
+        var count: usize = 0;
+        for (listers) |l| {
+            for (l.hashes.items) |hash| try self.insert(hash);
+            count += l.hashes.items.len;
         }
+        std.log.info("indexed {d} CAS blobs", .{count});
+    }
 
-        return .{ .scanned = scanned, .deleted = deleted };
+    fn insert(self: *BlobSet, hash: ContentHash) !void {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        const count = try self.counts.getOrPut(self.allocator, fingerprint(hash));
+        if (!count.found_existing) count.value_ptr.* = 0;
+        count.value_ptr.* +|= 1;
     }
 
-    fn collectReferencedHashes(self: *const CAS, allocator: Allocator, meta_index: *const MetaIndex, bucket: []const u8, referenced: *std.AutoHashMap(ContentHash, void)) !void {
-        _ = self;
-        const bucket_path = try std.fs.path.join(allocator, &.{ meta_index.data_dir, ".index", bucket });
-        defer allocator.free(bucket_path);
+    /// A blob was written
+    pub fn add(self: *BlobSet, hash: ContentHash) void {
+        self.insert(hash) catch {
+            self.mutex.lockUncancelable(app_io);
+            defer self.mutex.unlock(app_io);
+            self.complete = false;
+        };
+    }
+
+    /// A blob was deleted
+    pub fn remove(self: *BlobSet, hash: ContentHash) void {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        const count = self.counts.getPtr(fingerprint(hash)) orelse return;
+        if (count.* == std.math.maxInt(u8)) return;
+        count.* -= 1;
+        if (count.* == 0) _ = self.counts.remove(fingerprint(hash));
+    }
 
-        try collectHashesFromDir(allocator, bucket_path, bucket, "", meta_index, referenced);
+    /// False if the blob is certainly not stored
+    pub fn mayContain(self: *BlobSet, hash: ContentHash) bool {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        return !self.complete or self.counts.contains(fingerprint(hash));
     }
 };
 
-/// Recursively collect hashes from metadata directory for GC reference counting
-fn collectHashesFromDir(allocator: Allocator, dir_path: []const u8, bucket: []const u8, prefix: []const u8, meta_index: *const MetaIndex, referenced: *std.AutoHashMap(ContentHash, void)) !void {
-    var dir = std.Io.Dir.cwd().openDir(app_io, dir_path, .{ .iterate = true }) catch return;
-    defer dir.close(app_io);
+/// Reference counts of CAS blobs, and the unreferenced blobs waiting to be
+/// collected. Counts come from the metadata log's entries and are rebuilt
+/// with it at startup; the waiting blobs are saved in its checkpoint.
+///
+/// Entries with inline data don't reference a blob and aren't counted.
+/// A blob joins the queue when its count drops to zero, or when it is
+/// stored while unreferenced (a blob that arrives before its metadata, or
+/// whose PUT failed). Storing it again restarts its grace period.
+pub const BlobRefs = struct {
+    allocator: Allocator,
+    mutex: std.Io.Mutex = .init,
+    counts: std.AutoHashMapUnmanaged(ContentHash, u32) = .empty,
+    unreferenced: std.AutoHashMapUnmanaged(ContentHash, Candidate) = .empty, // -> its current queue entry
+    queue: std.ArrayListUnmanaged(Candidate) = .empty, // by `since`, from `head`
+    head: usize = 0,
+    next_seq: u64 = 0,
 
-    var iter = dir.iterate();
-    while (try iter.next(app_io)) |entry| {
-        const full_name = if (prefix.len > 0)
-            try std.fmt.allocPrint(allocator, "{s}/{s}", .{ prefix, entry.name })
-        else
-            try allocator.dupe(u8, entry.name);
-        defer allocator.free(full_name);
-
-        if (entry.kind == .directory) {
-            const subdir = try std.fs.path.join(allocator, &.{ dir_path, entry.name });
-            defer allocator.free(subdir);
-            try collectHashesFromDir(allocator, subdir, bucket, full_name, meta_index, referenced);
-        } else if (std.mem.endsWith(u8, entry.name, ".meta")) {
-            // Read hash from metadata file (even tombstones - they still reference content)
-            const key = full_name[0 .. full_name.len - 5]; // Remove .meta
-            const path = try meta_index.metaPath(allocator, bucket, key);
-            defer allocator.free(path);
+    /// Stale once `unreferenced` no longer maps its hash to its `seq`
+    const Candidate = struct { hash: ContentHash, since: i64, seq: u64 };
 
-            var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch continue;
-            defer file.close(app_io);
+    pub fn init(allocator: Allocator) BlobRefs {
+        return .{ .allocator = allocator };
+    }
 
-            var buf: [128]u8 = undefined;
-            const bytes_read = file.readPositionalAll(app_io, &buf, 0) catch continue;
-            const content = buf[0..bytes_read];
+    pub fn deinit(self: *BlobRefs) void {
+        self.counts.deinit(self.allocator);
+        self.unreferenced.deinit(self.allocator);
+        self.queue.deinit(self.allocator);
+    }
 
-            var lines = std.mem.splitScalar(u8, content, '\n');
-            const hash_hex = lines.next() orelse continue;
+    pub fn lock(self: *BlobRefs) void {
+        self.mutex.lockUncancelable(app_io);
+    }
 
-            if (hash_hex.len != 40) continue;
-            var hash: ContentHash = undefined;
-            _ = std.fmt.hexToBytes(&hash, hash_hex) catch continue;
+    pub fn unlock(self: *BlobRefs) void {
+        self.mutex.unlock(app_io);
+    }
 
-            try referenced.put(hash, {});
+    /// One more entry references `hash`
+    pub fn acquire(self: *BlobRefs, hash: ContentHash) !void {
+        self.lock();
+        defer self.unlock();
+        const count = try self.counts.getOrPut(self.allocator, hash);
+        if (!count.found_existing) {
+            count.value_ptr.* = 0;
+            _ = self.unreferenced.remove(hash);
+        }
+        count.value_ptr.* += 1;
+    }
+
+    /// One entry fewer references `hash`
+    pub fn release(self: *BlobRefs, hash: ContentHash) void {
+        self.lock();
+        defer self.unlock();
+        const count = self.counts.getPtr(hash) orelse return;
+        count.* -= 1;
+        if (count.* > 0) return;
+        _ = self.counts.remove(hash);
+        self.enqueue(hash, std.Io.Clock.real.now(app_io).toSeconds());
+    }
+
+    /// `hash` was just stored. Unless something references it, it may be
+    /// collected once the grace period has passed from now.
+    pub fn touch(self: *BlobRefs, hash: ContentHash) void {
+        self.lock();
+        defer self.unlock();
+        if (self.counts.contains(hash)) return;
+        self.enqueue(hash, std.Io.Clock.real.now(app_io).toSeconds());
+    }
+
+    /// Without memory for the queue the blob is only leaked, never lost
+    fn enqueue(self: *BlobRefs, hash: ContentHash, since: i64) void {
+        self.queue.ensureUnusedCapacity(self.allocator, 1) catch return;
+        const c = Candidate{ .hash = hash, .since = since, .seq = self.next_seq };
+        self.unreferenced.put(self.allocator, hash, c) catch return;
+        self.next_seq += 1;
+        self.queue.appendAssumeCapacity(c);
+    }
+
+    fn isCurrent(self: *const BlobRefs, c: Candidate) bool {
+        const current = self.unreferenced.get(c.hash) orelse return false;
+        return current.seq == c.seq;
+    }
+
+    /// The next unreferenced blob that has been so since `cutoff` or
+    /// earlier, now taken off the queue. The caller holds the lock.
+    pub fn nextDue(self: *BlobRefs, cutoff: i64) ?ContentHash {
+        defer if (self.head > 1024 and self.head * 2 > self.queue.items.len) {
+            const rest = self.queue.items.len - self.head;
+            std.mem.copyForwards(Candidate, self.queue.items[0..rest], self.queue.items[self.head..]);
+            self.queue.shrinkRetainingCapacity(rest);
+            self.head = 0;
+        };
+        while (self.head < self.queue.items.len) {
+            const c = self.queue.items[self.head];
+            if (!self.isCurrent(c)) {
+                self.head += 1;
+                continue;
+            }
+            if (c.since > cutoff) return null;
+            self.head += 1;
+            _ = self.unreferenced.remove(c.hash);
+            return c.hash;
         }
+        return null;
+    }
+
+    /// Queue a blob saved as waiting in a checkpoint
+    pub fn restore(self: *BlobRefs, hash: ContentHash, since: i64) void {
+        self.lock();
+        defer self.unlock();
+        if (self.counts.contains(hash)) return;
+        self.enqueue(hash, since);
     }
-}
+
+    /// Forget everything, before the metadata log is loaded again
+    fn reset(self: *BlobRefs) void {
+        self.lock();
+        defer self.unlock();
+        self.counts.clearRetainingCapacity();
+        self.unreferenced.clearRetainingCapacity();
+        self.queue.clearRetainingCapacity();
+        self.head = 0;
+    }
+};
 
 /// Metadata Index - maps S3 paths to content hashes
 /// Supports tombstones for delete propagation and inline storage for small objects
-const MetaIndex = struct {
+///
+/// Entries are kept by a MetaLog. Peers exchange them in a text form
+/// (`hash\nsize\ncreated\ndeleted\n[inline data]`, see readRaw/writeRaw).
+pub const MetaIndex = struct {
     data_dir: []const u8,
+    committer: *Committer,
+    log: *MetaLog,
 
-    const ObjectMeta = struct {
+    pub const ObjectMeta = struct {
         hash: ContentHash,
         size: u64,
         created: i64,
         deleted: i64, // 0 = not deleted, >0 = tombstone timestamp
         inline_data: ?[]const u8, // For small objects (<= INLINE_THRESHOLD)
-    };
-
-    /// Store metadata for an S3 object (with optional inline data for small objects)
-    pub fn put(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8, hash: ContentHash, size: u64) !void {
-        try self.putWithData(allocator, bucket, key, hash, size, null);
-    }
+        manifest: ?[]const u8 = null, // For objects stored in chunks (> CHUNK_SIZE), see Manifest
 
-    /// Store metadata with optional inline data
-    pub fn putWithData(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8, hash: ContentHash, size: u64, inline_data: ?[]const u8) !void {
-        const path = try self.metaPath(allocator, bucket, key);
-        defer allocator.free(path);
+        /// What both forms of an entry keep after its fixed fields
+        fn payload(self: ObjectMeta) ?[]const u8 {
+            return self.inline_data orelse self.manifest;
+        }
 
-        // Create parent directories
-        if (std.fs.path.dirname(path)) |dir| {
-            std.Io.Dir.cwd().createDirPath(app_io, dir) catch {};
+        /// Put bytes read back from an entry where they belong. Inline data
+        /// is always the whole object and a manifest never is.
+        fn setPayload(self: *ObjectMeta, bytes: ?[]const u8) void {
+            const data = bytes orelse return;
+            if (data.len == self.size) self.inline_data = data else self.manifest = data;
         }
+    };
 
-        var file = try std.Io.Dir.cwd().createFile(app_io, path, .{});
-        defer file.close(app_io);
+    /// Store metadata for an S3 object (with optional inline data for small objects)
+    pub fn put(self: *const MetaIndex, bucket: []const u8, key: []const u8, hash: ContentHash, size: u64) !void {
+        try self.putWithData(bucket, key, hash, size, null);
+    }
 
-        // Format: hex_hash\nsize\ncreated\ndeleted\n[inline_data_base64]
-        var hash_hex: [40]u8 = undefined;
-        bytesToHex(&hash, &hash_hex);
+    /// Store metadata for an object stored in chunks, listed by `manifest`
+    pub fn putChunked(self: *const MetaIndex, bucket: []const u8, key: []const u8, hash: ContentHash, size: u64, manifest: []const u8) !void {
         const created = std.Io.Clock.real.now(app_io).toSeconds();
+        try self.log.put(bucket, key, .{ .hash = hash, .size = size, .created = created, .deleted = 0, .inline_data = null, .manifest = manifest });
+    }
 
-        var buf: [128]u8 = undefined;
-        const header = std.fmt.bufPrint(&buf, "{s}\n{d}\n{d}\n0\n", .{ hash_hex, size, created }) catch unreachable;
-        try file.writeStreamingAll(app_io, header);
-
-        // Write inline data if provided
-        if (inline_data) |data| {
-            try file.writeStreamingAll(app_io, data);
-        }
+    /// Store metadata with optional inline data
+    pub fn putWithData(self: *const MetaIndex, bucket: []const u8, key: []const u8, hash: ContentHash, size: u64, inline_data: ?[]const u8) !void {
+        const created = std.Io.Clock.real.now(app_io).toSeconds();
+        try self.log.put(bucket, key, .{ .hash = hash, .size = size, .created = created, .deleted = 0, .inline_data = inline_data });
     }
 
     /// Get metadata for an S3 object (returns null for tombstones)
     pub fn get(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) !?struct { hash: ContentHash, size: u64 } {
         const meta = try self.getFull(allocator, bucket, key) orelse return null;
-        if (meta.inline_data) |data| allocator.free(data);
+        if (meta.payload()) |data| allocator.free(data);
         return .{ .hash = meta.hash, .size = meta.size };
     }
 
     /// Get full metadata including inline data
     pub fn getFull(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) !?ObjectMeta {
-        const path = try self.metaPath(allocator, bucket, key);
-        defer allocator.free(path);
-
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return null;
-        defer file.close(app_io);
-
-        const stat = try file.stat(app_io);
-        const content = try allocator.alloc(u8, stat.size);
-        defer allocator.free(content);
-        _ = try file.readPositionalAll(app_io, content, 0);
-
-        // Parse: hex_hash\nsize\ncreated\ndeleted\n[inline_data]
-        var lines = std.mem.splitScalar(u8, content, '\n');
-        const hash_hex = lines.next() orelse return null;
-        const size_str = lines.next() orelse return null;
-        const created_str = lines.next() orelse return null;
-        const deleted_str = lines.next() orelse return null;
-
-        if (hash_hex.len != 40) return null;
-        var hash: ContentHash = undefined;
-        _ = std.fmt.hexToBytes(&hash, hash_hex) catch return null;
-
-        const size = std.fmt.parseInt(u64, size_str, 10) catch return null;
-        const created = std.fmt.parseInt(i64, created_str, 10) catch return null;
-        const deleted = std.fmt.parseInt(i64, deleted_str, 10) catch 0;
-
+        const meta = try self.log.get(allocator, bucket, key) orelse return null;
         // Check tombstone - return null if deleted
-        if (deleted > 0) return null;
-
-        // Check for inline data after the 4th newline
-        var header_end: usize = 0;
-        var newline_count: usize = 0;
-        for (content, 0..) |c, i| {
-            if (c == '\n') {
-                newline_count += 1;
-                if (newline_count == 4) {
-                    header_end = i + 1;
-                    break;
-                }
-            }
-        }
-
-        var inline_data: ?[]const u8 = null;
-        if (header_end < content.len) {
-            inline_data = try allocator.dupe(u8, content[header_end..]);
+        if (meta.deleted > 0) {
+            if (meta.payload()) |data| allocator.free(data);
+            return null;
         }
+        return meta;
+    }
 
-        return .{
-            .hash = hash,
-            .size = size,
-            .created = created,
-            .deleted = 0,
-            .inline_data = inline_data,
-        };
+    /// Metadata without inline data, for HEAD (returns null for tombstones)
+    pub fn stat(self: *const MetaIndex, bucket: []const u8, key: []const u8) ?ObjectMeta {
+        const meta = self.log.stat(bucket, key) orelse return null;
+        if (meta.deleted > 0) return null;
+        return meta;
     }
 
-    /// Read the raw meta file content (including tombstones) for replication
+    /// The entry (including tombstones) in its text form, for replication
     pub fn readRaw(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) !?[]u8 {
-        const path = try self.metaPath(allocator, bucket, key);
-        defer allocator.free(path);
-
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return null;
-        defer file.close(app_io);
-
-        const stat = try file.stat(app_io);
-        const content = try allocator.alloc(u8, stat.size);
-        errdefer allocator.free(content);
-        _ = try file.readPositionalAll(app_io, content, 0);
-        return content;
+        const meta = try self.log.get(allocator, bucket, key) orelse return null;
+        defer if (meta.payload()) |data| allocator.free(data);
+        return try formatMetaContent(allocator, meta);
     }
 
-    /// Write raw meta file content verbatim, preserving origin timestamps
-    pub fn writeRaw(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8, content: []const u8) !void {
-        const path = try self.metaPath(allocator, bucket, key);
-        defer allocator.free(path);
-
-        if (std.fs.path.dirname(path)) |dir| {
-            std.Io.Dir.cwd().createDirPath(app_io, dir) catch {};
-        }
-
-        var file = try std.Io.Dir.cwd().createFile(app_io, path, .{});
-        defer file.close(app_io);
-        try file.writeStreamingAll(app_io, content);
+    /// Store an entry received in text form, preserving origin timestamps
+    pub fn writeRaw(self: *const MetaIndex, bucket: []const u8, key: []const u8, content: []const u8) !void {
+        const meta = parseMetaContent(content) orelse return error.InvalidMeta;
+        try self.log.put(bucket, key, meta);
     }
 
     /// Delete metadata by writing a tombstone (prevents resurrection during sync)
-    pub fn delete(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) void {
-        self.writeTombstone(allocator, bucket, key) catch {
-            // Fallback: just delete the file if tombstone fails
-            const path = self.metaPath(allocator, bucket, key) catch return;
-            defer allocator.free(path);
-            std.Io.Dir.cwd().deleteFile(app_io, path) catch {};
-        };
-    }
-
-    /// Write tombstone marker (preserves hash for GC reference counting)
-    fn writeTombstone(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) !void {
-        const path = try self.metaPath(allocator, bucket, key);
-        defer allocator.free(path);
-
-        // Read existing metadata to preserve hash
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return;
-        var buf: [128]u8 = undefined;
-        const bytes_read = file.readPositionalAll(app_io, &buf, 0) catch return;
-        file.close(app_io);
-        const content = buf[0..bytes_read];
-
-        var lines = std.mem.splitScalar(u8, content, '\n');
-        const hash_hex = lines.next() orelse return;
-        const size_str = lines.next() orelse return;
-        const created_str = lines.next() orelse return;
-
-        // Rewrite with tombstone timestamp
-        var out_file = try std.Io.Dir.cwd().createFile(app_io, path, .{});
-        defer out_file.close(app_io);
-
+    pub fn delete(self: *const MetaIndex, bucket: []const u8, key: []const u8) void {
         const deleted = std.Io.Clock.real.now(app_io).toSeconds();
-        var out_buf: [128]u8 = undefined;
-        const new_content = std.fmt.bufPrint(&out_buf, "{s}\n{s}\n{s}\n{d}\n", .{ hash_hex, size_str, created_str, deleted }) catch unreachable;
-        try out_file.writeStreamingAll(app_io, new_content);
+        self.log.tombstone(bucket, key, deleted) catch |err| {
+            std.log.warn("tombstone for {s}/{s} failed: {}", .{ bucket, key, err });
+        };
     }
 
     /// Check if entry is a tombstone (for cleanup)
     pub fn isTombstone(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) bool {
-        const path = self.metaPath(allocator, bucket, key) catch return false;
-        defer allocator.free(path);
-
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return false;
-        defer file.close(app_io);
+        const meta = (self.log.get(allocator, bucket, key) catch return false) orelse return false;
+        if (meta.payload()) |data| allocator.free(data);
+        return meta.deleted > 0;
+    }
 
-        var buf: [128]u8 = undefined;
-        const bytes_read = file.readPositionalAll(app_io, &buf, 0) catch return false;
-        const content = buf[0..bytes_read];
+    /// Remove tombstones older than TOMBSTONE_TTL_SECS, a batch at a time
+    /// so requests aren't held up. Returns how many were removed.
+    pub fn cleanupTombstones(self: *const MetaIndex) !usize {
+        const cutoff = std.Io.Clock.real.now(app_io).toSeconds() - TOMBSTONE_TTL_SECS;
+        var total: usize = 0;
+        while (true) {
+            const removed = try self.log.expireTombstones(cutoff, TOMBSTONE_EXPIRE_BATCH);
+            total += removed;
+            if (removed < TOMBSTONE_EXPIRE_BATCH) break;
+        }
+        return total;
+    }
 
-        var lines = std.mem.splitScalar(u8, content, '\n');
-        _ = lines.next(); // hash
-        _ = lines.next(); // size
-        _ = lines.next(); // created
-        const deleted_str = lines.next() orelse return false;
+    /// Forget every entry of a deleted bucket
+    pub fn dropBucket(self: *const MetaIndex, bucket: []const u8) void {
+        self.log.dropBucket(bucket) catch |err| {
+            std.log.warn("dropping metadata of bucket {s} failed: {}", .{ bucket, err });
+        };
+    }
+};
 
-        const deleted = std.fmt.parseInt(i64, deleted_str, 10) catch return false;
-        return deleted > 0;
+/// Digests of the metadata namespace for anti-entropy: a Merkle tree over
+/// hash ranges. Every entry falls in one of LEAVES leaves by the hash of its
+/// bucket and key, and a leaf's digest is the XOR of its entries' digests.
+/// A node's digest is the XOR of its children's, so updating an entry is
+/// one XOR and any node is computed from the leaves when asked for. Two
+/// nodes holding the same entries have the same tree, so peers compare
+/// roots and walk down only where they differ.
+pub const MetaTree = struct {
+    leaves: []u64,
+
+    pub const FANOUT = 16;
+    pub const DEPTH = 4; // levels below the root
+    pub const LEAVES = std.math.pow(usize, FANOUT, DEPTH);
+    pub const LeafSet = std.StaticBitSet(LEAVES);
+
+    pub fn init(allocator: Allocator) !MetaTree {
+        const leaves = try allocator.alloc(u64, LEAVES);
+        @memset(leaves, 0);
+        return .{ .leaves = leaves };
+    }
+
+    pub fn deinit(self: *MetaTree, allocator: Allocator) void {
+        allocator.free(self.leaves);
+    }
+
+    /// The leaf an entry for `key` falls in, on every node
+    pub fn leafOf(bucket: []const u8, key: []const u8) u16 {
+        var h = std.hash.Wyhash.init(0x6c656166);
+        h.update(bucket);
+        h.update(&.{0});
+        h.update(key);
+        return @intCast(h.final() % LEAVES);
+    }
+
+    /// What identifies an entry's version: nodes that agree on these agree
+    /// on the entry, inline data and manifest included, as both are named
+    /// by the hash
+    pub fn digest(bucket: []const u8, key: []const u8, hash: ContentHash, size: u64, created: i64, deleted: i64) u64 {
+        var fields: [20 + 8 * 3]u8 = undefined;
+        fields[0..20].* = hash;
+        std.mem.writeInt(u64, fields[20..28], size, .little);
+        std.mem.writeInt(i64, fields[28..36], created, .little);
+        std.mem.writeInt(i64, fields[36..44], deleted, .little);
+        var h = std.hash.Wyhash.init(0x656e7472);
+        h.update(bucket);
+        h.update(&.{0});
+        h.update(key);
+        h.update(&fields);
+        return h.final();
+    }
+
+    /// Add an entry's digest to its leaf, or take it out again
+    pub fn toggle(self: *MetaTree, leaf: u16, d: u64) void {
+        self.leaves[leaf] ^= d;
+    }
+
+    /// Digest of node `index` at `depth` (0 is the root, DEPTH a leaf)
+    pub fn node(self: *const MetaTree, depth: usize, index: usize) u64 {
+        const span = LEAVES / std.math.pow(usize, FANOUT, depth);
+        var d: u64 = 0;
+        for (self.leaves[index * span ..][0..span]) |leaf| d ^= leaf;
+        return d;
     }
+};
 
-    /// Cleanup expired tombstones
-    pub fn cleanupTombstones(self: *const MetaIndex, allocator: Allocator) !void {
-        const now = std.Io.Clock.real.now(app_io).toSeconds();
-        const index_path = try std.fs.path.join(allocator, &.{ self.data_dir, ".index" });
-        defer allocator.free(index_path);
+/// Log-structured store behind MetaIndex, under `<data_dir>/.meta/`:
+///
+///   NNNNNNNN.seg  append-only segments of binary records; appends go to
+///                 the newest, and a new one is started past
+///                 META_SEGMENT_SIZE
+///   checkpoint    the in-memory index as of a point in the log
+///
+/// Every entry, tombstones included, is held in memory along with where its
+/// record lives, so a lookup is a hash lookup and a write is one append.
+/// Inline data stays on disk and is read back with a single pread.
+///
+/// At startup the checkpoint is loaded and only the log after it is
+/// replayed. Replaying every segment from the start gives the same result,
+/// so a missing or stale checkpoint only costs time. Records carry a CRC,
+/// and a torn record at the end of the log is cut off. maintain(), run in
+/// the background, writes a checkpoint as the log grows. Once most of the
+/// log is overwritten records, it compacts: live records are copied into a
+/// new segment, and the old segments are deleted oldest first. Both take
+/// the lock only to snapshot the entries and to switch over, not for the
+/// file I/O in between.
+pub const MetaLog = struct {
+    allocator: Allocator,
+    data_dir: []const u8,
+    dir: []const u8, // <data_dir>/.meta
+    committer: *Committer,
+    refs: *BlobRefs, // counts follow the entries
+    mutex: std.Io.Mutex = .init,
+    synced: std.Io.Condition = .init, // a segment's `syncing` dropped to 0
+    buckets: std.StringHashMapUnmanaged(Keys) = .empty,
+    ordered: bool = false, // buckets' `order` is kept up to date; off while loading
+    segments: std.ArrayListUnmanaged(Segment) = .empty, // oldest first; appends go to the last
+    live_bytes: u64 = 0, // record bytes an entry still points at
+    total_bytes: u64 = 0, // record bytes in all segments
+    since_checkpoint: u64 = 0, // bytes appended since the last checkpoint
+    scratch: std.ArrayListUnmanaged(u8) = .empty, // record being encoded
+    cache: std.DoublyLinkedList = .{}, // inline data of recently read entries, most recent first
+    cache_count: usize = 0,
+    cache_bytes: usize = 0,
+    cache_hits: u64 = 0,
+    cache_misses: u64 = 0,
+    expiry: std.PriorityQueue(Expiry, void, Expiry.order) = .empty, // one per tombstone, oldest first; may be stale
+    tombstones: usize = 0,
+    tombstones_expired: u64 = 0,
+    tree: MetaTree = .{ .leaves = &.{} }, // follows the entries
+
+    /// A bucket's entries, and its keys in order for LIST. Tombstones stay
+    /// in the order until they expire; LIST skips them.
+    const Keys = struct {
+        entries: std.StringHashMapUnmanaged(Entry) = .empty,
+        order: std.ArrayListUnmanaged([]const u8) = .empty, // sorted; slices of the entries' keys
+        pending: std.ArrayListUnmanaged([]const u8) = .empty, // added since `order` was last merged
+
+        /// Merge `pending` into `order`
+        fn settle(self: *Keys, allocator: Allocator) !void {
+            if (self.pending.items.len == 0) return;
+            std.mem.sort([]const u8, self.pending.items, {}, keyLessThan);
+            var i = self.order.items.len;
+            var j = self.pending.items.len;
+            try self.order.resize(allocator, i + j);
+            // From the back, so nothing is overwritten before it is moved
+            var k = self.order.items.len;
+            while (j > 0) {
+                k -= 1;
+                if (i > 0 and keyLessThan({}, self.pending.items[j - 1], self.order.items[i - 1])) {
+                    i -= 1;
+                    self.order.items[k] = self.order.items[i];
+                } else {
+                    j -= 1;
+                    self.order.items[k] = self.pending.items[j];
+                }
+            }
+            self.pending.clearRetainingCapacity();
+        }
 
-        var dir = std.Io.Dir.cwd().openDir(app_io, index_path, .{ .iterate = true }) catch return;
-        defer dir.close(app_io);
+        /// Take `sorted`, keys in order, out of the order in one pass
+        fn unlistAll(self: *Keys, allocator: Allocator, sorted: []const []const u8) !void {
+            try self.settle(allocator);
+            const items = self.order.items;
+            var kept: usize = 0;
+            var read: usize = 0;
+            for (sorted) |key| {
+                const at = read + std.sort.lowerBound([]const u8, items[read..], key, keyOrder);
+                if (at == items.len or !std.mem.eql(u8, items[at], key)) continue;
+                std.mem.copyForwards([]const u8, items[kept..], items[read..at]);
+                kept += at - read;
+                read = at + 1;
+            }
+            std.mem.copyForwards([]const u8, items[kept..], items[read..]);
+            self.order.shrinkRetainingCapacity(kept + items.len - read);
+        }
 
-        var iter = dir.iterate();
-        while (try iter.next(app_io)) |entry| {
-            if (entry.kind == .directory) {
-                try self.cleanupBucketTombstones(allocator, entry.name, now);
+        /// Take `key` out of the order
+        fn unlist(self: *Keys, key: []const u8) void {
+            const at = std.sort.lowerBound([]const u8, self.order.items, key, keyOrder);
+            if (at < self.order.items.len and std.mem.eql(u8, self.order.items[at], key)) {
+                _ = self.order.orderedRemove(at);
+                return;
+            }
+            for (self.pending.items, 0..) |pending, i| {
+                if (std.mem.eql(u8, pending, key)) {
+                    _ = self.pending.swapRemove(i);
+                    return;
+                }
             }
         }
-    }
 
-    fn cleanupBucketTombstones(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, now: i64) !void {
-        const bucket_path = try std.fs.path.join(allocator, &.{ self.data_dir, ".index", bucket });
-        defer allocator.free(bucket_path);
+        fn deinit(self: *Keys, allocator: Allocator) void {
+            self.entries.deinit(allocator);
+            self.order.deinit(allocator);
+            self.pending.deinit(allocator);
+        }
 
-        self.cleanupDirTombstones(allocator, bucket_path, bucket, "", now) catch {};
-    }
+        fn keyLessThan(_: void, a: []const u8, b: []const u8) bool {
+            return std.mem.order(u8, a, b) == .lt;
+        }
 
-    fn cleanupDirTombstones(self: *const MetaIndex, allocator: Allocator, dir_path: []const u8, bucket: []const u8, prefix: []const u8, now: i64) !void {
-        var dir = std.Io.Dir.cwd().openDir(app_io, dir_path, .{ .iterate = true }) catch return;
-        defer dir.close(app_io);
+        fn keyOrder(key: []const u8, item: []const u8) std.math.Order {
+            return std.mem.order(u8, key, item);
+        }
+    };
 
-        var iter = dir.iterate();
-        while (try iter.next(app_io)) |entry| {
-            const full_name = if (prefix.len > 0)
-                try std.fmt.allocPrint(allocator, "{s}/{s}", .{ prefix, entry.name })
-            else
-                try allocator.dupe(u8, entry.name);
-            defer allocator.free(full_name);
+    const Segment = struct {
+        id: u32,
+        file: std.Io.File,
+        size: u64,
+        syncing: u32 = 0, // puts fsyncing it outside the lock; it stays open until they finish
+    };
 
-            if (entry.kind == .directory) {
-                const subdir = try std.fs.path.join(allocator, &.{ dir_path, entry.name });
-                defer allocator.free(subdir);
-                try self.cleanupDirTombstones(allocator, subdir, bucket, full_name, now);
-            } else if (std.mem.endsWith(u8, entry.name, ".meta")) {
-                // Check if expired tombstone
-                const key = full_name[0 .. full_name.len - 5]; // Remove .meta
-                if (self.getTombstoneAge(allocator, bucket, key, now)) |age| {
-                    if (age > TOMBSTONE_TTL_SECS) {
-                        const path = try self.metaPath(allocator, bucket, key);
-                        defer allocator.free(path);
-                        std.Io.Dir.cwd().deleteFile(app_io, path) catch {};
-                    }
+    /// A record to copy when compacting
+    const Copy = struct { segment: u32, offset: u64, len: u32 };
+
+    /// A key's latest record: what it says, and where it is
+    const Entry = struct {
+        hash: ContentHash,
+        size: u64,
+        created: i64,
+        deleted: i64,
+        segment: u32,
+        offset: u64, // of the record in its segment
+        len: u32, // of the whole record
+        inline_len: u32, // inline data or manifest, at the end of the record
+        cached: ?*Cached = null, // inline data, if in the cache
+        manifest: ?[*]const u8 = null, // of a chunked entry, `inline_len` bytes, always in memory
+        leaf: u16 = 0, // in the anti-entropy tree, set with the entry
+    };
+
+    /// Inline data kept in memory so hot small objects skip the pread.
+    /// `bucket` and `key` are the map's own, to find the entry on eviction.
+    const Cached = struct {
+        node: std.DoublyLinkedList.Node = .{},
+        bucket: []const u8,
+        key: []const u8,
+        data: []u8,
+    };
+
+    pub const CacheStats = struct { hits: u64, misses: u64, entries: usize, bytes: usize };
+
+    /// When a tombstone expires. Stale once its key has been overwritten or
+    /// removed, which is checked when it comes up rather than tracked.
+    const Expiry = struct {
+        deleted: i64,
+        name: []u8, // bucket followed by key
+        bucket_len: usize,
+
+        fn init(allocator: Allocator, bucket: []const u8, key: []const u8, deleted: i64) !Expiry {
+            const name = try allocator.alloc(u8, bucket.len + key.len);
+            @memcpy(name[0..bucket.len], bucket);
+            @memcpy(name[bucket.len..], key);
+            return .{ .deleted = deleted, .name = name, .bucket_len = bucket.len };
+        }
+
+        fn bucketName(self: Expiry) []const u8 {
+            return self.name[0..self.bucket_len];
+        }
+
+        fn keyName(self: Expiry) []const u8 {
+            return self.name[self.bucket_len..];
+        }
+
+        fn order(_: void, a: Expiry, b: Expiry) std.math.Order {
+            return std.math.order(a.deleted, b.deleted);
+        }
+
+        /// By bucket, then key
+        fn nameLessThan(_: void, a: Expiry, b: Expiry) bool {
+            return switch (std.mem.order(u8, a.bucketName(), b.bucketName())) {
+                .lt => true,
+                .gt => false,
+                .eq => std.mem.order(u8, a.keyName(), b.keyName()) == .lt,
+            };
+        }
+    };
+
+    pub const TombstoneStats = struct { count: usize, queued: usize, expired: u64 };
+
+    const Kind = enum(u8) { put = 'P', remove = 'R', drop_bucket = 'B' };
+
+    const Position = struct { segment: u32 = 0, offset: u64 = 0 };
+
+    const CHECKPOINT_MAGIC = "ZS3META2";
+    const MAX_RECORD = 1024 * 1024;
+
+    pub fn open(allocator: Allocator, data_dir: []const u8, committer: *Committer, refs: *BlobRefs) !MetaLog {
+        const dir = try std.fs.path.join(allocator, &.{ data_dir, ".meta" });
+        const tree = MetaTree.init(allocator) catch |err| {
+            allocator.free(dir);
+            return err;
+        };
+        var self = MetaLog{ .allocator = allocator, .data_dir = data_dir, .dir = dir, .committer = committer, .refs = refs, .tree = tree };
+        errdefer self.deinit();
+        try std.Io.Dir.cwd().createDirPath(app_io, dir);
+
+        // Segments, oldest first
+        var ids: std.ArrayListUnmanaged(u32) = .empty;
+        defer ids.deinit(allocator);
+        {
+            var d = try std.Io.Dir.cwd().openDir(app_io, dir, .{ .iterate = true });
+            defer d.close(app_io);
+            var iter = d.iterate();
+            while (try iter.next(app_io)) |entry| {
+                if (entry.kind != .file or !std.mem.endsWith(u8, entry.name, ".seg")) continue;
+                const id = std.fmt.parseInt(u32, entry.name[0 .. entry.name.len - 4], 10) catch continue;
+                try ids.append(allocator, id);
+            }
+        }
+        std.mem.sort(u32, ids.items, {}, std.sort.asc(u32));
+        for (ids.items) |id| {
+            const path = try self.segmentPath(allocator, id);
+            defer allocator.free(path);
+            const file = try std.Io.Dir.cwd().openFile(app_io, path, .{ .mode = .read_write });
+            errdefer file.close(app_io);
+            try self.segments.append(allocator, .{ .id = id, .file = file, .size = try file.length(app_io) });
+            self.total_bytes += self.segments.getLast().size;
+        }
+
+        const from = self.loadCheckpoint() catch |err| blk: {
+            if (err != error.FileNotFound) std.log.warn("metadata checkpoint unusable, replaying the log: {}", .{err});
+            self.clearEntries();
+            break :blk Position{};
+        };
+        try self.replay(from);
+        if (self.segments.items.len == 0) _ = try self.addSegment(1);
+        try self.buildOrder();
+        // Replay queues every tombstone in the log, removed ones included
+        self.purgeExpiries();
+
+        // One-shot import of the old one-file-per-key layout
+        const index_path = try std.fs.path.join(allocator, &.{ data_dir, ".index" });
+        defer allocator.free(index_path);
+        try self.migrate(index_path);
+        return self;
+    }
+
+    pub fn deinit(self: *MetaLog) void {
+        self.clearEntries();
+        self.buckets.deinit(self.allocator);
+        self.expiry.deinit(self.allocator);
+        for (self.segments.items) |seg| seg.file.close(app_io);
+        self.segments.deinit(self.allocator);
+        self.scratch.deinit(self.allocator);
+        self.tree.deinit(self.allocator);
+        self.allocator.free(self.dir);
+    }
+
+    fn lock(self: *MetaLog) void {
+        self.mutex.lockUncancelable(app_io);
+    }
+
+    fn unlock(self: *MetaLog) void {
+        self.mutex.unlock(app_io);
+    }
+
+    /// Store an entry for `key`, replacing any earlier one
+    pub fn put(self: *MetaLog, bucket: []const u8, key: []const u8, meta: MetaIndex.ObjectMeta) !void {
+        const seg = blk: {
+            self.lock();
+            defer self.unlock();
+            break :blk self.pin(try self.putLocked(bucket, key, meta));
+        };
+        try self.syncPinned(seg);
+    }
+
+    /// Turn a live entry into a tombstone, keeping its hash for GC
+    pub fn tombstone(self: *MetaLog, bucket: []const u8, key: []const u8, deleted: i64) !void {
+        const seg = blk: {
+            self.lock();
+            defer self.unlock();
+            const entry = self.find(bucket, key) orelse return;
+            // A chunked object's tombstone keeps its manifest, and so its
+            // chunks, as a whole object's keeps its blob
+            break :blk self.pin(try self.putLocked(bucket, key, .{
+                .hash = entry.hash,
+                .size = entry.size,
+                .created = entry.created,
+                .deleted = deleted,
+                .inline_data = null,
+                .manifest = if (manifestOf(entry)) |m| m.bytes else null,
+            }));
+        };
+        try self.syncPinned(seg);
+    }
+
+    /// A segment held open for a sync outside the lock
+    const Pinned = struct { id: u32, file: std.Io.File };
+
+    /// Keep `seg`, which a put was just appended to, open for syncPinned.
+    /// Null if puts aren't synced. The caller holds the lock.
+    fn pin(self: *MetaLog, seg: *Segment) ?Pinned {
+        if (self.committer.mode == .none) return null;
+        seg.syncing += 1;
+        return .{ .id = seg.id, .file = seg.file };
+    }
+
+    /// Keep a put as durable as the object it describes, without holding up
+    /// other writers, then let compaction close its segment
+    fn syncPinned(self: *MetaLog, pinned: ?Pinned) !void {
+        const p = pinned orelse return;
+        defer {
+            self.lock();
+            defer self.unlock();
+            const seg = self.segment(p.id).?;
+            seg.syncing -= 1;
+            if (seg.syncing == 0) self.synced.broadcast(app_io);
+        }
+        try p.file.sync(app_io);
+    }
+
+    fn putLocked(self: *MetaLog, bucket: []const u8, key: []const u8, meta: MetaIndex.ObjectMeta) !*Segment {
+        const inline_data = meta.payload() orelse "";
+        const record = try self.encode(.put, bucket, key, meta);
+        const seg, const offset = try self.append(record);
+        try self.setEntry(bucket, key, .{
+            .hash = meta.hash,
+            .size = meta.size,
+            .created = meta.created,
+            .deleted = meta.deleted,
+            .segment = seg.id,
+            .offset = offset,
+            .len = @intCast(record.len),
+            .inline_len = @intCast(inline_data.len),
+        }, meta.payload());
+        return seg;
+    }
+
+    /// An entry with its inline data or manifest copied out, or null if
+    /// there is none
+    pub fn get(self: *MetaLog, allocator: Allocator, bucket: []const u8, key: []const u8) !?MetaIndex.ObjectMeta {
+        self.lock();
+        defer self.unlock();
+        const b = self.buckets.getEntry(bucket) orelse return null;
+        const e = b.value_ptr.entries.getEntry(key) orelse return null;
+        const entry = e.value_ptr;
+        var meta = MetaIndex.ObjectMeta{
+            .hash = entry.hash,
+            .size = entry.size,
+            .created = entry.created,
+            .deleted = entry.deleted,
+            .inline_data = null,
+        };
+        if (entry.inline_len == 0) return meta;
+        if (manifestOf(entry.*)) |manifest| {
+            meta.setPayload(try allocator.dupe(u8, manifest.bytes));
+            return meta;
+        }
+
+        if (entry.cached) |cached| {
+            self.cache_hits += 1;
+            self.cache.remove(&cached.node);
+            self.cache.prepend(&cached.node);
+            meta.setPayload(try allocator.dupe(u8, cached.data));
+            return meta;
+        }
+        self.cache_misses += 1;
+        const data = (try self.readInline(allocator, entry.*)).?;
+        meta.setPayload(data);
+        self.cacheInline(b.key_ptr.*, e.key_ptr.*, entry, data) catch {};
+        return meta;
+    }
+
+    /// An entry without its inline data, which is never read
+    pub fn stat(self: *MetaLog, bucket: []const u8, key: []const u8) ?MetaIndex.ObjectMeta {
+        self.lock();
+        defer self.unlock();
+        const entry = self.find(bucket, key) orelse return null;
+        return .{ .hash = entry.hash, .size = entry.size, .created = entry.created, .deleted = entry.deleted, .inline_data = null };
+    }
+
+    pub fn cacheStats(self: *MetaLog) CacheStats {
+        self.lock();
+        defer self.unlock();
+        return .{ .hits = self.cache_hits, .misses = self.cache_misses, .entries = self.cache_count, .bytes = self.cache_bytes };
+    }
+
+    pub fn tombstoneStats(self: *MetaLog) TombstoneStats {
+        self.lock();
+        defer self.unlock();
+        return .{ .count = self.tombstones, .queued = self.expiry.count(), .expired = self.tombstones_expired };
+    }
+
+    fn find(self: *MetaLog, bucket: []const u8, key: []const u8) ?Entry {
+        const keys = self.buckets.getPtr(bucket) orelse return null;
+        return keys.entries.get(key);
+    }
+
+    /// Keep a copy of `entry`'s inline data, evicting the least recently
+    /// used entries past META_CACHE_ENTRIES or META_CACHE_BYTES
+    fn cacheInline(self: *MetaLog, bucket: []const u8, key: []const u8, entry: *Entry, data: []const u8) !void {
+        if (data.len > META_CACHE_BYTES) return;
+        const cached = try self.allocator.create(Cached);
+        errdefer self.allocator.destroy(cached);
+        cached.* = .{ .bucket = bucket, .key = key, .data = try self.allocator.dupe(u8, data) };
+        self.cache.prepend(&cached.node);
+        self.cache_count += 1;
+        self.cache_bytes += data.len;
+        entry.cached = cached;
+
+        while (self.cache_count > META_CACHE_ENTRIES or self.cache_bytes > META_CACHE_BYTES) {
+            const last: *Cached = @fieldParentPtr("node", self.cache.last.?);
+            const owner = self.buckets.getPtr(last.bucket).?.entries.getPtr(last.key).?;
+            self.uncache(owner);
+        }
+    }
+
+    /// Drop `entry`'s inline data from the cache, if it is there
+    fn uncache(self: *MetaLog, entry: *Entry) void {
+        const cached = entry.cached orelse return;
+        self.cache.remove(&cached.node);
+        self.cache_count -= 1;
+        self.cache_bytes -= cached.data.len;
+        self.allocator.free(cached.data);
+        self.allocator.destroy(cached);
+        entry.cached = null;
+    }
+
+    /// Inline data or manifest of `entry`, or null if it has none. The
+    /// caller holds the lock, which keeps the segment open.
+    fn readInline(self: *MetaLog, allocator: Allocator, entry: Entry) !?[]u8 {
+        if (entry.inline_len == 0) return null;
+        if (manifestOf(entry)) |manifest| return try allocator.dupe(u8, manifest.bytes);
+        const seg = self.segment(entry.segment) orelse return error.CorruptMetaLog;
+        const data = try allocator.alloc(u8, entry.inline_len);
+        errdefer allocator.free(data);
+        const at = entry.offset + entry.len - entry.inline_len;
+        if (try seg.file.readPositionalAll(app_io, data, at) != data.len) return error.CorruptMetaLog;
+        return data;
+    }
+
+    fn segment(self: *MetaLog, id: u32) ?*Segment {
+        for (self.segments.items) |*seg| {
+            if (seg.id == id) return seg;
+        }
+        return null;
+    }
+
+    /// Forget every entry of `bucket`
+    pub fn dropBucket(self: *MetaLog, bucket: []const u8) !void {
+        self.lock();
+        defer self.unlock();
+        if (!self.buckets.contains(bucket)) return;
+        _ = try self.append(try self.encode(.drop_bucket, bucket, "", null));
+        self.removeBucket(bucket);
+    }
+
+    /// Forget up to `limit` tombstones deleted before `cutoff`, oldest
+    /// first. Costs a heap pop per tombstone and one pass over the order of
+    /// each bucket they are in. Returns how many were forgotten.
+    pub fn expireTombstones(self: *MetaLog, cutoff: i64, limit: usize) !usize {
+        self.lock();
+        defer self.unlock();
+        self.dropStaleExpiries();
+
+        var due: std.ArrayListUnmanaged(Expiry) = .empty;
+        defer {
+            for (due.items) |x| self.allocator.free(x.name);
+            due.deinit(self.allocator);
+        }
+        var names: std.ArrayListUnmanaged([]const u8) = .empty;
+        defer names.deinit(self.allocator);
+        const most = @min(limit, self.tombstones);
+        try due.ensureTotalCapacity(self.allocator, most);
+        try names.ensureTotalCapacity(self.allocator, most);
+        while (self.expiry.peek()) |next| {
+            if (next.deleted >= cutoff) break;
+            if (self.isDue(next)) {
+                if (due.items.len == most) break;
+                due.appendAssumeCapacity(next);
+            } else {
+                self.allocator.free(next.name);
+            }
+            _ = self.expiry.pop();
+        }
+        std.mem.sort(Expiry, due.items, {}, Expiry.nameLessThan);
+
+        // What isn't done goes back; the heap still has room for it
+        var done: usize = 0;
+        errdefer {
+            for (due.items[done..]) |x| self.expiry.push(self.allocator, x) catch unreachable;
+            due.shrinkRetainingCapacity(done);
+        }
+        var removed: usize = 0;
+        while (done < due.items.len) {
+            const bucket = due.items[done].bucketName();
+            names.clearRetainingCapacity();
+            var end = done;
+            while (end < due.items.len and std.mem.eql(u8, due.items[end].bucketName(), bucket)) : (end += 1) {
+                const key = due.items[end].keyName();
+                // A key tombstoned twice at the same time is queued twice
+                if (names.items.len > 0 and std.mem.eql(u8, names.getLast(), key)) continue;
+                _ = try self.append(try self.encode(.remove, bucket, key, null));
+                names.appendAssumeCapacity(key);
+            }
+            const keys = self.buckets.getPtr(bucket).?;
+            try keys.unlistAll(self.allocator, names.items);
+            for (names.items) |key| self.forgetEntry(bucket, keys, key);
+            removed += names.items.len;
+            done = end;
+        }
+        self.tombstones_expired += removed;
+        return removed;
+    }
+
+    /// Whether `x` is still the expiry of its key's entry
+    fn isDue(self: *MetaLog, x: Expiry) bool {
+        const entry = self.find(x.bucketName(), x.keyName()) orelse return false;
+        return entry.deleted == x.deleted;
+    }
+
+    /// Free the expiries of tombstones that are gone, once they outnumber
+    /// the rest. The caller holds the lock.
+    fn dropStaleExpiries(self: *MetaLog) void {
+        if (self.expiry.count() > 2 * self.tombstones + 1024) self.purgeExpiries();
+    }
+
+    /// Free the expiries of tombstones that are gone
+    fn purgeExpiries(self: *MetaLog) void {
+        const items = self.expiry.items;
+        var kept: usize = 0;
+        for (items) |x| {
+            if (!self.isDue(x)) {
+                self.allocator.free(x.name);
+                continue;
+            }
+            items[kept] = x;
+            kept += 1;
+        }
+        // A sorted array is a valid heap
+        std.mem.sort(Expiry, items[0..kept], {}, expiryLessThan);
+        self.expiry.items.len = kept;
+    }
+
+    fn expiryLessThan(_: void, a: Expiry, b: Expiry) bool {
+        return a.deleted < b.deleted;
+    }
+
+    /// Up to `limit` live keys of `bucket` under `prefix`, from `from` on, in
+    /// order. Costs a binary search plus the keys returned and any
+    /// tombstones among them. Keys are allocated with `allocator`.
+    pub fn list(self: *MetaLog, allocator: Allocator, bucket: []const u8, prefix: []const u8, from: []const u8, limit: usize) ![]const KeyInfo {
+        self.lock();
+        defer self.unlock();
+        const keys = self.buckets.getPtr(bucket) orelse return &.{};
+        try keys.settle(self.allocator);
+
+        var page: std.ArrayListUnmanaged(KeyInfo) = .empty;
+        const start = if (std.mem.order(u8, from, prefix) == .gt) from else prefix;
+        var at = std.sort.lowerBound([]const u8, keys.order.items, start, Keys.keyOrder);
+        while (at < keys.order.items.len and page.items.len < limit) : (at += 1) {
+            const key = keys.order.items[at];
+            // Keys under the prefix are contiguous
+            if (!std.mem.startsWith(u8, key, prefix)) break;
+            const entry = keys.entries.get(key).?;
+            if (entry.deleted > 0) continue;
+            // The map's keys are only safe to use under the lock
+            try page.append(allocator, .{ .key = try allocator.dupe(u8, key), .size = entry.size, .mtime = entry.created });
+        }
+        return page.items;
+    }
+
+    /// Add the content hash of every entry, tombstones included, and of
+    /// every chunk of a chunked one, to `hashes`
+    pub fn collectHashes(self: *MetaLog, hashes: *std.AutoHashMap(ContentHash, void)) !void {
+        self.lock();
+        defer self.unlock();
+        var bucket_iter = self.buckets.valueIterator();
+        while (bucket_iter.next()) |keys| {
+            var key_iter = keys.entries.valueIterator();
+            while (key_iter.next()) |entry| {
+                try hashes.put(entry.hash, {});
+                const manifest = manifestOf(entry.*) orelse continue;
+                for (0..manifest.count()) |i| try hashes.put(manifest.chunk(i).hash, {});
+            }
+        }
+    }
+
+    /// Append every entry, tombstones included, or only those in the tree
+    /// leaves `leaves`, in the `/_zs3/index` wire format:
+    /// "<bucket>\n<key>\n<content_len>\n" + text content
+    pub fn dump(self: *MetaLog, allocator: Allocator, out: *std.ArrayListUnmanaged(u8), leaves: ?*const MetaTree.LeafSet) !void {
+        self.lock();
+        defer self.unlock();
+        var bucket_iter = self.buckets.iterator();
+        while (bucket_iter.next()) |b| {
+            var key_iter = b.value_ptr.entries.iterator();
+            while (key_iter.next()) |e| {
+                const entry = e.value_ptr.*;
+                if (leaves) |set| if (!set.isSet(entry.leaf)) continue;
+                const inline_data = try self.readInline(allocator, entry);
+                defer if (inline_data) |data| allocator.free(data);
+                var meta = MetaIndex.ObjectMeta{
+                    .hash = entry.hash,
+                    .size = entry.size,
+                    .created = entry.created,
+                    .deleted = entry.deleted,
+                    .inline_data = null,
+                };
+                meta.setPayload(inline_data);
+                const content = try formatMetaContent(allocator, meta);
+                defer allocator.free(content);
+
+                const frame = try std.fmt.allocPrint(allocator, "{s}\n{s}\n{d}\n", .{ b.key_ptr.*, e.key_ptr.*, content.len });
+                defer allocator.free(frame);
+                try out.appendSlice(allocator, frame);
+                try out.appendSlice(allocator, content);
+            }
+        }
+    }
+
+    /// Digests of the children of tree node `index` at `depth`
+    pub fn treeChildren(self: *MetaLog, depth: usize, index: usize) [MetaTree.FANOUT]u64 {
+        self.lock();
+        defer self.unlock();
+        var digests: [MetaTree.FANOUT]u64 = undefined;
+        for (&digests, 0..) |*d, i| d.* = self.tree.node(depth + 1, index * MetaTree.FANOUT + i);
+        return digests;
+    }
+
+    /// Checkpoint or compact, when due. Runs in the background, on one
+    /// thread.
+    pub fn maintain(self: *MetaLog) void {
+        const due: enum { none, compact, checkpoint } = blk: {
+            self.lock();
+            defer self.unlock();
+            if (self.total_bytes >= META_COMPACT_MIN and self.live_bytes * 2 < self.total_bytes) break :blk .compact;
+            if (self.since_checkpoint >= META_CHECKPOINT_BYTES) break :blk .checkpoint;
+            break :blk .none;
+        };
+        switch (due) {
+            .none => {},
+            .compact => self.compact() catch |err| std.log.warn("metadata compaction failed: {}", .{err}),
+            .checkpoint => self.writeCheckpoint() catch |err| std.log.warn("metadata checkpoint failed: {}", .{err}),
+        }
+    }
+
+    fn segmentPath(self: *const MetaLog, allocator: Allocator, id: u32) ![]const u8 {
+        var name: [16]u8 = undefined;
+        return std.fs.path.join(allocator, &.{ self.dir, try std.fmt.bufPrint(&name, "{d:0>8}.seg", .{id}) });
+    }
+
+    fn addSegment(self: *MetaLog, id: u32) !*Segment {
+        const path = try self.segmentPath(self.allocator, id);
+        defer self.allocator.free(path);
+        const file = try std.Io.Dir.cwd().createFile(app_io, path, .{ .read = true, .exclusive = true });
+        errdefer file.close(app_io);
+        try self.segments.append(self.allocator, .{ .id = id, .file = file, .size = 0 });
+        return &self.segments.items[self.segments.items.len - 1];
+    }
+
+    /// Write a record at the end of the log. Returns the segment and offset.
+    fn append(self: *MetaLog, record: []const u8) !struct { *Segment, u64 } {
+        var seg = &self.segments.items[self.segments.items.len - 1];
+        if (seg.size > 0 and seg.size + record.len > META_SEGMENT_SIZE) seg = try self.addSegment(seg.id + 1);
+        // A failed write is overwritten by the next append
+        try seg.file.writePositionalAll(app_io, record, seg.size);
+        const offset = seg.size;
+        seg.size += record.len;
+        self.total_bytes += record.len;
+        self.since_checkpoint += record.len;
+        return .{ seg, offset };
+    }
+
+    /// `<u32 crc><u32 len><u8 kind><u16 bucket len><bucket><u16 key len><key>`,
+    /// then for a put `<20-byte hash><u64 size><i64 created><i64 deleted>`
+    /// and the inline data or manifest. `len` counts what follows it and the CRC covers
+    /// everything after itself. Little-endian. The result is valid until the
+    /// next call.
+    fn encode(self: *MetaLog, kind: Kind, bucket: []const u8, key: []const u8, meta: ?MetaIndex.ObjectMeta) ![]const u8 {
+        const buf = &self.scratch;
+        buf.clearRetainingCapacity();
+        const inline_data = if (meta) |m| m.payload() orelse "" else "";
+        const len = 8 + 1 + 2 + bucket.len + 2 + key.len + (if (meta != null) 20 + 24 + inline_data.len else 0);
+        if (bucket.len > std.math.maxInt(u16) or key.len > std.math.maxInt(u16)) return error.NameTooLong;
+        if (len > MAX_RECORD) return error.MetaEntryTooLarge;
+        try buf.ensureTotalCapacity(self.allocator, len);
+
+        buf.appendNTimesAssumeCapacity(0, 8);
+        buf.appendAssumeCapacity(@intFromEnum(kind));
+        appendInt(buf, u16, @intCast(bucket.len));
+        buf.appendSliceAssumeCapacity(bucket);
+        appendInt(buf, u16, @intCast(key.len));
+        buf.appendSliceAssumeCapacity(key);
+        if (meta) |m| {
+            buf.appendSliceAssumeCapacity(&m.hash);
+            appendInt(buf, u64, m.size);
+            appendInt(buf, i64, m.created);
+            appendInt(buf, i64, m.deleted);
+            buf.appendSliceAssumeCapacity(inline_data);
+        }
+        std.mem.writeInt(u32, buf.items[4..8], @intCast(len - 8), .little);
+        std.mem.writeInt(u32, buf.items[0..4], std.hash.Crc32.hash(buf.items[4..]), .little);
+        return buf.items;
+    }
+
+    fn appendInt(buf: *std.ArrayListUnmanaged(u8), comptime T: type, value: T) void {
+        std.mem.writeInt(T, buf.addManyAsArrayAssumeCapacity(@sizeOf(T)), value, .little);
+    }
+
+    const Record = struct {
+        kind: Kind,
+        bucket: []const u8,
+        key: []const u8,
+        meta: MetaIndex.ObjectMeta,
+        inline_len: u32,
+    };
+
+    /// Parse the part of a record after its CRC and length
+    fn decode(body: []const u8) ?Record {
+        var pos: usize = 0;
+        const kind = std.enums.fromInt(Kind, (takeBytes(body, &pos, 1) orelse return null)[0]) orelse return null;
+        const bucket_len = std.mem.readInt(u16, (takeBytes(body, &pos, 2) orelse return null)[0..2], .little);
+        const bucket = takeBytes(body, &pos, bucket_len) orelse return null;
+        const key_len = std.mem.readInt(u16, (takeBytes(body, &pos, 2) orelse return null)[0..2], .little);
+        const key = takeBytes(body, &pos, key_len) orelse return null;
+        var record = Record{ .kind = kind, .bucket = bucket, .key = key, .meta = undefined, .inline_len = 0 };
+        if (kind != .put) return if (pos == body.len) record else null;
+
+        const fixed = takeBytes(body, &pos, 44) orelse return null;
+        const inline_data = body[pos..];
+        record.meta = .{
+            .hash = fixed[0..20].*,
+            .size = std.mem.readInt(u64, fixed[20..28], .little),
+            .created = std.mem.readInt(i64, fixed[28..36], .little),
+            .deleted = std.mem.readInt(i64, fixed[36..44], .little),
+            .inline_data = null,
+        };
+        record.meta.setPayload(if (inline_data.len > 0) inline_data else null);
+        record.inline_len = @intCast(inline_data.len);
+        return record;
+    }
+
+    fn takeBytes(buf: []const u8, pos: *usize, n: usize) ?[]const u8 {
+        if (buf.len - pos.* < n) return null;
+        defer pos.* += n;
+        return buf[pos.*..][0..n];
+    }
+
+    /// Apply the log from `from` on. A record that doesn't check out ends
+    /// the log: it is what a crash mid-append leaves behind.
+    fn replay(self: *MetaLog, from: Position) !void {
+        var body: std.ArrayListUnmanaged(u8) = .empty;
+        defer body.deinit(self.allocator);
+        const buf = try self.allocator.alloc(u8, SPOOL_CHUNK_SIZE);
+        defer self.allocator.free(buf);
+
+        var i: usize = 0;
+        while (i < self.segments.items.len) : (i += 1) {
+            const seg = &self.segments.items[i];
+            if (seg.id < from.segment) continue;
+            var pos: u64 = if (seg.id == from.segment) from.offset else 0;
+            var reader = seg.file.reader(app_io, buf);
+            try reader.seekTo(pos);
+            while (pos < seg.size) {
+                var header: [8]u8 = undefined;
+                reader.interface.readSliceAll(&header) catch break;
+                const len = std.mem.readInt(u32, header[4..8], .little);
+                if (len > MAX_RECORD) break;
+                try body.resize(self.allocator, len);
+                reader.interface.readSliceAll(body.items) catch break;
+                var crc = std.hash.Crc32.init();
+                crc.update(header[4..8]);
+                crc.update(body.items);
+                if (crc.final() != std.mem.readInt(u32, header[0..4], .little)) break;
+                const record = decode(body.items) orelse break;
+                try self.apply(seg.id, pos, 8 + len, record);
+                pos += 8 + len;
+            }
+            if (pos < seg.size) {
+                std.log.warn("metadata segment {d}: dropping {d} bytes after offset {d}", .{ seg.id, seg.size - pos, pos });
+                try seg.file.setLength(app_io, pos);
+                self.total_bytes -= seg.size - pos;
+                seg.size = pos;
+            }
+        }
+    }
+
+    fn apply(self: *MetaLog, seg: u32, offset: u64, len: u64, record: Record) !void {
+        switch (record.kind) {
+            .put => try self.setEntry(record.bucket, record.key, .{
+                .hash = record.meta.hash,
+                .size = record.meta.size,
+                .created = record.meta.created,
+                .deleted = record.meta.deleted,
+                .segment = seg,
+                .offset = offset,
+                .len = @intCast(len),
+                .inline_len = record.inline_len,
+            }, record.meta.payload()),
+            .remove => if (self.buckets.getPtr(record.bucket)) |keys| self.removeEntry(record.bucket, keys, record.key),
+            .drop_bucket => self.removeBucket(record.bucket),
+        }
+    }
+
+    /// Store `new` for `key`. `payload` is its inline data or manifest; a
+    /// manifest is copied into the entry.
+    fn setEntry(self: *MetaLog, bucket: []const u8, key: []const u8, new: Entry, payload: ?[]const u8) !void {
+        var entry = new;
+        if (isChunked(entry)) {
+            const bytes = payload orelse return error.CorruptMetaLog;
+            entry.manifest = (try self.allocator.dupe(u8, bytes[0..entry.inline_len])).ptr;
+        }
+        errdefer self.freeManifest(entry);
+        // Counted first, so an existing entry with the same hash doesn't
+        // briefly leave the blob unreferenced
+        try self.acquireRefs(entry);
+        errdefer self.releaseRefs(entry);
+        var expiry: ?Expiry = null;
+        if (entry.deleted > 0) {
+            try self.expiry.ensureUnusedCapacity(self.allocator, 1);
+            expiry = try Expiry.init(self.allocator, bucket, key, entry.deleted);
+        }
+        errdefer if (expiry) |x| self.allocator.free(x.name);
+        const b = try self.buckets.getOrPut(self.allocator, bucket);
+        if (!b.found_existing) {
+            b.key_ptr.* = self.allocator.dupe(u8, bucket) catch |err| {
+                self.buckets.removeByPtr(b.key_ptr);
+                return err;
+            };
+            b.value_ptr.* = .{};
+        }
+        const keys = b.value_ptr;
+        if (self.ordered) try keys.pending.ensureUnusedCapacity(self.allocator, 1);
+        const e = try keys.entries.getOrPut(self.allocator, key);
+        if (e.found_existing) {
+            self.live_bytes -= e.value_ptr.len;
+            self.uncache(e.value_ptr);
+            self.releaseRefs(e.value_ptr.*);
+            self.freeManifest(e.value_ptr.*);
+            self.untree(bucket, key, e.value_ptr.*);
+            if (e.value_ptr.deleted > 0) self.tombstones -= 1;
+        } else {
+            e.key_ptr.* = self.allocator.dupe(u8, key) catch |err| {
+                keys.entries.removeByPtr(e.key_ptr);
+                return err;
+            };
+            if (self.ordered) keys.pending.appendAssumeCapacity(e.key_ptr.*);
+        }
+        e.value_ptr.* = entry;
+        e.value_ptr.leaf = MetaTree.leafOf(bucket, key);
+        self.untree(bucket, key, e.value_ptr.*);
+        self.live_bytes += entry.len;
+        if (expiry) |x| {
+            self.expiry.push(self.allocator, x) catch unreachable;
+            self.tombstones += 1;
+        }
+    }
+
+    /// Whether `entry` holds a reference to a CAS blob
+    fn references(entry: Entry) bool {
+        return entry.inline_len == 0;
+    }
+
+    /// Whether `entry` is an object stored in chunks, with a manifest where
+    /// inline data would be. It references each of its chunks.
+    fn isChunked(entry: Entry) bool {
+        return entry.inline_len > 0 and entry.inline_len != entry.size;
+    }
+
+    /// The manifest of a chunked entry
+    fn manifestOf(entry: Entry) ?Manifest {
+        const bytes = entry.manifest orelse return null;
+        return .{ .bytes = bytes[0..entry.inline_len] };
+    }
+
+    fn freeManifest(self: *MetaLog, entry: Entry) void {
+        if (entry.manifest) |bytes| self.allocator.free(bytes[0..entry.inline_len]);
+    }
+
+    /// Count what `entry` references
+    fn acquireRefs(self: *MetaLog, entry: Entry) !void {
+        const manifest = manifestOf(entry) orelse {
+            if (references(entry)) try self.refs.acquire(entry.hash);
+            return;
+        };
+        for (0..manifest.count()) |i| {
+            self.refs.acquire(manifest.chunk(i).hash) catch |err| {
+                for (0..i) |j| self.refs.release(manifest.chunk(j).hash);
+                return err;
+            };
+        }
+    }
+
+    fn releaseRefs(self: *MetaLog, entry: Entry) void {
+        const manifest = manifestOf(entry) orelse {
+            if (references(entry)) self.refs.release(entry.hash);
+            return;
+        };
+        for (0..manifest.count()) |i| self.refs.release(manifest.chunk(i).hash);
+    }
+
+    /// Add `entry`'s digest to the tree, or take it out: the same XOR
+    fn untree(self: *MetaLog, bucket: []const u8, key: []const u8, entry: Entry) void {
+        self.tree.toggle(entry.leaf, MetaTree.digest(bucket, key, entry.hash, entry.size, entry.created, entry.deleted));
+    }
+
+    fn removeEntry(self: *MetaLog, bucket: []const u8, keys: *Keys, key: []const u8) void {
+        if (self.ordered) keys.unlist(key);
+        self.forgetEntry(bucket, keys, key);
+    }
+
+    /// Remove `key` from the map only; the caller takes it out of the order
+    fn forgetEntry(self: *MetaLog, bucket: []const u8, keys: *Keys, key: []const u8) void {
+        self.uncache(keys.entries.getPtr(key) orelse return);
+        const kv = keys.entries.fetchRemove(key).?;
+        self.releaseRefs(kv.value);
+        self.freeManifest(kv.value);
+        self.untree(bucket, kv.key, kv.value);
+        if (kv.value.deleted > 0) self.tombstones -= 1;
+        self.live_bytes -= kv.value.len;
+        self.allocator.free(kv.key);
+    }
+
+    fn removeBucket(self: *MetaLog, bucket: []const u8) void {
+        var kv = self.buckets.fetchRemove(bucket) orelse return;
+        self.freeKeys(kv.key, &kv.value);
+        self.allocator.free(kv.key);
+    }
+
+    fn freeKeys(self: *MetaLog, bucket: []const u8, keys: *Keys) void {
+        var iter = keys.entries.iterator();
+        while (iter.next()) |e| {
+            self.live_bytes -= e.value_ptr.len;
+            self.uncache(e.value_ptr);
+            self.releaseRefs(e.value_ptr.*);
+            self.freeManifest(e.value_ptr.*);
+            self.untree(bucket, e.key_ptr.*, e.value_ptr.*);
+            if (e.value_ptr.deleted > 0) self.tombstones -= 1;
+            self.allocator.free(e.key_ptr.*);
+        }
+        keys.deinit(self.allocator);
+    }
+
+    /// Sort every bucket's keys once loading is done, and keep them in
+    /// order from then on
+    fn buildOrder(self: *MetaLog) !void {
+        var iter = self.buckets.valueIterator();
+        while (iter.next()) |keys| {
+            keys.order.clearRetainingCapacity();
+            try keys.order.ensureTotalCapacity(self.allocator, keys.entries.count());
+            var key_iter = keys.entries.keyIterator();
+            while (key_iter.next()) |key| keys.order.appendAssumeCapacity(key.*);
+            std.mem.sort([]const u8, keys.order.items, {}, Keys.keyLessThan);
+        }
+        self.ordered = true;
+    }
+
+    fn clearEntries(self: *MetaLog) void {
+        // Counts are rebuilt along with the entries, if they are
+        self.refs.reset();
+        var iter = self.buckets.iterator();
+        while (iter.next()) |b| {
+            self.freeKeys(b.key_ptr.*, b.value_ptr);
+            self.allocator.free(b.key_ptr.*);
+        }
+        self.buckets.clearRetainingCapacity();
+        for (self.expiry.items) |x| self.allocator.free(x.name);
+        self.expiry.clearRetainingCapacity();
+    }
+
+    /// Copy every live record into a new segment and delete the old ones.
+    /// Appends move on to a fresh segment first, so the old ones stop
+    /// changing and are copied without the lock. The compacted segment takes
+    /// the id in between, to replay before anything appended meanwhile.
+    pub fn compact(self: *MetaLog) !void {
+        var copies: std.ArrayListUnmanaged(Copy) = .empty;
+        defer copies.deinit(self.allocator);
+        var sources: std.ArrayListUnmanaged(Pinned) = .empty; // the old segments
+        defer sources.deinit(self.allocator);
+        const seg_id = blk: {
+            self.lock();
+            defer self.unlock();
+            for (self.segments.items) |seg| try sources.append(self.allocator, .{ .id = seg.id, .file = seg.file });
+            var bucket_iter = self.buckets.valueIterator();
+            while (bucket_iter.next()) |keys| {
+                var key_iter = keys.entries.valueIterator();
+                while (key_iter.next()) |entry| try copies.append(self.allocator, .{ .segment = entry.segment, .offset = entry.offset, .len = entry.len });
+            }
+            const id = self.segments.getLast().id + 1;
+            _ = try self.addSegment(id + 1);
+            break :blk id;
+        };
+
+        // In log order, which the reads follow and the swap searches
+        std.mem.sort(Copy, copies.items, {}, struct {
+            fn lessThan(_: void, a: Copy, b: Copy) bool {
+                return a.segment < b.segment or (a.segment == b.segment and a.offset < b.offset);
+            }
+        }.lessThan);
+        const offsets = try self.allocator.alloc(u64, copies.items.len); // where each copy lands
+        defer self.allocator.free(offsets);
+
+        const path = try self.segmentPath(self.allocator, seg_id);
+        defer self.allocator.free(path);
+        const file = try std.Io.Dir.cwd().createFile(app_io, path, .{ .read = true, .exclusive = true });
+        var installed = false;
+        errdefer if (!installed) {
+            file.close(app_io);
+            std.Io.Dir.cwd().deleteFile(app_io, path) catch {};
+        };
+        var pending: std.ArrayListUnmanaged(u8) = .empty;
+        defer pending.deinit(self.allocator);
+        var end: u64 = 0;
+        var src = sources.items[0];
+        for (copies.items, offsets) |copy, *offset| {
+            if (copy.segment != src.id) src = for (sources.items) |s| {
+                if (s.id == copy.segment) break s;
+            } else return error.CorruptMetaLog;
+            const record = try pending.addManyAsSlice(self.allocator, copy.len);
+            if (try src.file.readPositionalAll(app_io, record, copy.offset) != record.len) return error.CorruptMetaLog;
+            offset.* = end + pending.items.len - record.len;
+            if (pending.items.len >= SPOOL_CHUNK_SIZE) {
+                try file.writePositionalAll(app_io, pending.items, end);
+                end += pending.items.len;
+                pending.clearRetainingCapacity();
+            }
+        }
+        try file.writePositionalAll(app_io, pending.items, end);
+        end += pending.items.len;
+        // The old segments go away below, whatever --durability says
+        try file.sync(app_io);
+
+        // Every entry still in an old segment was copied: nothing is
+        // appended there any more
+        {
+            self.lock();
+            defer self.unlock();
+            const at = for (self.segments.items, 0..) |seg, i| {
+                if (seg.id > seg_id) break i;
+            } else unreachable;
+            try self.segments.insert(self.allocator, at, .{ .id = seg_id, .file = file, .size = end });
+            installed = true;
+            self.total_bytes += end;
+            var bucket_iter = self.buckets.valueIterator();
+            while (bucket_iter.next()) |keys| {
+                var key_iter = keys.entries.valueIterator();
+                while (key_iter.next()) |entry| {
+                    if (entry.segment >= seg_id) continue;
+                    const i = std.sort.binarySearch(Copy, copies.items, Position{ .segment = entry.segment, .offset = entry.offset }, struct {
+                        fn order(pos: Position, copy: Copy) std.math.Order {
+                            if (pos.segment != copy.segment) return std.math.order(pos.segment, copy.segment);
+                            return std.math.order(pos.offset, copy.offset);
+                        }
+                    }.order) orelse return error.CorruptMetaLog;
+                    entry.segment = seg_id;
+                    entry.offset = offsets[i];
+                }
+            }
+        }
+
+        // Oldest first, so a crash part way leaves a suffix of the log
+        // followed by the compacted segment, which replays the same
+        try self.writeCheckpoint();
+        var old: std.ArrayListUnmanaged(Segment) = .empty;
+        defer old.deinit(self.allocator);
+        {
+            self.lock();
+            defer self.unlock();
+            try old.ensureTotalCapacity(self.allocator, sources.items.len);
+            // A put may still be syncing an old segment
+            while (self.segments.items[0].id < seg_id) {
+                if (self.segments.items[0].syncing > 0) {
+                    self.synced.waitUncancelable(app_io, &self.mutex);
+                    continue;
                 }
+                const seg = self.segments.orderedRemove(0);
+                self.total_bytes -= seg.size;
+                old.appendAssumeCapacity(seg);
+            }
+        }
+        for (old.items) |seg| {
+            seg.file.close(app_io);
+            const seg_path = try self.segmentPath(self.allocator, seg.id);
+            defer self.allocator.free(seg_path);
+            std.Io.Dir.cwd().deleteFile(app_io, seg_path) catch |err| std.log.warn("removing metadata segment {d}: {}", .{ seg.id, err });
+        }
+        std.log.info("compacted metadata log to {d} bytes", .{end});
+    }
+
+    /// Write every entry and the current end of the log to `checkpoint`.
+    /// It is encoded in memory under the lock and written out without it.
+    fn writeCheckpoint(self: *MetaLog) !void {
+        var out: std.Io.Writer.Allocating = .init(self.allocator);
+        defer out.deinit();
+        const appended = blk: {
+            self.lock();
+            defer self.unlock();
+            try self.encodeCheckpoint(&out.writer);
+            break :blk self.since_checkpoint;
+        };
+
+        const tmp_path = try tempFilePath(self.allocator, self.data_dir);
+        defer self.allocator.free(tmp_path);
+        const path = try std.fs.path.join(self.allocator, &.{ self.dir, "checkpoint" });
+        defer self.allocator.free(path);
+        var file = try std.Io.Dir.cwd().createFile(app_io, tmp_path, .{ .exclusive = true });
+        var committed = false;
+        defer {
+            file.close(app_io);
+            if (!committed) std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
+        }
+        try file.writePositionalAll(app_io, out.written(), 0);
+        // Compaction deletes segments the previous checkpoint may still need
+        try file.sync(app_io);
+
+        try self.committer.commit(tmp_path, path);
+        committed = true;
+        self.lock();
+        defer self.unlock();
+        self.since_checkpoint -= appended;
+    }
+
+    /// The checkpoint: the end of the log, every entry, and the blobs
+    /// waiting to be collected, then a CRC. The caller holds the lock.
+    fn encodeCheckpoint(self: *MetaLog, w: *std.Io.Writer) !void {
+        var cp = CheckpointWriter{ .writer = w };
+        var count: u64 = 0;
+        var bucket_iter = self.buckets.valueIterator();
+        while (bucket_iter.next()) |keys| count += keys.entries.count();
+        const last = self.segments.getLast();
+        try cp.write(CHECKPOINT_MAGIC);
+        try cp.int(u32, last.id);
+        try cp.int(u64, last.size);
+        try cp.int(u64, count);
+
+        var iter = self.buckets.iterator();
+        while (iter.next()) |b| {
+            var key_iter = b.value_ptr.entries.iterator();
+            while (key_iter.next()) |e| {
+                const entry = e.value_ptr.*;
+                try cp.int(u16, @intCast(b.key_ptr.len));
+                try cp.write(b.key_ptr.*);
+                try cp.int(u16, @intCast(e.key_ptr.len));
+                try cp.write(e.key_ptr.*);
+                try cp.write(&entry.hash);
+                try cp.int(u64, entry.size);
+                try cp.int(i64, entry.created);
+                try cp.int(i64, entry.deleted);
+                try cp.int(u32, entry.segment);
+                try cp.int(u64, entry.offset);
+                try cp.int(u32, entry.len);
+                try cp.int(u32, entry.inline_len);
+            }
+        }
+
+        // Blobs waiting to be collected, oldest first
+        {
+            const refs = self.refs;
+            refs.lock();
+            defer refs.unlock();
+            try cp.int(u64, refs.unreferenced.count());
+            for (refs.queue.items[refs.head..]) |c| {
+                if (!refs.isCurrent(c)) continue;
+                try cp.write(&c.hash);
+                try cp.int(i64, c.since);
             }
         }
+        var crc: [4]u8 = undefined;
+        std.mem.writeInt(u32, &crc, cp.crc.final(), .little);
+        try w.writeAll(&crc);
     }
 
-    fn getTombstoneAge(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8, now: i64) ?i64 {
-        const path = self.metaPath(allocator, bucket, key) catch return null;
-        defer allocator.free(path);
+    const CheckpointWriter = struct {
+        writer: *std.Io.Writer,
+        crc: std.hash.Crc32 = .init(),
+
+        fn write(self: *CheckpointWriter, bytes: []const u8) !void {
+            self.crc.update(bytes);
+            try self.writer.writeAll(bytes);
+        }
+
+        fn int(self: *CheckpointWriter, comptime T: type, value: T) !void {
+            var bytes: [@sizeOf(T)]u8 = undefined;
+            std.mem.writeInt(T, &bytes, value, .little);
+            try self.write(&bytes);
+        }
+    };
 
-        var file = std.Io.Dir.cwd().openFile(app_io, path, .{}) catch return null;
+    /// Load `checkpoint` and return where replay continues from. Fails if
+    /// it is damaged or refers to records that are no longer there.
+    fn loadCheckpoint(self: *MetaLog) !Position {
+        const path = try std.fs.path.join(self.allocator, &.{ self.dir, "checkpoint" });
+        defer self.allocator.free(path);
+        var file = try std.Io.Dir.cwd().openFile(app_io, path, .{});
         defer file.close(app_io);
+        const data = try self.allocator.alloc(u8, @intCast(try file.length(app_io)));
+        defer self.allocator.free(data);
+        if (try file.readPositionalAll(app_io, data, 0) != data.len) return error.CorruptCheckpoint;
+
+        if (data.len < CHECKPOINT_MAGIC.len + 24 or !std.mem.eql(u8, data[0..CHECKPOINT_MAGIC.len], CHECKPOINT_MAGIC))
+            return error.CorruptCheckpoint;
+        const body = data[0 .. data.len - 4];
+        if (std.hash.Crc32.hash(body) != std.mem.readInt(u32, data[data.len - 4 ..][0..4], .little)) return error.CorruptCheckpoint;
+
+        var pos: usize = CHECKPOINT_MAGIC.len;
+        const from = Position{
+            .segment = std.mem.readInt(u32, body[pos..][0..4], .little),
+            .offset = std.mem.readInt(u64, body[pos + 4 ..][0..8], .little),
+        };
+        const count = std.mem.readInt(u64, body[pos + 12 ..][0..8], .little);
+        pos += 20;
+        const start = self.segment(from.segment) orelse return error.StaleCheckpoint;
+        if (from.offset > start.size) return error.StaleCheckpoint;
+
+        for (0..count) |_| {
+            const bucket_len = std.mem.readInt(u16, (takeBytes(body, &pos, 2) orelse return error.CorruptCheckpoint)[0..2], .little);
+            const bucket = takeBytes(body, &pos, bucket_len) orelse return error.CorruptCheckpoint;
+            const key_len = std.mem.readInt(u16, (takeBytes(body, &pos, 2) orelse return error.CorruptCheckpoint)[0..2], .little);
+            const key = takeBytes(body, &pos, key_len) orelse return error.CorruptCheckpoint;
+            const fixed = takeBytes(body, &pos, 20 + 24 + 20) orelse return error.CorruptCheckpoint;
+            const entry = Entry{
+                .hash = fixed[0..20].*,
+                .size = std.mem.readInt(u64, fixed[20..28], .little),
+                .created = std.mem.readInt(i64, fixed[28..36], .little),
+                .deleted = std.mem.readInt(i64, fixed[36..44], .little),
+                .segment = std.mem.readInt(u32, fixed[44..48], .little),
+                .offset = std.mem.readInt(u64, fixed[48..56], .little),
+                .len = std.mem.readInt(u32, fixed[56..60], .little),
+                .inline_len = std.mem.readInt(u32, fixed[60..64], .little),
+            };
+            const seg = self.segment(entry.segment) orelse return error.StaleCheckpoint;
+            if (entry.offset + entry.len > seg.size or entry.inline_len > entry.len) return error.StaleCheckpoint;
+            // Manifests are kept in memory, so they are read in here, once
+            const payload = if (isChunked(entry)) try self.readInline(self.allocator, entry) else null;
+            defer if (payload) |p| self.allocator.free(p);
+            try self.setEntry(bucket, key, entry, payload);
+        }
+        const waiting = std.mem.readInt(u64, (takeBytes(body, &pos, 8) orelse return error.CorruptCheckpoint)[0..8], .little);
+        for (0..waiting) |_| {
+            const c = takeBytes(body, &pos, 28) orelse return error.CorruptCheckpoint;
+            self.refs.restore(c[0..20].*, std.mem.readInt(i64, c[20..28], .little));
+        }
+        if (pos != body.len) return error.CorruptCheckpoint;
+        return from;
+    }
 
-        var buf: [128]u8 = undefined;
-        const bytes_read = file.readPositionalAll(app_io, &buf, 0) catch return null;
-        const content = buf[0..bytes_read];
-
-        var lines = std.mem.splitScalar(u8, content, '\n');
-        _ = lines.next(); // hash
-        _ = lines.next(); // size
-        _ = lines.next(); // created
-        const deleted_str = lines.next() orelse return null;
-
-        const deleted = std.fmt.parseInt(i64, deleted_str, 10) catch return null;
-        if (deleted == 0) return null;
-        return now - deleted;
-    }
-
-    fn metaPath(self: *const MetaIndex, allocator: Allocator, bucket: []const u8, key: []const u8) ![]const u8 {
-        const key_with_ext = try std.fmt.allocPrint(allocator, "{s}.meta", .{key});
-        defer allocator.free(key_with_ext);
-        const path = try std.fs.path.join(allocator, &.{ self.data_dir, ".index", bucket, key_with_ext });
-        // Same filesystem guards as S3Context.objectPath (NAME_MAX per
-        // component, PATH_MAX total): an un-storable key must surface as a
-        // client error, not a 500. Note key_with_ext includes the ".meta"
-        // suffix, so its components are the ones that land on disk.
-        var component_itr = std.mem.splitScalar(u8, key_with_ext, '/');
-        while (component_itr.next()) |component| {
-            if (component.len >= std.posix.NAME_MAX) {
-                allocator.free(path);
-                return error.NameTooLong;
-            }
+    /// Import a `.index/` tree of text `.meta` files, the layout before the
+    /// log, and remove it once the entries are checkpointed.
+    fn migrate(self: *MetaLog, index_path: []const u8) !void {
+        var dir = std.Io.Dir.cwd().openDir(app_io, index_path, .{ .iterate = true }) catch return;
+        defer dir.close(app_io);
+
+        var arena = std.heap.ArenaAllocator.init(self.allocator);
+        defer arena.deinit();
+        var count: usize = 0;
+        var iter = dir.iterate();
+        while (try iter.next(app_io)) |entry| {
+            if (entry.kind != .directory) continue;
+            const bucket_path = try std.fs.path.join(arena.allocator(), &.{ index_path, entry.name });
+            try self.migrateDir(arena.allocator(), entry.name, bucket_path, "", &count);
         }
-        if (path.len >= std.posix.PATH_MAX) {
-            allocator.free(path);
-            return error.PathTooLong;
+        try self.segments.getLast().file.sync(app_io);
+        try self.writeCheckpoint();
+        try std.Io.Dir.cwd().deleteTree(app_io, index_path);
+        std.log.info("migrated {d} metadata entries from .index/ to .meta/", .{count});
+    }
+
+    fn migrateDir(self: *MetaLog, arena: Allocator, bucket: []const u8, dir_path: []const u8, prefix: []const u8, count: *usize) !void {
+        var dir = std.Io.Dir.cwd().openDir(app_io, dir_path, .{ .iterate = true }) catch return;
+        defer dir.close(app_io);
+
+        var iter = dir.iterate();
+        while (try iter.next(app_io)) |entry| {
+            const full_name = try std.fmt.allocPrint(arena, "{s}{s}", .{ prefix, entry.name });
+            if (entry.kind == .directory) {
+                const subdir = try std.fs.path.join(arena, &.{ dir_path, entry.name });
+                try self.migrateDir(arena, bucket, subdir, try std.fmt.allocPrint(arena, "{s}/", .{full_name}), count);
+            } else if (entry.kind == .file and std.mem.endsWith(u8, entry.name, ".meta")) {
+                const content = dir.readFileAlloc(app_io, entry.name, arena, .limited(MAX_RECORD)) catch continue;
+                const meta = parseMetaContent(content) orelse {
+                    std.log.warn("skipping unreadable metadata {s}/{s}", .{ bucket, full_name });
+                    continue;
+                };
+                _ = try self.putLocked(bucket, full_name[0 .. full_name.len - ".meta".len], meta);
+                count.* += 1;
+            }
         }
-        return path;
     }
 };
 
@@ -728,7 +2405,7 @@ const BucketOps = struct {
 };
 
 /// Peer information for DHT
-const PeerInfo = struct {
+pub const PeerInfo = struct {
     id: NodeId,
     address: net.IpAddress,
     last_seen: i64,
@@ -744,12 +2421,13 @@ const Kademlia = struct {
 
     self_id: NodeId,
     buckets: [ID_BITS]KBucket,
-    // Provider records are only touched from the event-loop thread
     providers: std.AutoHashMap(ContentHash, std.ArrayListUnmanaged(NodeId)),
     allocator: Allocator,
     // Guards `buckets`: the push worker reads/updates the routing table
-    // (gossip, peer snapshots) concurrently with the event loop
+    // (gossip, peer snapshots) concurrently with the event loops
     mutex: std.Io.Mutex = .init,
+    // Guards `providers`, shared by every event-loop worker and the push worker
+    providers_mutex: std.Io.Mutex = .init,
 
     /// A single k-bucket holding up to K peers
     const KBucket = struct {
@@ -935,6 +2613,8 @@ const Kademlia = struct {
 
     /// Announce that we have content (store provider record)
     pub fn announce(self: *Kademlia, hash: ContentHash) !void {
+        self.providers_mutex.lockUncancelable(app_io);
+        defer self.providers_mutex.unlock(app_io);
         const result = try self.providers.getOrPut(hash);
         if (!result.found_existing) {
             result.value_ptr.* = .empty;
@@ -948,6 +2628,8 @@ const Kademlia = struct {
 
     /// Record that a peer has content
     pub fn addProvider(self: *Kademlia, hash: ContentHash, provider: NodeId) !void {
+        self.providers_mutex.lockUncancelable(app_io);
+        defer self.providers_mutex.unlock(app_io);
         const result = try self.providers.getOrPut(hash);
         if (!result.found_existing) {
             result.value_ptr.* = .empty;
@@ -958,12 +2640,15 @@ const Kademlia = struct {
         try result.value_ptr.append(self.allocator, provider);
     }
 
-    /// Find nodes that have content
-    pub fn findProviders(self: *Kademlia, hash: ContentHash) []NodeId {
-        if (self.providers.get(hash)) |list| {
-            return list.items;
-        }
-        return &.{};
+    /// Find nodes that have content. Copies up to out.len provider IDs
+    /// into `out` and returns how many were written.
+    pub fn findProviders(self: *Kademlia, hash: ContentHash, out: []NodeId) usize {
+        self.providers_mutex.lockUncancelable(app_io);
+        defer self.providers_mutex.unlock(app_io);
+        const list = self.providers.get(hash) orelse return 0;
+        const n = @min(list.items.len, out.len);
+        @memcpy(out[0..n], list.items[0..n]);
+        return n;
     }
 
     /// Find a peer by its node ID
@@ -1071,6 +2756,7 @@ const ReplicationManager = struct {
     pending: std.ArrayListUnmanaged(ContentHash),
     target_replicas: u8,
     allocator: Allocator,
+    mutex: std.Io.Mutex = .init,
 
     pub fn init(allocator: Allocator) ReplicationManager {
         return .{
@@ -1086,6 +2772,8 @@ const ReplicationManager = struct {
 
     /// Schedule content for replication
     pub fn schedule(self: *ReplicationManager, hash: ContentHash) !void {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
         // Avoid duplicates
         for (self.pending.items) |h| {
             if (std.mem.eql(u8, &h, &hash)) return;
@@ -1095,13 +2783,15 @@ const ReplicationManager = struct {
 };
 
 /// Distributed mode configuration
-const DistributedConfig = struct {
+pub const DistributedConfig = struct {
     enabled: bool = false,
     node_id: NodeId = undefined,
     bootstrap_peers: []const []const u8 = &.{},
     target_replicas: u8 = REPLICATION_TARGET,
     http_port: u16 = 9000,
     gossip_interval_ms: u64 = GOSSIP_INTERVAL_MS,
+    write_acks: usize = WRITE_ACKS,
+    peer_deadline_ms: u64 = PEER_DEADLINE_MS,
 };
 
 /// Background worker: replicates blobs, propagates bucket ops, and gossips
@@ -1116,6 +2806,7 @@ const PushWorker = struct {
     const POLL_INTERVAL_MS = 50;
 
     dist: *DistributedContext = undefined,
+    ctx: *const S3Context = undefined, // for applying metadata pulled in gossip rounds
     mutex: std.Io.Mutex = .init,
     jobs: std.ArrayListUnmanaged(Job) = .empty,
 
@@ -1131,6 +2822,9 @@ const PushWorker = struct {
         const allocator = std.heap.page_allocator;
         const interval_ms: i64 = @intCast(self.dist.config.gossip_interval_ms);
         var last_gossip = std.Io.Clock.real.now(app_io).toMilliseconds();
+        var last_maintenance = last_gossip;
+        var last_gc = last_gossip;
+        var last_tombstone_sweep = last_gossip;
 
         while (true) {
             self.mutex.lockUncancelable(app_io);
@@ -1146,7 +2840,23 @@ const PushWorker = struct {
             const now = std.Io.Clock.real.now(app_io).toMilliseconds();
             if (now - last_gossip >= interval_ms) {
                 last_gossip = now;
-                gossipOnce(allocator, self.dist);
+                gossipOnce(allocator, self.ctx, self.dist);
+            }
+            if (now - last_maintenance >= META_MAINTENANCE_INTERVAL_MS) {
+                last_maintenance = now;
+                self.dist.meta_index.log.maintain();
+                self.dist.peer_pool.prune();
+            }
+            if (now - last_gc >= 1000) {
+                last_gc = now;
+                const deleted = self.dist.cas.collectGarbage(allocator, GC_BLOBS_PER_SEC);
+                if (deleted > 0) std.log.info("collected {d} unreferenced blobs", .{deleted});
+            }
+            if (now - last_tombstone_sweep >= TOMBSTONE_SWEEP_INTERVAL_MS) {
+                last_tombstone_sweep = now;
+                if (self.dist.meta_index.cleanupTombstones()) |removed| {
+                    if (removed > 0) std.log.info("removed {d} expired tombstones", .{removed});
+                } else |err| std.log.warn("tombstone cleanup failed: {}", .{err});
             }
         }
     }
@@ -1155,7 +2865,7 @@ const PushWorker = struct {
         const dist = self.dist;
         switch (job) {
             .blob => |b| {
-                broadcastAnnounce(dist, allocator, b.hash, dist.config.node_id);
+                broadcastAnnounce(dist, b.hash, dist.config.node_id);
                 replicateBlob(dist, allocator, b.hash);
             },
             .bucket => |b| {
@@ -1165,15 +2875,17 @@ const PushWorker = struct {
                 const path = if (b.deleted) "/_zs3/bucket_delete" else "/_zs3/bucket";
                 const body = std.fmt.allocPrint(allocator, "{s}\n{d}", .{ b.name, b.ts }) catch return;
                 defer allocator.free(body);
-                broadcastToPeers(dist, allocator, "POST", path, body);
+                broadcastToPeers(dist, "POST", path, body, null);
             },
         }
     }
 };
 
 /// One gossip round: refresh a few random peers (they also learn about us
-/// via the ping handshake) and pull their peer lists to repair the mesh
-fn gossipOnce(allocator: Allocator, dist: *DistributedContext) void {
+/// via the ping handshake) and pull their peer lists to repair the mesh,
+/// then run anti-entropy with one of them to repair metadata that missed
+/// a push
+fn gossipOnce(allocator: Allocator, ctx: *const S3Context, dist: *DistributedContext) void {
     var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
     const n = dist.kademlia.collectPeers(&peers);
     if (n == 0) return;
@@ -1190,25 +2902,32 @@ fn gossipOnce(allocator: Allocator, dist: *DistributedContext) void {
         } else |_| {}
         discoverPeersFrom(allocator, dist, peer);
     }
+
+    if (syncTreeFromPeer(allocator, ctx, peers[start])) |pulled| {
+        if (pulled > 0) std.log.info("anti-entropy: pulled {d} metadata entries from a peer", .{pulled});
+    } else |_| {}
 }
 
 /// Extended context for distributed mode
-const DistributedContext = struct {
+pub const DistributedContext = struct {
     config: DistributedConfig,
     cas: CAS,
     meta_index: MetaIndex,
     kademlia: Kademlia,
+    peer_pool: PeerPool,
+    fanout_threads: std.atomic.Value(usize) = .init(0), // FanOut requests in flight
     replication: ReplicationManager,
     worker: PushWorker,
     bucket_ops: BucketOps,
     allocator: Allocator,
 
-    pub fn init(allocator: Allocator, data_dir: []const u8, config: DistributedConfig) DistributedContext {
+    pub fn init(allocator: Allocator, data_dir: []const u8, committer: *Committer, meta_log: *MetaLog, blob_set: *BlobSet, config: DistributedConfig) DistributedContext {
         return .{
             .config = config,
-            .cas = .{ .data_dir = data_dir },
-            .meta_index = .{ .data_dir = data_dir },
+            .cas = .{ .data_dir = data_dir, .committer = committer, .refs = meta_log.refs, .present = blob_set },
+            .meta_index = .{ .data_dir = data_dir, .committer = committer, .log = meta_log },
             .kademlia = Kademlia.init(allocator, config.node_id),
+            .peer_pool = PeerPool.init(allocator),
             .replication = ReplicationManager.init(allocator),
             .worker = .{},
             .bucket_ops = .{ .data_dir = data_dir },
@@ -1218,6 +2937,7 @@ const DistributedContext = struct {
 
     pub fn deinit(self: *DistributedContext) void {
         self.kademlia.deinit();
+        self.peer_pool.deinit();
         self.replication.deinit();
     }
 };
@@ -1232,6 +2952,15 @@ pub fn main(init: std.process.Init) !void {
     var bootstrap_count: usize = 0;
     var port: u16 = 9000;
     var gossip_interval_ms: u64 = GOSSIP_INTERVAL_MS;
+    var write_acks: usize = WRITE_ACKS;
+    var peer_deadline_ms: u64 = PEER_DEADLINE_MS;
+    var workers: usize = 1;
+    var scan_threads: usize = SCAN_THREADS;
+    var timeouts: Timeouts = .{};
+    var durability: Durability = .none;
+    var io_backend: IoBackend = .epoll;
+    var group_commit_ms: u64 = GROUP_COMMIT_MS;
+    var reindex = false;
     var data_dir: []const u8 = build_options.data_dir;
     var raw_acl_list: []const u8 = build_options.acl_list;
     var show_help: bool = false;
@@ -1259,6 +2988,34 @@ pub fn main(init: std.process.Init) !void {
             port = std.fmt.parseInt(u16, arg[7..], 10) catch 9000;
         } else if (std.mem.startsWith(u8, arg, "--gossip-interval-ms=")) {
             gossip_interval_ms = std.fmt.parseInt(u64, arg[21..], 10) catch GOSSIP_INTERVAL_MS;
+        } else if (std.mem.startsWith(u8, arg, "--write-acks=")) {
+            write_acks = std.fmt.parseInt(usize, arg[13..], 10) catch WRITE_ACKS;
+        } else if (std.mem.startsWith(u8, arg, "--peer-deadline-ms=")) {
+            peer_deadline_ms = std.fmt.parseInt(u64, arg[19..], 10) catch PEER_DEADLINE_MS;
+        } else if (std.mem.startsWith(u8, arg, "--workers=")) {
+            workers = std.fmt.parseInt(usize, arg[10..], 10) catch 1;
+        } else if (std.mem.startsWith(u8, arg, "--scan-threads=")) {
+            scan_threads = std.fmt.parseInt(usize, arg[15..], 10) catch SCAN_THREADS;
+        } else if (std.mem.startsWith(u8, arg, "--io=")) {
+            io_backend = std.meta.stringToEnum(IoBackend, arg[5..]) orelse {
+                std.log.err("Invalid --io value '{s}' (expected epoll or uring)", .{arg[5..]});
+                return error.InvalidIoBackend;
+            };
+        } else if (std.mem.startsWith(u8, arg, "--durability=")) {
+            durability = Durability.parse(arg[13..]) orelse {
+                std.log.err("Invalid --durability value '{s}' (expected none, fsync or group)", .{arg[13..]});
+                return error.InvalidDurability;
+            };
+        } else if (std.mem.startsWith(u8, arg, "--group-commit-ms=")) {
+            group_commit_ms = std.fmt.parseInt(u64, arg[18..], 10) catch GROUP_COMMIT_MS;
+        } else if (std.mem.startsWith(u8, arg, "--header-timeout-ms=")) {
+            timeouts.header_ms = std.fmt.parseInt(i64, arg[20..], 10) catch HEADER_TIMEOUT_MS;
+        } else if (std.mem.startsWith(u8, arg, "--body-timeout-ms=")) {
+            timeouts.body_ms = std.fmt.parseInt(i64, arg[18..], 10) catch BODY_TIMEOUT_MS;
+        } else if (std.mem.startsWith(u8, arg, "--idle-timeout-ms=")) {
+            timeouts.idle_ms = std.fmt.parseInt(i64, arg[18..], 10) catch IDLE_TIMEOUT_MS;
+        } else if (std.mem.eql(u8, arg, "--reindex")) {
+            reindex = true;
         } else if (std.mem.eql(u8, arg, "--help") or std.mem.eql(u8, arg, "-h")) {
             show_help = true;
         }
@@ -1280,11 +3037,50 @@ pub fn main(init: std.process.Init) !void {
             \\  --gossip-interval-ms={d}
             \\      Interval for background peer gossip/refresh
             \\
+            \\  --write-acks={d}
+            \\      Peers that must accept a PUT or DELETE's metadata before the
+            \\      client is answered (the rest catch up in the background)
+            \\
+            \\  --peer-deadline-ms={d}
+            \\      Longest a request waits on its peers before answering anyway
+            \\
             \\  --port={d}
             \\      HTTP port to listen on
             \\
-            \\  --data-dir={s}
-            \\      The directory to store bucket data under
+            \\  --workers=N
+            \\      Event-loop threads serving requests (0 = one per CPU core)
+            \\
+            \\  --scan-threads={d}
+            \\      Threads reading directories when walking a tree: rebuilding a
+            \\      LIST key index, indexing CAS blobs (0 = one per CPU core)
+            \\
+            \\  --io=epoll|uring
+            \\      Linux socket I/O: readiness with epoll, or batched submissions
+            \\      through io_uring (falls back to epoll if unavailable)
+            \\
+            \\  --durability=none|fsync|group
+            \\      When writes reach stable storage: left to the kernel (none),
+            \\      fsynced before each reply (fsync), or fsynced in shared batches
+            \\      (group). Writes are atomic in every mode.
+            \\
+            \\  --group-commit-ms={d}
+            \\      Batch window for --durability=group
+            \\
+            \\  --header-timeout-ms={d}
+            \\      Close a client that takes longer to send its request headers
+            \\
+            \\  --body-timeout-ms={d}
+            \\      Close a client whose body upload or download stalls this long
+            \\
+            \\  --idle-timeout-ms={d}
+            \\      Close keep-alive connections idle between requests this long
+            \\
+            \\  --data-dir={s}
+            \\      The directory to store bucket data under
+            \\
+            \\  --reindex
+            \\      Rebuild the LIST key indexes from the files in each bucket, e.g.
+            \\      after changing bucket directories by hand
             \\
             \\  --acl={s}
             \\      The credentials for access
@@ -1297,7 +3093,7 @@ pub fn main(init: std.process.Init) !void {
             \\  zs3 --distributed                      # Distributed, auto-discover via mDNS
             \\  zs3 -d --bootstrap=10.0.0.1:9000       # Distributed with bootstrap peer
             \\
-        , .{ GOSSIP_INTERVAL_MS, port, data_dir, raw_acl_list });
+        , .{ GOSSIP_INTERVAL_MS, WRITE_ACKS, PEER_DEADLINE_MS, port, SCAN_THREADS, GROUP_COMMIT_MS, HEADER_TIMEOUT_MS, BODY_TIMEOUT_MS, IDLE_TIMEOUT_MS, data_dir, raw_acl_list });
         return;
     }
 
@@ -1316,9 +3112,39 @@ pub fn main(init: std.process.Init) !void {
         else => return err,
     };
 
+    // Scratch space for uploads in flight. Anything left over is from a
+    // crashed or killed process and can never be completed.
+    const tmp_dir = try std.fs.path.join(allocator, &.{ data_dir, ".tmp" });
+    defer allocator.free(tmp_dir);
+    std.Io.Dir.cwd().deleteTree(app_io, tmp_dir) catch {};
+    try std.Io.Dir.cwd().createDirPath(app_io, tmp_dir);
+
+    if (scan_threads == 0) scan_threads = std.Thread.getCpuCount() catch 1;
+
+    var committer = Committer{ .data_dir = data_dir, .mode = durability, .interval_ms = @max(group_commit_ms, 1) };
+    if (durability == .group) {
+        const commit_thread = try std.Thread.spawn(.{}, Committer.run, .{&committer});
+        commit_thread.detach();
+    }
+
+    // Bucket key indexes are rebuilt from the filesystem when missing
+    if (reindex) {
+        const keys_dir = try std.fs.path.join(allocator, &.{ data_dir, ".keys" });
+        defer allocator.free(keys_dir);
+        std.Io.Dir.cwd().deleteTree(app_io, keys_dir) catch {};
+    }
+    var key_index = KeyIndex.init(allocator, data_dir, &committer, scan_threads);
+    defer key_index.deinit();
+
     // Initialize distributed context if enabled
     var dist_ctx: ?DistributedContext = null;
     defer if (dist_ctx) |*d| d.deinit();
+    var blob_refs = BlobRefs.init(allocator);
+    defer blob_refs.deinit();
+    var blob_set = BlobSet.init(allocator);
+    defer blob_set.deinit();
+    var meta_log: ?MetaLog = null;
+    defer if (meta_log) |*m| m.deinit();
 
     if (distributed_enabled) {
         // Generate or load node ID
@@ -1329,15 +3155,18 @@ pub fn main(init: std.process.Init) !void {
             .bootstrap_peers = bootstrap_peers[0..bootstrap_count],
             .http_port = port,
             .gossip_interval_ms = gossip_interval_ms,
+            .write_acks = write_acks,
+            .peer_deadline_ms = peer_deadline_ms,
         };
-        dist_ctx = DistributedContext.init(allocator, data_dir, config);
+        meta_log = try MetaLog.open(allocator, data_dir, &committer, &blob_refs);
+        dist_ctx = DistributedContext.init(allocator, data_dir, &committer, &meta_log.?, &blob_set, config);
 
         var id_hex: [40]u8 = undefined;
         bytesToHex(&node_id, &id_hex);
         std.log.info("Distributed mode enabled. Node ID: {s}", .{id_hex});
         std.log.info("Known peers: {d}", .{dist_ctx.?.kademlia.peerCount()});
 
-        // Create .cas and .index directories
+        // Create .cas directory
         const dot_cas_path = try std.fs.path.join(allocator, &[_][]const u8{ data_dir, ".cas" });
         defer allocator.free(dot_cas_path);
 
@@ -1347,16 +3176,7 @@ pub fn main(init: std.process.Init) !void {
                 return error.FailedDataDirDotCasCreation;
             },
         };
-
-        const dot_index_path = try std.fs.path.join(allocator, &[_][]const u8{ data_dir, ".index" });
-        defer allocator.free(dot_index_path);
-
-        std.Io.Dir.cwd().createDir(app_io, dot_index_path, .default_dir) catch |err| switch (err) {
-            error.PathAlreadyExists => {},
-            else => {
-                return error.FailedDataDirDotIndexCreation;
-            },
-        };
+        try blob_set.load(dot_cas_path, scan_threads);
     }
 
     // Keys reference slices in raw_acl_list (argv or build_options string), both of
@@ -1378,7 +3198,20 @@ pub fn main(init: std.process.Init) !void {
         .data_dir = data_dir,
         .access_control_map = access_control_map,
         .distributed = if (dist_ctx != null) &dist_ctx.? else null,
+        .committer = &committer,
+        .key_index = &key_index,
+        .timeouts = timeouts,
+        .io_backend = io_backend,
     };
+
+    var handler_pool: HandlerPool = .{ .ctx = &ctx };
+    if (durability == .group) {
+        ctx.handler_pool = &handler_pool;
+        for (0..GROUP_COMMIT_THREADS) |_| {
+            const thread = try std.Thread.spawn(.{}, HandlerPool.run, .{&handler_pool});
+            thread.detach();
+        }
+    }
     defer ctx.deinit();
 
     const address = net.IpAddress.parseIp4("0.0.0.0", port) catch unreachable;
@@ -1391,19 +3224,58 @@ pub fn main(init: std.process.Init) !void {
 
         // Background replication/gossip worker
         dist_ctx.?.worker.dist = &dist_ctx.?;
+        dist_ctx.?.worker.ctx = &ctx;
         const worker_thread = try std.Thread.spawn(.{}, PushWorker.run, .{&dist_ctx.?.worker});
         worker_thread.detach();
     } else {
         std.log.info("S3 server listening on http://0.0.0.0:{d}", .{port});
     }
 
+    if (workers == 0) workers = std.Thread.getCpuCount() catch 1;
+    if (workers > 1) std.log.info("Serving with {d} workers", .{workers});
+    for (1..workers) |_| {
+        const thread = try std.Thread.spawn(.{}, serveWorker, .{ allocator, &ctx, address });
+        thread.detach();
+    }
+    try runEventLoop(allocator, &ctx, &server);
+}
+
+/// Set on the threads running client event loops, which must never wait
+/// for a group commit
+threadlocal var in_event_loop = false;
+
+fn runEventLoop(allocator: Allocator, ctx: *const S3Context, server: *net.Server) !void {
+    in_event_loop = true;
     if (builtin.os.tag == .linux) {
-        try eventLoopEpoll(allocator, &ctx, &server);
+        if (ctx.io_backend == .uring) {
+            if (std.os.linux.IoUring.init(URING_ENTRIES, 0)) |ring| {
+                var r = ring;
+                return eventLoopUring(allocator, ctx, server, &r);
+            } else |err| {
+                // Kernels before 5.6, or containers whose seccomp policy blocks it
+                std.log.warn("io_uring unavailable ({s}), falling back to epoll", .{@errorName(err)});
+            }
+        }
+        try eventLoopEpoll(allocator, ctx, server);
     } else if (builtin.os.tag == .macos) {
-        try eventLoopKqueue(allocator, &ctx, &server);
+        try eventLoopKqueue(allocator, ctx, server);
     }
 }
 
+/// Extra `--workers` thread: its own listener on the shared port (the
+/// listen options set SO_REUSEPORT, so the kernel spreads new connections
+/// across workers) and its own event loop. Handlers share `ctx`.
+fn serveWorker(allocator: Allocator, ctx: *const S3Context, address: net.IpAddress) void {
+    var server = address.listen(app_io, .{ .reuse_address = true }) catch |err| {
+        std.log.err("Worker failed to listen: {}", .{err});
+        return;
+    };
+    defer server.deinit(app_io);
+    runEventLoop(allocator, ctx, &server) catch |err| {
+        std.log.err("Worker event loop failed: {}", .{err});
+    };
+}
+
 /// Generate or load persistent node ID
 fn getOrCreateNodeId(allocator: Allocator, data_dir: []const u8) !NodeId {
     const id_path = try std.fs.path.join(allocator, &.{ data_dir, ".node_id" });
@@ -1432,32 +3304,20 @@ fn getOrCreateNodeId(allocator: Allocator, data_dir: []const u8) !NodeId {
 
 /// Handshake with a peer: exchange node IDs (the peer also learns about us
 /// via the X-Zs3-* headers) and return its PeerInfo
-fn pingPeerAddress(allocator: Allocator, dist: *const DistributedContext, address: net.IpAddress) !PeerInfo {
-    var stream = address.connect(app_io, .{ .mode = .stream }) catch return error.ConnectionFailed;
-    defer stream.close(app_io);
-    setPeerTimeout(stream);
-
+fn pingPeerAddress(allocator: Allocator, dist: *DistributedContext, address: net.IpAddress) !PeerInfo {
     var self_id_hex: [40]u8 = undefined;
     bytesToHex(&dist.config.node_id, &self_id_hex);
-    var request_buffer: [512]u8 = undefined;
-    const request = std.fmt.bufPrint(
-        &request_buffer,
-        "GET /_zs3/ping HTTP/1.1\r\nHost: {f}\r\nX-Zs3-Node-Id: {s}\r\nX-Zs3-Port: {d}\r\nConnection: close\r\n\r\n",
-        .{ address, self_id_hex, dist.config.http_port },
+    var header_buffer: [128]u8 = undefined;
+    const headers = std.fmt.bufPrint(
+        &header_buffer,
+        "X-Zs3-Node-Id: {s}\r\nX-Zs3-Port: {d}\r\n",
+        .{ self_id_hex, dist.config.http_port },
     ) catch return error.BufferTooSmall;
-    try streamWriteAll(stream, request);
-
-    var response_buffer = try allocator.alloc(u8, MAX_HEADER_SIZE);
-    defer allocator.free(response_buffer);
-    var total_read: usize = 0;
-    while (total_read < response_buffer.len) {
-        const count = streamRead(stream, response_buffer[total_read..]) catch break;
-        if (count == 0) break;
-        total_read += count;
-    }
-
-    const response = response_buffer[0..total_read];
-    if (!std.mem.startsWith(u8, response, "HTTP/1.1 200")) return error.InvalidBootstrapResponse;
+    const response = dist.peer_pool.request(allocator, address, "GET", "/_zs3/ping", headers, "", MAX_HEADER_SIZE) catch |err| switch (err) {
+        error.RequestFailed, error.InvalidResponse => return error.InvalidBootstrapResponse,
+        else => return error.ConnectionFailed,
+    };
+    defer allocator.free(response);
 
     const id_prefix = "\"id\":\"";
     const id_start = (std.mem.indexOf(u8, response, id_prefix) orelse return error.InvalidBootstrapResponse) + id_prefix.len;
@@ -1479,7 +3339,7 @@ fn pingPeerAddress(allocator: Allocator, dist: *const DistributedContext, addres
 /// "addr" field when present, falling back to the source's IP + gossiped
 /// port for older peers.
 fn discoverPeersFrom(allocator: Allocator, dist: *DistributedContext, source: PeerInfo) void {
-    const body = peerRequest(allocator, source.address, "GET", "/_zs3/peers", "", 64 * 1024) catch return;
+    const body = peerRequest(dist, allocator, source.address, "GET", "/_zs3/peers", "", 64 * 1024) catch return;
     defer allocator.free(body);
 
     var it = std.mem.splitSequence(u8, body, "\"id\":\"");
@@ -1517,7 +3377,7 @@ fn discoverPeersFrom(allocator: Allocator, dist: *DistributedContext, source: Pe
     }
 }
 
-fn connectBootstrapPeer(allocator: Allocator, dist: *const DistributedContext, peer_text: []const u8) !PeerInfo {
+fn connectBootstrapPeer(allocator: Allocator, dist: *DistributedContext, peer_text: []const u8) !PeerInfo {
     if (net.IpAddress.parseLiteral(peer_text)) |address| {
         return pingPeerAddress(allocator, dist, address);
     } else |_| {}
@@ -1551,392 +3411,1681 @@ fn bootstrapPeers(allocator: Allocator, ctx: *const S3Context, dist: *Distribute
         dist.kademlia.addPeer(peer);
         std.log.info("Connected to bootstrap peer {s}", .{peer_text});
         discoverPeersFrom(allocator, dist, peer);
-        syncIndexFromPeer(allocator, ctx, peer);
+        if (syncTreeFromPeer(allocator, ctx, peer)) |pulled| {
+            std.log.info("Synced {d} metadata entries from bootstrap peer", .{pulled});
+        } else |err| switch (err) {
+            // A peer without the anti-entropy endpoints: take its whole index
+            error.RequestFailed => syncIndexFromPeer(allocator, ctx, peer),
+            else => std.log.warn("Metadata sync from peer failed: {t}", .{err}),
+        }
     }
     std.log.info("Known peers: {d}", .{dist.kademlia.peerCount()});
 }
 
+/// Read from a blocking peer socket. Its SO_RCVTIMEO expiring surfaces
+/// as error.Timeout.
 fn streamRead(stream: net.Stream, buffer: []u8) !usize {
-    var buffers = [1][]u8{buffer};
-    return app_io.vtable.netRead(app_io.userdata, stream.socket.handle, &buffers);
+    while (true) {
+        const rc = posix.system.read(stream.socket.handle, buffer.ptr, buffer.len);
+        switch (posix.errno(rc)) {
+            .SUCCESS => return @intCast(rc),
+            .INTR => continue,
+            .AGAIN => return error.Timeout,
+            else => return error.ConnectionResetByPeer,
+        }
+    }
 }
 
+/// Write all of `bytes` to a blocking peer socket. Its SO_SNDTIMEO
+/// expiring surfaces as error.Timeout.
 fn streamWriteAll(stream: net.Stream, bytes: []const u8) !void {
     var written: usize = 0;
     while (written < bytes.len) {
-        const data = [1][]const u8{bytes[written..]};
-        const n = try app_io.vtable.netWrite(
-            app_io.userdata,
-            stream.socket.handle,
-            "",
-            &data,
-            1,
-        );
-        if (n == 0) return error.ConnectionResetByPeer;
-        written += n;
+        const rc = posix.system.write(stream.socket.handle, bytes[written..].ptr, bytes.len - written);
+        switch (posix.errno(rc)) {
+            .SUCCESS => {},
+            .INTR => continue,
+            .AGAIN => return error.Timeout,
+            else => return error.ConnectionResetByPeer,
+        }
+        if (rc == 0) return error.ConnectionResetByPeer;
+        written += @intCast(rc);
     }
 }
 
-fn readToEndAlloc(file: std.Io.File, allocator: Allocator, max_size: usize) ![]u8 {
-    var file_reader = file.reader(app_io, &.{});
-    return file_reader.interface.allocRemaining(allocator, .limited(max_size));
+/// Send `size` bytes of `file`, from its start, to a blocking peer socket
+fn streamSendFile(stream: net.Stream, file: std.Io.File, size: u64) !void {
+    var sent: u64 = 0;
+    while (sent < size) {
+        const count: usize = @intCast(@min(size - sent, 1 << 30));
+        // On a blocking socket nothing sent means SO_SNDTIMEO expired
+        const n = (try sendFileNonBlocking(stream.socket.handle, file.handle, sent, count)) orelse return error.Timeout;
+        sent += n;
+    }
 }
 
-fn eventLoopEpoll(allocator: Allocator, ctx: *const S3Context, server: *net.Server) !void {
-    const linux = std.os.linux;
-    const epfd = linux.epoll_create1(linux.EPOLL.CLOEXEC);
-    if (@as(isize, @bitCast(epfd)) < 0) return error.EpollCreate;
-    defer _ = linux.close(@intCast(epfd));
-
-    var ev = linux.epoll_event{ .events = linux.EPOLL.IN, .data = .{ .fd = server.socket.handle } };
-    if (@as(isize, @bitCast(linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_ADD, server.socket.handle, &ev))) < 0)
-        return error.EpollCtl;
-
-    var events: [MAX_CONNECTIONS]linux.epoll_event = undefined;
-    var peer_addresses = std.AutoHashMap(posix.fd_t, net.IpAddress).init(allocator);
-    defer peer_addresses.deinit();
-
+/// Read from a non-blocking socket. `null` means nothing is buffered yet
+/// and the event loop should wait for readiness.
+fn recvNonBlocking(fd: posix.fd_t, buf: []u8) !?usize {
     while (true) {
-        const n = linux.epoll_wait(@intCast(epfd), &events, MAX_CONNECTIONS, -1);
-        if (@as(isize, @bitCast(n)) < 0) continue;
-
-        for (events[0..n]) |event| {
-            if (event.data.fd == server.socket.handle) {
-                const conn = server.accept(app_io) catch continue;
-                peer_addresses.put(conn.socket.handle, conn.socket.address) catch {
-                    conn.close(app_io);
-                    continue;
-                };
-                var cev = linux.epoll_event{ .events = linux.EPOLL.IN | linux.EPOLL.ONESHOT, .data = .{ .fd = conn.socket.handle } };
-                _ = linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_ADD, conn.socket.handle, &cev);
-            } else {
-                const remote_address = peer_addresses.get(event.data.fd) orelse net.IpAddress{ .ip4 = net.Ip4Address.unspecified(0) };
-                _ = peer_addresses.remove(event.data.fd);
-                const stream = net.Stream{ .socket = .{ .handle = event.data.fd, .address = remote_address } };
-                _ = handleConnectionWithStream(allocator, ctx, stream) catch {};
-                _ = linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_DEL, event.data.fd, null);
-                stream.close(app_io);
-            }
+        const rc = posix.system.read(fd, buf.ptr, buf.len);
+        switch (posix.errno(rc)) {
+            .SUCCESS => return @intCast(rc),
+            .INTR => continue,
+            .AGAIN => return null,
+            else => return error.ConnectionResetByPeer,
         }
     }
 }
 
-fn eventLoopKqueue(allocator: Allocator, ctx: *const S3Context, server: *net.Server) !void {
-    const c = std.c;
-    const kq = c.kqueue();
-    if (kq < 0) return error.Kqueue;
-    defer _ = c.close(kq);
-
-    const server_fd = server.socket.handle;
-    var changes: [1]c.Kevent = .{.{
-        .ident = @intCast(server_fd),
-        .filter = c.EVFILT.READ,
-        .flags = c.EV.ADD,
-        .fflags = 0,
-        .data = 0,
-        .udata = 0,
-    }};
-    var events: [MAX_CONNECTIONS]c.Kevent = undefined;
-    var peer_addresses = std.AutoHashMap(posix.fd_t, net.IpAddress).init(allocator);
-    defer peer_addresses.deinit();
-    if (c.kevent(kq, &changes, 1, &events, 0, null) < 0) return error.Kevent;
-
+/// Gather-write to a non-blocking socket. `null` means the send buffer is full.
+fn sendNonBlocking(fd: posix.fd_t, parts: []const []const u8) !?usize {
+    var iov: [2]posix.iovec_const = undefined;
+    var count: usize = 0;
+    for (parts) |part| {
+        if (part.len == 0) continue;
+        iov[count] = .{ .base = part.ptr, .len = part.len };
+        count += 1;
+    }
+    if (count == 0) return 0;
     while (true) {
-        const nev = c.kevent(kq, &changes, 0, &events, MAX_CONNECTIONS, null);
-        if (nev < 0) continue;
+        const rc = posix.system.writev(fd, &iov, @intCast(count));
+        switch (posix.errno(rc)) {
+            .SUCCESS => return @intCast(rc),
+            .INTR => continue,
+            .AGAIN => return null,
+            else => return error.ConnectionResetByPeer,
+        }
+    }
+}
 
-        for (events[0..@intCast(nev)]) |ev| {
-            const fd: posix.fd_t = @intCast(ev.ident);
-            if (fd == server_fd) {
-                const conn = server.accept(app_io) catch continue;
-                peer_addresses.put(conn.socket.handle, conn.socket.address) catch {
-                    conn.close(app_io);
-                    continue;
-                };
-                var add: [1]c.Kevent = .{.{
-                    .ident = @intCast(conn.socket.handle),
-                    .filter = c.EVFILT.READ,
-                    .flags = c.EV.ADD | c.EV.ONESHOT,
-                    .fflags = 0,
-                    .data = 0,
-                    .udata = 0,
-                }};
-                const r = c.kevent(kq, &add, 1, &events, 0, null);
-                if (r < 0) std.log.err("kevent add failed", .{});
-            } else {
-                const remote_address = peer_addresses.get(fd) orelse net.IpAddress{ .ip4 = net.Ip4Address.unspecified(0) };
-                _ = peer_addresses.remove(fd);
-                const stream = net.Stream{ .socket = .{ .handle = fd, .address = remote_address } };
-                const keep = handleConnectionWithStream(allocator, ctx, stream) catch false;
-                if (keep) {
-                    peer_addresses.put(fd, remote_address) catch {
-                        stream.close(app_io);
-                        continue;
-                    };
-                    var add: [1]c.Kevent = .{.{
-                        .ident = @intCast(fd),
-                        .filter = c.EVFILT.READ,
-                        .flags = c.EV.ADD | c.EV.ONESHOT,
-                        .fflags = 0,
-                        .data = 0,
-                        .udata = 0,
-                    }};
-                    _ = c.kevent(kq, &add, 1, &events, 0, null);
-                } else {
-                    stream.close(app_io);
-                }
+/// Zero-copy `count` bytes of `file` starting at `offset` to a non-blocking
+/// socket. Returns how many bytes went out, or null if the socket is full.
+fn sendFileNonBlocking(sock: posix.fd_t, file: posix.fd_t, offset: u64, count: usize) !?usize {
+    if (builtin.os.tag == .linux) {
+        const linux = std.os.linux;
+        var off: i64 = @intCast(offset);
+        while (true) {
+            const rc = linux.sendfile(sock, file, &off, count);
+            switch (linux.errno(rc)) {
+                .SUCCESS => return if (rc == 0) error.EndOfStream else rc,
+                .INTR => continue,
+                .AGAIN => return null,
+                else => return error.ConnectionResetByPeer,
+            }
+        }
+    } else if (builtin.os.tag == .macos) {
+        while (true) {
+            // On EAGAIN/EINTR `len` still reports what was sent before the interruption
+            var len: std.c.off_t = @intCast(count);
+            const rc = std.c.sendfile(file, sock, @intCast(offset), &len, null, 0);
+            if (rc == 0) return if (len == 0) error.EndOfStream else @intCast(len);
+            switch (std.c.errno(rc)) {
+                .AGAIN => return if (len > 0) @intCast(len) else null,
+                .INTR => if (len > 0) return @intCast(len) else continue,
+                else => return error.ConnectionResetByPeer,
             }
         }
+    } else {
+        @compileError("sendfile is only wired up for Linux and macOS");
     }
 }
 
-const S3Context = struct {
-    allocator: Allocator,
-    data_dir: []const u8,
-    access_control_map: std.StringHashMap(acl.Credential),
-    distributed: ?*DistributedContext = null, // Optional distributed mode
+fn setNonBlocking(fd: posix.fd_t) !void {
+    const flags = posix.system.fcntl(fd, posix.F.GETFL, @as(usize, 0));
+    if (posix.errno(flags) != .SUCCESS) return error.Unexpected;
+    const nonblock = @as(usize, 1 << @bitOffsetOf(posix.O, "NONBLOCK"));
+    if (posix.errno(posix.system.fcntl(fd, posix.F.SETFL, @as(usize, @intCast(flags)) | nonblock)) != .SUCCESS)
+        return error.Unexpected;
+}
 
-    fn bucketPath(self: *const S3Context, allocator: Allocator, bucket: []const u8) ![]const u8 {
-        return std.fs.path.join(allocator, &[_][]const u8{ self.data_dir, bucket });
+/// Where the body of the request being read goes.
+const BodySink = union(enum) {
+    none,
+    memory: struct { data: []u8, filled: usize = 0 },
+    spool: BodySpool,
+    chunks: struct { writer: *ChunkWriter, buf: []u8, expected: u64 }, // large distributed PUT
+
+    fn remaining(self: *const BodySink) u64 {
+        return switch (self.*) {
+            .none => 0,
+            .memory => |m| m.data.len - m.filled,
+            .spool => |s| s.expected - s.size,
+            .chunks => |c| c.expected - c.writer.size,
+        };
     }
 
-    fn objectPath(self: *const S3Context, allocator: Allocator, bucket: []const u8, key: []const u8) ![]const u8 {
-        const path = try std.fs.path.join(allocator, &[_][]const u8{ self.data_dir, bucket, key });
-        // The flat-file layout turns a key into a filesystem path. Reject keys
-        // that cannot be stored on this platform with a clean client error
-        // instead of a 500 when the OS returns ENAMETOOLONG:
-        //   - a single component longer than NAME_MAX (255) cannot be a filename
-        //   - the full path must fit PATH_MAX (e.g. 1024 on macOS)
-        var component_itr = std.mem.splitScalar(u8, key, '/');
-        while (component_itr.next()) |component| {
-            if (component.len >= std.posix.NAME_MAX) {
-                allocator.free(path);
-                return error.NameTooLong;
-            }
+    /// Buffer the next socket read should land in. Never longer than what
+    /// is left of the body, so a pipelined request is never over-read.
+    fn readBuffer(self: *BodySink) []u8 {
+        return switch (self.*) {
+            .none => &.{},
+            .memory => |*m| m.data[m.filled..],
+            .spool => |*s| s.chunk[0..@intCast(@min(s.chunk.len, s.expected - s.size))],
+            .chunks => |*c| c.buf[0..@intCast(@min(c.buf.len, c.expected - c.writer.size))],
+        };
+    }
+
+    /// Account for `n` bytes received into readBuffer()
+    fn commit(self: *BodySink, n: usize) !void {
+        switch (self.*) {
+            .none => unreachable,
+            .memory => |*m| m.filled += n,
+            .spool => |*s| try s.write(s.chunk[0..n]),
+            .chunks => |*c| try c.writer.write(c.buf[0..n]),
         }
-        if (path.len >= std.posix.PATH_MAX) {
-            allocator.free(path);
-            return error.PathTooLong;
+    }
+
+    fn append(self: *BodySink, bytes: []const u8) !void {
+        switch (self.*) {
+            .none => unreachable,
+            .memory => |*m| {
+                @memcpy(m.data[m.filled..][0..bytes.len], bytes);
+                m.filled += bytes.len;
+            },
+            .spool => |*s| try s.write(bytes),
+            .chunks => |*c| try c.writer.write(bytes),
         }
-        return path;
     }
+};
 
-    pub fn deinit(self: *S3Context) void {
-        self.access_control_map.deinit();
+/// An aws-chunked request body on its way into a BodySink. Socket reads land
+/// in `raw`, and only the decoded payload reaches the sink.
+const ChunkedBody = struct {
+    decoder: AwsChunkedDecoder,
+    raw: []u8,
+    left: u64, // encoded bytes still to be received
+
+    /// Decode received bytes into `sink`. By the last encoded byte the
+    /// payload must have filled the sink exactly.
+    fn feed(self: *ChunkedBody, bytes: []const u8, sink: *BodySink) !void {
+        self.left -= bytes.len;
+        var rest = bytes;
+        while (rest.len > 0) {
+            const step = try self.decoder.decode(rest);
+            if (step.data.len > sink.remaining()) return error.MalformedChunk;
+            if (step.data.len > 0) try sink.append(step.data);
+            rest = rest[step.consumed..];
+        }
+        if (self.left == 0 and (!self.decoder.finished() or sink.remaining() != 0)) return error.MalformedChunk;
     }
 };
 
-const Request = struct {
-    method: []const u8,
-    path: []const u8,
-    query: []const u8,
-    headers: std.StringHashMap([]const u8),
-    body: []const u8,
-    remote_address: net.IpAddress,
+/// Per-socket state machine. A connection reads a request head, then its
+/// body, runs the handler, and writes the response, returning to the event
+/// loop whenever the socket would block, so one slow client never holds up
+/// the others. Bytes received past the end of a request (a pipelined
+/// follow-up) stay in `buf` for the next request.
+const Connection = struct {
+    stream: net.Stream,
+    phase: Phase = .head,
+    buf: [MAX_HEADER_SIZE]u8 = undefined,
+    len: usize = 0,
+    requests: u32 = 0,
+    last_active_ms: i64 = 0, // last progress in either direction
+    head_started_ms: i64 = 0, // first byte of the current request head
+    arena: std.heap.ArenaAllocator,
+    keep_alive: bool = false,
+    after_write: AfterWrite = .next_request,
+
+    // The request in flight
+    req: ?Request = null,
+    body: BodySink = .none,
+    chunked: ?ChunkedBody = null, // set when `body` is fed through the aws-chunked decoder
+    res: ?Response = null,
+    out: [2][]const u8 = .{ "", "" }, // unsent response head and in-memory body
+    file_sent: usize = 0,
+    chunk_head: [24]u8 = undefined, // framing of the streamed piece in `out`
+    chunks_sent: usize = 0,
+    stream_done: bool = false,
+
+    // io_uring loop only: the queued writev's vector, whether an operation
+    // is outstanding, and whether the connection is being torn down
+    iov: [2]posix.iovec_const = undefined,
+    in_flight: bool = false,
+    closing: bool = false,
+
+    // While the handler runs on the HandlerPool the loop leaves the
+    // connection alone, and gets it back through `table`
+    table: *ConnectionTable = undefined,
+    next_queued: ?*Connection = null, // in the pool's queue or the table's hand-back list
+    parked: bool = false, // loop thread only: handed to the pool and not back yet
+
+    const Phase = enum { head, body, handler, write, linger };
+    const AfterWrite = enum { next_request, close, linger };
+
+    /// What the connection is blocked on
+    const Need = union(enum) {
+        recv: []u8, // client bytes, into this buffer
+        send, // room in the socket for `out`, then the send_file range
+        park, // its handler, on the HandlerPool
+        close,
+    };
 
-    fn header(self: *const Request, name: []const u8) ?[]const u8 {
-        var lower_buf: [128]u8 = undefined;
-        const lower_name = std.ascii.lowerString(&lower_buf, name);
-        return self.headers.get(lower_name);
+    /// Drop the first `n` buffered bytes, keeping whatever follows them.
+    fn consume(self: *Connection, n: usize) void {
+        std.mem.copyForwards(u8, self.buf[0 .. self.len - n], self.buf[n..self.len]);
+        self.len -= n;
     }
 
-    fn deinit(self: *Request) void {
-        self.headers.deinit();
+    /// Queue a canned response (errors answered before a Request exists)
+    fn respondStatic(self: *Connection, msg: []const u8, after: AfterWrite) void {
+        self.out = .{ msg, "" };
+        self.after_write = after;
+        self.phase = .write;
     }
-};
-
-const Response = struct {
-    status: u16 = 200,
-    status_text: []const u8 = "OK",
-    headers: std.ArrayListUnmanaged(Header) = .empty,
-    body: []const u8 = "",
-    send_file: ?std.Io.File = null,
-    send_file_size: usize = 0,
-    send_file_offset: usize = 0,
-    allocator: Allocator,
-
-    const Header = struct { name: []const u8, value: []const u8 };
 
-    fn init(allocator: Allocator) Response {
-        return .{
-            .allocator = allocator,
-        };
+    /// Encoded body bytes still to be received from the socket
+    fn bodyLeft(self: *const Connection) u64 {
+        return if (self.chunked) |c| c.left else self.body.remaining();
     }
 
-    fn deinit(self: *Response) void {
-        self.headers.deinit(self.allocator);
-        if (self.send_file) |f| f.close(app_io);
+    /// Buffer the next body read should land in
+    fn bodyBuffer(self: *Connection) []u8 {
+        if (self.chunked) |*c| return c.raw[0..@intCast(@min(c.raw.len, c.left))];
+        return self.body.readBuffer();
     }
 
-    fn setHeader(self: *Response, name: []const u8, value: []const u8) void {
-        self.headers.append(self.allocator, .{ .name = name, .value = value }) catch {};
+    /// Account for `n` bytes received into bodyBuffer()
+    fn receivedBody(self: *Connection, n: usize) !void {
+        if (self.chunked) |*c| return self.decodeBody(c, c.raw[0..n]);
+        try self.body.commit(n);
     }
 
-    fn ok(self: *Response) void {
-        self.status = 200;
-        self.status_text = "OK";
+    /// Take body bytes that arrived together with the request head
+    fn appendBody(self: *Connection, bytes: []const u8) !void {
+        if (self.chunked) |*c| return self.decodeBody(c, bytes);
+        try self.body.append(bytes);
     }
 
-    fn noContent(self: *Response) void {
-        self.status = 204;
-        self.status_text = "No Content";
+    /// Decode aws-chunked bytes into the body sink. A bad chunk signature or
+    /// framing is answered right away instead of reading the rest of the
+    /// upload; the half-written body is dropped by endRequest.
+    fn decodeBody(self: *Connection, c: *ChunkedBody, bytes: []const u8) !void {
+        c.feed(bytes, &self.body) catch |err| switch (err) {
+            error.SignatureDoesNotMatch => return self.respondStatic(ERROR_403_CHUNK_SIGNATURE, .linger),
+            error.MalformedChunk => return self.respondStatic(ERROR_400_MALFORMED_CHUNK, .linger),
+            else => |e| return e,
+        };
     }
 
-    fn setXmlBody(self: *Response, body: []const u8) void {
-        self.setHeader("Content-Type", "application/xml");
-        self.body = body;
+    /// Whether the current response has been fully sent.
+    fn sendDone(self: *const Connection) bool {
+        if (self.out[0].len + self.out[1].len > 0) return false;
+        const res = self.res orelse return true;
+        if (res.head_only) return true;
+        if (res.stream != null) return self.stream_done;
+        if (res.send_file == null) return true;
+        return self.file_sent >= res.send_file_size;
+    }
+
+    /// Queue the next piece of a streamed body. A LIST body goes out as
+    /// HTTP chunks, each after the first starting with the CRLF that ends
+    /// the one before; a blob is framed by its Content-Length.
+    fn nextChunk(self: *Connection, stream: BodyStream) !void {
+        const data = try stream.next() orelse {
+            self.out = switch (stream) {
+                .list => .{ if (self.chunks_sent > 0) "\r\n0\r\n\r\n" else "0\r\n\r\n", "" },
+                .blob, .chunks => .{ "", "" },
+            };
+            self.stream_done = true;
+            return;
+        };
+        switch (stream) {
+            .list => {
+                const sep = if (self.chunks_sent > 0) "\r\n" else "";
+                self.out = .{ try std.fmt.bufPrint(&self.chunk_head, "{s}{x}\r\n", .{ sep, data.len }), data };
+            },
+            .blob, .chunks => self.out = .{ data, "" },
+        }
+        self.chunks_sent += 1;
     }
 
-    fn setSendFile(self: *Response, file: std.Io.File, size: usize, offset: usize) void {
-        self.send_file = file;
-        self.send_file_size = size;
-        self.send_file_offset = offset;
+    /// Account for `n` bytes of `out` taken by the socket.
+    fn sent(self: *Connection, n: usize, now: i64) void {
+        var left = n;
+        for (&self.out) |*part| {
+            const used = @min(left, part.len);
+            part.* = part.*[used..];
+            left -= used;
+        }
+        self.last_active_ms = now;
     }
 
-    fn write(self: *Response, stream: net.Stream) !void {
-        var buf: [8192]u8 = undefined;
-        var w: std.Io.Writer = .fixed(&buf);
+    /// Account for `n` bytes of the send_file range taken by the socket.
+    fn sentFile(self: *Connection, n: usize, now: i64) void {
+        self.file_sent += n;
+        self.last_active_ms = now;
+    }
 
-        try w.print("HTTP/1.1 {d} {s}\r\n", .{ self.status, self.status_text });
+    /// Zero-copy the rest of the send_file range without blocking.
+    /// Returns null once the socket is full.
+    fn sendFileChunk(self: *Connection) !?usize {
+        const res = &self.res.?;
+        return sendFileNonBlocking(self.stream.socket.handle, res.send_file.?.handle, res.send_file_offset + self.file_sent, res.send_file_size - self.file_sent);
+    }
 
-        // Check if Content-Length was already set via setHeader
-        var has_content_length = false;
-        for (self.headers.items) |h| {
-            if (std.ascii.eqlIgnoreCase(h.name, "content-length")) {
-                has_content_length = true;
-                break;
+    /// Run the state machine over what is already buffered, up to the point
+    /// where it needs the socket again.
+    fn advance(self: *Connection, ctx: *const S3Context, now: i64) Need {
+        while (true) {
+            switch (self.phase) {
+                .head => {
+                    if (findHeaderEnd(self.buf[0..self.len])) |header_end| {
+                        beginRequest(ctx, self, header_end, now) catch return .close;
+                        continue;
+                    }
+                    // If the 8KB buffer filled without seeing the header
+                    // terminator, the request headers exceed MAX_HEADER_SIZE.
+                    // Reject cleanly instead of parsing a truncated header section.
+                    if (self.len == self.buf.len) {
+                        self.respondStatic(ERROR_431, .linger);
+                        continue;
+                    }
+                    return .{ .recv = self.buf[self.len..] };
+                },
+                .body => {
+                    if (self.bodyLeft() == 0) {
+                        if (ctx.handler_pool) |pool| if (HandlerPool.wants(&self.req.?)) {
+                            self.parked = true;
+                            self.phase = .handler;
+                            pool.submit(self);
+                            return .park;
+                        };
+                        dispatchRequest(ctx, self) catch return .close;
+                        continue;
+                    }
+                    return .{ .recv = self.bodyBuffer() };
+                },
+                .handler => return .park,
+                .write => {
+                    if (self.out[0].len + self.out[1].len == 0 and !self.stream_done) {
+                        if (self.res) |res| if (res.stream) |stream| if (!res.head_only) {
+                            // The status line is already out; all that can be
+                            // done about a failure now is to cut the response short
+                            self.nextChunk(stream) catch |err| {
+                                std.log.err("Response stream failed: {}", .{err});
+                                return .close;
+                            };
+                        };
+                    }
+                    if (!self.sendDone()) return .send;
+                    switch (self.after_write) {
+                        .next_request => self.endRequest(),
+                        .close => return .close,
+                        .linger => {
+                            // The client may still be sending a request we
+                            // won't read. Closing with unread data queued sends
+                            // a RST, which can discard the error response, so
+                            // half-close and drain until the client hangs up.
+                            _ = posix.system.shutdown(self.stream.socket.handle, posix.SHUT.WR);
+                            self.endRequest();
+                            self.phase = .linger;
+                            self.len = 0;
+                        },
+                    }
+                },
+                // Drained bytes are thrown away
+                .linger => return .{ .recv = &self.buf },
             }
         }
+    }
 
-        // Only add auto Content-Length if not already set
-        if (!has_content_length) {
-            const content_len = if (self.send_file != null) self.send_file_size else self.body.len;
-            try w.print("Content-Length: {d}\r\n", .{content_len});
+    /// Account for `n` bytes received into the buffer advance() returned.
+    /// Returns false at end of stream: the client hung up, which mid-body
+    /// means a truncated upload that must not be acted on.
+    fn received(self: *Connection, n: usize, now: i64) bool {
+        if (n == 0) return false;
+        switch (self.phase) {
+            .head => {
+                if (self.len == 0) self.head_started_ms = now;
+                self.len += n;
+            },
+            .body => self.receivedBody(n) catch return false,
+            .linger => {},
+            .handler, .write => unreachable,
         }
-        try w.writeAll("Connection: close\r\n");
+        self.last_active_ms = now;
+        return true;
+    }
 
-        for (self.headers.items) |h| {
-            try w.print("{s}: {s}\r\n", .{ h.name, h.value });
+    /// Release everything belonging to the current request and get ready
+    /// for the next one on the same socket.
+    fn endRequest(self: *Connection) void {
+        switch (self.body) {
+            .spool => |*s| s.abort(),
+            .chunks => |c| c.writer.abort(),
+            else => {},
         }
-        try w.writeAll("\r\n");
-
-        try streamWriteAll(stream, w.buffered());
-
-        if (self.send_file) |file| {
-            // Use sendfile for zero-copy transfer
-            if (builtin.os.tag == .macos) {
-                var offset: i64 = @intCast(self.send_file_offset);
-                var remaining: usize = self.send_file_size;
-                while (remaining > 0) {
-                    var len: i64 = @intCast(remaining);
-                    const rc = std.c.sendfile(file.handle, stream.socket.handle, offset, &len, null, 0);
-                    if (len > 0) {
-                        offset += len;
-                        remaining -= @intCast(len);
-                    }
-                    if (rc == -1) {
-                        const e = std.c._errno().*;
-                        if (e == @intFromEnum(std.posix.E.AGAIN) or e == @intFromEnum(std.posix.E.INTR)) {
-                            app_io.sleep(.fromMilliseconds(1), .awake) catch {}; // 1ms
-                            continue;
-                        }
-                        break;
-                    }
-                }
-            } else if (builtin.os.tag == .linux) {
-                var offset: i64 = @intCast(self.send_file_offset);
-                var remaining: usize = self.send_file_size;
-                while (remaining > 0) {
-                    const rc = std.os.linux.sendfile(stream.socket.handle, file.handle, &offset, remaining);
-                    const sent = @as(isize, @bitCast(rc));
-                    if (sent <= 0) break;
-                    remaining -= @intCast(sent);
-                }
-            }
-        } else if (self.body.len > 0) {
-            try streamWriteAll(stream, self.body);
+        self.body = .none;
+        self.chunked = null;
+        if (self.req) |req| {
+            // A spooled body the handler didn't rename into place is garbage
+            if (req.spooled) |sp| std.Io.Dir.cwd().deleteFile(app_io, sp.path) catch {};
+            if (req.chunked) |w| w.abort();
         }
+        if (self.res) |*res| res.deinit();
+        self.req = null;
+        self.res = null;
+        self.out = .{ "", "" };
+        self.file_sent = 0;
+        self.chunks_sent = 0;
+        self.stream_done = false;
+        _ = self.arena.reset(.{ .retain_with_limit = 64 * 1024 });
+        self.phase = .head;
+        self.head_started_ms = self.last_active_ms;
+    }
+
+    fn deinit(self: *Connection) void {
+        self.endRequest();
+        self.arena.deinit();
+        self.stream.close(app_io);
+    }
+
+    /// Whether the connection has been stuck in its current phase for too long
+    fn timedOut(self: *const Connection, now: i64, timeouts: Timeouts) bool {
+        return switch (self.phase) {
+            .head => if (self.len == 0)
+                now - self.last_active_ms > timeouts.idle_ms
+            else
+                now - self.head_started_ms > timeouts.header_ms,
+            .body, .write => now - self.last_active_ms > timeouts.body_ms,
+            .linger => now - self.last_active_ms > LINGER_TIMEOUT_MS,
+            .handler => false, // expire() skips parked connections before asking
+        };
     }
 };
 
-fn parseRequestFromBuf(allocator: Allocator, data: []const u8, stream: net.Stream) !Request {
-    const total_read = data.len;
-    const line_end = std.mem.indexOf(u8, data, "\r\n") orelse return error.InvalidRequest;
-    const request_line = data[0..line_end];
+/// Socket I/O mechanism for the client event loops on Linux. macOS always
+/// uses kqueue.
+const IoBackend = enum { epoll, uring };
 
-    var parts = std.mem.splitScalar(u8, request_line, ' ');
-    const method = parts.next() orelse return error.InvalidRequest;
-    const full_path = parts.next() orelse return error.InvalidRequest;
-    var path: []const u8 = full_path;
-    var query: []const u8 = "";
-    if (std.mem.indexOf(u8, full_path, "?")) |q_idx| {
-        path = full_path[0..q_idx];
-        query = full_path[q_idx + 1 ..];
-    }
+/// Client-facing timeouts, in milliseconds.
+const Timeouts = struct {
+    header_ms: i64 = HEADER_TIMEOUT_MS, // whole request head, from its first byte
+    body_ms: i64 = BODY_TIMEOUT_MS, // without progress, receiving a body or sending a response
+    idle_ms: i64 = IDLE_TIMEOUT_MS, // keep-alive connection between requests
+};
 
-    var headers = std.StringHashMap([]const u8).init(allocator);
-    var header_section = data[line_end + 2 ..];
-    const header_end = std.mem.indexOf(u8, header_section, "\r\n\r\n") orelse header_section.len;
-    header_section = header_section[0..header_end];
+/// Lets another thread wake an event loop: an eventfd the loop reads on
+/// Linux, a user event on the loop's kqueue on macOS
+const Waker = struct {
+    fd: posix.fd_t = -1,
+    count: u64 = 0, // where reads of the eventfd land
 
-    var header_lines = std.mem.splitSequence(u8, header_section, "\r\n");
-    while (header_lines.next()) |line| {
-        if (line.len == 0) continue;
-        const colon = std.mem.indexOf(u8, line, ":") orelse continue;
-        var name_buf: [128]u8 = undefined;
-        const name = std.ascii.lowerString(&name_buf, std.mem.trim(u8, line[0..colon], " "));
-        const value = std.mem.trim(u8, line[colon + 1 ..], " ");
-        try headers.put(try allocator.dupe(u8, name), try allocator.dupe(u8, value));
+    const KQUEUE_IDENT = 0; // user events have an ident space of their own
+
+    fn openEventFd() !Waker {
+        const rc = std.os.linux.eventfd(0, std.os.linux.EFD.CLOEXEC);
+        if (@as(isize, @bitCast(rc)) < 0) return error.EventFd;
+        return .{ .fd = @intCast(rc) };
+    }
+
+    fn wake(self: *const Waker) void {
+        if (builtin.os.tag == .macos) {
+            const c = std.c;
+            var trigger: [1]c.Kevent = .{.{ .ident = KQUEUE_IDENT, .filter = c.EVFILT.USER, .flags = 0, .fflags = c.NOTE.TRIGGER, .data = 0, .udata = 0 }};
+            _ = c.kevent(self.fd, &trigger, 1, &trigger, 0, null);
+        } else {
+            const one: u64 = 1;
+            _ = posix.system.write(self.fd, std.mem.asBytes(&one), @sizeOf(u64));
+        }
+    }
+
+    /// Reset the eventfd once it has polled readable
+    fn drain(self: *Waker) void {
+        _ = posix.system.read(self.fd, std.mem.asBytes(&self.count), @sizeOf(u64));
+    }
+};
+
+/// Open client connections of one event loop, keyed by socket descriptor.
+const ConnectionTable = struct {
+    allocator: Allocator,
+    map: std.AutoHashMap(posix.fd_t, *Connection),
+    expired: std.ArrayListUnmanaged(posix.fd_t) = .empty,
+    // Connections whose handler has finished on the HandlerPool, for the
+    // loop to take back after `waker` fires
+    waker: Waker = .{},
+    handed_back_mutex: std.Io.Mutex = .init,
+    handed_back: ?*Connection = null,
+
+    fn init(allocator: Allocator) ConnectionTable {
+        return .{ .allocator = allocator, .map = std.AutoHashMap(posix.fd_t, *Connection).init(allocator) };
+    }
+
+    fn deinit(self: *ConnectionTable) void {
+        var it = self.map.valueIterator();
+        while (it.next()) |conn| {
+            conn.*.deinit();
+            self.allocator.destroy(conn.*);
+        }
+        self.map.deinit();
+        self.expired.deinit(self.allocator);
+    }
+
+    fn add(self: *ConnectionTable, stream: net.Stream) !*Connection {
+        try setNonBlocking(stream.socket.handle);
+        // Responses go out in several writes (a streamed LIST, the head
+        // before a sendfile body); don't let Nagle hold the last one back
+        // until the client's delayed ACK
+        const one: c_int = 1;
+        posix.setsockopt(stream.socket.handle, posix.IPPROTO.TCP, posix.TCP.NODELAY, std.mem.asBytes(&one)) catch {};
+        const conn = try self.allocator.create(Connection);
+        errdefer self.allocator.destroy(conn);
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        conn.* = .{ .stream = stream, .arena = .init(self.allocator), .last_active_ms = now, .head_started_ms = now, .table = self };
+        try self.map.put(stream.socket.handle, conn);
+        return conn;
+    }
+
+    /// Called on a HandlerPool thread once `conn`'s response is ready
+    fn handBack(self: *ConnectionTable, conn: *Connection) void {
+        self.handed_back_mutex.lockUncancelable(app_io);
+        conn.next_queued = self.handed_back;
+        self.handed_back = conn;
+        self.handed_back_mutex.unlock(app_io);
+        self.waker.wake();
+    }
+
+    /// The connections handed back since the last call, as a list linked
+    /// through `next_queued`
+    fn takeHandedBack(self: *ConnectionTable) ?*Connection {
+        self.handed_back_mutex.lockUncancelable(app_io);
+        defer self.handed_back_mutex.unlock(app_io);
+        defer self.handed_back = null;
+        return self.handed_back;
+    }
+
+    /// Closing the descriptor also drops it from the epoll/kqueue set.
+    fn close(self: *ConnectionTable, fd: posix.fd_t) void {
+        const conn = (self.map.fetchRemove(fd) orelse return).value;
+        conn.deinit();
+        self.allocator.destroy(conn);
+    }
+
+    /// Connections that have overrun their phase's timeout. The slice is
+    /// valid until the next call.
+    fn expire(self: *ConnectionTable, now: i64, timeouts: Timeouts) []const posix.fd_t {
+        self.expired.clearRetainingCapacity();
+        var it = self.map.iterator();
+        while (it.next()) |entry| {
+            if (entry.value_ptr.*.parked) continue; // its phase belongs to the pool thread
+            if (entry.value_ptr.*.timedOut(now, timeouts))
+                self.expired.append(self.allocator, entry.key_ptr.*) catch break;
+        }
+        return self.expired.items;
+    }
+
+    /// Close connections that have overrun their phase's timeout.
+    fn reapExpired(self: *ConnectionTable, now: i64, timeouts: Timeouts) void {
+        for (self.expire(now, timeouts)) |fd| self.close(fd);
+    }
+};
+
+/// Advance `conn` as far as it can go with non-blocking socket calls.
+/// On .wait the caller waits for the readiness `conn.phase` needs (writable
+/// in .write, readable otherwise). On .park the connection belongs to the
+/// HandlerPool until it is handed back, and must not be touched.
+fn driveConnection(ctx: *const S3Context, conn: *Connection) enum { wait, park, close } {
+    const fd = conn.stream.socket.handle;
+    while (true) {
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        switch (conn.advance(ctx, now)) {
+            .close => return .close,
+            .park => return .park,
+            .recv => |buf| {
+                const n = (recvNonBlocking(fd, buf) catch return .close) orelse return .wait;
+                if (!conn.received(n, now)) return .close;
+            },
+            .send => if (conn.out[0].len + conn.out[1].len > 0) {
+                const n = (sendNonBlocking(fd, &conn.out) catch return .close) orelse return .wait;
+                conn.sent(n, now);
+            } else {
+                const n = (conn.sendFileChunk() catch return .close) orelse return .wait;
+                conn.sentFile(n, now);
+            },
+        }
+    }
+}
+
+/// A complete request head is buffered: parse it and set up the body sink.
+fn beginRequest(ctx: *const S3Context, conn: *Connection, header_end: usize, now: i64) !void {
+    const head = conn.buf[0 .. header_end + 4];
+    conn.requests += 1;
+    conn.last_active_ms = now;
+    // Bodies we don't frame ourselves (Transfer-Encoding) can't be skipped
+    // reliably, so those connections are not reused.
+    const transfer_encoded = rawHeaderValue(head, "transfer-encoding") != null;
+    conn.keep_alive = requestKeepAlive(head) and
+        conn.requests < MAX_REQUESTS_PER_CONNECTION and
+        !transfer_encoded;
+    // Where the body ends is ambiguous: nothing after this head can be
+    // trusted to be the next request
+    const content_length = requestContentLength(head) orelse {
+        conn.keep_alive = false;
+        conn.consume(head.len);
+        conn.respondStatic(ERROR_400_BAD_FRAMING, .linger);
+        return;
+    };
+
+    // Allow peer protocol endpoints without auth
+    const is_peer_protocol = if (std.mem.indexOf(u8, head, "/_zs3/")) |_| true else false;
+    if (!is_peer_protocol and !hasAuth(head)) {
+        // The body is never read, so the connection can only be reused when
+        // there isn't one. A HEAD response carries the Content-Length but
+        // not the body.
+        const head_only = std.mem.startsWith(u8, head, "HEAD ");
+        const reuse = conn.keep_alive and content_length == 0;
+        const msg = if (reuse) ERROR_403 else ERROR_403_CLOSE;
+        conn.consume(head.len);
+        conn.respondStatic(if (head_only) msg[0 .. msg.len - 6] else msg, if (reuse) .next_request else if (content_length > 0 or transfer_encoded) .linger else .close);
+        return;
+    }
+    if (content_length > MAX_BODY_SIZE) {
+        conn.consume(head.len);
+        conn.respondStatic(ERROR_400_ENTITY_TOO_LARGE, .linger);
+        return;
+    }
+
+    const alloc = conn.arena.allocator();
+    var req = try parseRequestHead(alloc, head, conn.stream.socket.address);
+    conn.consume(head.len);
+
+    if (content_length > 0) {
+        const is_peer = std.mem.startsWith(u8, req.path, "/_zs3/");
+        const is_aws_chunked = if (req.header("x-amz-content-sha256")) |sha|
+            std.mem.eql(u8, sha, "STREAMING-AWS4-HMAC-SHA256-PAYLOAD")
+        else
+            false;
+
+        // Size of the payload itself, once any aws-chunked framing is removed
+        var body_length = content_length;
+        if (is_aws_chunked) {
+            const decoded = req.header("x-amz-decoded-content-length") orelse {
+                conn.respondStatic(ERROR_411_DECODED_LENGTH, .linger);
+                return;
+            };
+            body_length = std.fmt.parseInt(u64, decoded, 10) catch {
+                conn.respondStatic(ERROR_400_MALFORMED_CHUNK, .linger);
+                return;
+            };
+            if (body_length > content_length) {
+                conn.respondStatic(ERROR_400_MALFORMED_CHUNK, .linger);
+                return;
+            }
+
+            // Chunk signatures chain from the request signature, so check
+            // that now: a forged upload is refused before its body is read.
+            var decoder: AwsChunkedDecoder = .{};
+            if (!is_peer) {
+                const verified = SigV4.authenticate(ctx, &req, alloc) orelse {
+                    conn.respondStatic(ERROR_403_STREAM_DENIED, .linger);
+                    return;
+                };
+                req.authorized = .{ .authenticated = true, .role = verified.role };
+                const auth = verified.auth;
+                decoder.signer = SigV4.ChunkSigner.init(alloc, verified.signing_key, verified.amz_date, auth.date, auth.region, auth.service, auth.signature) catch {
+                    conn.respondStatic(ERROR_403_STREAM_DENIED, .linger);
+                    return;
+                };
+            }
+            conn.chunked = .{
+                .decoder = decoder,
+                .raw = try alloc.alloc(u8, @intCast(@min(content_length, SPOOL_CHUNK_SIZE))),
+                .left = content_length,
+            };
+        }
+
+        // Handle Expect: 100-continue - send 100 Continue before reading body.
+        // Nothing else is queued on the socket yet, so this tiny write fits.
+        if (req.header("expect")) |expect| {
+            if (std.ascii.eqlIgnoreCase(expect, "100-continue")) {
+                _ = sendNonBlocking(conn.stream.socket.handle, &.{"HTTP/1.1 100 Continue\r\n\r\n"}) catch null;
+            }
+        }
+
+        // Large object uploads, and blobs pushed by peers, go to disk in
+        // fixed-size chunks so memory per upload stays flat. In distributed
+        // mode an object big enough to be stored in chunks is cut into them
+        // as it arrives.
+        const is_blob_push = std.mem.startsWith(u8, req.path, "/_zs3/blob/");
+        const is_put = std.mem.eql(u8, req.method, "PUT");
+        if (is_put and body_length > CHUNK_SIZE and !is_peer and ctx.distributed != null and !hasQuery(req.query, "uploadId")) {
+            const writer = try alloc.create(ChunkWriter);
+            writer.* = .init(alloc, &ctx.distributed.?.cas);
+            conn.body = .{ .chunks = .{ .writer = writer, .buf = try alloc.alloc(u8, SPOOL_CHUNK_SIZE), .expected = body_length } };
+        } else if (is_put and body_length > STREAM_BODY_THRESHOLD and (!is_peer or is_blob_push)) {
+            const hasher: BodyHasher = if (hasQuery(req.query, "uploadId"))
+                .{ .sha256 = .init(.{}) }
+            else if (ctx.distributed != null)
+                .{ .blake3 = .init(.{}) }
+            else
+                .{ .wyhash = .init(0) };
+            conn.body = .{ .spool = try BodySpool.open(alloc, ctx.data_dir, body_length, hasher) };
+        } else {
+            conn.body = .{ .memory = .{ .data = try alloc.alloc(u8, @intCast(body_length)) } };
+        }
+    }
+    conn.req = req;
+    conn.phase = .body;
+
+    if (content_length > 0) {
+        // Body bytes that arrived together with the head
+        const buffered: usize = @intCast(@min(conn.len, content_length));
+        try conn.appendBody(conn.buf[0..buffered]);
+        conn.consume(buffered);
+    }
+}
+
+/// The body is complete: run the handler and queue its response.
+fn dispatchRequest(ctx: *const S3Context, conn: *Connection) !void {
+    const alloc = conn.arena.allocator();
+    const req = &conn.req.?;
+    switch (conn.body) {
+        .none => {},
+        .memory => |m| req.body = m.data,
+        .spool => |*s| req.spooled = s.finish(),
+        .chunks => |c| req.chunked = c.writer,
+    }
+    conn.body = .none;
+
+    conn.res = Response.init(alloc);
+    const res = &conn.res.?;
+    res.keep_alive = conn.keep_alive;
+    res.head_only = std.mem.eql(u8, req.method, "HEAD");
+
+    route(ctx, alloc, req, res) catch |err| {
+        switch (err) {
+            error.PathTooLong, error.NameTooLong => sendError(res, 400, "KeyTooLong", "Object key is too long for the filesystem (path or filename component limit)"),
+            else => {
+                std.log.err("Handler error: {}", .{err});
+                sendError(res, 500, "InternalError", "Internal server error");
+            },
+        }
+    };
+
+    const body = if (res.head_only or res.send_file != null or res.stream != null) "" else res.body;
+    conn.out = .{ try res.formatHead(alloc), body };
+    conn.after_write = if (conn.keep_alive) .next_request else .close;
+    conn.phase = .write;
+}
+
+/// Runs write requests off the event loops under --durability=group. Their
+/// commits wait for the committer's next flush, and on a loop thread that
+/// wait would hold up every other connection on the loop. The connection is
+/// parked while its handler runs here, then handed back to its loop to send
+/// the response. Up to GROUP_COMMIT_THREADS writes wait at once, and they
+/// share a flush.
+const HandlerPool = struct {
+    ctx: *const S3Context = undefined,
+    mutex: std.Io.Mutex = .init,
+    cond: std.Io.Condition = .init,
+    head: ?*Connection = null, // FIFO linked through next_queued
+    tail: ?*Connection = null,
+
+    /// Requests that may commit a file: uploads, multipart completion, and
+    /// blobs and metadata pushed by peers
+    fn wants(req: *const Request) bool {
+        return std.mem.eql(u8, req.method, "PUT") or std.mem.eql(u8, req.method, "POST");
+    }
+
+    fn submit(self: *HandlerPool, conn: *Connection) void {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        conn.next_queued = null;
+        if (self.tail) |tail| tail.next_queued = conn else self.head = conn;
+        self.tail = conn;
+        self.cond.signal(app_io);
+    }
+
+    fn run(self: *HandlerPool) void {
+        while (true) {
+            self.mutex.lockUncancelable(app_io);
+            while (self.head == null) self.cond.waitUncancelable(app_io, &self.mutex);
+            const conn = self.head.?;
+            self.head = conn.next_queued;
+            if (self.head == null) self.tail = null;
+            self.mutex.unlock(app_io);
+
+            dispatchRequest(self.ctx, conn) catch {
+                // No response could be made; the loop closes the connection
+                if (conn.res) |*res| res.deinit();
+                conn.res = null;
+                conn.respondStatic("", .close);
+            };
+            conn.table.handBack(conn);
+        }
+    }
+};
+
+fn eventLoopEpoll(allocator: Allocator, ctx: *const S3Context, server: *net.Server) !void {
+    const linux = std.os.linux;
+    const epfd = linux.epoll_create1(linux.EPOLL.CLOEXEC);
+    if (@as(isize, @bitCast(epfd)) < 0) return error.EpollCreate;
+    defer _ = linux.close(@intCast(epfd));
+
+    var ev = linux.epoll_event{ .events = linux.EPOLL.IN, .data = .{ .fd = server.socket.handle } };
+    if (@as(isize, @bitCast(linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_ADD, server.socket.handle, &ev))) < 0)
+        return error.EpollCtl;
+
+    var events: [MAX_CONNECTIONS]linux.epoll_event = undefined;
+    var connections = ConnectionTable.init(allocator);
+    defer connections.deinit();
+    var last_sweep = std.Io.Clock.awake.now(app_io).toMilliseconds();
+
+    connections.waker = try Waker.openEventFd();
+    defer _ = linux.close(connections.waker.fd);
+    var wev = linux.epoll_event{ .events = linux.EPOLL.IN, .data = .{ .fd = connections.waker.fd } };
+    if (@as(isize, @bitCast(linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_ADD, connections.waker.fd, &wev))) < 0)
+        return error.EpollCtl;
+
+    while (true) {
+        // Wake at least once a second so timed-out connections are reaped
+        const n = linux.epoll_wait(@intCast(epfd), &events, MAX_CONNECTIONS, 1000);
+        if (@as(isize, @bitCast(n)) < 0) continue;
+
+        for (events[0..n]) |event| {
+            const fd = event.data.fd;
+            if (fd == connections.waker.fd) {
+                connections.waker.drain();
+                var next = connections.takeHandedBack();
+                while (next) |conn| {
+                    next = conn.next_queued;
+                    conn.parked = false;
+                    const conn_fd = conn.stream.socket.handle;
+                    switch (driveConnection(ctx, conn)) {
+                        .close => connections.close(conn_fd),
+                        .park => {},
+                        .wait => epollRearm(@intCast(epfd), conn_fd, null, epollInterest(conn)),
+                    }
+                }
+            } else if (fd == server.socket.handle) {
+                const stream = server.accept(app_io) catch continue;
+                _ = connections.add(stream) catch {
+                    stream.close(app_io);
+                    continue;
+                };
+                var cev = linux.epoll_event{ .events = linux.EPOLL.IN, .data = .{ .fd = stream.socket.handle } };
+                _ = linux.epoll_ctl(@intCast(epfd), linux.EPOLL.CTL_ADD, stream.socket.handle, &cev);
+            } else {
+                const conn = connections.map.get(fd) orelse continue;
+                const before = epollInterest(conn);
+                switch (driveConnection(ctx, conn)) {
+                    .close => connections.close(fd),
+                    .park => epollRearm(@intCast(epfd), fd, before, null),
+                    .wait => epollRearm(@intCast(epfd), fd, before, epollInterest(conn)),
+                }
+            }
+        }
+
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        if (now - last_sweep >= 1000) {
+            connections.reapExpired(now, ctx.timeouts);
+            last_sweep = now;
+        }
+    }
+}
+
+/// The readiness the epoll loop waits for on `conn`'s socket: whichever
+/// direction the state machine is blocked on
+fn epollInterest(conn: *const Connection) u32 {
+    return if (conn.phase == .write) std.os.linux.EPOLL.OUT else std.os.linux.EPOLL.IN;
+}
+
+/// Change the registration of `fd` from `before` to `after`. A parked
+/// socket is taken out of the set, so a hang-up can't wake the loop for it.
+fn epollRearm(epfd: i32, fd: posix.fd_t, before: ?u32, after: ?u32) void {
+    const linux = std.os.linux;
+    if (before == after) return;
+    var ev = linux.epoll_event{ .events = after orelse 0, .data = .{ .fd = fd } };
+    const op: u32 = if (after == null) linux.EPOLL.CTL_DEL else if (before == null) linux.EPOLL.CTL_ADD else linux.EPOLL.CTL_MOD;
+    _ = linux.epoll_ctl(epfd, op, fd, &ev);
+}
+
+/// io_uring counterpart of eventLoopEpoll. Instead of waiting for readiness
+/// and then making a recv/send syscall per socket, every socket operation
+/// is queued on the ring, and one io_uring_enter per loop iteration submits
+/// them all and collects whatever finished. Handlers still run synchronously
+/// on this thread, exactly as with epoll.
+fn eventLoopUring(allocator: Allocator, ctx: *const S3Context, server: *net.Server, ring: *std.os.linux.IoUring) !void {
+    const linux = std.os.linux;
+    var connections = ConnectionTable.init(allocator);
+    defer connections.deinit();
+    defer ring.deinit(); // before the connections, whose buffers it may still reference
+
+    // user_data = fd << 8 | op. A connection is only freed once its one
+    // outstanding operation has completed, so an fd can't be reused while
+    // a completion for it is still due.
+    const Op = enum(u8) { accept, tick, wake, recv, send, poll_out };
+    const Ring = struct {
+        ring: *linux.IoUring,
+
+        fn userData(fd: posix.fd_t, op: Op) u64 {
+            return @as(u64, @as(u32, @bitCast(fd))) << 8 | @intFromEnum(op);
+        }
+
+        /// Make room in the submission queue by submitting what is queued
+        fn sqe(self: @This()) !void {
+            if (self.ring.sq_ready() >= self.ring.sq.sqes.len) _ = try self.ring.submit();
+        }
+
+        /// Queue the next operation `conn` is blocked on, or start closing it.
+        fn pump(self: @This(), c: *const S3Context, table: *ConnectionTable, conn: *Connection) void {
+            const fd = conn.stream.socket.handle;
+            while (!conn.closing) {
+                const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+                switch (conn.advance(c, now)) {
+                    .close => break,
+                    .park => return, // nothing queued until it is handed back
+                    .recv => |buf| {
+                        self.sqe() catch break;
+                        _ = self.ring.recv(userData(fd, .recv), fd, .{ .buffer = buf }, 0) catch break;
+                        conn.in_flight = true;
+                        return;
+                    },
+                    .send => if (conn.out[0].len + conn.out[1].len > 0) {
+                        var count: usize = 0;
+                        for (conn.out) |part| {
+                            if (part.len == 0) continue;
+                            conn.iov[count] = .{ .base = part.ptr, .len = part.len };
+                            count += 1;
+                        }
+                        self.sqe() catch break;
+                        _ = self.ring.writev(userData(fd, .send), fd, conn.iov[0..count], 0) catch break;
+                        conn.in_flight = true;
+                        return;
+                    } else {
+                        // sendfile has no ring opcode; it runs inline and waits
+                        // for room through the ring when the socket is full
+                        const n = (conn.sendFileChunk() catch break) orelse {
+                            self.sqe() catch break;
+                            _ = self.ring.poll_add(userData(fd, .poll_out), fd, linux.POLL.OUT) catch break;
+                            conn.in_flight = true;
+                            return;
+                        };
+                        conn.sentFile(n, now);
+                    },
+                }
+            }
+            beginClose(table, conn);
+        }
+
+        /// Shutting the socket down completes any outstanding operation;
+        /// the connection is freed when that completion arrives.
+        fn beginClose(table: *ConnectionTable, conn: *Connection) void {
+            conn.closing = true;
+            if (conn.in_flight) {
+                _ = posix.system.shutdown(conn.stream.socket.handle, posix.SHUT.RDWR);
+            } else {
+                table.close(conn.stream.socket.handle);
+            }
+        }
+    };
+    const r: Ring = .{ .ring = ring };
+
+    var accept_addr: std.Io.Threaded.PosixAddress = undefined;
+    var accept_len: posix.socklen_t = @sizeOf(std.Io.Threaded.PosixAddress);
+    _ = try ring.accept(Ring.userData(server.socket.handle, .accept), server.socket.handle, &accept_addr.any, &accept_len, posix.SOCK.CLOEXEC);
+
+    // Wake at least once a second so timed-out connections are reaped
+    const tick: linux.kernel_timespec = .{ .sec = 1, .nsec = 0 };
+    _ = try ring.timeout(Ring.userData(0, .tick), &tick, 0, 0);
+
+    connections.waker = try Waker.openEventFd();
+    defer _ = linux.close(connections.waker.fd);
+    const waker_buf = std.mem.asBytes(&connections.waker.count);
+    _ = try ring.read(Ring.userData(connections.waker.fd, .wake), connections.waker.fd, .{ .buffer = waker_buf }, 0);
+
+    var cqes: [256]linux.io_uring_cqe = undefined;
+    while (true) {
+        _ = ring.submit_and_wait(1) catch |err| switch (err) {
+            error.SignalInterrupt => continue,
+            else => return err,
+        };
+        const n = try ring.copy_cqes(&cqes, 0);
+
+        for (cqes[0..n]) |cqe| {
+            const op: Op = @enumFromInt(@as(u8, @truncate(cqe.user_data)));
+            const fd: posix.fd_t = @bitCast(@as(u32, @truncate(cqe.user_data >> 8)));
+            switch (op) {
+                .accept => {
+                    if (cqe.res >= 0) accepted: {
+                        const stream: net.Stream = .{ .socket = .{
+                            .handle = cqe.res,
+                            .address = std.Io.Threaded.addressFromPosix(&accept_addr),
+                        } };
+                        const conn = connections.add(stream) catch {
+                            stream.close(app_io);
+                            break :accepted;
+                        };
+                        r.pump(ctx, &connections, conn);
+                    }
+                    accept_len = @sizeOf(std.Io.Threaded.PosixAddress);
+                    r.sqe() catch {};
+                    _ = try ring.accept(Ring.userData(server.socket.handle, .accept), server.socket.handle, &accept_addr.any, &accept_len, posix.SOCK.CLOEXEC);
+                },
+                .tick => {
+                    const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+                    for (connections.expire(now, ctx.timeouts)) |expired_fd| {
+                        const conn = connections.map.get(expired_fd) orelse continue;
+                        if (!conn.closing) Ring.beginClose(&connections, conn);
+                    }
+                    r.sqe() catch {};
+                    _ = try ring.timeout(Ring.userData(0, .tick), &tick, 0, 0);
+                },
+                .wake => {
+                    var next = connections.takeHandedBack();
+                    while (next) |conn| {
+                        next = conn.next_queued;
+                        conn.parked = false;
+                        r.pump(ctx, &connections, conn);
+                    }
+                    r.sqe() catch {};
+                    _ = try ring.read(Ring.userData(connections.waker.fd, .wake), connections.waker.fd, .{ .buffer = waker_buf }, 0);
+                },
+                .recv, .send, .poll_out => {
+                    const conn = connections.map.get(fd) orelse continue;
+                    conn.in_flight = false;
+                    if (conn.closing) {
+                        connections.close(fd);
+                        continue;
+                    }
+                    const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+                    if (cqe.res < 0) {
+                        switch (@as(linux.E, @enumFromInt(-cqe.res))) {
+                            .AGAIN, .INTR => {}, // just try again
+                            else => {
+                                Ring.beginClose(&connections, conn);
+                                continue;
+                            },
+                        }
+                    } else if (op == .recv) {
+                        if (!conn.received(@intCast(cqe.res), now)) {
+                            Ring.beginClose(&connections, conn);
+                            continue;
+                        }
+                    } else if (op == .send) {
+                        conn.sent(@intCast(cqe.res), now);
+                    }
+                    r.pump(ctx, &connections, conn);
+                },
+            }
+        }
+    }
+}
+
+fn eventLoopKqueue(allocator: Allocator, ctx: *const S3Context, server: *net.Server) !void {
+    const c = std.c;
+    const kq = c.kqueue();
+    if (kq < 0) return error.Kqueue;
+    defer _ = c.close(kq);
+
+    const server_fd = server.socket.handle;
+    var changes: [1]c.Kevent = .{.{
+        .ident = @intCast(server_fd),
+        .filter = c.EVFILT.READ,
+        .flags = c.EV.ADD,
+        .fflags = 0,
+        .data = 0,
+        .udata = 0,
+    }};
+    var events: [MAX_CONNECTIONS]c.Kevent = undefined;
+    var connections = ConnectionTable.init(allocator);
+    defer connections.deinit();
+    if (c.kevent(kq, &changes, 1, &events, 0, null) < 0) return error.Kevent;
+
+    connections.waker = .{ .fd = kq };
+    var user: [1]c.Kevent = .{.{ .ident = Waker.KQUEUE_IDENT, .filter = c.EVFILT.USER, .flags = c.EV.ADD | c.EV.CLEAR, .fflags = 0, .data = 0, .udata = 0 }};
+    if (c.kevent(kq, &user, 1, &events, 0, null) < 0) return error.Kevent;
+
+    // Wake at least once a second so timed-out connections are reaped
+    const tick: c.timespec = .{ .sec = 1, .nsec = 0 };
+    var last_sweep = std.Io.Clock.awake.now(app_io).toMilliseconds();
+
+    while (true) {
+        const nev = c.kevent(kq, &changes, 0, &events, MAX_CONNECTIONS, &tick);
+        if (nev < 0) continue;
+
+        for (events[0..@intCast(nev)]) |ev| {
+            if (ev.filter == c.EVFILT.USER) {
+                var next = connections.takeHandedBack();
+                while (next) |conn| {
+                    next = conn.next_queued;
+                    conn.parked = false;
+                    const conn_fd = conn.stream.socket.handle;
+                    switch (driveConnection(ctx, conn)) {
+                        // Closing the descriptor removes its kevent registrations
+                        .close => connections.close(conn_fd),
+                        .park => {},
+                        .wait => kqueueRearm(kq, conn_fd, .none, kqueueInterest(conn)),
+                    }
+                }
+                continue;
+            }
+            const fd: posix.fd_t = @intCast(ev.ident);
+            if (fd == server_fd) {
+                const stream = server.accept(app_io) catch continue;
+                _ = connections.add(stream) catch {
+                    stream.close(app_io);
+                    continue;
+                };
+                // Both filters are registered up front; the write filter
+                // stays disabled until a response has to wait for the socket
+                const client: usize = @intCast(stream.socket.handle);
+                var add: [2]c.Kevent = .{
+                    .{ .ident = client, .filter = c.EVFILT.READ, .flags = c.EV.ADD, .fflags = 0, .data = 0, .udata = 0 },
+                    .{ .ident = client, .filter = c.EVFILT.WRITE, .flags = c.EV.ADD | c.EV.DISABLE, .fflags = 0, .data = 0, .udata = 0 },
+                };
+                const r = c.kevent(kq, &add, 2, &events, 0, null);
+                if (r < 0) std.log.err("kevent add failed", .{});
+            } else {
+                const conn = connections.map.get(fd) orelse continue;
+                const before = kqueueInterest(conn);
+                switch (driveConnection(ctx, conn)) {
+                    .close => connections.close(fd),
+                    .park => kqueueRearm(kq, fd, before, .none),
+                    .wait => kqueueRearm(kq, fd, before, kqueueInterest(conn)),
+                }
+            }
+        }
+
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        if (now - last_sweep >= 1000) {
+            connections.reapExpired(now, ctx.timeouts);
+            last_sweep = now;
+        }
+    }
+}
+
+const KqueueInterest = enum { read, write, none };
+
+/// The kqueue filter the loop waits on for `conn`, as for epollInterest
+fn kqueueInterest(conn: *const Connection) KqueueInterest {
+    return if (conn.phase == .write) .write else .read;
+}
+
+/// Enable the filter for `after` and disable the others
+fn kqueueRearm(kq: i32, fd: posix.fd_t, before: KqueueInterest, after: KqueueInterest) void {
+    const c = std.c;
+    if (before == after) return;
+    const client: usize = @intCast(fd);
+    var flip: [2]c.Kevent = .{
+        .{ .ident = client, .filter = c.EVFILT.READ, .flags = if (after == .read) c.EV.ENABLE else c.EV.DISABLE, .fflags = 0, .data = 0, .udata = 0 },
+        .{ .ident = client, .filter = c.EVFILT.WRITE, .flags = if (after == .write) c.EV.ENABLE else c.EV.DISABLE, .fflags = 0, .data = 0, .udata = 0 },
+    };
+    _ = c.kevent(kq, &flip, 2, &flip, 0, null);
+}
+
+pub const S3Context = struct {
+    allocator: Allocator,
+    data_dir: []const u8,
+    access_control_map: std.StringHashMap(acl.Credential),
+    distributed: ?*DistributedContext = null, // Optional distributed mode
+    committer: *Committer,
+    key_index: *KeyIndex,
+    timeouts: Timeouts = .{},
+    io_backend: IoBackend = .epoll,
+    handler_pool: ?*HandlerPool = null, // --durability=group only
+
+    fn bucketPath(self: *const S3Context, allocator: Allocator, bucket: []const u8) ![]const u8 {
+        return std.fs.path.join(allocator, &[_][]const u8{ self.data_dir, bucket });
+    }
+
+    fn objectPath(self: *const S3Context, allocator: Allocator, bucket: []const u8, key: []const u8) ![]const u8 {
+        const path = try std.fs.path.join(allocator, &[_][]const u8{ self.data_dir, bucket, key });
+        // The flat-file layout turns a key into a filesystem path. Reject keys
+        // that cannot be stored on this platform with a clean client error
+        // instead of a 500 when the OS returns ENAMETOOLONG:
+        //   - a single component longer than NAME_MAX (255) cannot be a filename
+        //   - the full path must fit PATH_MAX (e.g. 1024 on macOS)
+        var component_itr = std.mem.splitScalar(u8, key, '/');
+        while (component_itr.next()) |component| {
+            if (component.len >= std.posix.NAME_MAX) {
+                allocator.free(path);
+                return error.NameTooLong;
+            }
+        }
+        if (path.len >= std.posix.PATH_MAX) {
+            allocator.free(path);
+            return error.PathTooLong;
+        }
+        return path;
+    }
+
+    pub fn deinit(self: *S3Context) void {
+        self.access_control_map.deinit();
+    }
+};
+
+pub const Request = struct {
+    method: []const u8,
+    path: []const u8,
+    query: []const u8,
+    headers: std.StringHashMap([]const u8),
+    body: []const u8,
+    remote_address: net.IpAddress,
+    // Large PUT bodies arrive here instead of in `body`
+    spooled: ?SpooledBody = null,
+    // ...or, for an object stored in chunks, already cut and stored
+    chunked: ?*ChunkWriter = null,
+    // Set when the signature was already checked before the body was read
+    authorized: ?SigV4.ACLCtx = null,
+
+    fn header(self: *const Request, name: []const u8) ?[]const u8 {
+        var lower_buf: [128]u8 = undefined;
+        const lower_name = std.ascii.lowerString(&lower_buf, name);
+        return self.headers.get(lower_name);
+    }
+
+    fn deinit(self: *Request) void {
+        self.headers.deinit();
+    }
+};
+
+/// Fresh path for a scratch file under `<data_dir>/.tmp/`. That directory is
+/// on the same filesystem as the buckets and the CAS, so finished files can
+/// be renamed into place.
+fn tempFilePath(allocator: Allocator, data_dir: []const u8) ![]const u8 {
+    var rand: [8]u8 = undefined;
+    app_io.random(&rand);
+    var hex: [16]u8 = undefined;
+    bytesToHex(&rand, &hex);
+    return std.fs.path.join(allocator, &.{ data_dir, ".tmp", &hex });
+}
+
+/// How far a write must get before the request that made it is answered.
+const Durability = enum {
+    none, // renamed into place; the kernel flushes it when it likes
+    fsync, // file and directory fsynced before replying
+    group, // as fsync, but writers queued within --group-commit-ms share one flush
+
+    fn parse(s: []const u8) ?Durability {
+        return std.meta.stringToEnum(Durability, s);
+    }
+};
+
+/// Publishes finished temp files at their final paths. Object, part, blob
+/// and metadata writes all go through here, so after a crash a reader sees
+/// the old file or the new one, never a torn mix. How much has reached the
+/// disk by the time `commit` returns depends on `mode`.
+///
+/// A group commit waits for the next flush, which must not happen on an
+/// event loop thread: it would hold up every connection on the loop. Write
+/// requests run on the HandlerPool in group mode, and anything else that
+/// commits from a loop thread is flushed on its own, as in fsync mode.
+pub const Committer = struct {
+    data_dir: []const u8,
+    mode: Durability = .none,
+    interval_ms: u64 = GROUP_COMMIT_MS,
+    mutex: std.Io.Mutex = .init,
+    cond: std.Io.Condition = .init,
+    queue: std.ArrayListUnmanaged(*Pending) = .empty, // owned by std.heap.page_allocator
+
+    /// A group-mode commit waiting for the next flush. Lives on the
+    /// writer's stack; the writer blocks until `done`.
+    pub const Pending = struct {
+        tmp_path: []const u8,
+        final_path: []const u8,
+        done: bool = false,
+        err: ?anyerror = null,
+    };
+
+    /// Write `parts` to a fresh temp file and commit it at `path`.
+    pub fn writeFile(self: *Committer, allocator: Allocator, path: []const u8, parts: []const []const u8) !void {
+        const tmp_path = try tempFilePath(allocator, self.data_dir);
+        defer allocator.free(tmp_path);
+        errdefer std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
+        {
+            var file = try std.Io.Dir.cwd().createFile(app_io, tmp_path, .{ .exclusive = true });
+            defer file.close(app_io);
+            for (parts) |part| try file.writeStreamingAll(app_io, part);
+        }
+        try self.commit(tmp_path, path);
+    }
+
+    /// Atomically replace `final_path` with the finished file at
+    /// `tmp_path`. On error the temp file is left for the caller.
+    pub fn commit(self: *Committer, tmp_path: []const u8, final_path: []const u8) !void {
+        switch (self.mode) {
+            .none => try std.Io.Dir.rename(std.Io.Dir.cwd(), tmp_path, std.Io.Dir.cwd(), final_path, app_io),
+            .fsync => try commitSynced(tmp_path, final_path),
+            .group => {
+                if (in_event_loop) return commitSynced(tmp_path, final_path);
+                var pending: Pending = .{ .tmp_path = tmp_path, .final_path = final_path };
+                self.mutex.lockUncancelable(app_io);
+                defer self.mutex.unlock(app_io);
+                try self.queue.append(std.heap.page_allocator, &pending);
+                while (!pending.done) self.cond.waitUncancelable(app_io, &self.mutex);
+                if (pending.err) |err| return err;
+            },
+        }
     }
 
-    var body: []const u8 = "";
-    if (headers.get("content-length")) |cl_str| {
-        const content_length = std.fmt.parseInt(usize, cl_str, 10) catch 0;
-        if (content_length > MAX_BODY_SIZE) return error.PayloadTooLarge;
-        if (content_length > 0) {
-            // Handle Expect: 100-continue - send 100 Continue before reading body
-            if (headers.get("expect")) |expect| {
-                if (std.ascii.eqlIgnoreCase(expect, "100-continue")) {
-                    streamWriteAll(stream, "HTTP/1.1 100 Continue\r\n\r\n") catch {};
-                }
-            }
+    fn commitSynced(tmp_path: []const u8, final_path: []const u8) !void {
+        // Data first, so the rename can never expose an unwritten file
+        try syncFile(tmp_path);
+        try std.Io.Dir.rename(std.Io.Dir.cwd(), tmp_path, std.Io.Dir.cwd(), final_path, app_io);
+        try syncDir(std.fs.path.dirname(final_path) orelse ".");
+    }
 
-            const body_start_idx = std.mem.indexOf(u8, data, "\r\n\r\n").? + 4;
-            // Ensure we don't underflow: already_read = max(0, total_read - body_start_idx)
-            const already_read = if (total_read > body_start_idx) total_read - body_start_idx else 0;
-            // Cap already_read to content_length to prevent overflow in memcpy
-            const bytes_to_copy = @min(already_read, content_length);
+    /// Group-commit thread: flushes whatever has queued every `interval_ms`
+    pub fn run(self: *Committer) void {
+        var batch: std.ArrayListUnmanaged(*Pending) = .empty;
+        var dirs: std.StringHashMapUnmanaged(?anyerror) = .empty;
+        while (true) {
+            std.Io.sleep(app_io, .fromMilliseconds(@intCast(self.interval_ms)), .awake) catch {};
+            _ = self.flush(&batch, &dirs);
+        }
+    }
 
-            const body_buf = try allocator.alloc(u8, content_length);
-            if (bytes_to_copy > 0) {
-                @memcpy(body_buf[0..bytes_to_copy], data[body_start_idx .. body_start_idx + bytes_to_copy]);
-            }
+    /// Take the queued commits, fsync their files, rename them into place,
+    /// fsync each directory they touched once, and wake the writers.
+    /// Returns how many commits the flush covered.
+    pub fn flush(self: *Committer, batch: *std.ArrayListUnmanaged(*Pending), dirs: *std.StringHashMapUnmanaged(?anyerror)) usize {
+        const allocator = std.heap.page_allocator;
+        self.mutex.lockUncancelable(app_io);
+        std.mem.swap(std.ArrayListUnmanaged(*Pending), &self.queue, batch);
+        self.mutex.unlock(app_io);
+        const count = batch.items.len;
+        if (count == 0) return 0;
 
-            var remaining = content_length - bytes_to_copy;
-            var offset = bytes_to_copy;
-            while (remaining > 0) {
-                const n = streamRead(stream, body_buf[offset..]) catch |err| {
-                    // Handle non-blocking sockets - retry on WouldBlock
-                    if (err == error.WouldBlock) {
-                        app_io.sleep(.fromMilliseconds(1), .awake) catch {}; // 1ms sleep before retry
-                        continue;
-                    }
-                    return err;
-                };
-                if (n == 0) break;
-                offset += n;
-                remaining -= n;
-            }
-            body = body_buf;
+        for (batch.items) |p| syncFile(p.tmp_path) catch |err| {
+            p.err = err;
+        };
+        for (batch.items) |p| {
+            if (p.err != null) continue;
+            std.Io.Dir.rename(std.Io.Dir.cwd(), p.tmp_path, std.Io.Dir.cwd(), p.final_path, app_io) catch |err| {
+                p.err = err;
+                continue;
+            };
+            const dir = std.fs.path.dirname(p.final_path) orelse ".";
+            const gop = dirs.getOrPut(allocator, dir) catch {
+                p.err = error.OutOfMemory;
+                continue;
+            };
+            if (!gop.found_existing) gop.value_ptr.* = if (syncDir(dir)) |_| null else |err| err;
+            if (gop.value_ptr.*) |err| p.err = err;
+        }
+        // Keys point into the writers' paths, which go away once they wake
+        dirs.clearRetainingCapacity();
 
-            // Decode AWS chunked transfer encoding if present
-            if (headers.get("x-amz-content-sha256")) |sha| {
-                if (std.mem.eql(u8, sha, "STREAMING-AWS4-HMAC-SHA256-PAYLOAD")) {
-                    const decoded = try decodeAwsChunked(allocator, body);
-                    body = decoded;
-                }
+        self.mutex.lockUncancelable(app_io);
+        for (batch.items) |p| p.done = true;
+        self.mutex.unlock(app_io);
+        self.cond.broadcast(app_io);
+        batch.clearRetainingCapacity();
+        return count;
+    }
+
+    /// Commits waiting for the next flush
+    pub fn queued(self: *Committer) usize {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        return self.queue.items.len;
+    }
+
+    fn syncFile(path: []const u8) !void {
+        var file = try std.Io.Dir.cwd().openFile(app_io, path, .{});
+        defer file.close(app_io);
+        try file.sync(app_io);
+    }
+
+    /// Makes a rename or create in `path` durable
+    fn syncDir(path: []const u8) !void {
+        // .iterate opens a real descriptor (not O_PATH), which fsync needs
+        var dir = try std.Io.Dir.cwd().openDir(app_io, path, .{ .iterate = true });
+        defer dir.close(app_io);
+        switch (posix.errno(posix.system.fsync(dir.handle))) {
+            .SUCCESS => {},
+            .INVAL, .ROFS => {}, // filesystem doesn't sync directories
+            else => return error.InputOutput,
+        }
+    }
+};
+
+/// Incremental digest of an upload. Each handler names its object by a
+/// different hash, so only the one it will use is computed.
+const BodyHasher = union(enum) {
+    wyhash: std.hash.Wyhash, // standalone PUT ETag
+    sha256: SigV4.Sha256, // UploadPart ETag
+    blake3: CAS.Blake3, // distributed content hash
+
+    fn update(self: *BodyHasher, bytes: []const u8) void {
+        switch (self.*) {
+            inline else => |*h| h.update(bytes),
+        }
+    }
+
+    fn final(self: *BodyHasher) BodyDigest {
+        switch (self.*) {
+            .wyhash => |*h| return .{ .wyhash = h.final() },
+            .sha256 => |*h| return .{ .sha256 = h.finalResult() },
+            .blake3 => |*h| {
+                var full: [32]u8 = undefined;
+                h.final(&full);
+                return .{ .blake3 = full[0..20].* };
+            },
+        }
+    }
+};
+
+const BodyDigest = union(enum) {
+    wyhash: u64,
+    sha256: [32]u8,
+    blake3: ContentHash,
+};
+
+/// A request body streamed to a temp file instead of memory. The digest is
+/// computed as the bytes go by, so handlers only rename the file into place.
+/// Whatever is still at `path` after the request is deleted.
+const SpooledBody = struct {
+    path: []const u8,
+    size: u64,
+    digest: BodyDigest,
+};
+
+/// Temp file a large request body is written to as it arrives, hashing
+/// on the way, in SPOOL_CHUNK_SIZE pieces.
+const BodySpool = struct {
+    file: std.Io.File,
+    path: []const u8,
+    size: u64 = 0,
+    expected: u64,
+    hasher: BodyHasher,
+    chunk: []u8, // socket reads land here before going to the file
+
+    fn open(allocator: Allocator, data_dir: []const u8, content_length: u64, hasher: BodyHasher) !BodySpool {
+        const path = try tempFilePath(allocator, data_dir);
+        const file = try std.Io.Dir.cwd().createFile(app_io, path, .{ .exclusive = true });
+        errdefer {
+            file.close(app_io);
+            std.Io.Dir.cwd().deleteFile(app_io, path) catch {};
+        }
+        return .{
+            .file = file,
+            .path = path,
+            .expected = content_length,
+            .hasher = hasher,
+            .chunk = try allocator.alloc(u8, SPOOL_CHUNK_SIZE),
+        };
+    }
+
+    fn write(self: *BodySpool, bytes: []const u8) !void {
+        self.hasher.update(bytes);
+        try self.file.writeStreamingAll(app_io, bytes);
+        self.size += bytes.len;
+    }
+
+    /// All `expected` bytes are in: close the file and hand it to the handler
+    fn finish(self: *BodySpool) SpooledBody {
+        self.file.close(app_io);
+        return .{ .path = self.path, .size = self.size, .digest = self.hasher.final() };
+    }
+
+    /// The request died before the body completed
+    fn abort(self: *BodySpool) void {
+        self.file.close(app_io);
+        std.Io.Dir.cwd().deleteFile(app_io, self.path) catch {};
+    }
+};
+
+/// A response body produced piece by piece while it is sent
+const BodyStream = union(enum) {
+    list: *ListStream, // sent with chunked encoding
+    blob: *BlobFetch, // size known up front
+    chunks: *ChunkStream, // likewise
+
+    fn next(self: BodyStream) !?[]const u8 {
+        return switch (self) {
+            inline else => |s| s.next(),
+        };
+    }
+
+    /// Content-Length, or null for a chunked body
+    fn length(self: BodyStream) ?u64 {
+        return switch (self) {
+            .list => null,
+            .blob => |b| b.size,
+            .chunks => |c| c.size,
+        };
+    }
+
+    fn deinit(self: BodyStream) void {
+        switch (self) {
+            inline else => |s| s.deinit(),
+        }
+    }
+};
+
+const Response = struct {
+    status: u16 = 200,
+    status_text: []const u8 = "OK",
+    headers: std.ArrayListUnmanaged(Header) = .empty,
+    body: []const u8 = "",
+    send_file: ?std.Io.File = null,
+    send_file_size: usize = 0,
+    send_file_offset: usize = 0,
+    stream: ?BodyStream = null, // body produced while sending
+    keep_alive: bool = false,
+    head_only: bool = false, // HEAD: send headers (incl. Content-Length) but no body
+    allocator: Allocator,
+
+    const Header = struct { name: []const u8, value: []const u8 };
+
+    fn init(allocator: Allocator) Response {
+        return .{
+            .allocator = allocator,
+        };
+    }
+
+    fn deinit(self: *Response) void {
+        self.headers.deinit(self.allocator);
+        if (self.send_file) |f| f.close(app_io);
+        if (self.stream) |s| s.deinit();
+    }
+
+    fn setHeader(self: *Response, name: []const u8, value: []const u8) void {
+        self.headers.append(self.allocator, .{ .name = name, .value = value }) catch {};
+    }
+
+    fn ok(self: *Response) void {
+        self.status = 200;
+        self.status_text = "OK";
+    }
+
+    fn noContent(self: *Response) void {
+        self.status = 204;
+        self.status_text = "No Content";
+    }
+
+    fn setXmlBody(self: *Response, body: []const u8) void {
+        self.setHeader("Content-Type", "application/xml");
+        self.body = body;
+    }
+
+    fn setStream(self: *Response, stream: *ListStream) void {
+        self.setHeader("Content-Type", "application/xml");
+        self.setHeader("Transfer-Encoding", "chunked");
+        self.stream = .{ .list = stream };
+    }
+
+    fn setBlobStream(self: *Response, fetch: *BlobFetch) void {
+        self.stream = .{ .blob = fetch };
+    }
+
+    fn setSendFile(self: *Response, file: std.Io.File, size: usize, offset: usize) void {
+        self.send_file = file;
+        self.send_file_size = size;
+        self.send_file_offset = offset;
+    }
+
+    /// Status line and headers. The body (or `send_file`) is sent after
+    /// it by the connection, unless `head_only`.
+    fn formatHead(self: *const Response, allocator: Allocator) ![]const u8 {
+        const buf = try allocator.alloc(u8, 8192);
+        var w: std.Io.Writer = .fixed(buf);
+
+        try w.print("HTTP/1.1 {d} {s}\r\n", .{ self.status, self.status_text });
+
+        // Check if Content-Length was already set via setHeader
+        var has_content_length = false;
+        for (self.headers.items) |h| {
+            if (std.ascii.eqlIgnoreCase(h.name, "content-length")) {
+                has_content_length = true;
+                break;
             }
         }
+
+        // Only add auto Content-Length if not already set. A streamed LIST
+        // body is framed by its chunks instead.
+        if (!has_content_length) {
+            const content_len: ?u64 = if (self.stream) |s|
+                s.length()
+            else if (self.send_file != null)
+                self.send_file_size
+            else
+                self.body.len;
+            if (content_len) |len| try w.print("Content-Length: {d}\r\n", .{len});
+        }
+        try w.writeAll(if (self.keep_alive) "Connection: keep-alive\r\n" else "Connection: close\r\n");
+
+        for (self.headers.items) |h| {
+            try w.print("{s}: {s}\r\n", .{ h.name, h.value });
+        }
+        try w.writeAll("\r\n");
+        return w.buffered();
+    }
+};
+
+/// Parse a request line and headers (`head` ends with the blank line).
+/// The body is read separately by the connection state machine.
+fn parseRequestHead(allocator: Allocator, head: []const u8, remote_address: net.IpAddress) !Request {
+    const line_end = std.mem.indexOf(u8, head, "\r\n") orelse return error.InvalidRequest;
+    const request_line = head[0..line_end];
+
+    var parts = std.mem.splitScalar(u8, request_line, ' ');
+    const method = parts.next() orelse return error.InvalidRequest;
+    const full_path = parts.next() orelse return error.InvalidRequest;
+    var path: []const u8 = full_path;
+    var query: []const u8 = "";
+    if (std.mem.indexOf(u8, full_path, "?")) |q_idx| {
+        path = full_path[0..q_idx];
+        query = full_path[q_idx + 1 ..];
+    }
+
+    var headers = std.StringHashMap([]const u8).init(allocator);
+    var header_section = head[line_end + 2 ..];
+    const header_end = std.mem.indexOf(u8, header_section, "\r\n\r\n") orelse header_section.len;
+    header_section = header_section[0..header_end];
+
+    var header_lines = std.mem.splitSequence(u8, header_section, "\r\n");
+    while (header_lines.next()) |line| {
+        if (line.len == 0) continue;
+        const colon = std.mem.indexOf(u8, line, ":") orelse continue;
+        var name_buf: [128]u8 = undefined;
+        const name = std.ascii.lowerString(&name_buf, std.mem.trim(u8, line[0..colon], " "));
+        const value = std.mem.trim(u8, line[colon + 1 ..], " ");
+        try headers.put(try allocator.dupe(u8, name), try allocator.dupe(u8, value));
     }
 
     return Request{
@@ -1944,8 +5093,8 @@ fn parseRequestFromBuf(allocator: Allocator, data: []const u8, stream: net.Strea
         .path = try allocator.dupe(u8, path),
         .query = try allocator.dupe(u8, query),
         .headers = headers,
-        .body = body,
-        .remote_address = stream.socket.address,
+        .body = "",
+        .remote_address = remote_address,
     };
 }
 
@@ -1989,67 +5138,62 @@ fn findHeaderEnd(data: []const u8) ?usize {
     return null;
 }
 
-fn handleConnectionWithStream(allocator: Allocator, ctx: *const S3Context, stream: net.Stream) !bool {
-    var buf: [MAX_HEADER_SIZE]u8 = undefined;
-    var total_read: usize = 0;
-
-    while (total_read < buf.len) {
-        const n = streamRead(stream, buf[total_read..]) catch return false;
-        if (n == 0) return false;
-        total_read += n;
-        if (findHeaderEnd(buf[0..total_read])) |_| break;
-    }
-    if (total_read == 0) return false;
-    // If the 8KB buffer filled without seeing the header terminator, the
-    // request headers exceed MAX_HEADER_SIZE. Reject cleanly instead of
-    // parsing a truncated header section.
-    if (findHeaderEnd(buf[0..total_read]) == null) {
-        streamWriteAll(stream, ERROR_431) catch return false;
-        // Give the client's remaining bytes a moment to arrive, then drain
-        // them so the close is a clean FIN. Closing with unread data in the
-        // receive buffer sends a RST, which discards the 431 response.
-        app_io.sleep(.fromMilliseconds(1), .awake) catch {};
-        var discard: [512]u8 = undefined;
-        for (0..64) |_| {
-            const n = streamRead(stream, &discard) catch break;
-            if (n == 0) break;
+/// Look up a header in a raw request head (request line + header lines)
+/// without parsing it into a map. Name matching is case-insensitive.
+pub fn rawHeaderValue(head: []const u8, name: []const u8) ?[]const u8 {
+    var lines = std.mem.splitSequence(u8, head, "\r\n");
+    _ = lines.next(); // request line
+    while (lines.next()) |line| {
+        if (line.len == 0) break;
+        const colon = std.mem.indexOfScalar(u8, line, ':') orelse continue;
+        if (std.ascii.eqlIgnoreCase(std.mem.trim(u8, line[0..colon], " "), name)) {
+            return std.mem.trim(u8, line[colon + 1 ..], " \t");
         }
-        return false;
-    }
-
-    const data = buf[0..total_read];
-
-    // Allow peer protocol endpoints without auth
-    const is_peer_protocol = if (std.mem.indexOf(u8, data, "/_zs3/")) |_| true else false;
-    if (!is_peer_protocol and !hasAuth(data)) {
-        streamWriteAll(stream, ERROR_403) catch return false;
-        return true;
     }
+    return null;
+}
 
-    var arena = std.heap.ArenaAllocator.init(allocator);
-    defer arena.deinit();
-    const alloc = arena.allocator();
-
-    var req = parseRequestFromBuf(alloc, data, stream) catch |err| {
-        if (err == error.PayloadTooLarge) {
-            streamWriteAll(stream, ERROR_400_ENTITY_TOO_LARGE) catch return false;
-        }
-        return false;
-    };
-    var res = Response.init(alloc);
-
-    route(ctx, alloc, &req, &res) catch |err| {
-        switch (err) {
-            error.PathTooLong, error.NameTooLong => sendError(&res, 400, "KeyTooLong", "Object key is too long for the filesystem (path or filename component limit)"),
-            else => {
-                std.log.err("Handler error: {}", .{err});
-                sendError(&res, 500, "InternalError", "Internal server error");
-            },
+/// The request body's length from its Content-Length header, 0 without
+/// one. Null when the body can't be framed unambiguously: a value that
+/// isn't a plain decimal number, more than one Content-Length, or a
+/// Content-Length alongside Transfer-Encoding.
+pub fn requestContentLength(head: []const u8) ?u64 {
+    var length: ?u64 = null;
+    var transfer_encoded = false;
+    var lines = std.mem.splitSequence(u8, head, "\r\n");
+    _ = lines.next(); // request line
+    while (lines.next()) |line| {
+        if (line.len == 0) break;
+        const colon = std.mem.indexOfScalar(u8, line, ':') orelse continue;
+        const name = std.mem.trim(u8, line[0..colon], " ");
+        if (std.ascii.eqlIgnoreCase(name, "transfer-encoding")) {
+            transfer_encoded = true;
+        } else if (std.ascii.eqlIgnoreCase(name, "content-length")) {
+            if (length != null) return null;
+            // parseInt alone would take "+5" and "1_0"
+            const value = std.mem.trim(u8, line[colon + 1 ..], " \t");
+            if (value.len == 0) return null;
+            for (value) |c| if (!std.ascii.isDigit(c)) return null;
+            length = std.fmt.parseInt(u64, value, 10) catch return null;
         }
-    };
+    }
+    if (transfer_encoded and length != null) return null;
+    return length orelse 0;
+}
 
-    res.write(stream) catch return false;
-    return false;
+/// Whether the client asked for the connection to stay open after this
+/// request: HTTP/1.1 persists unless "Connection: close" is sent, HTTP/1.0
+/// only with an explicit "Connection: keep-alive".
+pub fn requestKeepAlive(head: []const u8) bool {
+    const line_end = std.mem.indexOf(u8, head, "\r\n") orelse head.len;
+    const http11 = std.mem.endsWith(u8, head[0..line_end], "HTTP/1.1");
+    const connection = rawHeaderValue(head, "connection") orelse return http11;
+    var tokens = std.mem.tokenizeAny(u8, connection, ", ");
+    while (tokens.next()) |token| {
+        if (std.ascii.eqlIgnoreCase(token, "close")) return false;
+        if (std.ascii.eqlIgnoreCase(token, "keep-alive")) return true;
+    }
+    return http11;
 }
 
 pub fn isValidBucketName(name: []const u8) bool {
@@ -2097,7 +5241,7 @@ fn route(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Respo
         return;
     }
 
-    const acl_ctx = SigV4.verify(ctx, req, allocator);
+    const acl_ctx = req.authorized orelse SigV4.verify(ctx, req, allocator);
 
     // S3 API requires authentication
     if (!acl_ctx.authenticated) {
@@ -2214,57 +5358,46 @@ pub const SigV4 = struct {
         }
     };
 
-    fn verify(ctx: *const S3Context, req: *const Request, allocator: Allocator) ACLCtx {
-        var acl_ctx = ACLCtx{
-            .authenticated = false,
-            .role = null,
-        };
+    /// A request whose Authorization header checked out
+    const Verified = struct {
+        role: acl.Role,
+        auth: ParsedAuth,
+        amz_date: []const u8,
+        signing_key: [32]u8,
+    };
 
-        const auth_header = req.header("authorization") orelse return acl_ctx;
-        const x_amz_date = req.header("x-amz-date") orelse return acl_ctx;
-        const x_amz_content_sha256 = req.header("x-amz-content-sha256") orelse "UNSIGNED-PAYLOAD";
+    pub fn verify(ctx: *const S3Context, req: *const Request, allocator: Allocator) ACLCtx {
+        const verified = authenticate(ctx, req, allocator) orelse
+            return .{ .authenticated = false, .role = null };
+        return .{ .authenticated = true, .role = verified.role };
+    }
 
-        const parsed = parseAuthHeader(auth_header) orelse return acl_ctx;
-        const credential = ctx.access_control_map.get(parsed.access_key);
+    fn authenticate(ctx: *const S3Context, req: *const Request, allocator: Allocator) ?Verified {
+        const auth_header = req.header("authorization") orelse return null;
+        const x_amz_date = req.header("x-amz-date") orelse return null;
+        const x_amz_content_sha256 = req.header("x-amz-content-sha256") orelse "UNSIGNED-PAYLOAD";
 
-        if (credential == null) {
-            return acl_ctx;
-        }
+        const parsed = parseAuthHeader(auth_header) orelse return null;
+        const entry = ctx.access_control_map.getEntry(parsed.access_key) orelse return null;
+        const credential = entry.value_ptr.*;
 
-        const canonical = buildCanonicalRequest(
+        const canonical_hash = hashCanonicalRequest(
             allocator,
             req,
             parsed.signed_headers,
             x_amz_content_sha256,
-        ) catch return acl_ctx;
-        defer allocator.free(canonical);
+        ) catch return null;
 
-        const string_to_sign = buildStringToSign(
-            allocator,
-            x_amz_date,
-            parsed.date,
-            parsed.region,
-            parsed.service,
-            canonical,
-        ) catch return acl_ctx;
-        defer allocator.free(string_to_sign);
-
-        const calculated_sig = calculateSignature(
-            allocator,
-            credential.?.secret_key,
-            parsed.date,
-            parsed.region,
-            parsed.service,
-            string_to_sign,
-        ) catch return acl_ctx;
-        defer allocator.free(calculated_sig);
-
-        if (std.mem.eql(u8, calculated_sig, parsed.signature)) {
-            acl_ctx.authenticated = true;
-            acl_ctx.role = credential.?.role;
-        }
+        const signing_key = signing_keys.get(entry.key_ptr.*, credential.secret_key, parsed.date, parsed.region, parsed.service);
+        const calculated_sig = calculateSignature(&signing_key, x_amz_date, parsed.date, parsed.region, parsed.service, canonical_hash);
+        if (!std.mem.eql(u8, &calculated_sig, parsed.signature)) return null;
 
-        return acl_ctx;
+        return .{
+            .role = credential.role,
+            .auth = parsed,
+            .amz_date = x_amz_date,
+            .signing_key = signing_key,
+        };
     }
 
     pub fn parseAuthHeader(header: []const u8) ?ParsedAuth {
@@ -2292,85 +5425,74 @@ pub const SigV4 = struct {
         return result;
     }
 
-    fn buildCanonicalRequest(
+    /// SHA-256 of the canonical request. The pieces are fed to the hash as
+    /// they are produced rather than assembled in a buffer first.
+    fn hashCanonicalRequest(
         allocator: Allocator,
         req: *const Request,
         signed_headers: []const u8,
         payload_hash: []const u8,
-    ) ![]const u8 {
-        var result: std.ArrayListUnmanaged(u8) = .empty;
-        errdefer result.deinit(allocator);
+    ) ![32]u8 {
+        var h = Sha256.init(.{});
 
-        try result.appendSlice(allocator, req.method);
-        try result.append(allocator, '\n');
+        h.update(req.method);
+        h.update("\n");
 
         // S3 uses single URI encoding — the path from the HTTP request line
         // is already URI-encoded, so use it as-is (no double-encoding)
-        const canonical_path = if (req.path.len == 0) "/" else req.path;
-        try result.appendSlice(allocator, canonical_path);
-        try result.append(allocator, '\n');
-
-        const sorted_query = try sortQueryString(allocator, req.query);
-        defer allocator.free(sorted_query);
-        try result.appendSlice(allocator, sorted_query);
-        try result.append(allocator, '\n');
+        h.update(if (req.path.len == 0) "/" else req.path);
+        h.update("\n");
+
+        // Sort the query in a stack buffer; requests with an unusual number
+        // of parameters take the allocating path.
+        var pairs_buf: [MAX_STACK_QUERY_PARAMS][]const u8 = undefined;
+        if (splitQueryPairs(req.query, &pairs_buf)) |pairs| {
+            std.mem.sort([]const u8, pairs, {}, queryPairLessThan);
+            for (pairs, 0..) |pair, i| {
+                if (i > 0) h.update("&");
+                h.update(pair);
+                if (std.mem.indexOfScalar(u8, pair, '=') == null) h.update("=");
+            }
+        } else {
+            const sorted_query = try sortQueryString(allocator, req.query);
+            defer allocator.free(sorted_query);
+            h.update(sorted_query);
+        }
+        h.update("\n");
 
         var header_iter = std.mem.splitScalar(u8, signed_headers, ';');
         while (header_iter.next()) |header_name| {
             const value = req.header(header_name) orelse "";
-            try result.appendSlice(allocator, header_name);
-            try result.append(allocator, ':');
-            try result.appendSlice(allocator, std.mem.trim(u8, value, " \t"));
-            try result.append(allocator, '\n');
+            h.update(header_name);
+            h.update(":");
+            h.update(std.mem.trim(u8, value, " \t"));
+            h.update("\n");
         }
-        try result.append(allocator, '\n');
+        h.update("\n");
 
-        try result.appendSlice(allocator, signed_headers);
-        try result.append(allocator, '\n');
+        h.update(signed_headers);
+        h.update("\n");
 
-        try result.appendSlice(allocator, payload_hash);
+        h.update(payload_hash);
 
-        return result.toOwnedSlice(allocator);
+        return h.finalResult();
     }
 
-    fn buildStringToSign(
-        allocator: Allocator,
-        amz_date: []const u8,
-        date_stamp: []const u8,
-        region: []const u8,
-        service: []const u8,
-        canonical_request: []const u8,
-    ) ![]const u8 {
-        var result: std.ArrayListUnmanaged(u8) = .empty;
-        errdefer result.deinit(allocator);
-
-        try result.appendSlice(allocator, "AWS4-HMAC-SHA256\n");
-        try result.appendSlice(allocator, amz_date);
-        try result.append(allocator, '\n');
-
-        try result.appendSlice(allocator, date_stamp);
-        try result.append(allocator, '/');
-        try result.appendSlice(allocator, region);
-        try result.append(allocator, '/');
-        try result.appendSlice(allocator, service);
-        try result.appendSlice(allocator, "/aws4_request\n");
-
-        const canonical_hash = hash(canonical_request);
-        var hex_buf: [64]u8 = undefined;
-        _ = std.fmt.bufPrint(&hex_buf, "{x}", .{canonical_hash}) catch unreachable;
-        try result.appendSlice(allocator, &hex_buf);
-
-        return result.toOwnedSlice(allocator);
+    /// Non-empty query parameters of `query`, or null if there are more than
+    /// `buf` holds.
+    fn splitQueryPairs(query: []const u8, buf: [][]const u8) ?[][]const u8 {
+        var n: usize = 0;
+        var iter = std.mem.splitScalar(u8, query, '&');
+        while (iter.next()) |pair| {
+            if (pair.len == 0) continue;
+            if (n == buf.len) return null;
+            buf[n] = pair;
+            n += 1;
+        }
+        return buf[0..n];
     }
 
-    fn calculateSignature(
-        allocator: Allocator,
-        secret_key: []const u8,
-        date_stamp: []const u8,
-        region: []const u8,
-        service: []const u8,
-        string_to_sign: []const u8,
-    ) ![]const u8 {
+    pub fn signingKey(secret_key: []const u8, date_stamp: []const u8, region: []const u8, service: []const u8) [32]u8 {
         var k_secret_buf: [256]u8 = undefined;
         const k_secret_len = 4 + secret_key.len;
         @memcpy(k_secret_buf[0..4], "AWS4");
@@ -2379,14 +5501,144 @@ pub const SigV4 = struct {
         const k_date = hmac(k_secret_buf[0..k_secret_len], date_stamp);
         const k_region = hmac(&k_date, region);
         const k_service = hmac(&k_region, service);
-        const k_signing = hmac(&k_service, "aws4_request");
-        const sig = hmac(&k_signing, string_to_sign);
+        return hmac(&k_service, "aws4_request");
+    }
+
+    /// Hex signature over the string to sign, which is fed to the HMAC
+    /// piece by piece.
+    fn calculateSignature(
+        signing_key: *const [32]u8,
+        amz_date: []const u8,
+        date_stamp: []const u8,
+        region: []const u8,
+        service: []const u8,
+        canonical_hash: [32]u8,
+    ) [64]u8 {
+        var canonical_hex: [64]u8 = undefined;
+        bytesToHex(&canonical_hash, &canonical_hex);
+
+        var mac = HmacSha256.init(signing_key);
+        mac.update("AWS4-HMAC-SHA256\n");
+        mac.update(amz_date);
+        mac.update("\n");
+        mac.update(date_stamp);
+        mac.update("/");
+        mac.update(region);
+        mac.update("/");
+        mac.update(service);
+        mac.update("/aws4_request\n");
+        mac.update(&canonical_hex);
+        var sig: [32]u8 = undefined;
+        mac.final(&sig);
+
+        var hex: [64]u8 = undefined;
+        bytesToHex(&sig, &hex);
+        return hex;
+    }
+
+    /// Signing keys derived on this thread. A key depends only on the secret,
+    /// date, region and service, so it is derived once per credential per
+    /// day instead of with four HMACs on every request.
+    threadlocal var signing_keys: KeyCache = .{};
+
+    pub const KeyCache = struct {
+        date: [8]u8 = @splat('0'), // YYYYMMDD all entries were derived for
+        entries: [SIGNING_KEY_CACHE_SIZE]Entry = undefined,
+        len: usize = 0,
+        next: usize = 0, // slot to reuse once full
+
+        const Entry = struct {
+            access_key: []const u8, // owned by the credential map
+            scope: [32]u8, // "<region>/<service>"
+            scope_len: usize,
+            key: [32]u8,
+        };
+
+        /// The signing key for a credential and scope, from the cache if it
+        /// was derived today. The cache starts over when a later date shows
+        /// up; requests still signed for an earlier date are derived
+        /// directly. `access_key` must outlive the cache.
+        pub fn get(self: *KeyCache, access_key: []const u8, secret_key: []const u8, date_stamp: []const u8, region: []const u8, service: []const u8) [32]u8 {
+            var scope_buf: [32]u8 = undefined;
+            const scope = std.fmt.bufPrint(&scope_buf, "{s}/{s}", .{ region, service }) catch
+                return signingKey(secret_key, date_stamp, region, service);
+            if (date_stamp.len != self.date.len) return signingKey(secret_key, date_stamp, region, service);
+
+            switch (std.mem.order(u8, date_stamp, &self.date)) {
+                .lt => return signingKey(secret_key, date_stamp, region, service),
+                .gt => {
+                    self.date = date_stamp[0..8].*;
+                    self.len = 0;
+                    self.next = 0;
+                },
+                .eq => for (self.entries[0..self.len]) |*entry| {
+                    if (std.mem.eql(u8, entry.access_key, access_key) and
+                        std.mem.eql(u8, entry.scope[0..entry.scope_len], scope))
+                        return entry.key;
+                },
+            }
 
-        const hex = try allocator.alloc(u8, 64);
-        _ = std.fmt.bufPrint(hex, "{x}", .{sig}) catch unreachable;
+            const key = signingKey(secret_key, date_stamp, region, service);
+            const slot = if (self.len < self.entries.len) blk: {
+                self.len += 1;
+                break :blk self.len - 1;
+            } else blk: {
+                self.next = (self.next + 1) % self.entries.len;
+                break :blk self.next;
+            };
+            self.entries[slot] = .{ .access_key = access_key, .scope = scope_buf, .scope_len = scope.len, .key = key };
+            return key;
+        }
+    };
 
-        return hex;
-    }
+    /// Verifies the chunk signatures of a STREAMING-AWS4-HMAC-SHA256-PAYLOAD
+    /// body. Each chunk is signed over the previous chunk's signature,
+    /// starting from the seed signature in the Authorization header, so
+    /// chunks can't be dropped, reordered or altered.
+    pub const ChunkSigner = struct {
+        signing_key: [32]u8,
+        prefix: []const u8, // "AWS4-HMAC-SHA256-PAYLOAD\n<amz-date>\n<scope>\n"
+        prev: [64]u8,
+
+        const EMPTY_SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855";
+
+        pub fn init(
+            allocator: Allocator,
+            signing_key: [32]u8,
+            amz_date: []const u8,
+            date_stamp: []const u8,
+            region: []const u8,
+            service: []const u8,
+            seed_signature: []const u8,
+        ) !ChunkSigner {
+            if (seed_signature.len != 64) return error.InvalidSignature;
+            return .{
+                .signing_key = signing_key,
+                .prefix = try std.fmt.allocPrint(allocator, "AWS4-HMAC-SHA256-PAYLOAD\n{s}\n{s}/{s}/{s}/aws4_request\n", .{ amz_date, date_stamp, region, service }),
+                .prev = seed_signature[0..64].*,
+            };
+        }
+
+        /// Check the signature of the next chunk, given the SHA-256 of its
+        /// data. On success it becomes the link the following chunk is
+        /// signed over.
+        pub fn check(self: *ChunkSigner, chunk_hash: [32]u8, signature: []const u8) bool {
+            var hash_hex: [64]u8 = undefined;
+            bytesToHex(&chunk_hash, &hash_hex);
+            var mac = HmacSha256.init(&self.signing_key);
+            mac.update(self.prefix);
+            mac.update(&self.prev);
+            mac.update("\n" ++ EMPTY_SHA256 ++ "\n");
+            mac.update(&hash_hex);
+            var sig: [32]u8 = undefined;
+            mac.final(&sig);
+            var expected: [64]u8 = undefined;
+            bytesToHex(&sig, &expected);
+            if (!std.mem.eql(u8, &expected, signature)) return false;
+            self.prev = expected;
+            return true;
+        }
+    };
 
     pub fn hmac(key: []const u8, msg: []const u8) [32]u8 {
         var out: [32]u8 = undefined;
@@ -2490,11 +5742,7 @@ pub fn sortQueryString(allocator: Allocator, query: []const u8) ![]const u8 {
         }
     }
 
-    std.mem.sort([]const u8, pairs.items, {}, struct {
-        fn lessThan(_: void, a: []const u8, b: []const u8) bool {
-            return std.mem.order(u8, a, b) == .lt;
-        }
-    }.lessThan);
+    std.mem.sort([]const u8, pairs.items, {}, queryPairLessThan);
 
     var result: std.ArrayListUnmanaged(u8) = .empty;
     for (pairs.items, 0..) |pair, i| {
@@ -2505,6 +5753,115 @@ pub fn sortQueryString(allocator: Allocator, query: []const u8) ![]const u8 {
     return result.toOwnedSlice(allocator);
 }
 
+/// SigV4 order of query parameters: bytewise, with a bare `key` compared as
+/// `key=`.
+fn queryPairLessThan(_: void, a: []const u8, b: []const u8) bool {
+    const a_bare = std.mem.indexOfScalar(u8, a, '=') == null;
+    const b_bare = std.mem.indexOfScalar(u8, b, '=') == null;
+    var i: usize = 0;
+    while (true) : (i += 1) {
+        const ca = normalizedQueryByte(a, a_bare, i) orelse return normalizedQueryByte(b, b_bare, i) != null;
+        const cb = normalizedQueryByte(b, b_bare, i) orelse return false;
+        if (ca != cb) return ca < cb;
+    }
+}
+
+fn normalizedQueryByte(pair: []const u8, bare: bool, i: usize) ?u8 {
+    if (i < pair.len) return pair[i];
+    if (bare and i == pair.len) return '=';
+    return null;
+}
+
+/// Extended attribute holding an object's ETag, written when the object is
+/// stored so GET and HEAD don't have to hash the file.
+const ETAG_XATTR = "user.zs3.etag";
+const MAX_ETAG_RECORD = 128;
+
+extern "c" fn fgetxattr(fd: c_int, name: [*:0]const u8, value: ?*anyopaque, size: usize, position: u32, options: c_int) isize;
+extern "c" fn fsetxattr(fd: c_int, name: [*:0]const u8, value: ?*const anyopaque, size: usize, position: u32, options: c_int) c_int;
+
+/// Best effort: filesystems without user xattrs just fall back to hashing.
+fn setXattr(fd: posix.fd_t, name: [*:0]const u8, value: []const u8) bool {
+    if (builtin.os.tag == .linux) {
+        return std.os.linux.errno(std.os.linux.fsetxattr(fd, name, value.ptr, value.len, 0)) == .SUCCESS;
+    } else if (builtin.os.tag == .macos) {
+        return fsetxattr(fd, name, value.ptr, value.len, 0, 0) == 0;
+    }
+    return false;
+}
+
+fn getXattr(fd: posix.fd_t, name: [*:0]const u8, buf: []u8) ?[]const u8 {
+    if (builtin.os.tag == .linux) {
+        const rc = std.os.linux.fgetxattr(fd, name, buf.ptr, buf.len);
+        if (std.os.linux.errno(rc) != .SUCCESS) return null;
+        return buf[0..rc];
+    } else if (builtin.os.tag == .macos) {
+        const rc = fgetxattr(fd, name, buf.ptr, buf.len, 0, 0);
+        if (rc < 0) return null;
+        return buf[0..@intCast(rc)];
+    }
+    return null;
+}
+
+/// Serialize an ETag together with the size and mtime of the file it
+/// describes: `<size> <mtime_ns> <etag>`.
+pub fn formatEtagRecord(buf: []u8, size: u64, mtime_ns: i96, etag: []const u8) ![]const u8 {
+    return std.fmt.bufPrint(buf, "{d} {d} {s}", .{ size, mtime_ns, etag });
+}
+
+/// The ETag in `record`, if the record still matches the file's size and
+/// mtime. A file rewritten out-of-band (or copied with its xattrs) keeps a
+/// stale record, which this rejects.
+pub fn parseEtagRecord(record: []const u8, size: u64, mtime_ns: i96) ?[]const u8 {
+    var it = std.mem.splitScalar(u8, record, ' ');
+    const rec_size = std.fmt.parseInt(u64, it.next() orelse return null, 10) catch return null;
+    const rec_mtime = std.fmt.parseInt(i96, it.next() orelse return null, 10) catch return null;
+    const etag = it.rest();
+    if (rec_size != size or rec_mtime != mtime_ns or etag.len == 0) return null;
+    return etag;
+}
+
+/// Record `etag` on a freshly written object file.
+fn saveObjectEtag(file: std.Io.File, etag: []const u8) void {
+    const stat = file.stat(app_io) catch return;
+    var buf: [MAX_ETAG_RECORD]u8 = undefined;
+    const record = formatEtagRecord(&buf, stat.size, stat.mtime.nanoseconds, etag) catch return;
+    _ = setXattr(file.handle, ETAG_XATTR, record);
+}
+
+/// The stored ETag of an object, if there is a valid one.
+fn loadObjectEtag(allocator: Allocator, file: std.Io.File, stat: std.Io.File.Stat) ?[]const u8 {
+    var buf: [MAX_ETAG_RECORD]u8 = undefined;
+    const record = getXattr(file.handle, ETAG_XATTR, &buf) orelse return null;
+    const etag = parseEtagRecord(record, stat.size, stat.mtime.nanoseconds) orelse return null;
+    return allocator.dupe(u8, etag) catch null;
+}
+
+fn wyhashEtag(allocator: Allocator, hash: u64) ![]const u8 {
+    return std.fmt.allocPrint(allocator, "\"{x}\"", .{hash});
+}
+
+/// ETag of an object file: the stored one, or for files placed in the
+/// bucket directory by other means, a streaming Wyhash of the content
+/// (which is then stored for next time).
+fn objectEtag(allocator: Allocator, file: std.Io.File, stat: std.Io.File.Stat) ![]const u8 {
+    if (loadObjectEtag(allocator, file, stat)) |etag| return etag;
+
+    const chunk = try allocator.alloc(u8, SPOOL_CHUNK_SIZE);
+    defer allocator.free(chunk);
+    var hasher = std.hash.Wyhash.init(0);
+    var offset: u64 = 0;
+    while (true) {
+        const n = try file.readPositionalAll(app_io, chunk, offset);
+        hasher.update(chunk[0..n]);
+        offset += n;
+        if (n < chunk.len) break;
+    }
+    const etag = try wyhashEtag(allocator, hasher.final());
+    saveObjectEtag(file, etag);
+    return etag;
+}
+
 fn handlePutObject(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Response, bucket: []const u8, key: []const u8) !void {
     // Keys ending with '/' are folder markers — store as ".folder_marker" file
     const effective_key = if (key.len > 0 and key[key.len - 1] == '/')
@@ -2520,23 +5877,43 @@ fn handlePutObject(ctx: *const S3Context, allocator: Allocator, req: *Request, r
         std.Io.Dir.cwd().createDirPath(app_io, dir) catch {};
     }
 
-    var file = std.Io.Dir.cwd().createFile(app_io, path, .{}) catch {
-        sendError(res, 500, "InternalError", "Cannot create file");
-        return;
+    // Use fast hash for ETag (wyhash is ~10x faster than SHA256). It is
+    // stored with the file so GET and HEAD don't recompute it.
+    // Large bodies are already in a temp file with their hash computed;
+    // small ones are written to one here. Either way the finished file is
+    // committed over the object, so readers never see a partial write.
+    const tmp_path, const hash = if (req.spooled) |sp|
+        .{ sp.path, sp.digest.wyhash }
+    else blk: {
+        const tmp_path = try tempFilePath(allocator, ctx.data_dir);
+        var file = std.Io.Dir.cwd().createFile(app_io, tmp_path, .{ .exclusive = true }) catch {
+            sendError(res, 500, "InternalError", "Cannot create file");
+            return;
+        };
+        defer file.close(app_io);
+        file.writeStreamingAll(app_io, req.body) catch {
+            std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
+            sendError(res, 500, "InternalError", "Cannot write file");
+            return;
+        };
+        break :blk .{ tmp_path, std.hash.Wyhash.hash(0, req.body) };
     };
-    defer file.close(app_io);
+    // A spooled body is cleaned up with the request; this covers the other
+    defer if (req.spooled == null) std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
 
-    file.writeStreamingAll(app_io, req.body) catch {
-        sendError(res, 500, "InternalError", "Cannot write file");
+    const etag = wyhashEtag(allocator, hash) catch {
+        sendError(res, 500, "InternalError", "ETag failed");
         return;
     };
-
-    // Use fast hash for ETag (wyhash is ~10x faster than SHA256)
-    const hash = std.hash.Wyhash.hash(0, req.body);
-    const etag = std.fmt.allocPrint(allocator, "\"{x}\"", .{hash}) catch {
-        sendError(res, 500, "InternalError", "ETag failed");
+    if (std.Io.Dir.cwd().openFile(app_io, tmp_path, .{})) |file| {
+        saveObjectEtag(file, etag);
+        file.close(app_io);
+    } else |_| {}
+    ctx.committer.commit(tmp_path, path) catch {
+        sendError(res, 500, "InternalError", "Cannot write file");
         return;
     };
+    ctx.key_index.noteWrite(bucket, key, path);
 
     res.ok();
     res.setHeader("ETag", etag);
@@ -2562,6 +5939,13 @@ fn handleGetObject(ctx: *const S3Context, allocator: Allocator, req: *Request, r
         return;
     };
 
+    // Directories back nested keys; they are not objects (see handleHeadObject)
+    if (stat.kind != .file) {
+        file.close(app_io);
+        sendError(res, 404, "NoSuchKey", "Object not found");
+        return;
+    }
+
     const last_modified = allocHttpDate(allocator, @intCast(stat.mtime.toSeconds())) catch {
         file.close(app_io);
         sendError(res, 500, "InternalError", "Date format failed");
@@ -2589,25 +5973,18 @@ fn handleGetObject(ctx: *const S3Context, allocator: Allocator, req: *Request, r
         }
     }
 
-    // For full file, read content to compute ETag
-    const content = readToEndAlloc(file, allocator, MAX_BODY_SIZE) catch {
+    const etag = objectEtag(allocator, file, stat) catch {
         file.close(app_io);
         sendError(res, 500, "InternalError", "Read failed");
         return;
     };
-    file.close(app_io);
-
-    const hash = std.hash.Wyhash.hash(0, content);
-    const etag = std.fmt.allocPrint(allocator, "\"{x}\"", .{hash}) catch {
-        sendError(res, 500, "InternalError", "ETag failed");
-        return;
-    };
 
+    // The whole object goes out with sendfile, so memory per GET stays flat
     res.ok();
     res.setHeader("Accept-Ranges", "bytes");
     res.setHeader("ETag", etag);
     res.setHeader("Last-Modified", last_modified);
-    res.body = content;
+    res.setSendFile(file, stat.size, 0);
 }
 
 fn handleDeleteObject(ctx: *const S3Context, allocator: Allocator, res: *Response, bucket: []const u8, key: []const u8) !void {
@@ -2620,6 +5997,7 @@ fn handleDeleteObject(ctx: *const S3Context, allocator: Allocator, res: *Respons
     defer allocator.free(path);
 
     deleteObjectInternal(ctx, allocator, bucket, path);
+    ctx.key_index.noteDelete(bucket, key);
     res.noContent();
 }
 
@@ -2660,13 +6038,14 @@ fn handleDeleteObjects(ctx: *const S3Context, allocator: Allocator, req: *Reques
         if (key.len > 0 and isValidKey(key)) {
             // In distributed mode, also delete from metadata index
             if (ctx.distributed) |dist| {
-                dist.meta_index.delete(allocator, bucket, key);
+                dist.meta_index.delete(bucket, key);
             }
 
             const path = ctx.objectPath(allocator, bucket, key) catch continue;
             defer allocator.free(path);
 
             deleteObjectInternal(ctx, allocator, bucket, path);
+            ctx.key_index.noteDelete(bucket, key);
 
             try xml.appendSlice(allocator, "<Deleted><Key>");
             try xmlEscape(allocator, &xml, key);
@@ -2710,18 +6089,11 @@ fn handleHeadObject(ctx: *const S3Context, allocator: Allocator, res: *Response,
         return;
     }
 
-    // Compute ETag from file content (same as PUT uses)
-    const content = readToEndAlloc(file, allocator, MAX_BODY_SIZE) catch {
+    // Stored at write time; only out-of-band files are hashed here
+    const etag = objectEtag(allocator, file, stat) catch {
         sendError(res, 500, "InternalError", "Read failed");
         return;
     };
-    defer allocator.free(content);
-
-    const hash = std.hash.Wyhash.hash(0, content);
-    const etag = std.fmt.allocPrint(allocator, "\"{x}\"", .{hash}) catch {
-        sendError(res, 500, "InternalError", "ETag failed");
-        return;
-    };
 
     const len_str = std.fmt.allocPrint(allocator, "{d}", .{stat.size}) catch {
         sendError(res, 500, "InternalError", "Format failed");
@@ -2741,187 +6113,986 @@ fn handleHeadObject(ctx: *const S3Context, allocator: Allocator, res: *Response,
 }
 
 fn handleListObjects(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Response, bucket: []const u8) !void {
+    const bucket_path = try ctx.bucketPath(allocator, bucket);
+    defer allocator.free(bucket_path);
+
+    var dir = std.Io.Dir.cwd().openDir(app_io, bucket_path, .{}) catch {
+        sendError(res, 404, "NoSuchBucket", "Bucket not found");
+        return;
+    };
+    dir.close(app_io);
+
+    try streamListObjects(ctx, allocator, req, res, bucket, .key_index);
+}
+
+/// Answer ListObjectsV2 with a ListStream. Everything it keeps is allocated
+/// from the request arena, which lives until the response is sent.
+fn streamListObjects(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Response, bucket: []const u8, source: ListStream.Source) !void {
     const prefix_raw = getQueryParam(req.query, "prefix") orelse "";
     const prefix = try uriDecode(allocator, prefix_raw);
-    defer allocator.free(prefix);
 
     const max_keys_str = getQueryParam(req.query, "max-keys") orelse "1000";
     const max_keys = std.fmt.parseInt(usize, max_keys_str, 10) catch 1000;
 
     const delimiter_raw = getQueryParam(req.query, "delimiter");
     const delimiter_decoded = if (delimiter_raw) |d| try uriDecode(allocator, d) else null;
-    defer if (delimiter_decoded) |d| allocator.free(d);
     // Treat empty delimiter the same as no delimiter
     const delimiter = if (delimiter_decoded) |d| (if (d.len > 0) d else null) else null;
 
-    const continuation_raw = getQueryParam(req.query, "continuation-token");
-    const continuation = if (continuation_raw) |c| try uriDecode(allocator, c) else null;
-    defer if (continuation) |c| allocator.free(c);
+    // Start at the first key that can be returned: the prefix, the key the
+    // continuation token resumes at, or the key just after start-after
+    var from: []const u8 = prefix;
+    if (getQueryParam(req.query, "continuation-token")) |raw| {
+        const token = try uriDecode(allocator, raw);
+        const key = decodeContinuationToken(allocator, token) catch {
+            sendError(res, 400, "InvalidArgument", "The continuation token provided is incorrect");
+            return;
+        };
+        if (std.mem.order(u8, key, from) == .gt) from = key;
+    }
+    if (getQueryParam(req.query, "start-after")) |raw| {
+        const start_after = try uriDecode(allocator, raw);
+        const after = try std.mem.concat(allocator, u8, &.{ start_after, "\x00" });
+        if (std.mem.order(u8, after, from) == .gt) from = after;
+    }
+
+    const stream = try allocator.create(ListStream);
+    stream.* = .{
+        .ctx = ctx,
+        .gpa = ctx.allocator,
+        .source = source,
+        .bucket = try allocator.dupe(u8, bucket),
+        .prefix = prefix,
+        .delimiter = delimiter,
+        .max_keys = max_keys,
+    };
+    try stream.setResume(from);
 
-    const bucket_path = try ctx.bucketPath(allocator, bucket);
-    defer allocator.free(bucket_path);
+    res.ok();
+    res.setStream(stream);
+}
 
-    var dir = std.Io.Dir.cwd().openDir(app_io, bucket_path, .{ .iterate = true }) catch {
-        sendError(res, 404, "NoSuchBucket", "Bucket not found");
-        return;
+/// A ListObjectsV2 response produced while it is sent. The connection asks
+/// for the next piece once the previous one is on the wire, and each piece
+/// lists at most LIST_BATCH_KEYS keys, so memory stays bounded by a batch
+/// however many keys the page has. Nothing is held between pieces: each
+/// batch picks the listing up again at `resume_at`, so writers never wait on a
+/// slow reader.
+const ListStream = struct {
+    ctx: *const S3Context,
+    gpa: Allocator, // for buffers reused across batches, not the request arena
+    source: Source,
+    bucket: []const u8,
+    prefix: []const u8,
+    delimiter: ?[]const u8,
+    max_keys: usize,
+    resume_at: std.ArrayListUnmanaged(u8) = .empty, // first key the next batch may return
+    out: std.ArrayListUnmanaged(u8) = .empty, // the piece being sent
+    count: usize = 0,
+    next_token: ?[]u8 = null, // key the next page starts at, once this one is full
+    phase: enum { head, keys, done } = .head,
+    finished: bool = false, // no more keys for this page
+
+    const Source = enum {
+        key_index, // standalone: the bucket's KeyIndex
+        meta_index, // distributed: the MetaIndex's log
     };
-    defer dir.close(app_io);
 
-    var xml: std.ArrayListUnmanaged(u8) = .empty;
-    defer xml.deinit(allocator);
+    const Step = enum { next, seek, done };
 
-    try xml.appendSlice(allocator, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>");
-    try xml.appendSlice(allocator, "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">");
-    try xml.appendSlice(allocator, "<Name>");
-    try xmlEscape(allocator, &xml, bucket);
-    try xml.appendSlice(allocator, "</Name><Prefix>");
-    try xmlEscape(allocator, &xml, prefix);
-    try xml.appendSlice(allocator, "</Prefix><MaxKeys>");
-    var max_keys_num_buf: [32]u8 = undefined;
-    const max_keys_num_str = std.fmt.bufPrint(&max_keys_num_buf, "{d}", .{max_keys}) catch "1000";
-    try xml.appendSlice(allocator, max_keys_num_str);
-    try xml.appendSlice(allocator, "</MaxKeys>");
-
-    var keys: std.ArrayListUnmanaged(KeyInfo) = .empty;
-    defer keys.deinit(allocator);
-
-    try collectKeys(allocator, bucket_path, "", prefix, &keys);
-
-    std.mem.sort(KeyInfo, keys.items, {}, struct {
-        fn lessThan(_: void, a: KeyInfo, b: KeyInfo) bool {
-            return std.mem.order(u8, a.key, b.key) == .lt;
-        }
-    }.lessThan);
-
-    var start_idx: usize = 0;
-    if (continuation) |cont| {
-        for (keys.items, 0..) |item, i| {
-            if (std.mem.eql(u8, item.key, cont)) {
-                start_idx = i;
-                break;
-            }
+    pub fn deinit(self: *ListStream) void {
+        self.resume_at.deinit(self.gpa);
+        self.out.deinit(self.gpa);
+        if (self.next_token) |token| self.gpa.free(token);
+    }
+
+    /// The next piece of the XML document, or null once all of it has been
+    /// returned. The slice is valid until the next call.
+    pub fn next(self: *ListStream) !?[]const u8 {
+        self.out.clearRetainingCapacity();
+        switch (self.phase) {
+            .head => {
+                try self.writeHead();
+                self.phase = .keys;
+            },
+            .keys => {},
+            .done => return null,
+        }
+        if (!self.finished) switch (self.source) {
+            .key_index => try self.fillFromKeyIndex(),
+            .meta_index => try self.fillFromMetaIndex(),
+        };
+        if (self.finished) {
+            try self.writeTail();
+            self.phase = .done;
         }
+        return self.out.items;
     }
 
-    var common_prefixes = std.StringHashMap(void).init(allocator);
-    defer common_prefixes.deinit();
+    fn setResume(self: *ListStream, key: []const u8) !void {
+        self.resume_at.clearRetainingCapacity();
+        try self.resume_at.appendSlice(self.gpa, key);
+    }
 
-    var count: usize = 0;
-    var is_truncated = false;
-    var next_token: ?[]const u8 = null;
+    fn fillFromKeyIndex(self: *ListStream) !void {
+        var keys = try self.ctx.key_index.iterateBucket(self.gpa, self.bucket, self.resume_at.items);
+        defer keys.deinit();
 
-    for (keys.items[start_idx..]) |item| {
-        if (count >= max_keys) {
-            is_truncated = true;
-            next_token = item.key;
-            break;
+        for (0..LIST_BATCH_KEYS) |_| {
+            const item = try keys.next() orelse {
+                self.finished = true;
+                return;
+            };
+            switch (try self.add(item)) {
+                .next => {},
+                .seek => try keys.seek(self.resume_at.items),
+                .done => return,
+            }
         }
+    }
 
-        if (delimiter) |delim| {
-            const after_prefix = if (prefix.len > 0 and std.mem.startsWith(u8, item.key, prefix))
-                item.key[prefix.len..]
-            else
-                item.key;
-
-            if (std.mem.indexOf(u8, after_prefix, delim)) |delim_idx| {
-                const common_prefix = item.key[0 .. prefix.len + delim_idx + delim.len];
-                if (!common_prefixes.contains(common_prefix)) {
-                    try common_prefixes.put(common_prefix, {});
-                    try xml.appendSlice(allocator, "<CommonPrefixes><Prefix>");
-                    try xmlEscape(allocator, &xml, common_prefix);
-                    try xml.appendSlice(allocator, "</Prefix></CommonPrefixes>");
-                    count += 1;
+    fn fillFromMetaIndex(self: *ListStream) !void {
+        var arena = std.heap.ArenaAllocator.init(self.gpa);
+        defer arena.deinit();
+        const scratch = arena.allocator();
+
+        const meta_log = self.ctx.distributed.?.meta_index.log;
+        var budget: usize = LIST_BATCH_KEYS;
+        while (budget > 0) {
+            const want = budget;
+            const keys = try meta_log.list(scratch, self.bucket, self.prefix, self.resume_at.items, want);
+            for (keys) |item| {
+                budget -= 1;
+                switch (try self.add(item)) {
+                    .next => {},
+                    // Past a common prefix: list again from `resume_at`
+                    .seek => break,
+                    .done => return,
                 }
-                continue;
+            } else if (keys.len < want) {
+                self.finished = true;
+                return;
+            }
+        }
+    }
+
+    /// Put one key on the page. Keys arrive in order, at or after `resume_at`;
+    /// `.seek` means the source should continue from `resume_at` instead.
+    fn add(self: *ListStream, item: KeyInfo) !Step {
+        // Keys under the prefix are contiguous, so the first one outside ends the page
+        if (!std.mem.startsWith(u8, item.key, self.prefix)) {
+            self.finished = true;
+            return .done;
+        }
+        if (self.count >= self.max_keys) {
+            self.next_token = try self.gpa.dupe(u8, item.key);
+            self.finished = true;
+            return .done;
+        }
+        self.count += 1;
+
+        if (self.delimiter) |delim| {
+            if (std.mem.indexOf(u8, item.key[self.prefix.len..], delim)) |delim_idx| {
+                const common_prefix = item.key[0 .. self.prefix.len + delim_idx + delim.len];
+                try self.out.appendSlice(self.gpa, "<CommonPrefixes><Prefix>");
+                try xmlEscape(self.gpa, &self.out, common_prefix);
+                try self.out.appendSlice(self.gpa, "</Prefix></CommonPrefixes>");
+                // Everything else under this prefix folds into it; skip it
+                // rather than reading it
+                try self.setResume(common_prefix);
+                const past = prefixSuccessor(self.resume_at.items) orelse {
+                    self.finished = true;
+                    return .done;
+                };
+                self.resume_at.shrinkRetainingCapacity(past.len);
+                return .seek;
             }
         }
 
-        try xml.appendSlice(allocator, "<Contents><Key>");
-        try xmlEscape(allocator, &xml, item.key);
-        try xml.appendSlice(allocator, "</Key><LastModified>");
+        try self.out.appendSlice(self.gpa, "<Contents><Key>");
+        try xmlEscape(self.gpa, &self.out, item.key);
+        try self.out.appendSlice(self.gpa, "</Key><LastModified>");
         var iso_buf: [20]u8 = undefined;
         formatIso8601(&iso_buf, item.mtime);
-        try xml.appendSlice(allocator, &iso_buf);
-        try xml.appendSlice(allocator, "</LastModified><Size>");
+        try self.out.appendSlice(self.gpa, &iso_buf);
+        try self.out.appendSlice(self.gpa, "</LastModified><Size>");
         var size_buf: [32]u8 = undefined;
         const size_str = std.fmt.bufPrint(&size_buf, "{d}", .{item.size}) catch "0";
-        try xml.appendSlice(allocator, size_str);
-        try xml.appendSlice(allocator, "</Size><StorageClass>STANDARD</StorageClass></Contents>");
-        count += 1;
+        try self.out.appendSlice(self.gpa, size_str);
+        try self.out.appendSlice(self.gpa, "</Size><StorageClass>STANDARD</StorageClass></Contents>");
+
+        // The smallest key after this one
+        try self.setResume(item.key);
+        try self.resume_at.append(self.gpa, 0);
+        return .next;
+    }
+
+    fn writeHead(self: *ListStream) !void {
+        try self.out.appendSlice(self.gpa, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>");
+        try self.out.appendSlice(self.gpa, "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">");
+        try self.out.appendSlice(self.gpa, "<Name>");
+        try xmlEscape(self.gpa, &self.out, self.bucket);
+        try self.out.appendSlice(self.gpa, "</Name><Prefix>");
+        try xmlEscape(self.gpa, &self.out, self.prefix);
+        try self.out.appendSlice(self.gpa, "</Prefix><MaxKeys>");
+        var max_keys_buf: [32]u8 = undefined;
+        const max_keys_str = std.fmt.bufPrint(&max_keys_buf, "{d}", .{self.max_keys}) catch "1000";
+        try self.out.appendSlice(self.gpa, max_keys_str);
+        try self.out.appendSlice(self.gpa, "</MaxKeys>");
+    }
+
+    fn writeTail(self: *ListStream) !void {
+        var count_buf: [32]u8 = undefined;
+        const count_str = std.fmt.bufPrint(&count_buf, "{d}", .{self.count}) catch "0";
+        try self.out.appendSlice(self.gpa, "<KeyCount>");
+        try self.out.appendSlice(self.gpa, count_str);
+        try self.out.appendSlice(self.gpa, "</KeyCount>");
+
+        if (self.next_token) |key| {
+            const token = try encodeContinuationToken(self.gpa, key);
+            defer self.gpa.free(token);
+            try self.out.appendSlice(self.gpa, "<IsTruncated>true</IsTruncated>");
+            try self.out.appendSlice(self.gpa, "<NextContinuationToken>");
+            try self.out.appendSlice(self.gpa, token);
+            try self.out.appendSlice(self.gpa, "</NextContinuationToken>");
+        } else {
+            try self.out.appendSlice(self.gpa, "<IsTruncated>false</IsTruncated>");
+        }
+
+        try self.out.appendSlice(self.gpa, "</ListBucketResult>");
+    }
+};
+
+/// A continuation token is the key the next page starts at, base64url
+/// encoded: opaque to clients, safe in a query string, and resolved with
+/// one index seek.
+pub fn encodeContinuationToken(allocator: Allocator, key: []const u8) ![]u8 {
+    const encoder = std.base64.url_safe_no_pad.Encoder;
+    const token = try allocator.alloc(u8, encoder.calcSize(key.len));
+    _ = encoder.encode(token, key);
+    return token;
+}
+
+pub fn decodeContinuationToken(allocator: Allocator, token: []const u8) ![]u8 {
+    const decoder = std.base64.url_safe_no_pad.Decoder;
+    const len = try decoder.calcSizeForSlice(token);
+    if (len > MAX_KEY_LENGTH) return error.InvalidToken;
+    const key = try allocator.alloc(u8, len);
+    errdefer allocator.free(key);
+    try decoder.decode(key, token);
+    return key;
+}
+
+/// The smallest key that sorts after every key starting with `prefix`,
+/// computed in place: trailing 0xff bytes are dropped and the last byte
+/// left is incremented. Null if there is none (all 0xff).
+pub fn prefixSuccessor(prefix: []u8) ?[]u8 {
+    var len = prefix.len;
+    while (len > 0 and prefix[len - 1] == 0xff) len -= 1;
+    if (len == 0) return null;
+    prefix[len - 1] += 1;
+    return prefix[0..len];
+}
+
+const KeyInfo = struct {
+    key: []const u8,
+    size: u64,
+    mtime: i64, // Unix timestamp in seconds
+};
+
+/// Every object under `base_path`, in no particular order, read with
+/// `threads` threads. `allocator` must be thread-safe.
+pub fn collectKeys(allocator: Allocator, base_path: []const u8, threads: usize) ![]KeyInfo {
+    const Collector = struct {
+        allocator: Allocator,
+        keys: std.ArrayListUnmanaged(KeyInfo) = .empty,
+
+        pub fn visit(self: *@This(), dir: std.Io.Dir, path: []const u8, entry: std.Io.Dir.Entry) !bool {
+            if (entry.kind != .file) return true;
+            const full_key = if (path.len > 0)
+                try std.fmt.allocPrint(self.allocator, "{s}/{s}", .{ path, entry.name })
+            else
+                try self.allocator.dupe(u8, entry.name);
+            // Translate .folder_marker files back to keys ending with /
+            const key = if (std.mem.endsWith(u8, full_key, ".folder_marker"))
+                full_key[0 .. full_key.len - ".folder_marker".len]
+            else
+                full_key;
+            // Use statFile instead of open+stat+close - much faster
+            const size, const mtime = blk: {
+                const stat = dir.statFile(app_io, entry.name, .{}) catch break :blk .{ 0, @as(i64, 0) };
+                break :blk .{ stat.size, @as(i64, @intCast(stat.mtime.toSeconds())) };
+            };
+            try self.keys.append(self.allocator, .{ .key = key, .size = size, .mtime = mtime });
+            return true;
+        }
+    };
+
+    const collectors = try allocator.alloc(Collector, @max(threads, 1));
+    defer allocator.free(collectors);
+    @memset(collectors, .{ .allocator = allocator });
+    defer for (collectors) |*c| c.keys.deinit(allocator);
+    try walkTree(Collector, allocator, base_path, collectors);
+
+    var total: usize = 0;
+    for (collectors) |c| total += c.keys.items.len;
+    var keys = try std.ArrayListUnmanaged(KeyInfo).initCapacity(allocator, total);
+    for (collectors) |c| keys.appendSliceAssumeCapacity(c.keys.items);
+    return keys.items;
+}
+
+/// Walk the tree under `root` with one thread per visitor, the calling
+/// thread included. Threads take whole directories from a shared stack and
+/// push the subdirectories they find, so a wide or deep tree keeps them all
+/// busy. Each thread reports to its own visitor, which needs no locking:
+///
+///   fn visit(self: *V, dir: std.Io.Dir, path: []const u8, entry: std.Io.Dir.Entry) !bool
+///
+/// gets each entry of the directory at `path` (relative to `root`, "" for
+/// the root) and returns, for a directory, whether to descend into it.
+/// Entries come in no particular order. A missing root or an unreadable
+/// directory is skipped. `allocator` must be thread-safe.
+pub fn walkTree(comptime V: type, allocator: Allocator, root: []const u8, visitors: []V) !void {
+    var root_dir = std.Io.Dir.cwd().openDir(app_io, root, .{}) catch return;
+    defer root_dir.close(app_io);
+    var walk = TreeWalk(V){ .root = root_dir, .paths = .init(allocator) };
+    defer {
+        walk.pending.deinit(allocator);
+        walk.paths.deinit();
+    }
+    try walk.pending.append(allocator, "");
+
+    var threads: std.ArrayListUnmanaged(std.Thread) = .empty;
+    defer threads.deinit(allocator);
+    try threads.ensureTotalCapacity(allocator, visitors.len);
+    for (visitors[1..]) |*visitor| {
+        const thread = std.Thread.spawn(.{}, TreeWalk(V).run, .{ &walk, visitor }) catch break;
+        threads.appendAssumeCapacity(thread);
+    }
+    walk.run(&visitors[0]);
+    for (threads.items) |thread| thread.join();
+    if (walk.failure) |err| return err;
+}
+
+fn TreeWalk(comptime V: type) type {
+    return struct {
+        const Self = @This();
+
+        root: std.Io.Dir,
+        mutex: std.Io.Mutex = .init,
+        changed: std.Io.Condition = .init, // a directory was pushed, or a thread finished one
+        paths: std.heap.ArenaAllocator, // of the directories found
+        pending: std.ArrayListUnmanaged([]const u8) = .empty,
+        busy: usize = 0, // threads reading a directory
+        failure: ?anyerror = null,
+
+        fn run(self: *Self, visitor: *V) void {
+            self.mutex.lockUncancelable(app_io);
+            defer self.mutex.unlock(app_io);
+            while (self.failure == null) {
+                const path = self.pending.pop() orelse {
+                    // Done once nobody can push more
+                    if (self.busy == 0) break;
+                    self.changed.waitUncancelable(app_io, &self.mutex);
+                    continue;
+                };
+                self.busy += 1;
+                self.mutex.unlock(app_io);
+                const result = self.read(visitor, path);
+                self.mutex.lockUncancelable(app_io);
+                self.busy -= 1;
+                result catch |err| {
+                    if (self.failure == null) self.failure = err;
+                };
+                self.changed.broadcast(app_io);
+            }
+        }
+
+        fn read(self: *Self, visitor: *V, path: []const u8) !void {
+            var dir = self.root.openDir(app_io, if (path.len > 0) path else ".", .{ .iterate = true }) catch return;
+            defer dir.close(app_io);
+            var iter = dir.iterate();
+            while (try iter.next(app_io)) |entry| {
+                const descend = try visitor.visit(dir, path, entry);
+                if (entry.kind == .directory and descend) try self.push(path, entry.name);
+            }
+        }
+
+        fn push(self: *Self, parent: []const u8, name: []const u8) !void {
+            self.mutex.lockUncancelable(app_io);
+            defer self.mutex.unlock(app_io);
+            const path = if (parent.len > 0)
+                try std.fmt.allocPrint(self.paths.allocator(), "{s}/{s}", .{ parent, name })
+            else
+                try self.paths.allocator().dupe(u8, name);
+            try self.pending.append(self.paths.child_allocator, path);
+            self.changed.signal(app_io);
+        }
+    };
+}
+
+/// Sorted, persistent key list of each standalone bucket, so LIST seeks to
+/// its starting key and reads one page instead of walking and sorting the
+/// whole bucket. Per bucket, under `<data_dir>/.keys/<bucket>/`:
+///
+///   base  key records in order, then a sparse index of every
+///         KEY_INDEX_BLOCK-th key and a footer
+///   log   PUTs and DELETEs since `base` was written
+///
+/// The log is also held in memory, sorted by key, and read merged over
+/// `base`. Once it reaches KEY_INDEX_FLUSH keys the two are merged into a new
+/// base and the log starts over. A bucket with no index files (or a
+/// damaged one) is indexed from its directory tree on first use, so
+/// deleting `.keys` (`--reindex`) rebuilds everything.
+///
+/// Each bucket has its own lock, so a compaction or rebuild holds up only
+/// that bucket. `mutex` guards just the bucket table and reference counts;
+/// it may be taken while holding a bucket's lock, never the other way round.
+pub const KeyIndex = struct {
+    allocator: Allocator,
+    data_dir: []const u8,
+    committer: *Committer,
+    scan_threads: usize, // for rebuilding a bucket's index from its files
+    mutex: std.Io.Mutex = .init,
+    buckets: std.StringHashMapUnmanaged(*Bucket) = .empty,
+
+    const BASE_MAGIC = "ZS3KEYS1";
+
+    const Bucket = struct {
+        name: []const u8,
+        dir: []const u8, // <data_dir>/.keys/<bucket>
+        mutex: std.Io.Mutex = .init, // guards everything below
+        refs: usize = 0, // under KeyIndex.mutex; the last one frees the bucket
+        loaded: bool = false,
+        dropped: bool = false, // out of the table; set under both locks
+        blocks: []Block = &.{}, // sparse index of `base`
+        base_end: u64 = 0, // records end here; the sparse index follows
+        log: std.Io.File = undefined, // open while loaded, until the last reference goes
+        log_end: u64 = 0,
+        changes: std.ArrayListUnmanaged(Change) = .empty, // sorted by key
+    };
+
+    /// Every KEY_INDEX_BLOCK-th key of `base` and where its record starts
+    const Block = struct { key: []const u8, offset: u64 };
+
+    /// A logged PUT or DELETE
+    const Change = struct {
+        key: []const u8,
+        size: u64,
+        mtime: i64,
+        deleted: bool,
+    };
+
+    pub fn init(allocator: Allocator, data_dir: []const u8, committer: *Committer, scan_threads: usize) KeyIndex {
+        return .{ .allocator = allocator, .data_dir = data_dir, .committer = committer, .scan_threads = scan_threads };
+    }
+
+    pub fn deinit(self: *KeyIndex) void {
+        var it = self.buckets.valueIterator();
+        while (it.next()) |b| self.release(b.*);
+        self.buckets.deinit(self.allocator);
+    }
+
+    /// Record an object written at `path` under `key`.
+    pub fn noteWrite(self: *KeyIndex, bucket: []const u8, key: []const u8, path: []const u8) void {
+        const stat = std.Io.Dir.cwd().statFile(app_io, path, .{}) catch return self.noteDelete(bucket, key);
+        self.note(bucket, .{ .key = key, .size = stat.size, .mtime = @intCast(stat.mtime.toSeconds()), .deleted = false });
+    }
+
+    /// Record that `key` is gone.
+    pub fn noteDelete(self: *KeyIndex, bucket: []const u8, key: []const u8) void {
+        self.note(bucket, .{ .key = key, .size = 0, .mtime = 0, .deleted = true });
+    }
+
+    fn note(self: *KeyIndex, bucket_name: []const u8, change: Change) void {
+        if (change.key.len > MAX_KEY_LENGTH) return;
+        const b = self.acquire(bucket_name) catch |err| {
+            std.log.warn("key index for {s} unavailable: {}", .{ bucket_name, err });
+            return;
+        };
+        defer self.unref(b);
+        // The index is only as good as its log. If it can't be written,
+        // let the next LIST rebuild the bucket's index from the filesystem.
+        self.apply(b, change) catch |err| {
+            std.log.warn("key index for {s} dropped: {}", .{ bucket_name, err });
+            self.forget(b, true);
+            b.mutex.unlock(app_io);
+            return;
+        };
+        b.mutex.unlock(app_io);
+        // Keep the index as durable as the object it describes, without
+        // holding up other writers. Our reference keeps the log open even if
+        // the bucket is dropped meanwhile; compaction only truncates it.
+        if (self.committer.mode != .none) b.log.sync(app_io) catch {};
+    }
+
+    fn apply(self: *KeyIndex, b: *Bucket, change: Change) !void {
+        var rec_buf: [1 + 2 + MAX_KEY_LENGTH + 16]u8 = undefined;
+        rec_buf[0] = if (change.deleted) 'D' else 'P';
+        const len = 1 + encodeRecord(rec_buf[1..], change.key, change.size, change.mtime);
+        try b.log.writePositionalAll(app_io, rec_buf[0..len], b.log_end);
+        b.log_end += len;
+        try self.remember(b, change);
+        if (b.changes.items.len >= KEY_INDEX_FLUSH) try self.compact(b);
+    }
+
+    /// Add a change to the in-memory log, replacing any earlier one for the key
+    fn remember(self: *KeyIndex, b: *Bucket, change: Change) !void {
+        const i = std.sort.lowerBound(Change, b.changes.items, change.key, compareChange);
+        if (i < b.changes.items.len and std.mem.eql(u8, b.changes.items[i].key, change.key)) {
+            const key = b.changes.items[i].key;
+            b.changes.items[i] = change;
+            b.changes.items[i].key = key;
+            return;
+        }
+        const key = try self.allocator.dupe(u8, change.key);
+        errdefer self.allocator.free(key);
+        var owned = change;
+        owned.key = key;
+        try b.changes.insert(self.allocator, i, owned);
+    }
+
+    fn compareChange(key: []const u8, change: Change) std.math.Order {
+        return std.mem.order(u8, key, change.key);
+    }
+
+    /// Forget a deleted bucket and delete its index files.
+    pub fn drop(self: *KeyIndex, bucket_name: []const u8) void {
+        const b = self.ref(bucket_name) catch return;
+        defer self.unref(b);
+        b.mutex.lockUncancelable(app_io);
+        defer b.mutex.unlock(app_io);
+        self.forget(b, true);
+    }
+
+    /// Take `b` out of the table, so the next user of the bucket starts
+    /// afresh, and optionally delete its index files. The caller holds the
+    /// bucket's lock. The files go under the table lock, so a new index for
+    /// the bucket can't be created while they are being deleted.
+    fn forget(self: *KeyIndex, b: *Bucket, delete_files: bool) void {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        if (self.buckets.get(b.name) == b) _ = self.buckets.remove(b.name);
+        b.dropped = true;
+        if (delete_files) std.Io.Dir.cwd().deleteTree(app_io, b.dir) catch {};
+    }
+
+    /// Reference the table entry of a bucket, adding an unloaded one if
+    /// there is none.
+    fn ref(self: *KeyIndex, bucket_name: []const u8) !*Bucket {
+        self.mutex.lockUncancelable(app_io);
+        defer self.mutex.unlock(app_io);
+        if (self.buckets.get(bucket_name)) |b| {
+            b.refs += 1;
+            return b;
+        }
+
+        const b = try self.allocator.create(Bucket);
+        errdefer self.allocator.destroy(b);
+        const name = try self.allocator.dupe(u8, bucket_name);
+        errdefer self.allocator.free(name);
+        const dir = try std.fs.path.join(self.allocator, &.{ self.data_dir, ".keys", bucket_name });
+        errdefer self.allocator.free(dir);
+        b.* = .{ .name = name, .dir = dir, .refs = 1 };
+        try self.buckets.put(self.allocator, name, b);
+        return b;
+    }
+
+    fn unref(self: *KeyIndex, b: *Bucket) void {
+        const last = blk: {
+            self.mutex.lockUncancelable(app_io);
+            defer self.mutex.unlock(app_io);
+            b.refs -= 1;
+            break :blk b.refs == 0 and b.dropped;
+        };
+        if (last) self.release(b);
+    }
+
+    /// The index of a bucket, loading or building it on first use. It comes
+    /// back locked and referenced; hand it back with `put`.
+    fn acquire(self: *KeyIndex, bucket_name: []const u8) !*Bucket {
+        while (true) {
+            const b = try self.ref(bucket_name);
+            b.mutex.lockUncancelable(app_io);
+            if (b.dropped) {
+                // Dropped while we waited; the table has moved on
+                self.put(b);
+                continue;
+            }
+            if (!b.loaded) self.load(b) catch |err| {
+                self.forget(b, false);
+                self.put(b);
+                return err;
+            };
+            return b;
+        }
+    }
+
+    /// Unlock and unreference a bucket from `acquire`
+    fn put(self: *KeyIndex, b: *Bucket) void {
+        b.mutex.unlock(app_io);
+        self.unref(b);
+    }
+
+    fn release(self: *KeyIndex, b: *Bucket) void {
+        if (b.loaded) b.log.close(app_io);
+        self.freeBlocks(b.blocks);
+        for (b.changes.items) |c| self.allocator.free(c.key);
+        b.changes.deinit(self.allocator);
+        self.allocator.free(b.dir);
+        self.allocator.free(b.name);
+        self.allocator.destroy(b);
+    }
+
+    fn freeBlocks(self: *KeyIndex, blocks: []Block) void {
+        for (blocks) |blk| self.allocator.free(blk.key);
+        self.allocator.free(blocks);
+    }
+
+    /// Load a bucket's index from its files, or build it from the bucket's
+    /// directory tree. The caller holds the bucket's lock.
+    fn load(self: *KeyIndex, b: *Bucket) !void {
+        const bucket_path = try std.fs.path.join(self.allocator, &.{ self.data_dir, b.name });
+        defer self.allocator.free(bucket_path);
+        var bucket_dir = std.Io.Dir.cwd().openDir(app_io, bucket_path, .{}) catch return error.NoSuchBucket;
+        bucket_dir.close(app_io);
+        try std.Io.Dir.cwd().createDirPath(app_io, b.dir);
+
+        const log_path = try std.fs.path.join(self.allocator, &.{ b.dir, "log" });
+        defer self.allocator.free(log_path);
+        b.log = try std.Io.Dir.cwd().createFile(app_io, log_path, .{ .read = true, .truncate = false });
+        errdefer {
+            b.log.close(app_io);
+            self.freeBlocks(b.blocks);
+            b.blocks = &.{};
+            for (b.changes.items) |c| self.allocator.free(c.key);
+            b.changes.clearRetainingCapacity();
+        }
+
+        if (self.loadBase(b)) |_| {
+            try self.replayLog(b);
+        } else |err| {
+            if (err != error.FileNotFound) std.log.warn("rebuilding key index for {s}: {}", .{ b.name, err });
+            try self.rebuild(b, bucket_path);
+        }
+        b.loaded = true;
+    }
+
+    /// Read the footer and sparse index of `base`
+    fn loadBase(self: *KeyIndex, b: *Bucket) !void {
+        const path = try std.fs.path.join(self.allocator, &.{ b.dir, "base" });
+        defer self.allocator.free(path);
+        var file = try std.Io.Dir.cwd().openFile(app_io, path, .{});
+        defer file.close(app_io);
+
+        const size = try file.length(app_io);
+        if (size < 16) return error.CorruptKeyIndex;
+        var footer: [16]u8 = undefined;
+        if (try file.readPositionalAll(app_io, &footer, size - 16) != 16) return error.CorruptKeyIndex;
+        if (!std.mem.eql(u8, footer[8..], BASE_MAGIC)) return error.CorruptKeyIndex;
+        const base_end = std.mem.readInt(u64, footer[0..8], .little);
+        if (base_end > size - 16) return error.CorruptKeyIndex;
+
+        const sparse = try self.allocator.alloc(u8, @intCast(size - 16 - base_end));
+        defer self.allocator.free(sparse);
+        if (try file.readPositionalAll(app_io, sparse, base_end) != sparse.len) return error.CorruptKeyIndex;
+
+        var blocks: std.ArrayListUnmanaged(Block) = .empty;
+        errdefer {
+            for (blocks.items) |blk| self.allocator.free(blk.key);
+            blocks.deinit(self.allocator);
+        }
+        var pos: usize = 0;
+        while (pos < sparse.len) {
+            const rec = decodeRecord(sparse[pos..]) orelse return error.CorruptKeyIndex;
+            const key = try self.allocator.dupe(u8, rec.key);
+            blocks.append(self.allocator, .{ .key = key, .offset = rec.size }) catch |err| {
+                self.allocator.free(key);
+                return err;
+            };
+            pos += rec.len;
+        }
+        b.blocks = try blocks.toOwnedSlice(self.allocator);
+        b.base_end = base_end;
+    }
+
+    /// Load the log into memory. A record cut short by a crash is dropped.
+    fn replayLog(self: *KeyIndex, b: *Bucket) !void {
+        const size = try b.log.length(app_io);
+        const data = try self.allocator.alloc(u8, @intCast(size));
+        defer self.allocator.free(data);
+        if (try b.log.readPositionalAll(app_io, data, 0) != data.len) return error.CorruptKeyIndex;
+
+        var pos: usize = 0;
+        while (pos < data.len) {
+            const op = data[pos];
+            if (op != 'P' and op != 'D') break;
+            const rec = decodeRecord(data[pos + 1 ..]) orelse break;
+            try self.remember(b, .{ .key = rec.key, .size = rec.size, .mtime = rec.mtime, .deleted = op == 'D' });
+            pos += 1 + rec.len;
+        }
+        if (pos < data.len) try b.log.setLength(app_io, pos);
+        b.log_end = pos;
     }
 
-    var count_buf: [32]u8 = undefined;
-    const count_str = std.fmt.bufPrint(&count_buf, "{d}", .{count}) catch "0";
-    try xml.appendSlice(allocator, "<KeyCount>");
-    try xml.appendSlice(allocator, count_str);
-    try xml.appendSlice(allocator, "</KeyCount>");
+    /// Index a bucket from its directory tree
+    fn rebuild(self: *KeyIndex, b: *Bucket, bucket_path: []const u8) !void {
+        var arena = std.heap.ArenaAllocator.init(self.allocator);
+        defer arena.deinit();
+        const alloc = arena.allocator();
+
+        const keys = try collectKeys(alloc, bucket_path, self.scan_threads);
+        std.mem.sort(KeyInfo, keys, {}, struct {
+            fn lessThan(_: void, a: KeyInfo, c: KeyInfo) bool {
+                return std.mem.order(u8, a.key, c.key) == .lt;
+            }
+        }.lessThan);
+
+        var writer = try BaseWriter.create(self, alloc);
+        defer writer.abort();
+        for (keys) |item| {
+            if (item.key.len <= MAX_KEY_LENGTH) try writer.add(item);
+        }
+        try self.install(b, &writer);
+    }
+
+    /// Merge the in-memory log into a new base and empty the log
+    fn compact(self: *KeyIndex, b: *Bucket) !void {
+        var arena = std.heap.ArenaAllocator.init(self.allocator);
+        defer arena.deinit();
+        const alloc = arena.allocator();
+
+        var writer = try BaseWriter.create(self, alloc);
+        defer writer.abort();
+        var it = try iterate(alloc, b, "");
+        defer it.deinit();
+        while (try it.next()) |item| try writer.add(item);
+        try self.install(b, &writer);
+    }
+
+    /// Put a finished base in place and start a fresh log over it
+    fn install(self: *KeyIndex, b: *Bucket, writer: *BaseWriter) !void {
+        const blocks = try writer.finish(self.allocator);
+        errdefer self.freeBlocks(blocks);
+        const path = try std.fs.path.join(self.allocator, &.{ b.dir, "base" });
+        defer self.allocator.free(path);
+        try self.committer.commit(writer.tmp_path, path);
+        writer.committed = true;
+
+        self.freeBlocks(b.blocks);
+        b.blocks = blocks;
+        b.base_end = writer.offset;
+        for (b.changes.items) |c| self.allocator.free(c.key);
+        b.changes.clearRetainingCapacity();
+        try b.log.setLength(app_io, 0);
+        b.log_end = 0;
+    }
+
+    /// Writes a new `base` to a temp file
+    const BaseWriter = struct {
+        index: *KeyIndex,
+        alloc: Allocator, // temporary; blocks are copied out by finish()
+        tmp_path: []const u8,
+        file: std.Io.File,
+        writer: std.Io.File.Writer,
+        offset: u64 = 0,
+        count: usize = 0,
+        blocks: std.ArrayListUnmanaged(Block) = .empty,
+        committed: bool = false,
+
+        fn create(index: *KeyIndex, alloc: Allocator) !BaseWriter {
+            const tmp_path = try tempFilePath(alloc, index.data_dir);
+            const buf = try alloc.alloc(u8, SPOOL_CHUNK_SIZE);
+            const file = try std.Io.Dir.cwd().createFile(app_io, tmp_path, .{ .exclusive = true });
+            return .{
+                .index = index,
+                .alloc = alloc,
+                .tmp_path = tmp_path,
+                .file = file,
+                .writer = file.writerStreaming(app_io, buf),
+            };
+        }
+
+        fn add(self: *BaseWriter, item: KeyInfo) !void {
+            if (self.count % KEY_INDEX_BLOCK == 0)
+                try self.blocks.append(self.alloc, .{ .key = try self.alloc.dupe(u8, item.key), .offset = self.offset });
+            var buf: [2 + MAX_KEY_LENGTH + 16]u8 = undefined;
+            const len = encodeRecord(&buf, item.key, item.size, item.mtime);
+            try self.writer.interface.writeAll(buf[0..len]);
+            self.offset += len;
+            self.count += 1;
+        }
+
+        /// Write the sparse index and footer, close the file, and return the
+        /// sparse index allocated with `allocator`.
+        fn finish(self: *BaseWriter, allocator: Allocator) ![]Block {
+            const w = &self.writer.interface;
+            for (self.blocks.items) |blk| {
+                var buf: [2 + MAX_KEY_LENGTH + 16]u8 = undefined;
+                try w.writeAll(buf[0..encodeRecord(&buf, blk.key, blk.offset, 0)]);
+            }
+            var footer: [16]u8 = undefined;
+            std.mem.writeInt(u64, footer[0..8], self.offset, .little);
+            @memcpy(footer[8..], BASE_MAGIC);
+            try w.writeAll(&footer);
+            try w.flush();
+
+            const blocks = try allocator.alloc(Block, self.blocks.items.len);
+            var copied: usize = 0;
+            errdefer {
+                for (blocks[0..copied]) |blk| allocator.free(blk.key);
+                allocator.free(blocks);
+            }
+            for (self.blocks.items, blocks) |src, *dst| {
+                dst.* = .{ .key = try allocator.dupe(u8, src.key), .offset = src.offset };
+                copied += 1;
+            }
+            return blocks;
+        }
 
-    if (is_truncated) {
-        try xml.appendSlice(allocator, "<IsTruncated>true</IsTruncated>");
-        if (next_token) |token| {
-            try xml.appendSlice(allocator, "<NextContinuationToken>");
-            try xmlEscape(allocator, &xml, token);
-            try xml.appendSlice(allocator, "</NextContinuationToken>");
+        fn abort(self: *BaseWriter) void {
+            self.file.close(app_io);
+            if (!self.committed) std.Io.Dir.cwd().deleteFile(app_io, self.tmp_path) catch {};
         }
-    } else {
-        try xml.appendSlice(allocator, "<IsTruncated>false</IsTruncated>");
-    }
+    };
 
-    try xml.appendSlice(allocator, "</ListBucketResult>");
+    /// Keys of `bucket_name` from `from` on. Writes to the bucket wait until
+    /// the iterator is deinitialized.
+    pub fn iterateBucket(self: *KeyIndex, allocator: Allocator, bucket_name: []const u8, from: []const u8) !Iterator {
+        const b = try self.acquire(bucket_name);
+        errdefer self.put(b);
+        var it = try iterate(allocator, b, from);
+        it.owner = self;
+        return it;
+    }
 
-    res.ok();
-    res.setXmlBody(try xml.toOwnedSlice(allocator));
-}
+    fn iterate(allocator: Allocator, b: *Bucket, from: []const u8) !Iterator {
+        const path = try std.fs.path.join(allocator, &.{ b.dir, "base" });
+        defer allocator.free(path);
+        const file = try std.Io.Dir.cwd().openFile(app_io, path, .{});
+        errdefer file.close(app_io);
 
-const KeyInfo = struct {
-    key: []const u8,
-    size: u64,
-    mtime: i64, // Unix timestamp in seconds
-};
+        var it: Iterator = .{
+            .allocator = allocator,
+            .bucket = b,
+            .changes = &.{},
+            .file = file,
+            .reader = file.reader(app_io, try allocator.alloc(u8, SPOOL_CHUNK_SIZE)),
+            .base_left = 0,
+        };
+        try it.seek(from);
+        return it;
+    }
 
-fn collectKeys(allocator: Allocator, base_path: []const u8, current_prefix: []const u8, filter_prefix: []const u8, keys: *std.ArrayListUnmanaged(KeyInfo)) !void {
-    const full_path = if (current_prefix.len > 0)
-        try std.fs.path.join(allocator, &[_][]const u8{ base_path, current_prefix })
-    else
-        try allocator.dupe(u8, base_path);
-    defer allocator.free(full_path);
+    /// Merges `base` (read sequentially from the seek point) with the
+    /// in-memory log, which wins on equal keys.
+    pub const Iterator = struct {
+        allocator: Allocator,
+        bucket: *Bucket,
+        owner: ?*KeyIndex = null, // holds the bucket from iterateBucket
+        changes: []const Change,
+        file: std.Io.File,
+        reader: std.Io.File.Reader,
+        base_left: u64, // record bytes of `base` not yet read
+        base: ?struct { key_len: usize, size: u64, mtime: i64 } = null, // next base record
+        base_key: [MAX_KEY_LENGTH]u8 = undefined,
+        out_key: [MAX_KEY_LENGTH]u8 = undefined, // key of the entry last returned from base
+
+        fn baseKey(self: *const Iterator) []const u8 {
+            return self.base_key[0..self.base.?.key_len];
+        }
 
-    var dir = std.Io.Dir.cwd().openDir(app_io, full_path, .{ .iterate = true }) catch return;
-    defer dir.close(app_io);
+        /// Continue from the first key at or after `from`
+        pub fn seek(self: *Iterator, from: []const u8) !void {
+            const b = self.bucket;
+            self.changes = b.changes.items[std.sort.lowerBound(Change, b.changes.items, from, compareChange)..];
 
-    var iter = dir.iterate();
-    while (try iter.next(app_io)) |entry| {
-        if (entry.name[0] == '.') continue;
+            // Start at the last block that begins at or before `from`
+            const block = std.sort.upperBound(Block, b.blocks, from, struct {
+                fn order(key: []const u8, blk: Block) std.math.Order {
+                    return std.mem.order(u8, key, blk.key);
+                }
+            }.order);
+            const offset = if (block == 0) 0 else b.blocks[block - 1].offset;
+            try self.reader.seekTo(offset);
+            self.base_left = b.base_end - offset;
+            try self.advanceBase();
+            while (self.base != null and std.mem.order(u8, self.baseKey(), from) == .lt) try self.advanceBase();
+        }
 
-        const full_key = if (current_prefix.len > 0)
-            try std.fmt.allocPrint(allocator, "{s}/{s}", .{ current_prefix, entry.name })
-        else
-            try allocator.dupe(u8, entry.name);
+        /// The next live key. Its key slice is valid until the next call.
+        pub fn next(self: *Iterator) !?KeyInfo {
+            while (true) {
+                const change: ?Change = if (self.changes.len > 0) self.changes[0] else null;
+                const order: std.math.Order = if (change == null and self.base == null)
+                    return null
+                else if (change == null)
+                    .gt
+                else if (self.base == null)
+                    .lt
+                else
+                    std.mem.order(u8, change.?.key, self.baseKey());
+
+                if (order == .gt) {
+                    const item = self.base.?;
+                    @memcpy(self.out_key[0..item.key_len], self.baseKey());
+                    try self.advanceBase();
+                    return .{ .key = self.out_key[0..item.key_len], .size = item.size, .mtime = item.mtime };
+                }
+                // The log has the latest word on this key
+                self.changes = self.changes[1..];
+                if (order == .eq) try self.advanceBase();
+                const c = change.?;
+                if (!c.deleted) return .{ .key = c.key, .size = c.size, .mtime = c.mtime };
+            }
+        }
 
-        if (entry.kind == .directory) {
-            try collectKeys(allocator, base_path, full_key, filter_prefix, keys);
-            allocator.free(full_key);
-        } else if (entry.kind == .file) {
-            // Translate .folder_marker files back to keys ending with /
-            const report_key = if (std.mem.endsWith(u8, full_key, ".folder_marker")) blk: {
-                const trimmed = try allocator.dupe(u8, full_key[0 .. full_key.len - ".folder_marker".len]);
-                allocator.free(full_key);
-                break :blk trimmed;
-            } else full_key;
-
-            if (filter_prefix.len == 0 or std.mem.startsWith(u8, report_key, filter_prefix)) {
-                // Use statFile instead of open+stat+close - much faster
-                const size, const mtime = blk: {
-                    const stat = dir.statFile(app_io, entry.name, .{}) catch break :blk .{ 0, @as(i64, 0) };
-                    break :blk .{ stat.size, @as(i64, @intCast(stat.mtime.toSeconds())) };
-                };
-                try keys.append(allocator, .{ .key = report_key, .size = size, .mtime = mtime });
-            } else {
-                allocator.free(report_key);
+        fn advanceBase(self: *Iterator) !void {
+            if (self.base_left == 0) {
+                self.base = null;
+                return;
             }
+            const r = &self.reader.interface;
+            const len = try r.takeInt(u16, .little);
+            if (len > self.base_key.len) return error.CorruptKeyIndex;
+            try r.readSliceAll(self.base_key[0..len]);
+            const size = try r.takeInt(u64, .little);
+            const mtime = try r.takeInt(i64, .little);
+            self.base = .{ .key_len = len, .size = size, .mtime = mtime };
+            self.base_left -|= 2 + @as(u64, len) + 16;
+        }
+
+        pub fn deinit(self: *Iterator) void {
+            self.file.close(app_io);
+            self.allocator.free(self.reader.interface.buffer);
+            if (self.owner) |index| index.put(self.bucket);
         }
+    };
+
+    /// `<u16 key len><key><u64 size><i64 mtime>`, little-endian. Returns the
+    /// encoded length.
+    fn encodeRecord(buf: []u8, key: []const u8, size: u64, mtime: i64) usize {
+        std.mem.writeInt(u16, buf[0..2], @intCast(key.len), .little);
+        @memcpy(buf[2..][0..key.len], key);
+        std.mem.writeInt(u64, buf[2 + key.len ..][0..8], size, .little);
+        std.mem.writeInt(i64, buf[10 + key.len ..][0..8], mtime, .little);
+        return 18 + key.len;
     }
-}
+
+    const Record = struct { key: []const u8, size: u64, mtime: i64, len: usize };
+
+    fn decodeRecord(buf: []const u8) ?Record {
+        if (buf.len < 2) return null;
+        const key_len = std.mem.readInt(u16, buf[0..2], .little);
+        if (key_len > MAX_KEY_LENGTH or buf.len < 18 + @as(usize, key_len)) return null;
+        return .{
+            .key = buf[2..][0..key_len],
+            .size = std.mem.readInt(u64, buf[2 + key_len ..][0..8], .little),
+            .mtime = std.mem.readInt(i64, buf[10 + key_len ..][0..8], .little),
+            .len = 18 + key_len,
+        };
+    }
+};
 
 fn handleCreateBucket(ctx: *const S3Context, allocator: Allocator, res: *Response, bucket: []const u8) !void {
     const path = try ctx.bucketPath(allocator, bucket);
@@ -2975,16 +7146,15 @@ fn handleDeleteBucket(ctx: *const S3Context, allocator: Allocator, res: *Respons
         else => std.log.warn("delete bucket failed: {}", .{err}),
     };
 
+    ctx.key_index.drop(bucket);
+
     if (ctx.distributed) |dist| {
         const ts = std.Io.Clock.real.now(app_io).toSeconds();
         dist.bucket_ops.noteDelete(allocator, bucket, ts);
-        // Drop the object-metadata tree for this bucket so tombstones and
-        // inline data don't leak, and peers can't serve a deleted bucket's
-        // index on a later sync.
-        if (std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index", bucket })) |index_path| {
-            defer allocator.free(index_path);
-            std.Io.Dir.cwd().deleteTree(app_io, index_path) catch {};
-        } else |_| {}
+        // Drop the bucket's object metadata so tombstones and inline data
+        // don't leak, and peers can't serve a deleted bucket's index on a
+        // later sync.
+        dist.meta_index.dropBucket(bucket);
         if (std.heap.page_allocator.dupe(u8, bucket)) |name| {
             dist.worker.enqueue(.{ .bucket = .{ .name = name, .deleted = true, .ts = ts } });
         } else |_| {}
@@ -3095,18 +7265,19 @@ fn handleUploadPart(ctx: *const S3Context, allocator: Allocator, req: *Request,
     const part_path = std.fmt.allocPrint(allocator, "{s}/.uploads/{s}/{s}", .{ ctx.data_dir, upload_id, part_number }) catch return;
     defer allocator.free(part_path);
 
-    var file = std.Io.Dir.cwd().createFile(app_io, part_path, .{}) catch {
-        sendError(res, 500, "InternalError", "Cannot create part file");
-        return;
-    };
-    defer file.close(app_io);
-
-    file.writeStreamingAll(app_io, req.body) catch {
-        sendError(res, 500, "InternalError", "Cannot write part");
-        return;
+    const etag_hash = if (req.spooled) |sp| blk: {
+        ctx.committer.commit(sp.path, part_path) catch {
+            sendError(res, 500, "InternalError", "Cannot write part");
+            return;
+        };
+        break :blk sp.digest.sha256;
+    } else blk: {
+        ctx.committer.writeFile(allocator, part_path, &.{req.body}) catch {
+            sendError(res, 500, "InternalError", "Cannot write part");
+            return;
+        };
+        break :blk SigV4.hash(req.body);
     };
-
-    const etag_hash = SigV4.hash(req.body);
     const etag = try std.fmt.allocPrint(allocator, "\"{x}\"", .{etag_hash});
 
     res.ok();
@@ -3138,12 +7309,6 @@ fn handleCompleteMultipart(ctx: *const S3Context, allocator: Allocator, req: *Re
         };
     }
 
-    var final_file = std.Io.Dir.cwd().createFile(app_io, final_path, .{}) catch {
-        sendError(res, 500, "InternalError", "Cannot create final file");
-        return;
-    };
-    defer final_file.close(app_io);
-
     var dir = std.Io.Dir.cwd().openDir(app_io, parts_dir, .{ .iterate = true }) catch {
         sendError(res, 404, "NoSuchUpload", "Upload not found");
         return;
@@ -3152,18 +7317,44 @@ fn handleCompleteMultipart(ctx: *const S3Context, allocator: Allocator, req: *Re
 
     var parts: std.ArrayListUnmanaged(u32) = .empty;
     defer parts.deinit(allocator);
+    var parts_size: u64 = 0; // decides how distributed mode stores the result
 
     var iter = dir.iterate();
     while (try iter.next(app_io)) |entry| {
         if (entry.kind == .file and entry.name[0] != '.') {
             const num = std.fmt.parseInt(u32, entry.name, 10) catch continue;
             try parts.append(allocator, num);
+            if (ctx.distributed != null) {
+                const stat = dir.statFile(app_io, entry.name, .{}) catch continue;
+                parts_size += stat.size;
+            }
         }
     }
 
     std.mem.sort(u32, parts.items, {}, std.sort.asc(u32));
 
+    // Assemble into a temp file and rename it into place, copying each part
+    // through a fixed-size buffer so memory doesn't grow with object size
+    const tmp_path = try tempFilePath(allocator, ctx.data_dir);
+    defer allocator.free(tmp_path);
+    defer std.Io.Dir.cwd().deleteFile(app_io, tmp_path) catch {};
+    var final_file = std.Io.Dir.cwd().createFile(app_io, tmp_path, .{ .exclusive = true }) catch {
+        sendError(res, 500, "InternalError", "Cannot create final file");
+        return;
+    };
+
+    const chunk = try allocator.alloc(u8, SPOOL_CHUNK_SIZE);
+    defer allocator.free(chunk);
     var hasher = std.crypto.hash.Md5.init(.{});
+    // Distributed mode indexes the result by content: a large object is cut
+    // into chunks on the way through, anything else hashed whole
+    var content_hasher = CAS.Blake3.init(.{});
+    var chunker: ?ChunkWriter = if (ctx.distributed) |dist|
+        if (parts_size > CHUNK_SIZE) .init(allocator, &dist.cas) else null
+    else
+        null;
+    defer if (chunker) |*w| w.deinit();
+    var total_size: u64 = 0;
     var parts_assembled: usize = 0;
 
     for (parts.items) |part_num| {
@@ -3181,56 +7372,77 @@ fn handleCompleteMultipart(ctx: *const S3Context, allocator: Allocator, req: *Re
         };
         defer part_file.close(app_io);
 
-        const stat = part_file.stat(app_io) catch continue;
-        const data = allocator.alloc(u8, stat.size) catch continue;
-        defer allocator.free(data);
-
-        const bytes_read = part_file.readPositionalAll(app_io, data, 0) catch continue;
-        final_file.writeStreamingAll(app_io, data[0..bytes_read]) catch |err| {
-            std.log.warn("failed to write part {d}: {}", .{ part_num, err });
-            continue;
+        var part_hasher = std.crypto.hash.Md5.init(.{});
+        var offset: u64 = 0;
+        const copied = while (true) {
+            const n = part_file.readPositionalAll(app_io, chunk, offset) catch break false;
+            if (n == 0) break true;
+            final_file.writeStreamingAll(app_io, chunk[0..n]) catch |err| {
+                std.log.warn("failed to write part {d}: {}", .{ part_num, err });
+                break false;
+            };
+            part_hasher.update(chunk[0..n]);
+            if (chunker) |*w| {
+                w.write(chunk[0..n]) catch |err| {
+                    std.log.warn("failed to chunk part {d}: {}", .{ part_num, err });
+                    break false;
+                };
+            } else if (ctx.distributed != null) content_hasher.update(chunk[0..n]);
+            offset += n;
+            if (n < chunk.len) break true;
         };
+        total_size += offset;
+        if (!copied) continue;
 
         var part_hash: [16]u8 = undefined;
-        std.crypto.hash.Md5.hash(data[0..bytes_read], &part_hash, .{});
+        part_hasher.final(&part_hash);
         hasher.update(&part_hash);
         parts_assembled += 1;
     }
 
+    var final_hash: [16]u8 = undefined;
+    hasher.final(&final_hash);
+    var etag_buf: [48]u8 = undefined;
+    const multipart_etag = std.fmt.bufPrint(&etag_buf, "\"{x}-{d}\"", .{ final_hash, parts_assembled }) catch "\"\"";
+    saveObjectEtag(final_file, multipart_etag);
+    final_file.close(app_io);
+
+    ctx.committer.commit(tmp_path, final_path) catch {
+        sendError(res, 500, "InternalError", "Cannot write final file");
+        return;
+    };
+    ctx.key_index.noteWrite(bucket, key, final_path);
+
     std.Io.Dir.cwd().deleteTree(app_io, parts_dir) catch |err| {
         std.log.warn("failed to cleanup upload dir: {}", .{err});
     };
 
     // In distributed mode, index the assembled file so distributed GET can find it
-    if (ctx.distributed) |dist| {
-        const assembled = blk: {
-            var f = std.Io.Dir.cwd().openFile(app_io, final_path, .{}) catch break :blk null;
+    if (ctx.distributed) |dist| index: {
+        if (chunker) |*w| {
+            _ = putChunkedObject(ctx, bucket, key, w) catch {};
+            break :index;
+        }
+        var full_hash: [32]u8 = undefined;
+        content_hasher.final(&full_hash);
+        const content_hash: ContentHash = full_hash[0..20].*;
+        if (total_size <= INLINE_THRESHOLD) {
+            var f = std.Io.Dir.cwd().openFile(app_io, final_path, .{}) catch break :index;
             defer f.close(app_io);
-            const stat = f.stat(app_io) catch break :blk null;
-            const data = allocator.alloc(u8, stat.size) catch break :blk null;
-            const n = f.readPositionalAll(app_io, data, 0) catch break :blk null;
-            break :blk data[0..n];
-        };
-        if (assembled) |data| {
-            const content_hash = CAS.computeHash(data);
-            if (data.len <= INLINE_THRESHOLD) {
-                dist.meta_index.putWithData(allocator, bucket, key, content_hash, data.len, data) catch {};
-            } else {
-                _ = dist.cas.store(allocator, data) catch {};
-                dist.meta_index.put(allocator, bucket, key, content_hash, data.len) catch {};
-                dist.kademlia.announce(content_hash) catch {};
-                dist.replication.schedule(content_hash) catch {};
-            }
-            propagateObjectMeta(ctx, allocator, bucket, key);
-            if (data.len > INLINE_THRESHOLD) {
-                dist.worker.enqueue(.{ .blob = .{ .hash = content_hash } });
-            }
+            const n = f.readPositionalAll(app_io, chunk[0..@intCast(total_size)], 0) catch break :index;
+            dist.meta_index.putWithData(bucket, key, content_hash, n, chunk[0..n]) catch {};
+        } else {
+            dist.cas.storeFile(allocator, final_path, content_hash, .copy) catch break :index;
+            dist.meta_index.put(bucket, key, content_hash, total_size) catch {};
+            dist.kademlia.announce(content_hash) catch {};
+            dist.replication.schedule(content_hash) catch {};
+        }
+        propagateObjectMeta(ctx, allocator, bucket, key);
+        if (total_size > INLINE_THRESHOLD) {
+            dist.worker.enqueue(.{ .blob = .{ .hash = content_hash } });
         }
     }
 
-    var final_hash: [16]u8 = undefined;
-    hasher.final(&final_hash);
-
     var xml: std.ArrayListUnmanaged(u8) = .empty;
     defer xml.deinit(allocator);
 
@@ -3241,9 +7453,9 @@ fn handleCompleteMultipart(ctx: *const S3Context, allocator: Allocator, req: *Re
     try xml.appendSlice(allocator, "</Bucket><Key>");
     try xmlEscape(allocator, &xml, key);
 
-    var etag_buf: [72]u8 = undefined;
-    const etag = std.fmt.bufPrint(&etag_buf, "</Key><ETag>\"{x}-{d}\"</ETag>", .{ final_hash, parts_assembled }) catch "</Key><ETag>\"\"</ETag>";
-    try xml.appendSlice(allocator, etag);
+    try xml.appendSlice(allocator, "</Key><ETag>");
+    try xml.appendSlice(allocator, multipart_etag);
+    try xml.appendSlice(allocator, "</ETag>");
     try xml.appendSlice(allocator, "</CompleteMultipartUploadResult>");
 
     res.ok();
@@ -3369,7 +7581,12 @@ fn handlePeerProtocol(ctx: *const S3Context, dist: *DistributedContext, allocato
         var id_hex: [40]u8 = undefined;
         bytesToHex(&dist.config.node_id, &id_hex);
         res.ok();
-        res.body = try std.fmt.allocPrint(allocator, "{{\"id\":\"{s}\",\"peers\":{d}}}", .{ id_hex, dist.kademlia.peerCount() });
+        const cache = dist.meta_index.log.cacheStats();
+        const tombstones = dist.meta_index.log.tombstoneStats();
+        res.body = try std.fmt.allocPrint(allocator, "{{\"id\":\"{s}\",\"peers\":{d},\"meta_cache\":{{\"hits\":{d},\"misses\":{d},\"entries\":{d},\"bytes\":{d}}},\"tombstones\":{{\"count\":{d},\"queued\":{d},\"expired\":{d}}}}}", .{
+            id_hex,           dist.kademlia.peerCount(), cache.hits,         cache.misses, cache.entries, cache.bytes,
+            tombstones.count, tombstones.queued,         tombstones.expired,
+        });
     } else if (std.mem.eql(u8, path, "peers")) {
         // Return known peers for gossip
         var json: std.ArrayListUnmanaged(u8) = .empty;
@@ -3411,19 +7628,33 @@ fn handlePeerProtocol(ctx: *const S3Context, dist: *DistributedContext, allocato
 
         if (std.mem.eql(u8, req.method, "GET")) {
             // Fetch blob by hash
-            const data = dist.cas.retrieve(allocator, hash) catch {
+            const file = dist.cas.open(allocator, hash) catch {
                 sendError(res, 404, "NotFound", "Content not found");
                 return;
             };
+            const stat = file.stat(app_io) catch {
+                file.close(app_io);
+                sendError(res, 500, "InternalError", "Stat failed");
+                return;
+            };
             res.ok();
-            res.body = data;
+            res.setSendFile(file, stat.size, 0);
         } else if (std.mem.eql(u8, req.method, "PUT")) {
-            // Store blob (pushed from another node) and record ourselves as provider
-            const stored_hash = dist.cas.store(allocator, req.body) catch {
+            // Store blob (pushed from another node) and record ourselves as
+            // provider. Large blobs were spooled and hashed on the way in.
+            const digest = if (req.spooled) |sp| sp.digest.blake3 else CAS.computeHash(req.body);
+            if (!std.mem.eql(u8, &digest, &hash)) {
+                sendError(res, 400, "BadDigest", "Content does not match its hash");
+                return;
+            }
+            const stored = if (req.spooled) |sp|
+                dist.cas.storeFile(allocator, sp.path, hash, .move)
+            else if (dist.cas.store(allocator, req.body)) |_| {} else |err| err;
+            stored catch {
                 sendError(res, 500, "InternalError", "Failed to store");
                 return;
             };
-            dist.kademlia.announce(stored_hash) catch {};
+            dist.kademlia.announce(hash) catch {};
             res.ok();
         } else {
             sendError(res, 405, "MethodNotAllowed", "Method not allowed");
@@ -3442,7 +7673,8 @@ fn handlePeerProtocol(ctx: *const S3Context, dist: *DistributedContext, allocato
             return;
         };
 
-        const providers = dist.kademlia.findProviders(hash);
+        var provider_buf: [MAX_BROADCAST_PEERS]NodeId = undefined;
+        const providers = provider_buf[0..dist.kademlia.findProviders(hash, &provider_buf)];
 
         var json: std.ArrayListUnmanaged(u8) = .empty;
         try json.appendSlice(allocator, "[");
@@ -3596,6 +7828,52 @@ fn handlePeerProtocol(ctx: *const S3Context, dist: *DistributedContext, allocato
         };
         res.ok();
         res.body = try out.toOwnedSlice(allocator);
+    } else if (std.mem.eql(u8, path, "tree")) {
+        // Anti-entropy: digests of the children of some metadata tree nodes
+        // Body: "<depth>\n<index>,<index>,...", response: 16 hex digits
+        // per child, FANOUT children per node, in the order asked
+        if (!std.mem.eql(u8, req.method, "POST")) {
+            sendError(res, 405, "MethodNotAllowed", "Use POST");
+            return;
+        }
+        const depth_end = std.mem.indexOfScalar(u8, req.body, '\n') orelse req.body.len;
+        const depth = std.fmt.parseInt(usize, req.body[0..depth_end], 10) catch MetaTree.DEPTH;
+        if (depth >= MetaTree.DEPTH or depth_end == req.body.len) {
+            sendError(res, 400, "InvalidRequest", "Invalid tree depth");
+            return;
+        }
+        const nodes = parseTreeIndices(allocator, req.body[depth_end + 1 ..], std.math.pow(usize, MetaTree.FANOUT, depth)) orelse {
+            sendError(res, 400, "InvalidRequest", "Invalid tree nodes");
+            return;
+        };
+        var out: std.ArrayListUnmanaged(u8) = .empty;
+        try out.ensureTotalCapacity(allocator, nodes.len * MetaTree.FANOUT * 16);
+        for (nodes) |node| {
+            for (dist.meta_index.log.treeChildren(depth, node)) |d| out.printAssumeCapacity("{x:0>16}", .{d});
+        }
+        res.ok();
+        res.body = try out.toOwnedSlice(allocator);
+    } else if (std.mem.eql(u8, path, "range")) {
+        // Anti-entropy: every entry in some metadata tree leaves
+        // Body: "<leaf>,<leaf>,...", response: as for index
+        if (!std.mem.eql(u8, req.method, "POST")) {
+            sendError(res, 405, "MethodNotAllowed", "Use POST");
+            return;
+        }
+        const leaves = parseTreeIndices(allocator, req.body, MetaTree.LEAVES) orelse {
+            sendError(res, 400, "InvalidRequest", "Invalid tree leaves");
+            return;
+        };
+        var set: MetaTree.LeafSet = .initEmpty();
+        for (leaves) |leaf| set.set(leaf);
+        var out: std.ArrayListUnmanaged(u8) = .empty;
+        dist.meta_index.log.dump(allocator, &out, &set) catch {
+            out.deinit(allocator);
+            sendError(res, 500, "InternalError", "Index dump failed");
+            return;
+        };
+        res.ok();
+        res.body = try out.toOwnedSlice(allocator);
     } else if (std.mem.eql(u8, path, "bucket")) {
         // Bucket creation propagated from a peer (body: "bucket\ncreate_ts")
         if (!std.mem.eql(u8, req.method, "POST")) {
@@ -3648,9 +7926,7 @@ fn handlePeerProtocol(ctx: *const S3Context, dist: *DistributedContext, allocato
         const bucket_path = try ctx.bucketPath(allocator, bucket);
         defer allocator.free(bucket_path);
         std.Io.Dir.cwd().deleteTree(app_io, bucket_path) catch {};
-        const index_path = try std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index", bucket });
-        defer allocator.free(index_path);
-        std.Io.Dir.cwd().deleteTree(app_io, index_path) catch {};
+        dist.meta_index.dropBucket(bucket);
         dist.bucket_ops.noteDelete(allocator, bucket, delete_ts);
         res.ok();
     } else {
@@ -3667,17 +7943,29 @@ fn handleDistributedPut(ctx: *const S3Context, allocator: Allocator, req: *Reque
     defer allocator.free(bucket_path);
     std.Io.Dir.cwd().createDirPath(app_io, bucket_path) catch {};
 
-    // Compute content hash
-    const hash = CAS.computeHash(req.body);
+    if (req.chunked) |writer| {
+        const hash = try putChunkedObject(ctx, bucket, key, writer);
+        res.ok();
+        res.setHeader("ETag", try std.fmt.allocPrint(allocator, "\"{x}\"", .{hash}));
+        return;
+    }
+
+    // Compute content hash (spooled bodies were hashed while streaming in)
+    const size: u64 = if (req.spooled) |sp| sp.size else req.body.len;
+    const hash = if (req.spooled) |sp| sp.digest.blake3 else CAS.computeHash(req.body);
 
     // For small objects, store inline in metadata (skip CAS)
     // Inline objects are NOT announced to DHT since they can't be fetched via blob API
-    if (req.body.len <= INLINE_THRESHOLD) {
-        try dist.meta_index.putWithData(allocator, bucket, key, hash, req.body.len, req.body);
+    if (size <= INLINE_THRESHOLD) {
+        try dist.meta_index.putWithData(bucket, key, hash, req.body.len, req.body);
     } else {
         // Store content in CAS for larger objects
-        _ = try dist.cas.store(allocator, req.body);
-        try dist.meta_index.put(allocator, bucket, key, hash, req.body.len);
+        if (req.spooled) |sp| {
+            try dist.cas.storeFile(allocator, sp.path, hash, .move);
+        } else {
+            _ = try dist.cas.store(allocator, req.body);
+        }
+        try dist.meta_index.put(bucket, key, hash, size);
 
         // Announce to DHT and schedule replication (only for CAS objects)
         dist.kademlia.announce(hash) catch {};
@@ -3687,7 +7975,7 @@ fn handleDistributedPut(ctx: *const S3Context, allocator: Allocator, req: *Reque
     // Propagate the namespace entry to peers synchronously (small, keeps
     // cross-node reads consistent); replicate CAS blobs in the background
     propagateObjectMeta(ctx, allocator, bucket, key);
-    if (req.body.len > INLINE_THRESHOLD) {
+    if (size > INLINE_THRESHOLD) {
         dist.worker.enqueue(.{ .blob = .{ .hash = hash } });
     }
 
@@ -3698,6 +7986,25 @@ fn handleDistributedPut(ctx: *const S3Context, allocator: Allocator, req: *Reque
     res.setHeader("ETag", etag);
 }
 
+/// Record an object whose chunks `writer` has stored. Each chunk is
+/// announced and replicated as a blob of its own, so peers fetch and keep
+/// only the chunks they lack. Returns the object's hash, the manifest's.
+fn putChunkedObject(ctx: *const S3Context, bucket: []const u8, key: []const u8, writer: *ChunkWriter) !ContentHash {
+    const dist = ctx.distributed.?;
+    const manifest = try writer.finish();
+    const hash = CAS.computeHash(manifest);
+    try dist.meta_index.putChunked(bucket, key, hash, writer.size, manifest);
+
+    propagateObjectMeta(ctx, writer.allocator, bucket, key);
+    const m = Manifest{ .bytes = manifest };
+    for (0..m.count()) |i| {
+        const chunk = m.chunk(i).hash;
+        dist.kademlia.announce(chunk) catch {};
+        dist.worker.enqueue(.{ .blob = .{ .hash = chunk } });
+    }
+    return hash;
+}
+
 /// Distributed GET - lookup metadata, retrieve from CAS/inline or peers with quorum
 fn handleDistributedGet(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Response, bucket: []const u8, key: []const u8) !void {
     const dist = ctx.distributed.?;
@@ -3721,16 +8028,21 @@ fn handleDistributedGet(ctx: *const S3Context, allocator: Allocator, req: *Reque
         return serveContent(allocator, req, res, "", &meta.hash, meta.created);
     }
 
+    if (meta.manifest) |bytes| {
+        return serveChunked(dist, allocator, req, res, &meta, .{ .bytes = bytes });
+    }
+
     // Try local CAS
-    if (dist.cas.retrieve(allocator, meta.hash)) |data| {
-        return serveContent(allocator, req, res, data, &meta.hash, meta.created);
+    if (dist.cas.open(allocator, meta.hash)) |file| {
+        return serveBlob(allocator, req, res, file, &meta.hash, meta.created);
     } else |_| {}
 
     // Content not local - try known providers first, verifying content hashes
-    const providers = dist.kademlia.findProviders(meta.hash);
-    for (providers) |provider_id| {
+    var provider_buf: [MAX_BROADCAST_PEERS]NodeId = undefined;
+    const provider_count = dist.kademlia.findProviders(meta.hash, &provider_buf);
+    for (provider_buf[0..provider_count]) |provider_id| {
         const peer = dist.kademlia.findPeerById(provider_id) orelse continue;
-        if (fetchVerifyServe(dist, allocator, req, res, peer.address, &meta)) return;
+        if (fetchBlob(dist, allocator, req, res, peer.address, &meta)) return;
     }
 
     // No usable provider record (e.g. this node joined after the announce) -
@@ -3738,26 +8050,394 @@ fn handleDistributedGet(ctx: *const S3Context, allocator: Allocator, req: *Reque
     var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
     const peer_count = dist.kademlia.collectPeers(&peers);
     for (peers[0..peer_count]) |peer| {
-        if (fetchVerifyServe(dist, allocator, req, res, peer.address, &meta)) return;
+        if (fetchBlob(dist, allocator, req, res, peer.address, &meta)) return;
     }
 
     sendError(res, 404, "NoSuchKey", "Content not available from any provider");
 }
 
-/// Fetch a blob from one peer, verify its hash, cache it, and serve it.
-/// Returns false (without touching the response) if the peer can't supply it.
-fn fetchVerifyServe(dist: *DistributedContext, allocator: Allocator, req: *Request, res: *Response, address: net.IpAddress, meta: *const MetaIndex.ObjectMeta) bool {
-    const data = fetchFromPeer(allocator, address, meta.hash) catch return false;
-    const fetched_hash = CAS.computeHash(data);
-    if (!std.mem.eql(u8, &fetched_hash, &meta.hash)) {
-        allocator.free(data);
-        return false;
+/// Fetch a blob from one peer and serve it. A whole-object GET is streamed
+/// to the client as the blob arrives; a range is served from the local copy
+/// once all of it is in. Returns false (without touching the response) if
+/// the peer can't supply it.
+fn fetchBlob(dist: *DistributedContext, allocator: Allocator, req: *Request, res: *Response, address: net.IpAddress, meta: *const MetaIndex.ObjectMeta) bool {
+    const etag = std.fmt.allocPrint(allocator, "\"{x}\"", .{meta.hash}) catch return false;
+    const last_modified = allocHttpDate(allocator, meta.created) catch return false;
+    const fetch = allocator.create(BlobFetch) catch return false;
+    fetch.* = BlobFetch.open(dist, allocator, address, meta.hash, meta.size) catch return false;
+
+    if (req.header("range") != null) {
+        defer fetch.deinit();
+        while (fetch.next() catch return false) |_| {}
+        const file = dist.cas.open(allocator, meta.hash) catch return false;
+        serveBlob(allocator, req, res, file, &meta.hash, meta.created);
+        return true;
+    }
+
+    res.ok();
+    res.setHeader("Accept-Ranges", "bytes");
+    res.setHeader("ETag", etag);
+    res.setHeader("Last-Modified", last_modified);
+    res.setBlobStream(fetch);
+    return true;
+}
+
+/// A blob read from a peer while it is sent on to the client. Each piece
+/// is hashed and written to a temp file on its way through, so memory stays
+/// at one SPOOL_CHUNK_SIZE buffer however large the blob. Once the whole
+/// blob is in and matches its hash, the temp file becomes the local copy.
+const BlobFetch = struct {
+    dist: *DistributedContext,
+    allocator: Allocator,
+    hash: ContentHash,
+    size: u64,
+    response: PeerResponse,
+    spool: BodySpool,
+    state: enum { reading, finished } = .reading,
+
+    /// Ask `address` for the blob. Fails, before anything is sent to the
+    /// client, if the peer doesn't have it or offers the wrong size.
+    fn open(dist: *DistributedContext, allocator: Allocator, address: net.IpAddress, hash: ContentHash, size: u64) !BlobFetch {
+        var hash_hex: [40]u8 = undefined;
+        bytesToHex(&hash, &hash_hex);
+        var path_buf: [64]u8 = undefined;
+        const path = std.fmt.bufPrint(&path_buf, "/_zs3/blob/{s}", .{hash_hex}) catch return error.BufferTooSmall;
+
+        var response = try dist.peer_pool.open(address, "GET", path, "", .{ .bytes = "" });
+        errdefer response.close();
+        if (response.length != size) return error.InvalidResponse;
+        return .{
+            .dist = dist,
+            .allocator = allocator,
+            .hash = hash,
+            .size = size,
+            .response = response,
+            .spool = try BodySpool.open(allocator, dist.cas.data_dir, size, .{ .blake3 = .init(.{}) }),
+        };
+    }
+
+    /// The next piece of the blob, or null once all of it has been returned
+    /// and stored. The slice is valid until the next call. The last piece
+    /// is held back until the blob matches its hash, so a bad copy never
+    /// reaches the client whole; it is error.HashMismatch and is not kept.
+    pub fn next(self: *BlobFetch) !?[]const u8 {
+        if (self.state == .finished) return null;
+        const n = try self.response.read(self.spool.chunk);
+        if (n == 0) return error.InvalidResponse;
+        try self.spool.write(self.spool.chunk[0..n]);
+        if (self.spool.size == self.size) try self.store();
+        return self.spool.chunk[0..n];
+    }
+
+    fn store(self: *BlobFetch) !void {
+        const body = self.spool.finish();
+        self.state = .finished;
+        if (!std.mem.eql(u8, &body.digest.blake3, &self.hash)) return error.HashMismatch;
+        try self.dist.cas.storeFile(self.allocator, body.path, self.hash, .move);
+        self.dist.kademlia.announce(self.hash) catch {};
+    }
+
+    pub fn deinit(self: *BlobFetch) void {
+        self.response.close();
+        switch (self.state) {
+            .reading => self.spool.abort(),
+            // Still there unless it was moved into the CAS
+            .finished => std.Io.Dir.cwd().deleteFile(app_io, self.spool.path) catch {},
+        }
+    }
+};
+
+/// Serve an object stored in chunks, with range request support. Only the
+/// chunks a range covers are read. The first is in hand before anything is
+/// sent, so an object that can't be put together here is a 404.
+fn serveChunked(dist: *DistributedContext, allocator: Allocator, req: *Request, res: *Response, meta: *const MetaIndex.ObjectMeta, manifest: Manifest) !void {
+    const last_modified = try allocHttpDate(allocator, meta.created);
+    const range = if (req.header("range")) |h| parseRange(h, meta.size) else null;
+    const start, const end = if (range) |r| .{ r.start, r.end + 1 } else .{ 0, meta.size };
+
+    const stream = try allocator.create(ChunkStream);
+    stream.* = try ChunkStream.init(dist, allocator, manifest, start, end);
+    stream.prepare() catch {
+        stream.deinit();
+        sendError(res, 404, "NoSuchKey", "Content not available from any provider");
+        return;
+    };
+
+    if (range) |r| {
+        res.status = 206;
+        res.status_text = "Partial Content";
+        res.setHeader("Content-Range", try std.fmt.allocPrint(allocator, "bytes {d}-{d}/{d}", .{ r.start, r.end, meta.size }));
+    } else {
+        res.ok();
+        res.setHeader("ETag", try std.fmt.allocPrint(allocator, "\"{x}\"", .{meta.hash}));
+    }
+    res.setHeader("Accept-Ranges", "bytes");
+    res.setHeader("Last-Modified", last_modified);
+    res.stream = .{ .chunks = stream };
+}
+
+/// Part of a chunked object, read chunk by chunk from the CAS while it is
+/// sent. Chunks missing here are fetched from peers by a ChunkFetch, ahead
+/// of the stream and several at a time, and kept.
+const ChunkStream = struct {
+    dist: *DistributedContext,
+    allocator: Allocator,
+    manifest: Manifest,
+    first: usize, // chunks the part covers
+    last: usize,
+    index: usize, // chunk being read
+    offset: u64, // read position in it
+    left: u64, // bytes still to return
+    size: u64,
+    file: ?std.Io.File = null,
+    fetch: ?*ChunkFetch = null,
+    buf: []u8,
+
+    /// The stream of bytes [start, end) of the object
+    fn init(dist: *DistributedContext, allocator: Allocator, manifest: Manifest, start: u64, end: u64) !ChunkStream {
+        var first: usize = 0;
+        var pos: u64 = 0; // where chunk `first` begins
+        while (first + 1 < manifest.count() and pos + manifest.chunk(first).size <= start) : (first += 1) {
+            pos += manifest.chunk(first).size;
+        }
+        var last = first;
+        var last_end = pos + manifest.chunk(first).size;
+        while (last + 1 < manifest.count() and last_end < end) {
+            last += 1;
+            last_end += manifest.chunk(last).size;
+        }
+        return .{
+            .dist = dist,
+            .allocator = allocator,
+            .manifest = manifest,
+            .first = first,
+            .last = last,
+            .index = first,
+            .offset = start - pos,
+            .left = end - start,
+            .size = end - start,
+            .buf = try allocator.alloc(u8, SPOOL_CHUNK_SIZE),
+        };
+    }
+
+    /// Start fetching the chunks not stored here and open the first one
+    fn prepare(self: *ChunkStream) !void {
+        self.fetch = try ChunkFetch.start(self.dist, self.allocator, self.manifest, self.first, self.last + 1);
+        try self.open();
+    }
+
+    fn open(self: *ChunkStream) !void {
+        if (self.fetch) |f| try f.wait(self.index - self.first);
+        self.file = try self.dist.cas.open(self.allocator, self.manifest.chunk(self.index).hash);
+    }
+
+    /// The next piece of the part, or null once all of it has been
+    /// returned. The slice is valid until the next call. A chunk that
+    /// can't be had cuts the response short.
+    pub fn next(self: *ChunkStream) !?[]const u8 {
+        if (self.left == 0) return null;
+        if (self.offset == self.manifest.chunk(self.index).size) {
+            self.file.?.close(app_io);
+            self.file = null;
+            self.index += 1;
+            self.offset = 0;
+            try self.open();
+        }
+        const chunk_left = self.manifest.chunk(self.index).size - self.offset;
+        const want: usize = @intCast(@min(self.buf.len, chunk_left, self.left));
+        const n = try self.file.?.readPositionalAll(app_io, self.buf[0..want], self.offset);
+        if (n != want) return error.InvalidResponse;
+        self.offset += n;
+        self.left -= n;
+        return self.buf[0..n];
+    }
+
+    pub fn deinit(self: *ChunkStream) void {
+        if (self.file) |f| f.close(app_io);
+        if (self.fetch) |f| f.cancel();
+    }
+};
+
+/// Chunks of an object fetched from peers on up to CHUNK_FETCH_THREADS
+/// threads. Each takes the next chunk nobody has started, so chunks come in
+/// roughly in order and several peers serve one object at once. Owned by
+/// std.heap.page_allocator, since the threads can outlive the request; the
+/// last one out frees it.
+const ChunkFetch = struct {
+    dist: *DistributedContext,
+    items: []Item,
+    next: std.atomic.Value(usize) = .init(0), // where threads look for work
+    cancelled: std.atomic.Value(bool) = .init(false),
+    refs: std.atomic.Value(usize),
+
+    const Item = struct {
+        chunk: Manifest.Chunk,
+        turn: usize, // chunk index, to spread chunks over peers
+        state: std.atomic.Value(State),
+        ready: std.Io.Event = .unset,
+    };
+    const State = enum(u8) { pending, fetching, done, failed };
+
+    /// Fetch chunks [first, last) of `manifest` that aren't stored here.
+    /// Null if they all are.
+    fn start(dist: *DistributedContext, scratch: Allocator, manifest: Manifest, first: usize, last: usize) !?*ChunkFetch {
+        const allocator = std.heap.page_allocator;
+        const items = try allocator.alloc(Item, last - first);
+        var pending: usize = 0;
+        for (items, first..) |*item, i| {
+            const chunk = manifest.chunk(i);
+            const local = dist.cas.exists(scratch, chunk.hash);
+            item.* = .{ .chunk = chunk, .turn = i, .state = .init(if (local) .done else .pending) };
+            if (local) item.ready.set(app_io) else pending += 1;
+        }
+        if (pending == 0) {
+            allocator.free(items);
+            return null;
+        }
+        const self = allocator.create(ChunkFetch) catch |err| {
+            allocator.free(items);
+            return err;
+        };
+        self.* = .{ .dist = dist, .items = items, .refs = .init(1) };
+
+        // The stream fetches any chunk it reaches before a thread does, so
+        // threads that can't be started only cost speed
+        for (0..@min(pending, CHUNK_FETCH_THREADS)) |_| {
+            if (dist.fanout_threads.fetchAdd(1, .monotonic) >= MAX_FANOUT_THREADS) {
+                _ = dist.fanout_threads.fetchSub(1, .monotonic);
+                break;
+            }
+            _ = self.refs.fetchAdd(1, .monotonic);
+            const thread = std.Thread.spawn(.{ .stack_size = FANOUT_STACK_SIZE }, work, .{self}) catch {
+                _ = dist.fanout_threads.fetchSub(1, .monotonic);
+                _ = self.refs.fetchSub(1, .monotonic);
+                break;
+            };
+            thread.detach();
+        }
+        return self;
+    }
+
+    fn work(self: *ChunkFetch) void {
+        defer {
+            _ = self.dist.fanout_threads.fetchSub(1, .monotonic);
+            self.release();
+        }
+        while (!self.cancelled.load(.monotonic)) {
+            const i = self.next.fetchAdd(1, .monotonic);
+            if (i >= self.items.len) break;
+            self.claim(i);
+        }
+    }
+
+    /// Fetch item `i` unless someone already has
+    fn claim(self: *ChunkFetch, i: usize) void {
+        const item = &self.items[i];
+        if (item.state.cmpxchgStrong(.pending, .fetching, .acquire, .monotonic) != null) return;
+        const ok = fetchChunk(self.dist, item.chunk, item.turn);
+        item.state.store(if (ok) .done else .failed, .release);
+        item.ready.set(app_io);
+    }
+
+    /// Block until item `i` is stored here, fetching it on this thread if
+    /// no other has started on it
+    fn wait(self: *ChunkFetch, i: usize) !void {
+        self.claim(i);
+        self.items[i].ready.waitUncancelable(app_io);
+        if (self.items[i].state.load(.acquire) != .done) return error.ChunkUnavailable;
+    }
+
+    /// The stream is done with it: threads stop after their current chunk
+    fn cancel(self: *ChunkFetch) void {
+        self.cancelled.store(true, .monotonic);
+        self.release();
+    }
+
+    fn release(self: *ChunkFetch) void {
+        if (self.refs.fetchSub(1, .acq_rel) != 1) return;
+        std.heap.page_allocator.free(self.items);
+        std.heap.page_allocator.destroy(self);
+    }
+};
+
+/// Fetch one chunk into the CAS from whichever peer has it: its known
+/// providers, then every peer. The list is started at a different place for
+/// each chunk, so the chunks of one object are spread over peers.
+fn fetchChunk(dist: *DistributedContext, chunk: Manifest.Chunk, turn: usize) bool {
+    var arena = std.heap.ArenaAllocator.init(std.heap.page_allocator);
+    defer arena.deinit();
+    const allocator = arena.allocator();
+
+    var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
+    var count: usize = 0;
+    var provider_buf: [MAX_BROADCAST_PEERS]NodeId = undefined;
+    for (provider_buf[0..dist.kademlia.findProviders(chunk.hash, &provider_buf)]) |id| {
+        if (std.mem.eql(u8, &id, &dist.kademlia.self_id)) continue;
+        peers[count] = dist.kademlia.findPeerById(id) orelse continue;
+        count += 1;
+    }
+    const providers = count;
+    count += dist.kademlia.collectPeers(peers[count..]);
+
+    for ([_][]const PeerInfo{ peers[0..providers], peers[providers..count] }) |group| {
+        for (0..group.len) |k| {
+            const peer = group[(turn + k) % group.len];
+            const fetch = allocator.create(BlobFetch) catch return false;
+            fetch.* = BlobFetch.open(dist, allocator, peer.address, chunk.hash, chunk.size) catch continue;
+            defer fetch.deinit();
+            // next() is null only once the chunk is checked and stored
+            const stored = while (true) {
+                const piece = fetch.next() catch break false;
+                if (piece == null) break true;
+            };
+            if (stored) return true;
+        }
+    }
+    return false;
+}
+
+/// Serve a stored blob with sendfile, with range request support. Takes
+/// ownership of `file`.
+fn serveBlob(allocator: Allocator, req: *Request, res: *Response, file: std.Io.File, hash: *const ContentHash, created: i64) void {
+    const stat = file.stat(app_io) catch {
+        file.close(app_io);
+        sendError(res, 500, "InternalError", "Stat failed");
+        return;
+    };
+    const last_modified = allocHttpDate(allocator, created) catch {
+        file.close(app_io);
+        sendError(res, 500, "InternalError", "Date format failed");
+        return;
+    };
+
+    if (req.header("range")) |range_header| {
+        if (parseRange(range_header, stat.size)) |range| {
+            const content_range = std.fmt.allocPrint(allocator, "bytes {d}-{d}/{d}", .{ range.start, range.end, stat.size }) catch {
+                file.close(app_io);
+                sendError(res, 500, "InternalError", "Range format failed");
+                return;
+            };
+
+            res.status = 206;
+            res.status_text = "Partial Content";
+            res.setHeader("Content-Range", content_range);
+            res.setHeader("Accept-Ranges", "bytes");
+            res.setHeader("Last-Modified", last_modified);
+            res.setSendFile(file, range.end - range.start + 1, range.start);
+            return;
+        }
     }
-    // Cache locally for future reads and record ourselves as provider
-    _ = dist.cas.store(allocator, data) catch {};
-    dist.kademlia.announce(meta.hash) catch {};
-    serveContent(allocator, req, res, data, &meta.hash, meta.created);
-    return true;
+
+    const etag = std.fmt.allocPrint(allocator, "\"{x}\"", .{hash.*}) catch {
+        file.close(app_io);
+        sendError(res, 500, "InternalError", "ETag failed");
+        return;
+    };
+    res.ok();
+    res.setHeader("Accept-Ranges", "bytes");
+    res.setHeader("ETag", etag);
+    res.setHeader("Last-Modified", last_modified);
+    res.setSendFile(file, stat.size, 0);
 }
 
 /// Serve content with range request support
@@ -3797,15 +8477,6 @@ fn serveContent(allocator: Allocator, req: *Request, res: *Response, data: []con
     res.body = data;
 }
 
-/// Fetch content from a remote peer
-fn fetchFromPeer(allocator: Allocator, address: net.IpAddress, hash: ContentHash) ![]const u8 {
-    var hash_hex: [40]u8 = undefined;
-    bytesToHex(&hash, &hash_hex);
-    var path_buf: [64]u8 = undefined;
-    const path = std.fmt.bufPrint(&path_buf, "/_zs3/blob/{s}", .{hash_hex}) catch return error.BufferTooSmall;
-    return peerRequest(allocator, address, "GET", path, "", MAX_BODY_SIZE);
-}
-
 /// Set send/receive timeouts on a peer socket so a stuck peer can't wedge
 /// the event loop (peer requests are synchronous within a request handler)
 fn setPeerTimeout(stream: net.Stream) void {
@@ -3815,40 +8486,490 @@ fn setPeerTimeout(stream: net.Stream) void {
 }
 
 /// Send a request to a peer's /_zs3/ endpoint and return the response body
-fn peerRequest(allocator: Allocator, address: net.IpAddress, method: []const u8, path: []const u8, body: []const u8, max_response: usize) ![]u8 {
-    var stream = address.connect(app_io, .{ .mode = .stream }) catch return error.ConnectionFailed;
-    defer stream.close(app_io);
-    setPeerTimeout(stream);
-
-    var header_buf: [512]u8 = undefined;
-    const header = std.fmt.bufPrint(&header_buf, "{s} {s} HTTP/1.1\r\nHost: {f}\r\nContent-Length: {d}\r\nConnection: close\r\n\r\n", .{ method, path, address, body.len }) catch return error.BufferTooSmall;
-    streamWriteAll(stream, header) catch return error.WriteFailed;
-    if (body.len > 0) streamWriteAll(stream, body) catch return error.WriteFailed;
-
-    var response: std.ArrayListUnmanaged(u8) = .empty;
-    defer response.deinit(allocator);
-    var chunk: [16 * 1024]u8 = undefined;
-    while (true) {
-        const n = streamRead(stream, &chunk) catch break;
-        if (n == 0) break;
-        try response.appendSlice(allocator, chunk[0..n]);
-        if (response.items.len > max_response) return error.ResponseTooLarge;
+fn peerRequest(dist: *DistributedContext, allocator: Allocator, address: net.IpAddress, method: []const u8, path: []const u8, body: []const u8, max_response: usize) ![]u8 {
+    return dist.peer_pool.request(allocator, address, method, path, "", body, max_response);
+}
+
+/// Keep-alive connections to peers for the /_zs3/ protocol, shared by the
+/// event loop workers and the push worker. A request takes an idle
+/// connection to its peer when there is one, and gives it back once the
+/// response, framed by its Content-Length, has been read. Up to
+/// PEER_POOL_IDLE idle connections are kept per peer, each for at most
+/// PEER_IDLE_MS. A request that fails closes the peer's other idle
+/// connections too, as they have likely failed the same way.
+///
+/// A pooled connection may have been closed by the peer while it sat idle.
+/// If writing the request fails, the peer never saw it, and it is sent
+/// again on a new connection. If the connection closes with no response
+/// after the request went out, the peer may have acted on it. The request
+/// is then resent only if it is idempotent (see `idempotent`).
+pub const PeerPool = struct {
+    allocator: Allocator,
+    mutex: std.Io.Mutex = .init,
+    idle: std.ArrayListUnmanaged(Idle) = .empty,
+
+    const Idle = struct { address: net.IpAddress, stream: net.Stream, since: i64 };
+
+    pub fn init(allocator: Allocator) PeerPool {
+        return .{ .allocator = allocator };
     }
 
-    const data = response.items;
-    const header_end = std.mem.indexOf(u8, data, "\r\n\r\n") orelse return error.InvalidResponse;
-    if (!std.mem.startsWith(u8, data, "HTTP/1.1 200")) return error.RequestFailed;
-    return allocator.dupe(u8, data[header_end + 4 ..]);
-}
+    pub fn deinit(self: *PeerPool) void {
+        for (self.idle.items) |c| c.stream.close(app_io);
+        self.idle.deinit(self.allocator);
+    }
+
+    fn lock(self: *PeerPool) void {
+        self.mutex.lockUncancelable(app_io);
+    }
+
+    fn unlock(self: *PeerPool) void {
+        self.mutex.unlock(app_io);
+    }
+
+    /// Send a request and return the body of a 200 response. `headers` are
+    /// extra header lines, each ending in CRLF.
+    pub fn request(self: *PeerPool, allocator: Allocator, address: net.IpAddress, method: []const u8, path: []const u8, headers: []const u8, body: []const u8, max_response: usize) ![]u8 {
+        var response = try self.open(address, method, path, headers, .{ .bytes = body });
+        defer response.close();
+        if (response.length) |len| if (len > max_response) return error.ResponseTooLarge;
+
+        var out: std.ArrayListUnmanaged(u8) = .empty;
+        errdefer out.deinit(allocator);
+        if (response.length) |len| try out.ensureTotalCapacityPrecise(allocator, @intCast(len));
+        while (true) {
+            try out.ensureUnusedCapacity(allocator, 16 * 1024);
+            const n = try response.read(out.unusedCapacitySlice());
+            if (n == 0) break;
+            out.items.len += n;
+            if (out.items.len > max_response) return error.ResponseTooLarge;
+        }
+        return out.toOwnedSlice(allocator);
+    }
+
+    /// Send a request and read the head of its response. A 200 is returned
+    /// with its body still to be read, and must be closed; any other status
+    /// is error.RequestFailed.
+    pub fn open(self: *PeerPool, address: net.IpAddress, method: []const u8, path: []const u8, headers: []const u8, body: PeerBody) !PeerResponse {
+        if (self.take(address)) |stream| {
+            if (self.begin(stream, address, method, path, headers, body)) |response| {
+                return response;
+            } else |err| switch (err) {
+                // Closed while idle: the peer never saw the request
+                error.StaleConnection => {},
+                error.NoResponse => if (!idempotent(method, path)) {
+                    self.evict(address);
+                    return error.InvalidResponse;
+                },
+                error.RequestFailed => return err,
+                else => {
+                    self.evict(address);
+                    return err;
+                },
+            }
+        }
+        const stream = address.connect(app_io, .{ .mode = .stream }) catch {
+            self.evict(address);
+            return error.ConnectionFailed;
+        };
+        setPeerTimeout(stream);
+        // Head and body go out as separate writes
+        const one: c_int = 1;
+        posix.setsockopt(stream.socket.handle, posix.IPPROTO.TCP, posix.TCP.NODELAY, std.mem.asBytes(&one)) catch {};
+        return self.begin(stream, address, method, path, headers, body) catch |err| switch (err) {
+            error.StaleConnection, error.NoResponse => error.InvalidResponse,
+            error.RequestFailed => err,
+            else => {
+                self.evict(address);
+                return err;
+            },
+        };
+    }
+
+    /// Whether sending a request twice has the same effect as sending it
+    /// once. Every endpoint peers call is: GETs and the POSTed queries only
+    /// read, blobs are PUT under their content hash, and metadata, announce
+    /// and bucket POSTs carry origin timestamps that are merged
+    /// last-write-wins. An endpoint missing here is never resent.
+    fn idempotent(method: []const u8, path: []const u8) bool {
+        if (std.mem.eql(u8, method, "GET")) return true;
+        if (std.mem.eql(u8, method, "PUT")) return std.mem.startsWith(u8, path, "/_zs3/blob/");
+        if (!std.mem.eql(u8, method, "POST")) return false;
+        const endpoints = [_][]const u8{
+            "/_zs3/meta", "/_zs3/meta_get",      "/_zs3/announce", "/_zs3/bucket",
+            "/_zs3/tree", "/_zs3/bucket_delete", "/_zs3/range",
+        };
+        for (endpoints) |endpoint| {
+            if (std.mem.eql(u8, path, endpoint)) return true;
+        }
+        return false;
+    }
+
+    /// Send one request on `stream` and read up to the end of the response
+    /// head. error.StaleConnection: the request couldn't be sent in full;
+    /// error.NoResponse: it was, and the connection closed before any of
+    /// the response. On error the stream has been closed or given back.
+    fn begin(self: *PeerPool, stream: net.Stream, address: net.IpAddress, method: []const u8, path: []const u8, headers: []const u8, body: PeerBody) !PeerResponse {
+        var response: PeerResponse = .{ .pool = self, .address = address, .stream = stream };
+        var handed_off = false;
+        errdefer if (!handed_off) stream.close(app_io);
+
+        const head = std.fmt.bufPrint(&response.buf, "{s} {s} HTTP/1.1\r\nHost: {f}\r\nContent-Length: {d}\r\n{s}\r\n", .{ method, path, address, body.len(), headers }) catch return error.BufferTooSmall;
+        // A write refused by the peer means it closed the connection first
+        streamWriteAll(stream, head) catch |err| return if (err == error.Timeout) err else error.StaleConnection;
+        switch (body) {
+            .bytes => |bytes| if (bytes.len > 0) streamWriteAll(stream, bytes) catch |err| return if (err == error.Timeout) err else error.StaleConnection,
+            .file => |f| streamSendFile(stream, f.file, f.size) catch |err| return if (err == error.Timeout) err else error.StaleConnection,
+        }
+
+        var len: usize = 0;
+        const header_end = while (true) {
+            if (std.mem.indexOf(u8, response.buf[0..len], "\r\n\r\n")) |at| break at + 4;
+            if (len == response.buf.len) return error.InvalidResponse;
+            const n = streamRead(stream, response.buf[len..]) catch |err| {
+                if (len == 0 and err == error.ConnectionResetByPeer) return error.NoResponse;
+                return err;
+            };
+            if (n == 0) return if (len == 0) error.NoResponse else error.InvalidResponse;
+            len += n;
+        };
+
+        var length: ?u64 = null;
+        var close = false;
+        var lines = std.mem.splitSequence(u8, response.buf[0 .. header_end - 4], "\r\n");
+        const ok = std.mem.startsWith(u8, lines.next().?, "HTTP/1.1 200");
+        while (lines.next()) |line| {
+            const colon = std.mem.indexOfScalar(u8, line, ':') orelse continue;
+            const name = line[0..colon];
+            const value = std.mem.trim(u8, line[colon + 1 ..], " \t");
+            if (std.ascii.eqlIgnoreCase(name, "content-length")) {
+                length = std.fmt.parseInt(u64, value, 10) catch return error.InvalidResponse;
+            } else if (std.ascii.eqlIgnoreCase(name, "connection")) {
+                close = std.ascii.eqlIgnoreCase(value, "close");
+            } else if (std.ascii.eqlIgnoreCase(name, "transfer-encoding")) {
+                return error.InvalidResponse; // no peer endpoint streams
+            }
+        }
+
+        response.start = header_end;
+        response.end = len;
+        response.length = length;
+        if (length) |l| {
+            // Anything past the body means the framing can't be trusted
+            response.left = l;
+            response.reusable = !close and len - header_end <= l;
+        } else {
+            // Unframed: the body runs to EOF
+            response.left = std.math.maxInt(u64);
+        }
+        if (!ok) {
+            // An error body that came with the head leaves the connection
+            // ready for the next request
+            response.left -|= len - header_end;
+            handed_off = true;
+            response.close();
+            return error.RequestFailed;
+        }
+        return response;
+    }
+
+    /// An idle connection to `address`, most recently used first. Expired
+    /// ones met on the way are closed.
+    fn take(self: *PeerPool, address: net.IpAddress) ?net.Stream {
+        self.lock();
+        defer self.unlock();
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        var i = self.idle.items.len;
+        while (i > 0) {
+            i -= 1;
+            const c = self.idle.items[i];
+            if (now - c.since >= PEER_IDLE_MS) {
+                c.stream.close(app_io);
+                _ = self.idle.orderedRemove(i);
+            } else if (c.address.eql(&address)) {
+                _ = self.idle.orderedRemove(i);
+                return c.stream;
+            }
+        }
+        return null;
+    }
+
+    /// Keep `stream` for a later request to `address`, unless the peer
+    /// already has PEER_POOL_IDLE idle connections
+    fn give(self: *PeerPool, address: net.IpAddress, stream: net.Stream) void {
+        self.lock();
+        defer self.unlock();
+        var count: usize = 0;
+        for (self.idle.items) |c| {
+            if (c.address.eql(&address)) count += 1;
+        }
+        if (count >= PEER_POOL_IDLE) return stream.close(app_io);
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        self.idle.append(self.allocator, .{ .address = address, .stream = stream, .since = now }) catch stream.close(app_io);
+    }
+
+    /// Close the idle connections to `address`
+    fn evict(self: *PeerPool, address: net.IpAddress) void {
+        self.lock();
+        defer self.unlock();
+        var i: usize = 0;
+        while (i < self.idle.items.len) {
+            const c = self.idle.items[i];
+            if (c.address.eql(&address)) {
+                c.stream.close(app_io);
+                _ = self.idle.orderedRemove(i);
+            } else i += 1;
+        }
+    }
+
+    /// Close connections idle for PEER_IDLE_MS or more
+    pub fn prune(self: *PeerPool) void {
+        self.lock();
+        defer self.unlock();
+        const now = std.Io.Clock.awake.now(app_io).toMilliseconds();
+        var i: usize = 0;
+        while (i < self.idle.items.len) {
+            const c = self.idle.items[i];
+            if (now - c.since >= PEER_IDLE_MS) {
+                c.stream.close(app_io);
+                _ = self.idle.orderedRemove(i);
+            } else i += 1;
+        }
+    }
+};
+
+/// Body of a request to a peer
+const PeerBody = union(enum) {
+    bytes: []const u8,
+    file: struct { file: std.Io.File, size: u64 }, // sent with sendfile
+
+    fn len(self: PeerBody) u64 {
+        return switch (self) {
+            .bytes => |b| b.len,
+            .file => |f| f.size,
+        };
+    }
+};
+
+/// The body of a peer's 200 response, read a piece at a time. `close`
+/// gives the connection back to the pool once all of it has been read.
+const PeerResponse = struct {
+    pool: *PeerPool,
+    address: net.IpAddress,
+    stream: net.Stream,
+    length: ?u64 = null, // Content-Length; null: the body runs to EOF
+    left: u64 = 0, // body bytes not yet read
+    reusable: bool = false,
+    buf: [4096]u8 = undefined, // response head, then body bytes read with it
+    start: usize = 0,
+    end: usize = 0,
+
+    /// Read body bytes into `dest`. Returns 0 at the end of the body.
+    pub fn read(self: *PeerResponse, dest: []u8) !usize {
+        if (self.left == 0 or dest.len == 0) return 0;
+        const want: usize = @intCast(@min(dest.len, self.left));
+        const n = if (self.start < self.end) n: {
+            const n = @min(want, self.end - self.start);
+            @memcpy(dest[0..n], self.buf[self.start..][0..n]);
+            self.start += n;
+            break :n n;
+        } else try streamRead(self.stream, dest[0..want]);
+        if (n == 0) {
+            if (self.length != null) return error.InvalidResponse;
+            self.left = 0;
+            return 0;
+        }
+        self.left -= n;
+        return n;
+    }
+
+    pub fn close(self: *PeerResponse) void {
+        if (self.reusable and self.left == 0) {
+            self.pool.give(self.address, self.stream);
+        } else {
+            self.stream.close(app_io);
+        }
+    }
+};
+
+/// A peer-protocol request sent to many peers at once, each on its own
+/// thread. The caller waits until `want` peers have answered 200, every
+/// peer has answered, or the deadline passes, whichever comes first.
+/// Requests still in flight then finish in the background, and the last
+/// thread out frees the fan-out. Everything is owned by
+/// std.heap.page_allocator, since it outlives the caller's request.
+pub const FanOut = struct {
+    dist: *DistributedContext,
+    method: []const u8, // a literal
+    path: []u8,
+    body: []u8,
+    max_response: usize,
+    want: usize,
+    keep: bool, // 200 bodies are kept for the caller
+    total: usize,
+    mutex: std.Io.Mutex = .init,
+    ready: std.Io.Event = .unset,
+    acks: usize = 0,
+    answered: usize = 0,
+    refs: usize,
+    waiting: bool = true,
+    replies: std.ArrayListUnmanaged(Reply) = .empty,
+
+    pub const Reply = struct { peer: NodeId, body: []u8 };
+
+    /// Send the request to every peer in `peers`. Returns null, with
+    /// nothing sent, if the fan-out can't be allocated.
+    pub fn start(dist: *DistributedContext, method: []const u8, path: []const u8, body: []const u8, max_response: usize, peers: []const PeerInfo, want: usize, keep: bool) ?*FanOut {
+        const allocator = std.heap.page_allocator;
+        const self = allocator.create(FanOut) catch return null;
+        const path_copy = allocator.dupe(u8, path) catch {
+            allocator.destroy(self);
+            return null;
+        };
+        const body_copy = allocator.dupe(u8, body) catch {
+            allocator.free(path_copy);
+            allocator.destroy(self);
+            return null;
+        };
+        self.* = .{
+            .dist = dist,
+            .method = method,
+            .path = path_copy,
+            .body = body_copy,
+            .max_response = max_response,
+            .want = want,
+            .keep = keep,
+            .total = peers.len,
+            .refs = peers.len + 1,
+        };
+        if (want == 0 or peers.len == 0) self.ready.set(app_io);
+        for (peers) |peer| {
+            // A hung peer holds each thread until PEER_IO_TIMEOUT_SECS, so
+            // the count is capped rather than left to grow with the writes
+            if (dist.fanout_threads.fetchAdd(1, .monotonic) >= MAX_FANOUT_THREADS) {
+                _ = dist.fanout_threads.fetchSub(1, .monotonic);
+                self.finish(peer.id, null);
+                continue;
+            }
+            const thread = std.Thread.spawn(.{ .stack_size = FANOUT_STACK_SIZE }, send, .{ self, peer }) catch {
+                _ = dist.fanout_threads.fetchSub(1, .monotonic);
+                self.finish(peer.id, null);
+                continue;
+            };
+            thread.detach();
+        }
+        return self;
+    }
+
+    fn send(self: *FanOut, peer: PeerInfo) void {
+        const dist = self.dist;
+        defer _ = dist.fanout_threads.fetchSub(1, .monotonic);
+        const response = peerRequest(dist, std.heap.page_allocator, peer.address, self.method, self.path, self.body, self.max_response) catch null;
+        self.finish(peer.id, response);
+    }
+
+    /// Record one peer's answer (null: it failed) and drop its reference
+    fn finish(self: *FanOut, peer: NodeId, response: ?[]u8) void {
+        self.mutex.lockUncancelable(app_io);
+        self.answered += 1;
+        if (response) |r| {
+            self.acks += 1;
+            if (self.keep and self.waiting) {
+                self.replies.append(std.heap.page_allocator, .{ .peer = peer, .body = r }) catch std.heap.page_allocator.free(r);
+            } else std.heap.page_allocator.free(r);
+        }
+        if (self.acks >= self.want or self.answered == self.total) self.ready.set(app_io);
+        self.refs -= 1;
+        const last = self.refs == 0;
+        self.mutex.unlock(app_io);
+        if (last) self.destroy();
+    }
+
+    /// Block until the fan-out is ready or `timeout_ms` has passed
+    pub fn wait(self: *FanOut, timeout_ms: u64) void {
+        const deadline = std.Io.Clock.Timestamp.fromNow(app_io, .{ .raw = .fromMilliseconds(@intCast(timeout_ms)), .clock = .awake });
+        while (!self.ready.isSet()) {
+            // A timeout can also be a spurious wakeup
+            self.ready.waitTimeout(app_io, .{ .deadline = deadline }) catch {};
+            if (deadline.durationFromNow(app_io).raw.nanoseconds <= 0) break;
+        }
+    }
+
+    /// Stop waiting and take the replies kept so far, which the caller
+    /// frees with `freeReplies`. `self` must not be used afterwards.
+    pub fn close(self: *FanOut) []const Reply {
+        self.mutex.lockUncancelable(app_io);
+        self.waiting = false;
+        const replies = self.replies.toOwnedSlice(std.heap.page_allocator) catch &.{};
+        self.refs -= 1;
+        const last = self.refs == 0;
+        self.mutex.unlock(app_io);
+        if (last) self.destroy();
+        return replies;
+    }
+
+    pub fn freeReplies(replies: []const Reply) void {
+        for (replies) |r| std.heap.page_allocator.free(r.body);
+        std.heap.page_allocator.free(replies);
+    }
 
-/// Best-effort broadcast of a peer-protocol request to all known peers
-fn broadcastToPeers(dist: *DistributedContext, allocator: Allocator, method: []const u8, path: []const u8, body: []const u8) void {
+    fn destroy(self: *FanOut) void {
+        const allocator = std.heap.page_allocator;
+        for (self.replies.items) |r| allocator.free(r.body);
+        self.replies.deinit(allocator);
+        allocator.free(self.path);
+        allocator.free(self.body);
+        allocator.destroy(self);
+    }
+};
+
+/// Best-effort broadcast of a peer-protocol request to all known peers,
+/// sent to all of them at once. Returns once `acks` of them have accepted
+/// it (null: all of them) or after the peer deadline; the rest are
+/// delivered in the background.
+fn broadcastToPeers(dist: *DistributedContext, method: []const u8, path: []const u8, body: []const u8, acks: ?usize) void {
     var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
     const n = dist.kademlia.collectPeers(&peers);
-    for (peers[0..n]) |peer| {
-        const response = peerRequest(allocator, peer.address, method, path, body, 4096) catch continue;
-        allocator.free(response);
+    if (n == 0) return;
+    const fan_out = FanOut.start(dist, method, path, body, 4096, peers[0..n], acks orelse n, false) orelse return;
+    fan_out.wait(dist.config.peer_deadline_ms);
+    FanOut.freeReplies(fan_out.close());
+}
+
+/// Parse a metadata entry in its text form,
+/// `hash\nsize\ncreated\ndeleted\n[inline data or manifest]`. Either points
+/// into `content`.
+pub fn parseMetaContent(content: []const u8) ?MetaIndex.ObjectMeta {
+    var lines = std.mem.splitScalar(u8, content, '\n');
+    const hash_hex = lines.next() orelse return null;
+    if (hash_hex.len != 40) return null;
+    var hash: ContentHash = undefined;
+    _ = std.fmt.hexToBytes(&hash, hash_hex) catch return null;
+    const size = std.fmt.parseInt(u64, lines.next() orelse return null, 10) catch return null;
+    const created = std.fmt.parseInt(i64, lines.next() orelse return null, 10) catch return null;
+    const deleted = std.fmt.parseInt(i64, lines.next() orelse return null, 10) catch return null;
+    // Inline data, if any, follows the 4th newline
+    const header_end = lines.index orelse content.len;
+    var meta: MetaIndex.ObjectMeta = .{
+        .hash = hash,
+        .size = size,
+        .created = created,
+        .deleted = deleted,
+        .inline_data = null,
+    };
+    meta.setPayload(if (header_end < content.len) content[header_end..] else null);
+    if (meta.manifest) |m| {
+        // Anything but inline data must be the manifest the hash names
+        if (!Manifest.isValid(m, size) or !std.mem.eql(u8, &CAS.computeHash(m), &hash)) return null;
     }
+    return meta;
+}
+
+/// The text form of a metadata entry, as parsed by parseMetaContent
+pub fn formatMetaContent(allocator: Allocator, meta: MetaIndex.ObjectMeta) ![]u8 {
+    var hash_hex: [40]u8 = undefined;
+    bytesToHex(&meta.hash, &hash_hex);
+    return std.fmt.allocPrint(allocator, "{s}\n{d}\n{d}\n{d}\n{s}", .{ hash_hex, meta.size, meta.created, meta.deleted, meta.payload() orelse "" });
 }
 
 /// Parse the logical timestamp of a raw meta entry: max(created, deleted).
@@ -3885,8 +9006,17 @@ fn applyRemoteMeta(ctx: *const S3Context, allocator: Allocator, bucket: []const
         defer allocator.free(existing);
         if (metaContentTimestamp(existing)) |existing_ts| {
             if (existing_ts > incoming_ts) return;
-            if (existing_ts == incoming_ts and !isTombstoneContent(content)) return;
+            if (existing_ts == incoming_ts) {
+                // Break ties the same way on every node so anti-entropy
+                // converges: a tombstone wins, then the greater content
+                const incoming_deleted = isTombstoneContent(content);
+                if (isTombstoneContent(existing) != incoming_deleted) {
+                    if (!incoming_deleted) return;
+                } else if (std.mem.order(u8, existing, content) != .lt) return;
+            }
         }
+    } else if (isTombstoneContent(content) and incoming_ts < std.Io.Clock.real.now(app_io).toSeconds() - TOMBSTONE_TTL_SECS) {
+        return; // expired, and already swept here
     }
 
     // Ensure the bucket data dir exists so ListBuckets sees the bucket
@@ -3894,7 +9024,7 @@ fn applyRemoteMeta(ctx: *const S3Context, allocator: Allocator, bucket: []const
     defer allocator.free(bucket_path);
     std.Io.Dir.cwd().createDirPath(app_io, bucket_path) catch {};
 
-    try dist.meta_index.writeRaw(allocator, bucket, key, content);
+    try dist.meta_index.writeRaw(bucket, key, content);
 }
 
 /// Push the local meta entry (object or tombstone) for bucket/key to all peers
@@ -3905,11 +9035,11 @@ fn propagateObjectMeta(ctx: *const S3Context, allocator: Allocator, bucket: []co
 
     const body = std.fmt.allocPrint(allocator, "{s}\n{s}\n{s}", .{ bucket, key, content }) catch return;
     defer allocator.free(body);
-    broadcastToPeers(dist, allocator, "POST", "/_zs3/meta", body);
+    broadcastToPeers(dist, "POST", "/_zs3/meta", body, dist.config.write_acks);
 }
 
 /// Tell all peers that `provider` has the content for `hash`
-fn broadcastAnnounce(dist: *DistributedContext, allocator: Allocator, hash: ContentHash, provider: NodeId) void {
+fn broadcastAnnounce(dist: *DistributedContext, hash: ContentHash, provider: NodeId) void {
     var hash_hex: [40]u8 = undefined;
     bytesToHex(&hash, &hash_hex);
     var provider_hex: [40]u8 = undefined;
@@ -3917,15 +9047,16 @@ fn broadcastAnnounce(dist: *DistributedContext, allocator: Allocator, hash: Cont
 
     var body_buf: [81]u8 = undefined;
     const body = std.fmt.bufPrint(&body_buf, "{s}\n{s}", .{ hash_hex, provider_hex }) catch return;
-    broadcastToPeers(dist, allocator, "POST", "/_zs3/announce", body);
+    broadcastToPeers(dist, "POST", "/_zs3/announce", body, null);
 }
 
 /// Push a CAS blob to peers until the replication target is met
 /// (this node counts as one replica), announcing each new holder
 fn replicateBlob(dist: *DistributedContext, allocator: Allocator, hash: ContentHash) void {
     if (dist.replication.target_replicas <= 1) return;
-    const data = dist.cas.retrieve(allocator, hash) catch return;
-    defer allocator.free(data);
+    const file = dist.cas.open(allocator, hash) catch return;
+    defer file.close(app_io);
+    const stat = file.stat(app_io) catch return;
 
     var hash_hex: [40]u8 = undefined;
     bytesToHex(&hash, &hash_hex);
@@ -3935,14 +9066,17 @@ fn replicateBlob(dist: *DistributedContext, allocator: Allocator, hash: ContentH
     var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
     const n = dist.kademlia.collectPeers(&peers);
     var replicas: usize = 1;
-    for (peers[0..n]) |peer| {
+    // Started at a place set by the hash, so the chunks of a large object
+    // land on different peers rather than all on the first few
+    for (0..n) |k| {
         if (replicas >= dist.replication.target_replicas) break;
-        const response = peerRequest(allocator, peer.address, "PUT", path, data, 4096) catch continue;
-        allocator.free(response);
+        const peer = peers[(hash[0] + k) % n];
+        // Sent from the file with sendfile
+        var response = dist.peer_pool.open(peer.address, "PUT", path, "", .{ .file = .{ .file = file, .size = stat.size } }) catch continue;
+        response.close();
         replicas += 1;
-        // No local addProvider here: this runs on the worker thread and the
-        // providers map belongs to the event loop; peers learn via announce
-        broadcastAnnounce(dist, allocator, hash, peer.id);
+        dist.kademlia.addProvider(hash, peer.id) catch {};
+        broadcastAnnounce(dist, hash, peer.id);
     }
 }
 
@@ -3954,34 +9088,142 @@ fn fetchMetaFromPeers(ctx: *const S3Context, allocator: Allocator, bucket: []con
     const body = std.fmt.allocPrint(allocator, "{s}\n{s}", .{ bucket, key }) catch return null;
     defer allocator.free(body);
 
+    // Asked of all peers at once; the first to have an entry ends the
+    // wait, and any others that answered by then are merged in too
     var peers: [MAX_BROADCAST_PEERS]PeerInfo = undefined;
     const n = dist.kademlia.collectPeers(&peers);
-    for (peers[0..n]) |peer| {
-        const content = peerRequest(allocator, peer.address, "POST", "/_zs3/meta_get", body, MAX_META_RESPONSE) catch continue;
-        defer allocator.free(content);
-
-        applyRemoteMeta(ctx, allocator, bucket, key, content) catch continue;
-        // Re-read locally: null means the entry is a tombstone
-        const meta = (dist.meta_index.getFull(allocator, bucket, key) catch null) orelse continue;
-
-        // The source peer can serve the blob for CAS-backed objects
-        if (meta.inline_data == null and meta.size > 0) {
-            dist.kademlia.addProvider(meta.hash, peer.id) catch {};
+    if (n == 0) return null;
+    const fan_out = FanOut.start(dist, "POST", "/_zs3/meta_get", body, MAX_META_RESPONSE, peers[0..n], 1, true) orelse return null;
+    fan_out.wait(dist.config.peer_deadline_ms);
+    const replies = fan_out.close();
+    defer FanOut.freeReplies(replies);
+
+    var applied = false;
+    for (replies) |reply| {
+        applyRemoteMeta(ctx, allocator, bucket, key, reply.body) catch continue;
+        applied = true;
+    }
+    if (!applied) return null;
+    // Re-read locally: null means the entry is a tombstone
+    const meta = (dist.meta_index.getFull(allocator, bucket, key) catch null) orelse return null;
+
+    // The peers that sent the winning entry can serve the blob for
+    // CAS-backed objects (a chunked object's chunks are looked up one by one)
+    if (meta.payload() == null and meta.size > 0) {
+        for (replies) |reply| {
+            const theirs = parseMetaContent(reply.body) orelse continue;
+            if (std.mem.eql(u8, &theirs.hash, &meta.hash)) dist.kademlia.addProvider(meta.hash, reply.peer) catch {};
         }
-        return meta;
     }
-    return null;
+    return meta;
 }
 
-/// Pull the full metadata index from a peer (join-time sync).
-/// Wire format per entry: "<bucket>\n<key>\n<content_len>\n" + content bytes.
+/// Pull the full metadata index from a peer (join-time sync with a peer
+/// that predates the anti-entropy tree)
 fn syncIndexFromPeer(allocator: Allocator, ctx: *const S3Context, peer: PeerInfo) void {
-    const body = peerRequest(allocator, peer.address, "GET", "/_zs3/index", "", MAX_INDEX_SYNC_SIZE) catch |err| {
+    const body = peerRequest(ctx.distributed.?, allocator, peer.address, "GET", "/_zs3/index", "", MAX_INDEX_SYNC_SIZE) catch |err| {
         std.log.warn("Index sync from peer failed: {t}", .{err});
         return;
     };
     defer allocator.free(body);
+    std.log.info("Synced {d} metadata entries from bootstrap peer", .{applyIndexDump(allocator, ctx, body)});
+}
+
+/// Anti-entropy with one peer: compare metadata trees from the root down,
+/// following only the nodes whose digests differ, then pull the entries of
+/// the leaves that still do. The cost follows the differences, not the size
+/// of the namespace. Entries that are newer here are left for the peer to
+/// pull in its own rounds. Returns how many entries were pulled.
+fn syncTreeFromPeer(allocator: Allocator, ctx: *const S3Context, peer: PeerInfo) !usize {
+    const dist = ctx.distributed.?;
+    var differ: std.ArrayListUnmanaged(u32) = .empty; // nodes at `depth`
+    defer differ.deinit(allocator);
+    var next: std.ArrayListUnmanaged(u32) = .empty;
+    defer next.deinit(allocator);
+    try differ.append(allocator, 0);
+
+    for (0..MetaTree.DEPTH) |depth| {
+        next.clearRetainingCapacity();
+        var done: usize = 0;
+        while (done < differ.items.len) {
+            const batch = differ.items[done..@min(done + TREE_SYNC_BATCH, differ.items.len)];
+            try diffTreeNodes(allocator, dist, peer, depth, batch, &next);
+            done += batch.len;
+        }
+        std.mem.swap(std.ArrayListUnmanaged(u32), &differ, &next);
+        if (differ.items.len == 0) return 0;
+    }
+
+    var pulled: usize = 0;
+    var done: usize = 0;
+    while (done < differ.items.len) {
+        const batch = differ.items[done..@min(done + TREE_SYNC_BATCH, differ.items.len)];
+        pulled += try pullTreeLeaves(allocator, ctx, peer, batch);
+        done += batch.len;
+    }
+    return pulled;
+}
+
+/// Ask `peer` for the children of tree nodes `nodes` at `depth`, and add
+/// the children whose digests differ from ours to `differ`
+fn diffTreeNodes(allocator: Allocator, dist: *DistributedContext, peer: PeerInfo, depth: usize, nodes: []const u32, differ: *std.ArrayListUnmanaged(u32)) !void {
+    var body: std.ArrayListUnmanaged(u8) = .empty;
+    defer body.deinit(allocator);
+    try body.print(allocator, "{d}\n", .{depth});
+    try formatTreeIndices(allocator, &body, nodes);
+
+    const size = nodes.len * MetaTree.FANOUT * 16;
+    const response = try peerRequest(dist, allocator, peer.address, "POST", "/_zs3/tree", body.items, size);
+    defer allocator.free(response);
+    if (response.len != size) return error.InvalidResponse;
+
+    for (nodes, 0..) |node, i| {
+        const ours = dist.meta_index.log.treeChildren(depth, node);
+        for (ours, 0..) |d, c| {
+            const hex = response[(i * MetaTree.FANOUT + c) * 16 ..][0..16];
+            const theirs = std.fmt.parseInt(u64, hex, 16) catch return error.InvalidResponse;
+            if (theirs != d) try differ.append(allocator, @intCast(node * MetaTree.FANOUT + c));
+        }
+    }
+}
+
+/// Pull and apply the entries of tree leaves `leaves` from `peer`. A set
+/// too large for one response is asked for in halves.
+fn pullTreeLeaves(allocator: Allocator, ctx: *const S3Context, peer: PeerInfo, leaves: []const u32) !usize {
+    var body: std.ArrayListUnmanaged(u8) = .empty;
+    defer body.deinit(allocator);
+    try formatTreeIndices(allocator, &body, leaves);
+
+    const response = peerRequest(ctx.distributed.?, allocator, peer.address, "POST", "/_zs3/range", body.items, MAX_INDEX_SYNC_SIZE) catch |err| {
+        if (err != error.ResponseTooLarge or leaves.len == 1) return err;
+        const half = leaves.len / 2;
+        return try pullTreeLeaves(allocator, ctx, peer, leaves[0..half]) + try pullTreeLeaves(allocator, ctx, peer, leaves[half..]);
+    };
+    defer allocator.free(response);
+    return applyIndexDump(allocator, ctx, response);
+}
 
+fn formatTreeIndices(allocator: Allocator, out: *std.ArrayListUnmanaged(u8), indices: []const u32) !void {
+    for (indices, 0..) |index, i| try out.print(allocator, "{s}{d}", .{ if (i > 0) "," else "", index });
+}
+
+/// Tree node indices as sent by formatTreeIndices: at most TREE_SYNC_BATCH,
+/// each below `limit`. Null if malformed.
+pub fn parseTreeIndices(allocator: Allocator, text: []const u8, limit: usize) ?[]u32 {
+    var indices: std.ArrayListUnmanaged(u32) = .empty;
+    var iter = std.mem.splitScalar(u8, text, ',');
+    while (iter.next()) |part| {
+        const index = std.fmt.parseInt(u32, part, 10) catch break;
+        if (index >= limit or indices.items.len == TREE_SYNC_BATCH) break;
+        indices.append(allocator, index) catch break;
+    } else return indices.toOwnedSlice(allocator) catch null;
+    indices.deinit(allocator);
+    return null;
+}
+
+/// Apply every entry of an index dump (LWW). Wire format per entry:
+/// "<bucket>\n<key>\n<content_len>\n" + content bytes.
+fn applyIndexDump(allocator: Allocator, ctx: *const S3Context, body: []const u8) usize {
     var applied: usize = 0;
     var offset: usize = 0;
     while (offset < body.len) {
@@ -3999,254 +9241,37 @@ fn syncIndexFromPeer(allocator: Allocator, ctx: *const S3Context, peer: PeerInfo
         applyRemoteMeta(ctx, allocator, bucket, key, content) catch continue;
         applied += 1;
     }
-    std.log.info("Synced {d} metadata entries from bootstrap peer", .{applied});
+    return applied;
 }
 
 /// Serialize the entire metadata index (including tombstones) for a joining peer
 fn dumpMetaIndex(dist: *const DistributedContext, allocator: Allocator, out: *std.ArrayListUnmanaged(u8)) !void {
-    const index_path = try std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index" });
-    defer allocator.free(index_path);
-
-    var dir = std.Io.Dir.cwd().openDir(app_io, index_path, .{ .iterate = true }) catch return;
-    defer dir.close(app_io);
-
-    var iter = dir.iterate();
-    while (try iter.next(app_io)) |entry| {
-        if (entry.kind != .directory or entry.name[0] == '.') continue;
-        const bucket = try allocator.dupe(u8, entry.name);
-        defer allocator.free(bucket);
-        try dumpMetaDir(dist, allocator, bucket, "", out);
-    }
-}
-
-fn dumpMetaDir(dist: *const DistributedContext, allocator: Allocator, bucket: []const u8, prefix: []const u8, out: *std.ArrayListUnmanaged(u8)) !void {
-    const dir_path = if (prefix.len > 0)
-        try std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index", bucket, prefix })
-    else
-        try std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index", bucket });
-    defer allocator.free(dir_path);
-
-    var dir = std.Io.Dir.cwd().openDir(app_io, dir_path, .{ .iterate = true }) catch return;
-    defer dir.close(app_io);
-
-    var iter = dir.iterate();
-    while (try iter.next(app_io)) |entry| {
-        if (entry.name[0] == '.') continue;
-        const full_name = if (prefix.len > 0)
-            try std.fmt.allocPrint(allocator, "{s}/{s}", .{ prefix, entry.name })
-        else
-            try allocator.dupe(u8, entry.name);
-        defer allocator.free(full_name);
-
-        if (entry.kind == .directory) {
-            try dumpMetaDir(dist, allocator, bucket, full_name, out);
-        } else if (std.mem.endsWith(u8, entry.name, ".meta")) {
-            const key = full_name[0 .. full_name.len - 5];
-            const content = (dist.meta_index.readRaw(allocator, bucket, key) catch continue) orelse continue;
-            defer allocator.free(content);
-
-            const frame = try std.fmt.allocPrint(allocator, "{s}\n{s}\n{d}\n", .{ bucket, key, content.len });
-            defer allocator.free(frame);
-            try out.appendSlice(allocator, frame);
-            try out.appendSlice(allocator, content);
-        }
-    }
+    try dist.meta_index.log.dump(allocator, out, null);
 }
 
 /// Distributed DELETE - write tombstone and propagate it to peers
 fn handleDistributedDelete(ctx: *const S3Context, allocator: Allocator, res: *Response, bucket: []const u8, key: []const u8) !void {
     const dist = ctx.distributed.?;
-    dist.meta_index.delete(allocator, bucket, key);
+    dist.meta_index.delete(bucket, key);
     propagateObjectMeta(ctx, allocator, bucket, key);
     res.noContent();
 }
 
 /// Distributed LIST - list objects from metadata index
 fn handleDistributedList(ctx: *const S3Context, allocator: Allocator, req: *Request, res: *Response, bucket: []const u8) !void {
-    const dist = ctx.distributed.?;
-
-    const prefix_raw = getQueryParam(req.query, "prefix") orelse "";
-    const prefix = try uriDecode(allocator, prefix_raw);
-    defer allocator.free(prefix);
-
-    const max_keys_str = getQueryParam(req.query, "max-keys") orelse "1000";
-    const max_keys = std.fmt.parseInt(usize, max_keys_str, 10) catch 1000;
-
-    const delimiter_raw = getQueryParam(req.query, "delimiter");
-    const delimiter_decoded = if (delimiter_raw) |d| try uriDecode(allocator, d) else null;
-    defer if (delimiter_decoded) |d| allocator.free(d);
-    const delimiter = if (delimiter_decoded) |d| (if (d.len > 0) d else null) else null;
-
-    const continuation_raw = getQueryParam(req.query, "continuation-token");
-    const continuation = if (continuation_raw) |c| try uriDecode(allocator, c) else null;
-    defer if (continuation) |c| allocator.free(c);
-
-    // Path to the bucket's index directory
-    const index_path = try std.fs.path.join(allocator, &.{ dist.meta_index.data_dir, ".index", bucket });
-    defer allocator.free(index_path);
-
-    var xml: std.ArrayListUnmanaged(u8) = .empty;
-    defer xml.deinit(allocator);
-
-    try xml.appendSlice(allocator, "<?xml version=\"1.0\" encoding=\"UTF-8\"?>");
-    try xml.appendSlice(allocator, "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">");
-    try xml.appendSlice(allocator, "<Name>");
-    try xmlEscape(allocator, &xml, bucket);
-    try xml.appendSlice(allocator, "</Name><Prefix>");
-    try xmlEscape(allocator, &xml, prefix);
-    try xml.appendSlice(allocator, "</Prefix><MaxKeys>");
-    var dist_max_keys_num_buf: [32]u8 = undefined;
-    const dist_max_keys_num_str = std.fmt.bufPrint(&dist_max_keys_num_buf, "{d}", .{max_keys}) catch "1000";
-    try xml.appendSlice(allocator, dist_max_keys_num_str);
-    try xml.appendSlice(allocator, "</MaxKeys>");
-
-    var keys: std.ArrayListUnmanaged(KeyInfo) = .empty;
-    defer keys.deinit(allocator);
-
-    // Collect keys from metadata index
-    collectMetaKeys(allocator, index_path, "", prefix, &keys, &dist.meta_index, bucket) catch {};
-
-    std.mem.sort(KeyInfo, keys.items, {}, struct {
-        fn lessThan(_: void, a: KeyInfo, b: KeyInfo) bool {
-            return std.mem.order(u8, a.key, b.key) == .lt;
-        }
-    }.lessThan);
-
-    var start_idx: usize = 0;
-    if (continuation) |cont| {
-        for (keys.items, 0..) |item, i| {
-            if (std.mem.eql(u8, item.key, cont)) {
-                start_idx = i;
-                break;
-            }
-        }
-    }
-
-    var common_prefixes = std.StringHashMap(void).init(allocator);
-    defer common_prefixes.deinit();
-
-    var count: usize = 0;
-    var is_truncated = false;
-    var next_token: ?[]const u8 = null;
-
-    for (keys.items[start_idx..]) |item| {
-        if (count >= max_keys) {
-            is_truncated = true;
-            next_token = item.key;
-            break;
-        }
-
-        if (delimiter) |delim| {
-            const after_prefix = if (prefix.len > 0 and std.mem.startsWith(u8, item.key, prefix))
-                item.key[prefix.len..]
-            else
-                item.key;
-
-            if (std.mem.indexOf(u8, after_prefix, delim)) |delim_idx| {
-                const common_prefix = item.key[0 .. prefix.len + delim_idx + delim.len];
-                if (!common_prefixes.contains(common_prefix)) {
-                    try common_prefixes.put(common_prefix, {});
-                    try xml.appendSlice(allocator, "<CommonPrefixes><Prefix>");
-                    try xmlEscape(allocator, &xml, common_prefix);
-                    try xml.appendSlice(allocator, "</Prefix></CommonPrefixes>");
-                    count += 1;
-                }
-                continue;
-            }
-        }
-
-        try xml.appendSlice(allocator, "<Contents><Key>");
-        try xmlEscape(allocator, &xml, item.key);
-        try xml.appendSlice(allocator, "</Key><LastModified>");
-        var iso_buf2: [20]u8 = undefined;
-        formatIso8601(&iso_buf2, item.mtime);
-        try xml.appendSlice(allocator, &iso_buf2);
-        try xml.appendSlice(allocator, "</LastModified><Size>");
-        var size_buf: [32]u8 = undefined;
-        const size_str = std.fmt.bufPrint(&size_buf, "{d}", .{item.size}) catch "0";
-        try xml.appendSlice(allocator, size_str);
-        try xml.appendSlice(allocator, "</Size><StorageClass>STANDARD</StorageClass></Contents>");
-        count += 1;
-    }
-
-    var count_buf: [32]u8 = undefined;
-    const count_str = std.fmt.bufPrint(&count_buf, "{d}", .{count}) catch "0";
-    try xml.appendSlice(allocator, "<KeyCount>");
-    try xml.appendSlice(allocator, count_str);
-    try xml.appendSlice(allocator, "</KeyCount>");
-
-    if (is_truncated) {
-        try xml.appendSlice(allocator, "<IsTruncated>true</IsTruncated>");
-        if (next_token) |token| {
-            try xml.appendSlice(allocator, "<NextContinuationToken>");
-            try xmlEscape(allocator, &xml, token);
-            try xml.appendSlice(allocator, "</NextContinuationToken>");
-        }
-    } else {
-        try xml.appendSlice(allocator, "<IsTruncated>false</IsTruncated>");
-    }
-
-    try xml.appendSlice(allocator, "</ListBucketResult>");
-
-    res.ok();
-    res.setXmlBody(try xml.toOwnedSlice(allocator));
-}
-
-/// Collect keys from the metadata index directory
-fn collectMetaKeys(allocator: Allocator, base_path: []const u8, current_prefix: []const u8, filter_prefix: []const u8, keys: *std.ArrayListUnmanaged(KeyInfo), meta_index: *const MetaIndex, bucket: []const u8) !void {
-    const full_path = if (current_prefix.len > 0)
-        try std.fs.path.join(allocator, &[_][]const u8{ base_path, current_prefix })
-    else
-        try allocator.dupe(u8, base_path);
-    defer allocator.free(full_path);
-
-    var dir = std.Io.Dir.cwd().openDir(app_io, full_path, .{ .iterate = true }) catch return;
-    defer dir.close(app_io);
-
-    var iter = dir.iterate();
-    while (try iter.next(app_io)) |entry| {
-        if (entry.name[0] == '.') continue;
-
-        const full_name = if (current_prefix.len > 0)
-            try std.fmt.allocPrint(allocator, "{s}/{s}", .{ current_prefix, entry.name })
-        else
-            try allocator.dupe(u8, entry.name);
-
-        if (entry.kind == .directory) {
-            try collectMetaKeys(allocator, base_path, full_name, filter_prefix, keys, meta_index, bucket);
-            allocator.free(full_name);
-        } else if (entry.kind == .file) {
-            // Strip .meta extension to get the key
-            if (std.mem.endsWith(u8, entry.name, ".meta")) {
-                const key_name_len = full_name.len - 5; // Remove ".meta"
-                const key = full_name[0..key_name_len];
-
-                if (filter_prefix.len == 0 or std.mem.startsWith(u8, key, filter_prefix)) {
-                    // Get full metadata (returns null for tombstones)
-                    const meta = meta_index.getFull(allocator, bucket, key) catch null;
-                    // Skip tombstoned entries - they shouldn't appear in listings
-                    if (meta) |m| {
-                        if (m.inline_data) |data| allocator.free(data);
-                        const key_copy = try allocator.dupe(u8, key);
-                        try keys.append(allocator, .{ .key = key_copy, .size = m.size, .mtime = m.created });
-                    }
-                }
-            }
-            allocator.free(full_name);
-        }
-    }
+    try streamListObjects(ctx, allocator, req, res, bucket, .meta_index);
 }
 
 /// Distributed HEAD - return metadata without body
 fn handleDistributedHead(ctx: *const S3Context, allocator: Allocator, res: *Response, bucket: []const u8, key: []const u8) !void {
     const dist = ctx.distributed.?;
 
-    const meta = try dist.meta_index.getFull(allocator, bucket, key) orelse
+    const meta = dist.meta_index.stat(bucket, key) orelse
         fetchMetaFromPeers(ctx, allocator, bucket, key) orelse {
-            sendError(res, 404, "NoSuchKey", "Object not found");
-            return;
-        };
-    if (meta.inline_data) |data| allocator.free(data);
+        sendError(res, 404, "NoSuchKey", "Object not found");
+        return;
+    };
+    if (meta.payload()) |data| allocator.free(data);
 
     const size_str = std.fmt.allocPrint(allocator, "{d}", .{meta.size}) catch {
         sendError(res, 500, "InternalError", "Format failed");
@@ -14,6 +14,7 @@ const SigV4 = main.SigV4;
 const formatHttpDate = main.formatHttpDate;
 const formatIso8601 = main.formatIso8601;
 const decodeAwsChunked = main.decodeAwsChunked;
+const AwsChunkedDecoder = main.AwsChunkedDecoder;
 
 test "isValidBucketName" {
     try std.testing.expect(isValidBucketName("mybucket"));
@@ -277,6 +278,37 @@ test "SigV4.hmac" {
     try std.testing.expectEqualStrings("6e9ef29b75fffc5b7abae527d58fdadb2fe42e7219011976917343065f58ed4a", &hex);
 }
 
+test "SigV4.KeyCache - reuses keys within a day and starts over at rollover" {
+    var cache: SigV4.KeyCache = .{};
+    const secret = "wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY";
+    const day1 = SigV4.signingKey(secret, "20130524", "us-east-1", "s3");
+    const day2 = SigV4.signingKey(secret, "20130525", "us-east-1", "s3");
+
+    try std.testing.expectEqual(day1, cache.get("AKID", secret, "20130524", "us-east-1", "s3"));
+    try std.testing.expectEqual(day1, cache.get("AKID", secret, "20130524", "us-east-1", "s3"));
+    try std.testing.expectEqual(@as(usize, 1), cache.len);
+
+    // Another scope is another key
+    const west = cache.get("AKID", secret, "20130524", "us-west-2", "s3");
+    try std.testing.expectEqual(SigV4.signingKey(secret, "20130524", "us-west-2", "s3"), west);
+    try std.testing.expectEqual(@as(usize, 2), cache.len);
+
+    // A new day drops yesterday's keys
+    try std.testing.expectEqual(day2, cache.get("AKID", secret, "20130525", "us-east-1", "s3"));
+    try std.testing.expectEqual(@as(usize, 1), cache.len);
+
+    // A straggler signed for the previous day is derived, not cached
+    try std.testing.expectEqual(day1, cache.get("AKID", secret, "20130524", "us-east-1", "s3"));
+    try std.testing.expectEqual(@as(usize, 1), cache.len);
+}
+
+test "sortQueryString - bare keys sort as key=" {
+    const allocator = std.testing.allocator;
+    const sorted = try sortQueryString(allocator, "uploads&prefix=a&list-type=2&a-b=1&a");
+    defer allocator.free(sorted);
+    try std.testing.expectEqualStrings("a-b=1&a=&list-type=2&prefix=a&uploads=", sorted);
+}
+
 test "formatHttpDate - Unix epoch" {
     var buf: [29]u8 = undefined;
     formatHttpDate(&buf, 0);
@@ -458,6 +490,95 @@ test "decodeAwsChunked - hex size uppercase" {
     try std.testing.expectEqualStrings("0123456789", result);
 }
 
+test "decodeAwsChunked - malformed framing" {
+    const allocator = std.testing.allocator;
+    try std.testing.expectError(error.MalformedChunk, decodeAwsChunked(allocator, "zz;chunk-signature=a\r\n"));
+    try std.testing.expectError(error.MalformedChunk, decodeAwsChunked(allocator, "3;chunk-signature=a\r\nabcXX0;chunk-signature=b\r\n\r\n"));
+    try std.testing.expectError(error.MalformedChunk, decodeAwsChunked(allocator, "3;chunk-signature=a\r\nabc\r\n"));
+    try std.testing.expectError(error.MalformedChunk, decodeAwsChunked(allocator, "0;chunk-signature=a\r\n\r\nextra"));
+}
+
+// Example from the AWS "Signature Calculations for the Authorization Header:
+// Transferring Payload in Multiple Chunks" documentation: 66560 bytes of 'a'
+// in a 64KB and a 1KB chunk.
+fn awsExampleSigner() !SigV4.ChunkSigner {
+    const key = SigV4.signingKey("wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY", "20130524", "us-east-1", "s3");
+    return SigV4.ChunkSigner.init(std.testing.allocator, key, "20130524T000000Z", "20130524", "us-east-1", "s3", "4f232c4386841ef735655705268965c44a0e4690baa4adea153f7db9fa80a0a9");
+}
+
+fn awsExampleBody(allocator: std.mem.Allocator) ![]u8 {
+    const a = [_]u8{'a'} ** 65536;
+    return std.mem.concat(allocator, u8, &.{
+        "10000;chunk-signature=ad80c730a21e5b8d04586a2213dd63b9a0e99e0e2307b0ade35a65485a288648\r\n",
+        &a,
+        "\r\n400;chunk-signature=0055627c9e194cb4542bae2aa5492e3c1575bbb81b612b7d234b86a503ef5497\r\n",
+        a[0..1024],
+        "\r\n0;chunk-signature=b6c6ea8a5354eaf15b3cb7646744f4275b71ea724fed81ceb9323e279d449df9\r\n\r\n",
+    });
+}
+
+test "AwsChunkedDecoder - verifies the AWS example chunk signatures in any split" {
+    const allocator = std.testing.allocator;
+    const body = try awsExampleBody(allocator);
+    defer allocator.free(body);
+
+    // Feed the body in pieces of varying size, as socket reads would deliver it
+    for ([_]usize{ 1, 7, 100, 65536, body.len }) |piece| {
+        const signer = try awsExampleSigner();
+        defer allocator.free(signer.prefix);
+        var decoder: AwsChunkedDecoder = .{ .signer = signer };
+        var decoded: usize = 0;
+        var pos: usize = 0;
+        while (pos < body.len) {
+            const end = @min(pos + piece, body.len);
+            var rest = body[pos..end];
+            while (rest.len > 0) {
+                const step = try decoder.decode(rest);
+                for (step.data) |c| try std.testing.expectEqual(@as(u8, 'a'), c);
+                decoded += step.data.len;
+                rest = rest[step.consumed..];
+            }
+            pos = end;
+        }
+        try std.testing.expect(decoder.finished());
+        try std.testing.expectEqual(@as(usize, 66560), decoded);
+    }
+}
+
+test "AwsChunkedDecoder - rejects altered or missing chunk signatures" {
+    const allocator = std.testing.allocator;
+    const body = try awsExampleBody(allocator);
+    defer allocator.free(body);
+
+    const Case = struct { at: usize, byte: u8 };
+    const cases = [_]Case{
+        .{ .at = 100, .byte = 'b' }, // payload of the first chunk
+        .{ .at = 30, .byte = '0' }, // first chunk's signature
+        .{ .at = body.len - 10, .byte = '0' }, // final chunk's signature
+    };
+    for (cases) |case| {
+        const tampered = try allocator.dupe(u8, body);
+        defer allocator.free(tampered);
+        tampered[case.at] = case.byte;
+
+        const signer = try awsExampleSigner();
+        defer allocator.free(signer.prefix);
+        var decoder: AwsChunkedDecoder = .{ .signer = signer };
+        var rest: []const u8 = tampered;
+        const result = while (rest.len > 0) {
+            const step = decoder.decode(rest) catch |err| break err;
+            rest = rest[step.consumed..];
+        } else error.NoError;
+        try std.testing.expectEqual(error.SignatureDoesNotMatch, result);
+    }
+
+    // A signer requires every chunk to carry a signature
+    const signer = try awsExampleSigner();
+    defer allocator.free(signer.prefix);
+    var decoder: AwsChunkedDecoder = .{ .signer = signer };
+    try std.testing.expectError(error.MalformedChunk, decoder.decode("5\r\nhello\r\n"));
+}
+
 // ============================================================================
 // Distributed metadata replication helpers
 // ============================================================================
@@ -506,6 +627,55 @@ test "metaContentTimestamp - rejects malformed entries" {
     try std.testing.expectEqual(@as(?i64, null), metaContentTimestamp(VALID_HASH ++ "\n-1\n2\n0\n"));
 }
 
+const parseMetaContent = main.parseMetaContent;
+const formatMetaContent = main.formatMetaContent;
+
+test "parseMetaContent - tombstone without inline data" {
+    const meta = parseMetaContent(VALID_HASH ++ "\n123\n1700000000\n1700000500\n").?;
+    try std.testing.expectEqual(@as(u64, 123), meta.size);
+    try std.testing.expectEqual(@as(i64, 1700000000), meta.created);
+    try std.testing.expectEqual(@as(i64, 1700000500), meta.deleted);
+    try std.testing.expectEqual(@as(?[]const u8, null), meta.inline_data);
+    try std.testing.expectEqual(@as(?@TypeOf(meta), null), parseMetaContent(VALID_HASH ++ "\n1\n2\nabc\n"));
+}
+
+test "formatMetaContent - round trips inline data" {
+    const allocator = std.testing.allocator;
+    const content = VALID_HASH ++ "\n10\n1700000002\n0\n123\n456\n78";
+    const meta = parseMetaContent(content).?;
+    try std.testing.expectEqualStrings("123\n456\n78", meta.inline_data.?);
+    const formatted = try formatMetaContent(allocator, meta);
+    defer allocator.free(formatted);
+    try std.testing.expectEqualStrings(content, formatted);
+}
+
+test "parseMetaContent - a payload that isn't the object is its chunk manifest" {
+    const allocator = std.testing.allocator;
+    // Two chunks of 3 and 4 MiB: hash followed by little-endian size
+    var manifest: [56]u8 = undefined;
+    @memset(manifest[0..20], 0xaa);
+    std.mem.writeInt(u64, manifest[20..28], 3 << 20, .little);
+    @memset(manifest[28..48], 0xbb);
+    std.mem.writeInt(u64, manifest[48..56], 4 << 20, .little);
+    var full: [32]u8 = undefined;
+    std.crypto.hash.Blake3.hash(&manifest, &full, .{});
+    var hash_hex: [40]u8 = undefined;
+    _ = std.fmt.bufPrint(&hash_hex, "{x}", .{full[0..20].*}) catch unreachable;
+
+    const content = hash_hex ++ "\n7340032\n1700000002\n0\n" ++ manifest;
+    const meta = parseMetaContent(content).?;
+    try std.testing.expectEqual(@as(?[]const u8, null), meta.inline_data);
+    try std.testing.expectEqualSlices(u8, &manifest, meta.manifest.?);
+    const formatted = try formatMetaContent(allocator, meta);
+    defer allocator.free(formatted);
+    try std.testing.expectEqualSlices(u8, content, formatted);
+
+    // A manifest must add up to the size and match the hash
+    try std.testing.expectEqual(@as(?@TypeOf(meta), null), parseMetaContent(hash_hex ++ "\n7340033\n1700000002\n0\n" ++ manifest));
+    try std.testing.expectEqual(@as(?@TypeOf(meta), null), parseMetaContent(VALID_HASH ++ "\n7340032\n1700000002\n0\n" ++ manifest));
+    try std.testing.expectEqual(@as(?@TypeOf(meta), null), parseMetaContent(hash_hex ++ "\n7340032\n1700000002\n0\n" ++ manifest[0..55]));
+}
+
 test "isTombstoneContent" {
     try std.testing.expect(!isTombstoneContent(VALID_HASH ++ "\n123\n1700000000\n0\n"));
     try std.testing.expect(isTombstoneContent(VALID_HASH ++ "\n123\n1700000000\n1700000500\n"));
@@ -518,3 +688,1023 @@ test "isTombstoneContent" {
     // Negative deleted timestamp is not a tombstone
     try std.testing.expect(!isTombstoneContent(VALID_HASH ++ "\n123\n1700000000\n-5\n"));
 }
+
+// ============================================================================
+// Content-defined chunking
+// ============================================================================
+
+const ChunkCutter = main.ChunkCutter;
+
+/// Where ChunkCutter ends chunks in `data`, fed in pieces of `step` bytes
+fn chunkEnds(allocator: std.mem.Allocator, data: []const u8, step: usize) ![]usize {
+    var ends: std.ArrayListUnmanaged(usize) = .empty;
+    errdefer ends.deinit(allocator);
+    var cutter: ChunkCutter = .{};
+    var pos: usize = 0; // of the next piece
+    while (pos < data.len) {
+        const piece = data[pos..@min(pos + step, data.len)];
+        if (cutter.cut(piece)) |n| {
+            pos += n;
+            try ends.append(allocator, pos);
+        } else pos += piece.len;
+    }
+    return ends.toOwnedSlice(allocator);
+}
+
+test "ChunkCutter - boundaries depend on content alone" {
+    const allocator = std.testing.allocator;
+    const data = try allocator.alloc(u8, 24 << 20);
+    defer allocator.free(data);
+    var prng = std.Random.DefaultPrng.init(24);
+    prng.random().bytes(data);
+
+    // However the stream is split
+    const a = try chunkEnds(allocator, data, 1 << 20);
+    defer allocator.free(a);
+    const b = try chunkEnds(allocator, data, 65537);
+    defer allocator.free(b);
+    try std.testing.expectEqualSlices(usize, a, b);
+    try std.testing.expect(a.len >= 2);
+    var prev: usize = 0;
+    for (a) |end| {
+        try std.testing.expect(end - prev >= 1 << 20);
+        try std.testing.expect(end - prev <= 16 << 20);
+        prev = end;
+    }
+
+    // Bytes inserted early move the boundaries after them by as much, and
+    // leave them where they were in the content
+    const edited = try std.mem.concat(allocator, u8, &.{ data[0 .. 3 << 20], "inserted", data[3 << 20 ..] });
+    defer allocator.free(edited);
+    const c = try chunkEnds(allocator, edited, 1 << 20);
+    defer allocator.free(c);
+    var shared: usize = 0;
+    for (a) |end| {
+        if (end <= 3 << 20) continue;
+        if (std.mem.indexOfScalar(usize, c, end + "inserted".len) != null) shared += 1;
+    }
+    var after: usize = 0;
+    for (a) |end| after += @intFromBool(end > 3 << 20);
+    try std.testing.expect(shared + 1 >= after);
+}
+
+// ============================================================================
+// HTTP keep-alive
+// ============================================================================
+
+const rawHeaderValue = main.rawHeaderValue;
+const requestKeepAlive = main.requestKeepAlive;
+
+test "rawHeaderValue" {
+    const head = "PUT /b/k HTTP/1.1\r\nHost: x\r\ncontent-LENGTH:  42 \r\nConnection: close\r\n\r\n";
+    try std.testing.expectEqualStrings("42", rawHeaderValue(head, "Content-Length").?);
+    try std.testing.expectEqualStrings("close", rawHeaderValue(head, "connection").?);
+    try std.testing.expectEqual(@as(?[]const u8, null), rawHeaderValue(head, "expect"));
+    // The request line is never treated as a header
+    try std.testing.expectEqual(@as(?[]const u8, null), rawHeaderValue("GET /a:b HTTP/1.1\r\n\r\n", "GET /a"));
+}
+
+test "requestKeepAlive - HTTP/1.1 persists by default" {
+    try std.testing.expect(requestKeepAlive("GET / HTTP/1.1\r\nHost: x\r\n\r\n"));
+    try std.testing.expect(!requestKeepAlive("GET / HTTP/1.1\r\nConnection: close\r\n\r\n"));
+    try std.testing.expect(!requestKeepAlive("GET / HTTP/1.1\r\nconnection: Close\r\n\r\n"));
+}
+
+test "requestKeepAlive - HTTP/1.0 needs explicit keep-alive" {
+    try std.testing.expect(!requestKeepAlive("GET / HTTP/1.0\r\nHost: x\r\n\r\n"));
+    try std.testing.expect(requestKeepAlive("GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n"));
+    try std.testing.expect(requestKeepAlive("GET / HTTP/1.0\r\nConnection: TE, keep-alive\r\n\r\n"));
+}
+
+const requestContentLength = main.requestContentLength;
+
+test "requestContentLength - plain lengths" {
+    try std.testing.expectEqual(@as(?u64, 0), requestContentLength("GET / HTTP/1.1\r\nHost: x\r\n\r\n"));
+    try std.testing.expectEqual(@as(?u64, 42), requestContentLength("PUT /b/k HTTP/1.1\r\ncontent-length:  42 \r\n\r\n"));
+    // Chunked bodies are framed by their encoding, not a length
+    try std.testing.expectEqual(@as(?u64, 0), requestContentLength("PUT /b/k HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"));
+}
+
+test "requestContentLength - ambiguous framing is rejected" {
+    const bad = [_][]const u8{
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 3x\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: +3\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 1_0\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length:\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 99999999999999999999999\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 3\r\ncontent-length: 40\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nContent-Length: 3\r\nTransfer-Encoding: chunked\r\n\r\n",
+        "PUT /b/k HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: 3\r\n\r\n",
+    };
+    for (bad) |head| try std.testing.expectEqual(@as(?u64, null), requestContentLength(head));
+}
+
+// ============================================================================
+// Stored ETags
+// ============================================================================
+
+const formatEtagRecord = main.formatEtagRecord;
+const parseEtagRecord = main.parseEtagRecord;
+
+test "etag record - round trip" {
+    var buf: [128]u8 = undefined;
+    const record = try formatEtagRecord(&buf, 1048576, 1700000000123456789, "\"9a26821e6900d357\"");
+    try std.testing.expectEqualStrings("\"9a26821e6900d357\"", parseEtagRecord(record, 1048576, 1700000000123456789).?);
+    // Multipart ETags carry a part count
+    const mp = try formatEtagRecord(&buf, 0, -1, "\"0123456789abcdef0123456789abcdef-3\"");
+    try std.testing.expectEqualStrings("\"0123456789abcdef0123456789abcdef-3\"", parseEtagRecord(mp, 0, -1).?);
+}
+
+test "etag record - stale or malformed records are rejected" {
+    var buf: [128]u8 = undefined;
+    const record = try formatEtagRecord(&buf, 42, 1000, "\"abc\"");
+    try std.testing.expectEqual(@as(?[]const u8, null), parseEtagRecord(record, 43, 1000));
+    try std.testing.expectEqual(@as(?[]const u8, null), parseEtagRecord(record, 42, 1001));
+    try std.testing.expectEqual(@as(?[]const u8, null), parseEtagRecord("42 1000", 42, 1000));
+    try std.testing.expectEqual(@as(?[]const u8, null), parseEtagRecord("x 1000 \"abc\"", 42, 1000));
+    try std.testing.expectEqual(@as(?[]const u8, null), parseEtagRecord("", 0, 0));
+}
+
+const prefixSuccessor = main.prefixSuccessor;
+
+test "prefixSuccessor" {
+    var photos = "photos/".*;
+    try std.testing.expectEqualStrings("photos0", prefixSuccessor(&photos).?);
+    // Trailing 0xff bytes can't be incremented; carry into the byte before
+    var carried = "a\xff\xff".*;
+    try std.testing.expectEqualStrings("b", prefixSuccessor(&carried).?);
+    var none = "\xff".*;
+    try std.testing.expectEqual(@as(?[]u8, null), prefixSuccessor(&none));
+}
+
+const encodeContinuationToken = main.encodeContinuationToken;
+const decodeContinuationToken = main.decodeContinuationToken;
+
+test "continuation token - round trip" {
+    const allocator = std.testing.allocator;
+    const token = try encodeContinuationToken(allocator, "photos/2024/a b+c?.jpg");
+    defer allocator.free(token);
+    // Nothing in it needs escaping in a query string
+    for (token) |c| try std.testing.expect(std.ascii.isAlphanumeric(c) or c == '-' or c == '_');
+    const key = try decodeContinuationToken(allocator, token);
+    defer allocator.free(key);
+    try std.testing.expectEqualStrings("photos/2024/a b+c?.jpg", key);
+}
+
+test "continuation token - rejects malformed tokens" {
+    const allocator = std.testing.allocator;
+    try std.testing.expectError(error.InvalidCharacter, decodeContinuationToken(allocator, "not a token"));
+    try std.testing.expectError(error.InvalidPadding, decodeContinuationToken(allocator, "a"));
+}
+
+const MetaTree = main.MetaTree;
+const parseTreeIndices = main.parseTreeIndices;
+
+test "MetaTree - digests depend on the entries, not their order" {
+    const allocator = std.testing.allocator;
+    var a = try MetaTree.init(allocator);
+    defer a.deinit(allocator);
+    var b = try MetaTree.init(allocator);
+    defer b.deinit(allocator);
+
+    const hash = [_]u8{7} ** 20;
+    const keys = [_][]const u8{ "a.txt", "photos/b.jpg", "c" };
+    for (keys) |key| a.toggle(MetaTree.leafOf("bucket", key), MetaTree.digest("bucket", key, hash, 10, 1000, 0));
+    var i: usize = keys.len;
+    while (i > 0) : (i -= 1) b.toggle(MetaTree.leafOf("bucket", keys[i - 1]), MetaTree.digest("bucket", keys[i - 1], hash, 10, 1000, 0));
+    try std.testing.expectEqual(a.node(0, 0), b.node(0, 0));
+    try std.testing.expect(a.node(0, 0) != 0);
+
+    // A newer version of one entry changes the root and its leaf
+    const leaf = MetaTree.leafOf("bucket", "c");
+    b.toggle(leaf, MetaTree.digest("bucket", "c", hash, 10, 1000, 0));
+    b.toggle(leaf, MetaTree.digest("bucket", "c", hash, 10, 1000, 2000));
+    try std.testing.expect(a.node(0, 0) != b.node(0, 0));
+    try std.testing.expect(a.node(MetaTree.DEPTH, leaf) != b.node(MetaTree.DEPTH, leaf));
+
+    // Taking every entry out again leaves an empty tree
+    for (keys) |key| a.toggle(MetaTree.leafOf("bucket", key), MetaTree.digest("bucket", key, hash, 10, 1000, 0));
+    try std.testing.expectEqual(@as(u64, 0), a.node(0, 0));
+}
+
+test "MetaTree - nodes fold their children" {
+    const allocator = std.testing.allocator;
+    var tree = try MetaTree.init(allocator);
+    defer tree.deinit(allocator);
+    for (0..50) |i| tree.toggle(@intCast(i * 1301 % MetaTree.LEAVES), i *% 0x9e3779b97f4a7c15);
+
+    for (0..MetaTree.DEPTH) |depth| {
+        const index = 3 % std.math.pow(usize, MetaTree.FANOUT, depth);
+        var folded: u64 = 0;
+        for (0..MetaTree.FANOUT) |c| folded ^= tree.node(depth + 1, index * MetaTree.FANOUT + c);
+        try std.testing.expectEqual(tree.node(depth, index), folded);
+    }
+    try std.testing.expectEqual(tree.leaves[1301], tree.node(MetaTree.DEPTH, 1301));
+    try std.testing.expectEqual(MetaTree.leafOf("b", "k"), MetaTree.leafOf("b", "k"));
+}
+
+test "parseTreeIndices" {
+    const allocator = std.testing.allocator;
+    const indices = parseTreeIndices(allocator, "0,15,3", 16).?;
+    defer allocator.free(indices);
+    try std.testing.expectEqualSlices(u32, &.{ 0, 15, 3 }, indices);
+    try std.testing.expectEqual(@as(?[]u32, null), parseTreeIndices(allocator, "0,16", 16));
+    try std.testing.expectEqual(@as(?[]u32, null), parseTreeIndices(allocator, "1,,2", 16));
+    try std.testing.expectEqual(@as(?[]u32, null), parseTreeIndices(allocator, "", 16));
+}
+
+// ============================================================================
+// Group commit
+// ============================================================================
+
+const Committer = main.Committer;
+
+/// Path of `name` inside a testing tmp dir, relative to the working directory
+fn tmpPath(allocator: std.mem.Allocator, tmp: *const std.testing.TmpDir, name: []const u8) ![]u8 {
+    return std.fs.path.join(allocator, &.{ ".zig-cache", "tmp", &tmp.sub_path, name });
+}
+
+test "Committer - queued group commits finish in one flush" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+
+    var committer: Committer = .{ .data_dir = "", .mode = .group };
+    defer committer.queue.deinit(std.heap.page_allocator);
+
+    const Writer = struct {
+        fn run(c: *Committer, tmp_path: []const u8, final_path: []const u8, result: *?anyerror) void {
+            c.commit(tmp_path, final_path) catch |err| {
+                result.* = err;
+            };
+        }
+    };
+    const writers = 4;
+    var paths: [writers][2][]u8 = undefined;
+    var results: [writers]?anyerror = .{null} ** writers;
+    var threads: [writers]std.Thread = undefined;
+    for (0..writers) |i| {
+        var name: [8]u8 = undefined;
+        paths[i][0] = try tmpPath(allocator, &tmp, try std.fmt.bufPrint(&name, "tmp{d}", .{i}));
+        paths[i][1] = try tmpPath(allocator, &tmp, try std.fmt.bufPrint(&name, "obj{d}", .{i}));
+        try tmp.dir.writeFile(std.testing.io, .{ .sub_path = std.fs.path.basename(paths[i][0]), .data = "data" });
+        threads[i] = try std.Thread.spawn(.{}, Writer.run, .{ &committer, paths[i][0], paths[i][1], &results[i] });
+    }
+    defer for (paths) |p| {
+        allocator.free(p[0]);
+        allocator.free(p[1]);
+    };
+
+    // Every writer waits in the queue until a flush covers it
+    while (committer.queued() < writers) try std.Io.sleep(std.testing.io, .fromMilliseconds(1), .awake);
+    var batch: std.ArrayListUnmanaged(*Committer.Pending) = .empty;
+    defer batch.deinit(std.heap.page_allocator);
+    var dirs: std.StringHashMapUnmanaged(?anyerror) = .empty;
+    defer dirs.deinit(std.heap.page_allocator);
+    try std.testing.expectEqual(@as(usize, writers), committer.flush(&batch, &dirs));
+    for (threads) |t| t.join();
+
+    for (results) |r| try std.testing.expectEqual(@as(?anyerror, null), r);
+    for (0..writers) |i| {
+        var name: [8]u8 = undefined;
+        var buf: [16]u8 = undefined;
+        try std.testing.expectEqualStrings("data", try tmp.dir.readFile(std.testing.io, try std.fmt.bufPrint(&name, "obj{d}", .{i}), &buf));
+        try std.testing.expectError(error.FileNotFound, tmp.dir.access(std.testing.io, std.fs.path.basename(paths[i][0]), .{}));
+    }
+    try std.testing.expectEqual(@as(usize, 0), committer.flush(&batch, &dirs));
+}
+
+// ============================================================================
+// Key index
+// ============================================================================
+
+const KeyIndex = main.KeyIndex;
+
+/// Keys of `bucket`, joined with commas
+fn indexedKeys(allocator: std.mem.Allocator, index: *KeyIndex, bucket: []const u8) ![]u8 {
+    var out: std.ArrayListUnmanaged(u8) = .empty;
+    errdefer out.deinit(allocator);
+    var it = try index.iterateBucket(allocator, bucket, "");
+    defer it.deinit();
+    while (try it.next()) |item| {
+        if (out.items.len > 0) try out.append(allocator, ',');
+        try out.appendSlice(allocator, item.key);
+    }
+    return out.toOwnedSlice(allocator);
+}
+
+fn expectKeys(index: *KeyIndex, bucket: []const u8, expected: []const u8) !void {
+    const keys = try indexedKeys(std.testing.allocator, index, bucket);
+    defer std.testing.allocator.free(keys);
+    try std.testing.expectEqualStrings(expected, keys);
+}
+
+test "KeyIndex - changes survive a restart through the log" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    try tmp.dir.createDirPath(std.testing.io, "b");
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "b/a", .data = "1" });
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "b/c", .data = "22" });
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+    const path = try tmpPath(allocator, &tmp, "b/c");
+    defer allocator.free(path);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    {
+        var index = KeyIndex.init(allocator, data_dir, &committer, 1);
+        defer index.deinit();
+        // The first use indexes the bucket from its files
+        try expectKeys(&index, "b", "a,c");
+        // Logged only: "x" has no file, so a rebuild would lose it
+        index.noteWrite("b", "x", path);
+        index.noteDelete("b", "a");
+        try expectKeys(&index, "b", "c,x");
+    }
+    var index = KeyIndex.init(allocator, data_dir, &committer, 1);
+    defer index.deinit();
+    try expectKeys(&index, "b", "c,x");
+
+    var it = try index.iterateBucket(allocator, "b", "x");
+    defer it.deinit();
+    const item = (try it.next()).?;
+    try std.testing.expectEqualStrings("x", item.key);
+    try std.testing.expectEqual(@as(u64, 2), item.size);
+}
+
+test "KeyIndex - a full log is compacted into the base" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    try tmp.dir.createDirPath(std.testing.io, "b");
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "b/obj", .data = "1" });
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+    const path = try tmpPath(allocator, &tmp, "b/obj");
+    defer allocator.free(path);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    var index = KeyIndex.init(allocator, data_dir, &committer, 1);
+    defer index.deinit();
+    for (0..main.KEY_INDEX_FLUSH) |i| {
+        var key: [16]u8 = undefined;
+        index.noteWrite("b", try std.fmt.bufPrint(&key, "k{d:0>6}", .{i}), path);
+    }
+    // The last write triggered the merge, so the log starts over
+    const log = try tmp.dir.statFile(std.testing.io, ".keys/b/log", .{});
+    try std.testing.expectEqual(@as(u64, 0), log.size);
+
+    var it = try index.iterateBucket(allocator, "b", "k001000");
+    defer it.deinit();
+    var count: usize = 0;
+    var last: [16]u8 = undefined;
+    var last_len: usize = 0;
+    while (try it.next()) |item| {
+        if (count > 0) try std.testing.expect(std.mem.order(u8, last[0..last_len], item.key) == .lt);
+        @memcpy(last[0..item.key.len], item.key);
+        last_len = item.key.len;
+        count += 1;
+    }
+    // k001000..k016383, then the file-backed "obj"
+    try std.testing.expectEqual(main.KEY_INDEX_FLUSH - 1000 + 1, count);
+    try std.testing.expectEqualStrings("obj", last[0..last_len]);
+}
+
+test "KeyIndex - a damaged or dropped index is rebuilt from the files" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    try tmp.dir.createDirPath(std.testing.io, "b/dir");
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "b/dir/one", .data = "1" });
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "b/two", .data = "2" });
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+    const path = try tmpPath(allocator, &tmp, "b/two");
+    defer allocator.free(path);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    {
+        var index = KeyIndex.init(allocator, data_dir, &committer, 1);
+        defer index.deinit();
+        index.noteWrite("b", "ghost", path);
+        try expectKeys(&index, "b", "dir/one,ghost,two");
+    }
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = ".keys/b/base", .data = "not an index" });
+    // The rebuild warns about the damaged base
+    std.testing.log_level = .err;
+    defer std.testing.log_level = .warn;
+    {
+        var index = KeyIndex.init(allocator, data_dir, &committer, 1);
+        defer index.deinit();
+        try expectKeys(&index, "b", "dir/one,two");
+
+        index.noteWrite("b", "ghost", path);
+        index.drop("b");
+        try std.testing.expectError(error.FileNotFound, tmp.dir.access(std.testing.io, ".keys/b", .{}));
+        try expectKeys(&index, "b", "dir/one,two");
+    }
+}
+
+// ============================================================================
+// Metadata log
+// ============================================================================
+
+const MetaLog = main.MetaLog;
+const BlobRefs = main.BlobRefs;
+
+fn putInline(log: *MetaLog, key: []const u8, data: []const u8) !void {
+    try log.put("b", key, .{ .hash = @splat(0), .size = data.len, .created = 1, .deleted = 0, .inline_data = data });
+}
+
+fn expectInline(log: *MetaLog, key: []const u8, data: []const u8) !void {
+    const meta = (try log.get(std.testing.allocator, "b", key)).?;
+    defer std.testing.allocator.free(meta.inline_data.?);
+    try std.testing.expectEqualStrings(data, meta.inline_data.?);
+}
+
+test "MetaLog - compaction keeps every entry, including puts made meanwhile" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .fsync };
+    var refs = BlobRefs.init(allocator);
+    defer refs.deinit();
+    {
+        var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+        defer log.deinit();
+        for (0..200) |i| {
+            var key: [8]u8 = undefined;
+            const name = try std.fmt.bufPrint(&key, "k{d}", .{i});
+            try putInline(&log, name, "old");
+            try putInline(&log, name, name);
+        }
+        try log.tombstone("b", "k0", 5);
+
+        const Writer = struct {
+            fn run(l: *MetaLog, result: *?anyerror) void {
+                for (0..200) |i| {
+                    var key: [8]u8 = undefined;
+                    const name = std.fmt.bufPrint(&key, "w{d}", .{i}) catch unreachable;
+                    putInline(l, name, name) catch |err| {
+                        result.* = err;
+                        return;
+                    };
+                }
+            }
+        };
+        var result: ?anyerror = null;
+        const writer = try std.Thread.spawn(.{}, Writer.run, .{ &log, &result });
+        try log.compact();
+        writer.join();
+        try std.testing.expectEqual(@as(?anyerror, null), result);
+        try expectInline(&log, "k7", "k7");
+        try expectInline(&log, "w199", "w199");
+    }
+
+    // The old segment is gone; the compacted one and the one written
+    // meanwhile replay to the same entries
+    var segments: usize = 0;
+    var dir = try tmp.dir.openDir(std.testing.io, ".meta", .{ .iterate = true });
+    defer dir.close(std.testing.io);
+    var iter = dir.iterate();
+    while (try iter.next(std.testing.io)) |entry| {
+        if (std.mem.endsWith(u8, entry.name, ".seg")) segments += 1;
+    }
+    try std.testing.expectEqual(@as(usize, 2), segments);
+
+    var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+    defer log.deinit();
+    for (1..200) |i| {
+        var key: [8]u8 = undefined;
+        const name = try std.fmt.bufPrint(&key, "k{d}", .{i});
+        try expectInline(&log, name, name);
+    }
+    for (0..200) |i| {
+        var key: [8]u8 = undefined;
+        const name = try std.fmt.bufPrint(&key, "w{d}", .{i});
+        try expectInline(&log, name, name);
+    }
+    try std.testing.expectEqual(@as(i64, 5), log.stat("b", "k0").?.deleted);
+}
+
+test "MetaLog - chunked entries count their chunks from the resident manifest" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+
+    const a: [20]u8 = @splat('a');
+    const b: [20]u8 = @splat('b');
+    var manifest: [56]u8 = undefined;
+    @memcpy(manifest[0..20], &a);
+    std.mem.writeInt(u64, manifest[20..28], 3, .little);
+    @memcpy(manifest[28..48], &b);
+    std.mem.writeInt(u64, manifest[48..56], 4, .little);
+    const chunked: main.MetaIndex.ObjectMeta = .{ .hash = @splat('m'), .size = 7, .created = 1, .deleted = 0, .inline_data = null, .manifest = &manifest };
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    var refs = BlobRefs.init(allocator);
+    defer refs.deinit();
+    {
+        var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+        defer log.deinit();
+        try log.put("b", "big", chunked);
+        try std.testing.expectEqual(@as(?u32, 1), refs.counts.get(a));
+        try std.testing.expectEqual(@as(?u32, 1), refs.counts.get(b));
+
+        // A tombstone keeps the chunks; an overwrite lets them go
+        try log.tombstone("b", "big", 5);
+        try std.testing.expectEqual(@as(?u32, 1), refs.counts.get(a));
+        try putInline(&log, "big", "xy");
+        try std.testing.expectEqual(@as(?u32, null), refs.counts.get(a));
+        try std.testing.expectEqual(@as(?u32, null), refs.counts.get(b));
+
+        try log.put("b", "big", chunked);
+        try log.compact();
+    }
+
+    // Loaded from the checkpoint, which doesn't hold manifests
+    var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+    defer log.deinit();
+    try std.testing.expectEqual(@as(?u32, 1), refs.counts.get(a));
+    try std.testing.expectEqual(@as(?u32, 1), refs.counts.get(b));
+    const meta = (try log.get(allocator, "b", "big")).?;
+    defer allocator.free(meta.manifest.?);
+    try std.testing.expectEqualSlices(u8, &manifest, meta.manifest.?);
+}
+
+// ============================================================================
+// CAS garbage collection
+// ============================================================================
+
+/// The next blob due for collection, taken off the queue as the collector does
+fn nextDue(refs: *BlobRefs, cutoff: i64) ?[20]u8 {
+    refs.lock();
+    defer refs.unlock();
+    return refs.nextDue(cutoff);
+}
+
+test "BlobRefs - a blob waits for collection once its last reference goes" {
+    main.app_io = std.testing.io;
+    var refs = BlobRefs.init(std.testing.allocator);
+    defer refs.deinit();
+    const a: [20]u8 = @splat('a');
+    const never = std.math.maxInt(i64);
+
+    try refs.acquire(a);
+    try refs.acquire(a);
+    refs.release(a);
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, never));
+    refs.release(a);
+    try std.testing.expectEqual(@as(?[20]u8, a), nextDue(&refs, never));
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, never));
+
+    // Referenced again while waiting: its queue entry goes stale
+    refs.touch(a);
+    try refs.acquire(a);
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, never));
+    refs.release(a);
+    try std.testing.expectEqual(@as(?[20]u8, a), nextDue(&refs, never));
+}
+
+test "BlobRefs - blobs come due after their grace period, oldest first" {
+    main.app_io = std.testing.io;
+    var refs = BlobRefs.init(std.testing.allocator);
+    defer refs.deinit();
+    const a: [20]u8 = @splat('a');
+    const b: [20]u8 = @splat('b');
+    const never = std.math.maxInt(i64);
+
+    refs.restore(a, 100);
+    refs.restore(b, 200);
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, 99));
+    try std.testing.expectEqual(@as(?[20]u8, a), nextDue(&refs, 150));
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, 150));
+    try std.testing.expectEqual(@as(?[20]u8, b), nextDue(&refs, 200));
+
+    // Stored again while waiting: the grace period starts over, and the
+    // blob comes due once
+    refs.restore(a, 300);
+    refs.touch(a);
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, 300));
+    try std.testing.expectEqual(@as(?[20]u8, a), nextDue(&refs, never));
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, never));
+
+    // A referenced blob isn't queued when stored
+    try refs.acquire(b);
+    refs.touch(b);
+    refs.restore(b, 0);
+    try std.testing.expectEqual(@as(?[20]u8, null), nextDue(&refs, never));
+}
+
+test "BlobRefs - the queue keeps its order as it is drained and refilled" {
+    main.app_io = std.testing.io;
+    var refs = BlobRefs.init(std.testing.allocator);
+    defer refs.deinit();
+
+    // Past the point where drained entries are dropped from the front
+    var next: u32 = 0;
+    var due: u32 = 0;
+    for (0..6) |_| {
+        for (0..1000) |_| {
+            var hash: [20]u8 = @splat(0);
+            std.mem.writeInt(u32, hash[0..4], next, .little);
+            refs.restore(hash, next);
+            next += 1;
+        }
+        for (0..700) |_| {
+            const hash = nextDue(&refs, std.math.maxInt(i64)).?;
+            try std.testing.expectEqual(due, std.mem.readInt(u32, hash[0..4], .little));
+            due += 1;
+        }
+    }
+    while (nextDue(&refs, std.math.maxInt(i64))) |hash| : (due += 1) {
+        try std.testing.expectEqual(due, std.mem.readInt(u32, hash[0..4], .little));
+    }
+    try std.testing.expectEqual(next, due);
+}
+
+// ============================================================================
+// Tombstone expiry
+// ============================================================================
+
+test "MetaLog - a tombstone expires only while it is the key's latest entry" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    var refs = BlobRefs.init(allocator);
+    defer refs.deinit();
+    {
+        var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+        defer log.deinit();
+
+        // Put again: the queued expiry is stale
+        try putInline(&log, "k", "v1");
+        try log.tombstone("b", "k", 10);
+        try putInline(&log, "k", "v2");
+        try std.testing.expectEqual(@as(usize, 0), try log.expireTombstones(100, 10));
+        try expectInline(&log, "k", "v2");
+
+        // Deleted again later: only the later expiry counts
+        try log.tombstone("b", "k", 20);
+        try log.tombstone("b", "k", 30);
+        try std.testing.expectEqual(@as(usize, 0), try log.expireTombstones(25, 10));
+        try std.testing.expectEqual(@as(i64, 30), log.stat("b", "k").?.deleted);
+        try std.testing.expectEqual(@as(usize, 1), try log.expireTombstones(31, 10));
+        try std.testing.expectEqual(null, log.stat("b", "k"));
+
+        const stats = log.tombstoneStats();
+        try std.testing.expectEqual(@as(usize, 0), stats.count);
+        try std.testing.expectEqual(@as(usize, 0), stats.queued);
+        try std.testing.expectEqual(@as(u64, 1), stats.expired);
+    }
+
+    // The removal is logged
+    var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+    defer log.deinit();
+    try std.testing.expectEqual(null, log.stat("b", "k"));
+    try std.testing.expectEqual(@as(usize, 0), log.tombstoneStats().count);
+}
+
+test "MetaLog - a key tombstoned twice at the same time is removed once" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    var refs = BlobRefs.init(allocator);
+    defer refs.deinit();
+    var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+    defer log.deinit();
+
+    try putInline(&log, "k", "v");
+    try log.tombstone("b", "k", 40);
+    try log.tombstone("b", "k", 40);
+    try putInline(&log, "later", "v");
+    try log.tombstone("b", "later", 1000);
+    try std.testing.expectEqual(@as(usize, 3), log.tombstoneStats().queued);
+
+    // Both expiries of "k" come due in one batch
+    try std.testing.expectEqual(@as(usize, 1), try log.expireTombstones(41, 10));
+    try std.testing.expectEqual(null, log.stat("b", "k"));
+    const stats = log.tombstoneStats();
+    try std.testing.expectEqual(@as(usize, 1), stats.count);
+    try std.testing.expectEqual(@as(usize, 1), stats.queued);
+    try std.testing.expectEqual(@as(u64, 1), stats.expired);
+    try std.testing.expectEqual(@as(i64, 1000), log.stat("b", "later").?.deleted);
+}
+
+// ============================================================================
+// CAS presence set
+// ============================================================================
+
+const BlobSet = main.BlobSet;
+
+/// A hash whose fingerprint (its first 8 bytes) is `fingerprint`
+fn blobHash(fingerprint: u64, rest: u8) [20]u8 {
+    var hash: [20]u8 = @splat(rest);
+    std.mem.writeInt(u64, hash[0..8], fingerprint, .little);
+    return hash;
+}
+
+test "BlobSet - removing a blob doesn't hide one that shares its fingerprint" {
+    main.app_io = std.testing.io;
+    var set = BlobSet.init(std.testing.allocator);
+    defer set.deinit();
+    const a = blobHash(7, 'a');
+    const b = blobHash(7, 'b');
+    const c = blobHash(8, 'c');
+
+    try std.testing.expect(!set.mayContain(a));
+    set.add(a);
+    set.add(b);
+    set.add(c);
+    set.remove(a);
+    try std.testing.expect(set.mayContain(b));
+    try std.testing.expect(set.mayContain(c));
+    set.remove(c);
+    try std.testing.expect(!set.mayContain(c));
+    try std.testing.expect(set.mayContain(b));
+    set.remove(b);
+    try std.testing.expect(!set.mayContain(b));
+}
+
+test "BlobSet - a saturated fingerprint is never forgotten" {
+    main.app_io = std.testing.io;
+    var set = BlobSet.init(std.testing.allocator);
+    defer set.deinit();
+
+    // More blobs than the count holds; it sticks rather than wrap
+    for (0..300) |i| set.add(blobHash(1, @intCast(i % 256)));
+    for (0..300) |i| set.remove(blobHash(1, @intCast(i % 256)));
+    try std.testing.expect(set.mayContain(blobHash(1, 0)));
+}
+
+test "BlobSet - load finds every blob in the CAS" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+
+    var hashes: [40][20]u8 = undefined;
+    for (&hashes, 0..) |*hash, i| {
+        hash.* = blobHash(i * 0x0101010101010101, @intCast(i));
+        const hex = std.fmt.bytesToHex(hash.*, .lower);
+        var path: [64]u8 = undefined;
+        try tmp.dir.createDirPath(std.testing.io, hex[0..2]);
+        try tmp.dir.writeFile(std.testing.io, .{ .sub_path = try std.fmt.bufPrint(&path, "{s}/{s}.blob", .{ hex[0..2], hex[2..] }), .data = "" });
+    }
+    // Not blobs
+    try tmp.dir.writeFile(std.testing.io, .{ .sub_path = "00/notablob", .data = "" });
+
+    const cas_path = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(cas_path);
+    var set = BlobSet.init(allocator);
+    defer set.deinit();
+    try set.load(cas_path, 4);
+    for (hashes) |hash| try std.testing.expect(set.mayContain(hash));
+    try std.testing.expect(!set.mayContain(blobHash(0xdead, 0)));
+
+    set.remove(hashes[3]);
+    try std.testing.expect(!set.mayContain(hashes[3]));
+    for (hashes, 0..) |hash, i| if (i != 3) try std.testing.expect(set.mayContain(hash));
+}
+
+// ============================================================================
+// Peer connections
+// ============================================================================
+
+const PeerPool = main.PeerPool;
+const FanOut = main.FanOut;
+
+/// A peer on an ephemeral loopback port that answers every request with
+/// `reply`, and closes each connection after `per_conn` requests. It serves
+/// one connection at a time until `stop`.
+const FakePeer = struct {
+    server: std.Io.net.Server,
+    reply: []const u8,
+    per_conn: usize,
+    connections: std.atomic.Value(usize) = .init(0),
+    requests: std.atomic.Value(usize) = .init(0),
+    closed: std.atomic.Value(usize) = .init(0), // connections it closed itself
+    thread: std.Thread = undefined,
+
+    const ok = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok";
+
+    fn start(self: *FakePeer, reply: []const u8, per_conn: usize) !void {
+        const loopback = try std.Io.net.IpAddress.parseIp4("127.0.0.1", 0);
+        self.* = .{ .server = try loopback.listen(std.testing.io, .{ .reuse_address = true }), .reply = reply, .per_conn = per_conn };
+        self.thread = try std.Thread.spawn(.{}, run, .{self});
+    }
+
+    fn address(self: *const FakePeer) std.Io.net.IpAddress {
+        return self.server.socket.address;
+    }
+
+    /// Stop accepting, once the client has closed the connection being served
+    fn stop(self: *FakePeer) void {
+        const listener: std.Io.net.Stream = .{ .socket = self.server.socket };
+        listener.shutdown(std.testing.io, .both) catch {};
+        self.thread.join();
+        self.server.deinit(std.testing.io);
+    }
+
+    fn run(self: *FakePeer) void {
+        while (true) {
+            const conn = self.server.accept(std.testing.io) catch return;
+            defer conn.close(std.testing.io);
+            _ = self.connections.fetchAdd(1, .monotonic);
+            self.serve(conn) catch continue;
+            _ = self.closed.fetchAdd(1, .monotonic);
+        }
+    }
+
+    /// Answer `per_conn` requests on `conn`; an error: the client left first
+    fn serve(self: *FakePeer, conn: std.Io.net.Stream) !void {
+        var read_buf: [1024]u8 = undefined;
+        var write_buf: [1024]u8 = undefined;
+        var reader = conn.reader(std.testing.io, &read_buf);
+        var writer = conn.writer(std.testing.io, &write_buf);
+        for (0..self.per_conn) |_| {
+            var length: usize = 0;
+            while (true) {
+                const line = try reader.interface.takeDelimiterInclusive('\n');
+                if (std.mem.eql(u8, line, "\r\n")) break;
+                if (std.ascii.startsWithIgnoreCase(line, "content-length:")) {
+                    length = try std.fmt.parseInt(usize, std.mem.trim(u8, line[15..], " \r\n"), 10);
+                }
+            }
+            try reader.interface.discardAll(length);
+            _ = self.requests.fetchAdd(1, .monotonic);
+            try writer.interface.writeAll(self.reply);
+            try writer.interface.flush();
+        }
+    }
+};
+
+test "PeerPool - a connection is given back and reused" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var peer: FakePeer = undefined;
+    try peer.start(FakePeer.ok, 10);
+    defer peer.stop();
+    var pool = PeerPool.init(allocator);
+    defer pool.deinit();
+
+    for (0..3) |_| {
+        const body = try pool.request(allocator, peer.address(), "GET", "/_zs3/ping", "", "", 16);
+        defer allocator.free(body);
+        try std.testing.expectEqualStrings("ok", body);
+        try std.testing.expectEqual(@as(usize, 1), pool.idle.items.len);
+    }
+    try std.testing.expectEqual(@as(usize, 1), peer.connections.load(.monotonic));
+}
+
+test "PeerPool - an error response gives the connection back; Connection: close doesn't" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    {
+        var peer: FakePeer = undefined;
+        try peer.start("HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\n\r\nno", 10);
+        defer peer.stop();
+        var pool = PeerPool.init(allocator);
+        defer pool.deinit();
+        for (0..2) |_| {
+            try std.testing.expectError(error.RequestFailed, pool.request(allocator, peer.address(), "GET", "/_zs3/ping", "", "", 16));
+            try std.testing.expectEqual(@as(usize, 1), pool.idle.items.len);
+        }
+        try std.testing.expectEqual(@as(usize, 1), peer.connections.load(.monotonic));
+    }
+    {
+        var peer: FakePeer = undefined;
+        try peer.start("HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok", 10);
+        defer peer.stop();
+        var pool = PeerPool.init(allocator);
+        defer pool.deinit();
+        const body = try pool.request(allocator, peer.address(), "GET", "/_zs3/ping", "", "", 16);
+        defer allocator.free(body);
+        try std.testing.expectEqualStrings("ok", body);
+        try std.testing.expectEqual(@as(usize, 0), pool.idle.items.len);
+    }
+}
+
+/// Wait until `peer` has closed `n` connections
+fn waitClosed(peer: *FakePeer, n: usize) !void {
+    while (peer.closed.load(.monotonic) < n) try std.Io.sleep(std.testing.io, .fromMilliseconds(1), .awake);
+}
+
+test "PeerPool - an idempotent request is resent when a pooled connection had closed" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var peer: FakePeer = undefined;
+    try peer.start(FakePeer.ok, 1);
+    defer peer.stop();
+    var pool = PeerPool.init(allocator);
+    defer pool.deinit();
+
+    allocator.free(try pool.request(allocator, peer.address(), "GET", "/_zs3/ping", "", "", 16));
+    try waitClosed(&peer, 1);
+    // The request goes out on the pooled connection, which the peer has
+    // closed, and then again on a new one
+    const body = try pool.request(allocator, peer.address(), "POST", "/_zs3/meta_get", "", "", 16);
+    defer allocator.free(body);
+    try std.testing.expectEqualStrings("ok", body);
+    try waitClosed(&peer, 2);
+    try std.testing.expectEqual(@as(usize, 2), peer.connections.load(.monotonic));
+    try std.testing.expectEqual(@as(usize, 2), peer.requests.load(.monotonic));
+}
+
+test "PeerPool - a request that isn't idempotent is not resent after it went out" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var peer: FakePeer = undefined;
+    try peer.start(FakePeer.ok, 1);
+    defer peer.stop();
+    var pool = PeerPool.init(allocator);
+    defer pool.deinit();
+
+    allocator.free(try pool.request(allocator, peer.address(), "GET", "/_zs3/ping", "", "", 16));
+    try waitClosed(&peer, 1);
+    try std.testing.expectError(error.InvalidResponse, pool.request(allocator, peer.address(), "POST", "/_zs3/unknown", "", "", 16));
+    try std.testing.expectEqual(@as(usize, 0), pool.idle.items.len);
+    try std.testing.expectEqual(@as(usize, 1), peer.connections.load(.monotonic));
+}
+
+test "FanOut - keeps the replies of the peers that answered" {
+    main.app_io = std.testing.io;
+    const allocator = std.testing.allocator;
+    var tmp = std.testing.tmpDir(.{});
+    defer tmp.cleanup();
+    try tmp.dir.createDirPath(std.testing.io, ".tmp");
+    const data_dir = try tmpPath(allocator, &tmp, "");
+    defer allocator.free(data_dir);
+
+    var committer: Committer = .{ .data_dir = data_dir, .mode = .none };
+    var refs = BlobRefs.init(allocator);
+    defer refs.deinit();
+    var log = try MetaLog.open(allocator, data_dir, &committer, &refs);
+    defer log.deinit();
+    var blob_set = BlobSet.init(allocator);
+    defer blob_set.deinit();
+    var peers: [2]FakePeer = undefined;
+    for (&peers) |*p| try p.start(FakePeer.ok, 10);
+    defer for (&peers) |*p| p.stop();
+    var dist = main.DistributedContext.init(allocator, data_dir, &committer, &log, &blob_set, .{ .node_id = @splat(0) });
+    defer dist.deinit();
+    // Nothing listens on the third peer's port
+    var gone: FakePeer = undefined;
+    try gone.start(FakePeer.ok, 10);
+    const gone_address = gone.address();
+    gone.stop();
+
+    var infos: [3]main.PeerInfo = undefined;
+    for (&infos, 0..) |*info, i| info.* = .{
+        .id = @splat(@intCast(i + 1)),
+        .address = if (i < 2) peers[i].address() else gone_address,
+        .last_seen = 0,
+        .content_count = 0,
+    };
+    const fanout = FanOut.start(&dist, "POST", "/_zs3/meta_get", "query", 16, &infos, 3, true).?;
+    // Ready once every peer has answered, well before the deadline
+    const started = std.Io.Clock.awake.now(std.testing.io);
+    fanout.wait(10_000);
+    try std.testing.expect(started.durationTo(std.Io.Clock.awake.now(std.testing.io)).toMilliseconds() < 5_000);
+    const replies = fanout.close();
+    defer FanOut.freeReplies(replies);
+    // The threads are done with the pool before it goes
+    defer while (dist.fanout_threads.load(.monotonic) > 0) std.Io.sleep(std.testing.io, .fromMilliseconds(1), .awake) catch {};
+
+    try std.testing.expectEqual(@as(usize, 2), replies.len);
+    for (replies) |r| {
+        try std.testing.expectEqualStrings("ok", r.body);
+        try std.testing.expect(r.peer[0] == 1 or r.peer[0] == 2);
+    }
+    try std.testing.expectEqual(@as(usize, 2), dist.peer_pool.idle.items.len);
+}
@@ -113,6 +113,38 @@ def raw_request(method, path, headers=None, body=b"", query=""):
     status_line = response.split("\r\n", 1)[0] if response else ""
     return status_line, response
 
+def pipelined(first_head, body=b"", signed=False):
+    """Send a request head, then `body`, then a second request, all in one
+    write on a keep-alive connection. The second request is unsigned, so
+    it gets a 403. Returns the status codes of the responses read until
+    the server closes the connection.
+
+    With honest framing the second request is answered too; when the
+    framing is ambiguous the server must stop after one response, or the
+    body could be read as a request of its own (request smuggling).
+    """
+    method, path = first_head[0].split()[:2]
+    lines = [f"{first_head[0]} HTTP/1.1", f"Host: {HOST}"]
+    if signed:
+        lines += [f"{k}: {v}" for k, v in sign_request(method, path, payload=body).items()]
+    lines += first_head[1:]
+    second = f"GET /testbucket HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n".encode()
+    raw = ("\r\n".join(lines) + "\r\n\r\n").encode() + body + second
+
+    with socket.create_connection((HOST.split(':')[0], int(HOST.split(':')[1])), timeout=5) as sock:
+        sock.sendall(raw)
+        chunks = []
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = b"".join(chunks).decode(errors="replace")
+    return [int(part[:3]) for part in response.split("HTTP/1.1 ")[1:] if part[:3].isdigit()]
+
 def test(name, expected_status, actual_status, body=""):
     status = "PASS" if actual_status == expected_status else "FAIL"
     print(f"  [{status}] {name}: {actual_status} (expected {expected_status})")
@@ -310,6 +342,30 @@ def run_tests():
     else:
         failed += 1
 
+    # Pipelining: a body must never be read as the next request
+    print("\n[Pipelining]")
+
+    statuses = pipelined(["GET /testbucket", "Content-Length: 0"], signed=True)
+    if test("Pipelined requests both answered", "[200, 403]", str(statuses)):
+        passed += 1
+    else:
+        failed += 1
+
+    smuggled = f"GET /testbucket HTTP/1.1\r\nHost: {HOST}\r\n\r\n".encode()
+    framing_cases = [
+        ("Malformed Content-Length", ["PUT /testbucket/smuggle.txt", "Content-Length: 3x"], True),
+        ("Malformed Content-Length, unauthenticated", ["PUT /testbucket/smuggle.txt", "Content-Length: 3x"], False),
+        ("Duplicate Content-Length", ["PUT /testbucket/smuggle.txt", f"Content-Length: {len(smuggled)}", f"Content-Length: {len(smuggled)}"], True),
+        ("Conflicting Content-Length", ["PUT /testbucket/smuggle.txt", "Content-Length: 0", f"Content-Length: {len(smuggled)}"], True),
+        ("Content-Length with Transfer-Encoding", ["PUT /testbucket/smuggle.txt", "Content-Length: 0", "Transfer-Encoding: chunked"], False),
+    ]
+    for name, head, signed in framing_cases:
+        statuses = pipelined(head, smuggled, signed=signed)
+        if test(f"{name} rejected, connection closed", "[400]", str(statuses)):
+            passed += 1
+        else:
+            failed += 1
+
     # Batch Operations
     print("\n[Batch Operations]")
 